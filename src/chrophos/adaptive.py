@@ -0,0 +1,192 @@
+import bisect
+import json
+import logging
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Union
+
+from chrophos.dedupe import Signature
+from chrophos.layout import frame_number
+
+logger = logging.getLogger(__name__)
+
+INTERVAL_LOG_NAME = "intervals.jsonl"
+
+
+class Change:
+    BUSY = "busy"
+    CALM = "calm"
+    STEADY = "steady"
+    UNKNOWN = "unknown"
+
+
+@dataclass
+class IntervalDecision:
+    frame: int
+    time: datetime
+    # The interval to the next frame, in seconds
+    interval: float
+    change: str
+    distance: Union[int, None] = None
+    luminance_delta: Union[float, None] = None
+
+    def as_dict(self):
+        return {**asdict(self), "time": self.time.isoformat()}
+
+
+class AdaptiveInterval:
+    """Adjust the capture interval to how much the scene is changing from frame to frame
+
+    Change is measured between consecutive frames' thumbnails, as the distance between their
+    difference hashes and the difference in their mean luminance (see `chrophos.dedupe`). A frame
+    is busy if either reaches its busy threshold, and calm if both are within their calm
+    thresholds. The interval is divided by `factor` after any busy frame, so as not to miss the
+    start of anything, but only multiplied by it after `patience` calm frames in a row; it always
+    stays between `min_interval` and `max_interval`. Every decision is logged to `log_path`, so
+    that the sequence can be retimed (see `uniform_sources`).
+    """
+
+    def __init__(
+        self,
+        min_interval: timedelta,
+        max_interval: timedelta,
+        factor=1.5,
+        busy_distance=10,
+        busy_luminance=0.03,
+        calm_distance=3,
+        calm_luminance=0.005,
+        patience=5,
+        log_path: Union[Path, None] = None,
+    ):
+        if min_interval > max_interval:
+            raise ValueError(f"Minimum interval {min_interval} is over the maximum {max_interval}")
+        if factor <= 1:
+            raise ValueError(f"Interval factor must be over 1, not {factor}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.busy_distance = busy_distance
+        self.busy_luminance = busy_luminance
+        self.calm_distance = calm_distance
+        self.calm_luminance = calm_luminance
+        self.patience = patience
+        self.log_path = log_path
+        self.previous: Union[Signature, None] = None
+        self.calm_in_a_row = 0
+        self.counts = {Change.BUSY: 0, Change.CALM: 0, Change.STEADY: 0, Change.UNKNOWN: 0}
+        self._log = None
+
+    def clamp(self, interval: timedelta):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def classify(self, distance: int, luminance_delta: float):
+        if distance >= self.busy_distance or luminance_delta >= self.busy_luminance:
+            return Change.BUSY
+        if distance <= self.calm_distance and luminance_delta <= self.calm_luminance:
+            return Change.CALM
+        return Change.STEADY
+
+    def observe(
+        self,
+        frame: int,
+        time: datetime,
+        current: Union[Signature, None],
+        interval: timedelta,
+    ) -> timedelta:
+        """Take in the signature of the frame just captured; returns the interval to the next"""
+        if current is None or self.previous is None:
+            decision = IntervalDecision(frame, time, 0, Change.UNKNOWN)
+        else:
+            distance = current.distance(self.previous)
+            luminance_delta = abs(current.mean - self.previous.mean)
+            decision = IntervalDecision(
+                frame, time, 0, self.classify(distance, luminance_delta), distance, luminance_delta
+            )
+        if current is not None:
+            self.previous = current
+
+        new_interval = interval
+        if decision.change == Change.BUSY:
+            self.calm_in_a_row = 0
+            new_interval = self.clamp(interval / self.factor)
+        elif decision.change == Change.CALM:
+            self.calm_in_a_row += 1
+            if self.calm_in_a_row >= self.patience:
+                self.calm_in_a_row = 0
+                new_interval = self.clamp(interval * self.factor)
+        else:
+            self.calm_in_a_row = 0
+        if new_interval != interval:
+            logger.info(
+                f"Scene is {decision.change} (hash distance {decision.distance}, luminance delta"
+                f" {decision.luminance_delta:.4f}); interval {interval} -> {new_interval}"
+            )
+        decision.interval = new_interval.total_seconds()
+        self.counts[decision.change] += 1
+        self._record(decision)
+        return new_interval
+
+    def _record(self, decision: IntervalDecision):
+        if self.log_path is None:
+            return
+        if self._log is None:
+            self._log = open(self.log_path, "a")
+        self._log.write(json.dumps(decision.as_dict()) + "\n")
+        self._log.flush()
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+        logger.info(
+            f"Scene changes: {self.counts[Change.BUSY]:,} busy, {self.counts[Change.STEADY]:,}"
+            f" steady and {self.counts[Change.CALM]:,} calm frames"
+        )
+
+
+def load_frame_times(path: Path) -> dict[int, datetime]:
+    """The commanded capture time of every frame in an interval log"""
+    times = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                times[record["frame"]] = datetime.fromisoformat(record["time"])
+    return times
+
+
+def source_frame(source) -> Union[int, None]:
+    """The frame number of a path, or of an (archive directory, entry) pair"""
+    if isinstance(source, tuple):
+        return source[1].frame
+    return frame_number(source)
+
+
+def uniform_sources(sources: list, frame_times: dict[int, datetime], interval: timedelta) -> list:
+    """Resample frames captured at varying intervals onto a fixed `interval`, for retiming
+
+    `sources` are as from `chrophos.stack.frame_sources`. Each slot of the fixed grid gets the
+    last frame captured at or before it, so that frames shot while the interval was long are
+    held, and some of those shot while it was short are skipped. Frames without a time are left
+    out.
+    """
+    timed = sorted(
+        (
+            (frame_times[frame], source)
+            for source in sources
+            if (frame := source_frame(source)) is not None and frame in frame_times
+        ),
+        key=lambda pair: pair[0],
+    )
+    if not timed:
+        return []
+    if len(timed) < len(sources):
+        logger.warning(f"{len(sources) - len(timed):,} frame(s) have no recorded time; skipping")
+    times = [time for time, _ in timed]
+    resampled = []
+    slot = times[0]
+    while slot <= times[-1]:
+        resampled.append(timed[bisect.bisect_right(times, slot) - 1][1])
+        slot += interval
+    return resampled
@@ -0,0 +1,437 @@
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Iterator, Union
+
+from chrophos.layout import frame_number, open_layout
+
+logger = logging.getLogger(__name__)
+
+CHUNK_PREFIX = "chunk_"
+CHUNK_SUFFIX = ".tlc"
+INDEX_SUFFIX = ".index.jsonl"
+# Every frame in a chunk is preceded by a header, so that a chunk can be made sense of even
+# without its index: magic, length of the name, size of the data, CRC-32 of the data
+RECORD_MAGIC = b"CHRF"
+RECORD_HEADER = struct.Struct("<4sHQI")
+
+
+class ArchiveError(ValueError):
+    """Indicates a missing or corrupt frame in an archive"""
+
+
+@dataclass
+class ArchiveEntry:
+    """Where a single frame's data lives within a chunk"""
+
+    chunk: str
+    name: str
+    frame: Union[int, None]
+    # Offset of the frame's data (not its header) within the chunk
+    offset: int
+    size: int
+    crc32: int
+    mtime: float
+
+
+def is_archive(path: Path):
+    return any(path.glob(f"{CHUNK_PREFIX}*{INDEX_SUFFIX}"))
+
+
+class ArchiveWriter:
+    """Append frames to chunk files of up to `frames_per_chunk` frames or `max_chunk_bytes`
+
+    Chunks are append-only. Index entries are only written once the data they point to has been
+    fsync'd, every `sync_frames` frames; reopening an archive truncates any data past the end of
+    the index, i.e. frames that were written but never indexed.
+    """
+
+    def __init__(
+        self,
+        archive_dir: Path,
+        frames_per_chunk=1000,
+        max_chunk_bytes=4 * 2**30,
+        sync_frames=10,
+        block_size=2**20,
+        throttle: Union[Callable[[int], None], None] = None,
+        on_sync: Union[Callable[[list[ArchiveEntry]], None], None] = None,
+    ):
+        self.archive_dir = archive_dir
+        self.frames_per_chunk = frames_per_chunk
+        self.max_chunk_bytes = max_chunk_bytes
+        self.sync_frames = sync_frames
+        self.block_size = block_size
+        # Called with the size of each block before it is written
+        self.throttle = throttle
+        # Called with the entries that have just been indexed
+        self.on_sync = on_sync
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+
+        self._chunk_number = -1
+        self._data = None
+        self._index = None
+        self._chunk_frames = 0
+        self._pending: list[ArchiveEntry] = []
+        self._open_last_chunk()
+
+    def _chunk_path(self, number: int):
+        return self.archive_dir / f"{CHUNK_PREFIX}{number:06d}{CHUNK_SUFFIX}"
+
+    def _index_path(self, number: int):
+        return self.archive_dir / f"{CHUNK_PREFIX}{number:06d}{INDEX_SUFFIX}"
+
+    def _open_last_chunk(self):
+        chunks = sorted(self.archive_dir.glob(f"{CHUNK_PREFIX}*{CHUNK_SUFFIX}"))
+        if not chunks:
+            self._open_chunk(0)
+            return
+        number = int(chunks[-1].name[len(CHUNK_PREFIX) : -len(CHUNK_SUFFIX)])
+        entries = read_index(self._index_path(number))
+        end = entries[-1].offset + entries[-1].size if entries else 0
+        if chunks[-1].stat().st_size != end:
+            logger.warning(f"Truncating {chunks[-1]} to the end of its last indexed frame")
+            os.truncate(chunks[-1], end)
+        self._open_chunk(number, frames=len(entries))
+
+    def _open_chunk(self, number: int, frames=0):
+        self.close_chunk()
+        self._chunk_number = number
+        self._data = open(self._chunk_path(number), "ab")
+        self._index = open(self._index_path(number), "a")
+        self._chunk_frames = frames
+
+    def _chunk_full(self, size: int):
+        if not self._chunk_frames:
+            return False
+        return (
+            self._chunk_frames >= self.frames_per_chunk
+            or self._data.tell() + size > self.max_chunk_bytes
+        )
+
+    def add(self, name: str, data, mtime: Union[float, None] = None) -> ArchiveEntry:
+        view = memoryview(data).cast("B")
+        encoded_name = name.encode()
+        if self._chunk_full(RECORD_HEADER.size + len(encoded_name) + view.nbytes):
+            self.sync()
+            self._open_chunk(self._chunk_number + 1)
+        crc32 = zlib.crc32(view)
+        self._data.write(RECORD_HEADER.pack(RECORD_MAGIC, len(encoded_name), view.nbytes, crc32))
+        self._data.write(encoded_name)
+        offset = self._data.tell()
+        for start in range(0, view.nbytes, self.block_size):
+            block = view[start : start + self.block_size]
+            if self.throttle:
+                self.throttle(block.nbytes)
+            self._data.write(block)
+        entry = ArchiveEntry(
+            chunk=self._chunk_path(self._chunk_number).name,
+            name=name,
+            frame=frame_number(Path(name)),
+            offset=offset,
+            size=view.nbytes,
+            crc32=crc32,
+            mtime=time.time() if mtime is None else mtime,
+        )
+        self._pending.append(entry)
+        self._chunk_frames += 1
+        if len(self._pending) >= self.sync_frames:
+            self.sync()
+        return entry
+
+    def sync(self) -> list[ArchiveEntry]:
+        """Make the pending frames durable, then index them; returns the frames indexed"""
+        if not self._pending:
+            return []
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        for entry in self._pending:
+            self._index.write(json.dumps(asdict(entry)) + "\n")
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        synced = self._pending
+        self._pending = []
+        if self.on_sync:
+            self.on_sync(synced)
+        return synced
+
+    def close_chunk(self):
+        if self._data is None:
+            return
+        self.sync()
+        self._data.close()
+        self._index.close()
+        self._data = None
+        self._index = None
+
+    def close(self):
+        self.close_chunk()
+
+
+def read_index(path: Path) -> list[ArchiveEntry]:
+    entries = []
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    entries.append(ArchiveEntry(**json.loads(line)))
+                except json.JSONDecodeError:
+                    # A torn final line is expected after a power loss
+                    break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class ArchiveReader:
+    """Read frames straight out of an archive's chunks, without unpacking them"""
+
+    def __init__(self, archive_dir: Path):
+        self.archive_dir = archive_dir
+        self.entries: list[ArchiveEntry] = []
+        for index_path in sorted(archive_dir.glob(f"{CHUNK_PREFIX}*{INDEX_SUFFIX}")):
+            self.entries.extend(read_index(index_path))
+        self._by_name = {entry.name: entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name: str):
+        return name in self._by_name
+
+    def find(self, name: str) -> ArchiveEntry:
+        try:
+            return self._by_name[name]
+        except KeyError as error:
+            raise ArchiveError(f"No frame named {name!r} in {self.archive_dir}") from error
+
+    def read(self, entry: Union[ArchiveEntry, str], verify=True) -> bytes:
+        if isinstance(entry, str):
+            entry = self.find(entry)
+        return read_entry(self.archive_dir, entry, verify=verify)
+
+    def frames(
+        self, suffix: Union[str, None] = None, verify=True
+    ) -> Iterator[tuple[ArchiveEntry, bytes]]:
+        """Every frame (with the given suffix), in frame order, reading each chunk sequentially"""
+        entries = [entry for entry in self.entries if suffix is None or entry.name.endswith(suffix)]
+        entries.sort(key=lambda entry: (entry.frame is None, entry.frame, entry.name))
+        file = None
+        try:
+            for entry in entries:
+                if file is None or file.name != str(self.archive_dir / entry.chunk):
+                    if file is not None:
+                        file.close()
+                    file = open(self.archive_dir / entry.chunk, "rb")
+                file.seek(entry.offset)
+                data = file.read(entry.size)
+                _check_entry(entry, data, verify)
+                yield entry, data
+        finally:
+            if file is not None:
+                file.close()
+
+
+def _check_entry(entry: ArchiveEntry, data: bytes, verify: bool):
+    if len(data) != entry.size:
+        raise ArchiveError(f"{entry.name} is truncated in {entry.chunk}")
+    if verify and zlib.crc32(data) != entry.crc32:
+        raise ArchiveError(f"{entry.name} is corrupt in {entry.chunk} (bad checksum)")
+
+
+def read_entry(archive_dir: Path, entry: ArchiveEntry, verify=True) -> bytes:
+    """Read a single frame, given its index entry; doesn't need the rest of the index"""
+    with open(archive_dir / entry.chunk, "rb") as file:
+        file.seek(entry.offset)
+        data = file.read(entry.size)
+    _check_entry(entry, data, verify)
+    return data
+
+
+class ArchivePacker(threading.Thread):
+    """Pack frames into an archive in the background, as they are committed to disk
+
+    Pass `submit` as a FrameWriter's `on_commit`. Packing is throttled to `bandwidth` bytes per
+    second (if given) and stops, between blocks, whenever the capture loop is inside `paused()`,
+    so that it never competes with downloads from the camera. If `remove_packed` is set, frames
+    are deleted once they are safely in the archive.
+
+    If packing fails, the packer stops accepting frames, and `stop` raises the error.
+    """
+
+    def __init__(
+        self,
+        archive_dir: Path,
+        frames_per_chunk=1000,
+        max_chunk_bytes=4 * 2**30,
+        bandwidth: Union[float, None] = None,
+        remove_packed=False,
+    ):
+        super().__init__(name="chrophos-packer", daemon=True)
+        self.archive_dir = archive_dir
+        self.frames_per_chunk = frames_per_chunk
+        self.max_chunk_bytes = max_chunk_bytes
+        self.bandwidth = bandwidth
+        self.remove_packed = remove_packed
+        self.packed_frames = 0
+        self.packed_bytes = 0
+        self.paused_seconds = 0.0
+
+        self._queue: queue.Queue[Union[Path, None]] = queue.Queue()
+        # Set while the packer is allowed to do I/O
+        self._running = threading.Event()
+        self._running.set()
+        self._sources: dict[str, Path] = {}
+        self._throttle_start = time.perf_counter()
+        self._throttle_bytes = 0
+        self.error: Union[Exception, None] = None
+        self.rejected_frames = 0
+
+    def submit(self, paths: list[Path]):
+        if self.error is not None:
+            # Nothing is taking them off the queue any more
+            if not self.rejected_frames:
+                logger.error(f"Archive packer failed ({self.error}); no longer archiving frames")
+            self.rejected_frames += len(paths)
+            return
+        for path in paths:
+            self._queue.put(path)
+
+    @contextmanager
+    def paused(self):
+        self._running.clear()
+        try:
+            yield
+        finally:
+            self._running.set()
+
+    def _wait_for_capture(self):
+        if not self._running.is_set():
+            start = time.perf_counter()
+            self._running.wait()
+            self.paused_seconds += time.perf_counter() - start
+            # Time spent paused doesn't count towards the bandwidth budget
+            self._throttle_start = time.perf_counter()
+            self._throttle_bytes = 0
+
+    def _throttle(self, size: int):
+        self._wait_for_capture()
+        if self.bandwidth:
+            self._throttle_bytes += size
+            ahead = self._throttle_bytes / self.bandwidth - (
+                time.perf_counter() - self._throttle_start
+            )
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def run(self):
+        writer = None
+        try:
+            writer = ArchiveWriter(
+                self.archive_dir,
+                frames_per_chunk=self.frames_per_chunk,
+                max_chunk_bytes=self.max_chunk_bytes,
+                throttle=self._throttle,
+                on_sync=self._packed,
+            )
+            while True:
+                try:
+                    path = self._queue.get(timeout=1)
+                except queue.Empty:
+                    # Nothing new for a while; don't leave packed frames unindexed
+                    writer.sync()
+                    continue
+                if path is None:
+                    break
+                data = self._read(path, writer.block_size)
+                self._sources[path.name] = path
+                writer.add(path.name, data, mtime=path.stat().st_mtime)
+                self.packed_frames += 1
+                self.packed_bytes += len(data)
+        except Exception as error:
+            logger.exception(f"Archive packer failed: {error}")
+            self.error = error
+            # Free whatever was queued; nothing will pack it now
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info(
+            f"Packed {self.packed_frames:,} frames ({self.packed_bytes / 2**30:.2f} GiB) into"
+            f" {self.archive_dir}; paused for capture for {self.paused_seconds:.1f}s"
+        )
+
+    def _read(self, path: Path, block_size: int) -> bytearray:
+        """Read a frame a block at a time, stopping between blocks while capture is paused"""
+        with open(path, "rb") as file:
+            data = bytearray(os.fstat(file.fileno()).st_size)
+            view = memoryview(data)
+            offset = 0
+            while offset < len(data):
+                self._wait_for_capture()
+                read = file.readinto(view[offset : offset + block_size])
+                if not read:
+                    raise ArchiveError(f"{path} was truncated while being packed")
+                offset += read
+        return data
+
+    def _packed(self, entries: list[ArchiveEntry]):
+        for entry in entries:
+            source = self._sources.pop(entry.name, None)
+            if self.remove_packed and source is not None:
+                source.unlink()
+
+    def stop(self):
+        """Pack everything submitted so far, then stop; raises the error packing failed with, if
+        it did
+        """
+        self._queue.put(None)
+        self.join()
+        if self.error is not None:
+            if self.rejected_frames:
+                logger.error(f"{self.rejected_frames:,} frame(s) weren't archived")
+            raise self.error
+
+
+def pack_directory(
+    root: Path,
+    archive_dir: Path,
+    frames_per_chunk=1000,
+    max_chunk_bytes=4 * 2**30,
+    remove_packed=False,
+):
+    """Pack every frame of an output directory that isn't already in the archive"""
+    already_packed = ArchiveReader(archive_dir) if archive_dir.exists() else None
+    sources = {}
+
+    def packed(entries: list[ArchiveEntry]):
+        for entry in entries:
+            source = sources.pop(entry.name)
+            if remove_packed:
+                source.unlink()
+
+    writer = ArchiveWriter(
+        archive_dir,
+        frames_per_chunk=frames_per_chunk,
+        max_chunk_bytes=max_chunk_bytes,
+        on_sync=packed,
+    )
+    count = 0
+    try:
+        for path in open_layout(root).frame_paths():
+            if already_packed is not None and path.name in already_packed:
+                continue
+            sources[path.name] = path
+            writer.add(path.name, path.read_bytes(), mtime=path.stat().st_mtime)
+            count += 1
+    finally:
+        writer.close()
+    return count
@@ -1,17 +1,32 @@
+import json
 import logging
+import math
+import os
+import platform
 import statistics
 import time
+from dataclasses import dataclass
+from datetime import datetime
 from pathlib import Path
+from typing import Union
 
+import numpy as np
+import tomlkit
 import typer
 
 from chrophos.camera.backend import Backend
 from chrophos.camera.camera import Camera
+from chrophos.perf import environment, summarize
 
 logger = logging.getLogger(__name__)
 
 app = typer.Typer()
 
+DEFAULT_RESULTS_DIR = Path("bench_results")
+# Read-only widgets identifying the camera, as named by gphoto2
+CAMERA_WIDGETS = ("cameramodel", "manufacturer", "serialnumber", "deviceversion")
+OVERALL = "overall"
+
 
 def print_stats(prefix: str, dark_times: list[float]):
     min_dark_time = min(dark_times)
@@ -66,12 +81,212 @@ def bench_sustained_capture_rate(trials: int, shutter: str, backend: Backend, ou
     """
 
 
+def camera_info(camera: Camera) -> dict[str, Union[str, None]]:
+    info = {}
+    for widget in CAMERA_WIDGETS:
+        try:
+            info[widget] = str(camera.backend.get_config_value(widget))
+        except Exception as error:
+            logger.debug(f"Can't read {widget} from the camera: {error}")
+            info[widget] = None
+    return info
+
+
+def storage_info(path: Path) -> dict[str, Union[str, int, None]]:
+    """Where frames were written to: the mount (and device and filesystem) that holds `path`"""
+    path = path.resolve()
+    info = {"path": str(path), "mount": None, "device": None, "filesystem": None}
+    try:
+        with open("/proc/mounts") as file:
+            mounts = [line.split()[:3] for line in file]
+    except OSError:
+        mounts = []
+    # The longest mount point that contains the path is the one it's on
+    for device, mount, filesystem in sorted(mounts, key=lambda mount: len(mount[1])):
+        if path == Path(mount) or Path(mount) in path.parents:
+            info.update(mount=mount, device=device, filesystem=filesystem)
+    try:
+        stats = os.statvfs(path)
+        info["total_bytes"] = stats.f_blocks * stats.f_frsize
+    except OSError:
+        info["total_bytes"] = None
+    return info
+
+
+def make_record(
+    trials: int,
+    mode: str,
+    dark_times_per_shutter: dict[str, list[float]],
+    camera: Union[Camera, None] = None,
+    output_dir: Union[Path, None] = None,
+) -> dict:
+    """A benchmark run, with what's needed to tell it apart from other runs"""
+    all_dark_times = [t for dark_times in dark_times_per_shutter.values() for t in dark_times]
+    return {
+        "environment": {
+            **environment(),
+            "host": platform.node(),
+            "camera": camera_info(camera) if camera is not None else {},
+            "storage": storage_info(output_dir) if output_dir is not None else {},
+        },
+        "trials": trials,
+        "mode": mode,
+        "samples": dark_times_per_shutter,
+        "summary": {
+            **{
+                shutter: summarize(dark_times)
+                for shutter, dark_times in dark_times_per_shutter.items()
+            },
+            OVERALL: summarize(all_dark_times),
+        },
+    }
+
+
+def save_record(record: dict, results_dir: Path = DEFAULT_RESULTS_DIR) -> Path:
+    results_dir.mkdir(parents=True, exist_ok=True)
+    model = record["environment"]["camera"].get("cameramodel") or "camera"
+    timestamp = datetime.fromisoformat(record["environment"]["timestamp"])
+    path = results_dir / f"{timestamp:%Y%m%dT%H%M%S}_{model.replace(' ', '_')}.json"
+    with open(path, "w") as file:
+        json.dump(record, file, indent=2)
+    return path
+
+
+def load_records(paths: list[Path]) -> list[dict]:
+    """Load benchmark records; directories are searched for them"""
+    records = []
+    for path in paths:
+        for record_path in sorted(path.glob("*.json")) if path.is_dir() else [path]:
+            with open(record_path) as file:
+                records.append(json.load(file))
+    return records
+
+
+def merge_samples(records: list[dict]) -> dict[str, list[float]]:
+    """Pool the samples of several runs, by shutter speed"""
+    samples: dict[str, list[float]] = {}
+    for record in records:
+        for shutter, dark_times in record["samples"].items():
+            samples.setdefault(shutter, []).extend(dark_times)
+    return samples
+
+
+def mann_whitney_u(baseline: list[float], current: list[float]) -> float:
+    """Two-sided p-value of the Mann-Whitney U test that the two samples come from the same
+    distribution, by the normal approximation (with tie and continuity corrections)
+
+    Dark times are skewed (by the odd slow download), so ranks are compared rather than means. With
+    fewer than a handful of trials per side, nothing will come out as significant.
+    """
+    n1, n2 = len(baseline), len(current)
+    if not n1 or not n2:
+        return 1.0
+    combined = np.concatenate([baseline, current])
+    _, inverse, counts = np.unique(combined, return_inverse=True, return_counts=True)
+    # Tied values all get the average of the ranks they span
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    ties = float(np.sum(counts**3 - counts))
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))) if n > 1 else 0.0
+    if variance <= 0:
+        return 1.0
+    z = max(abs(u - n1 * n2 / 2) - 0.5, 0.0) / math.sqrt(variance)
+    return min(1.0, 2 * (1 - statistics.NormalDist().cdf(z)))
+
+
+@dataclass
+class BenchComparison:
+    shutter: str
+    baseline_median: float
+    current_median: float
+    p_value: float
+    # Significantly different, and slower by more than the threshold
+    regressed: bool
+
+
+def compare(
+    baseline: list[dict], current: list[dict], threshold=0.1, alpha=0.05
+) -> list[BenchComparison]:
+    """Compare the dark times of two sets of runs, per shutter speed and overall"""
+    old_samples, new_samples = merge_samples(baseline), merge_samples(current)
+    shutters = [shutter for shutter in new_samples if shutter in old_samples]
+    old_samples[OVERALL] = [t for shutter in shutters for t in old_samples[shutter]]
+    new_samples[OVERALL] = [t for shutter in shutters for t in new_samples[shutter]]
+    comparison = []
+    for shutter in [*shutters, OVERALL] if shutters else []:
+        old, new = old_samples[shutter], new_samples[shutter]
+        old_median, new_median = statistics.median(old), statistics.median(new)
+        p_value = mann_whitney_u(old, new)
+        regressed = p_value < alpha and new_median > old_median * (1 + threshold)
+        comparison.append(BenchComparison(shutter, old_median, new_median, p_value, regressed))
+    return comparison
+
+
+def environment_changes(baseline: list[dict], current: list[dict]) -> dict[str, tuple]:
+    """What differs between the (last) environment of each set of runs, e.g. firmware or storage"""
+
+    def flatten(record: dict):
+        env = record["environment"]
+        return {
+            "chrophos_version": env.get("chrophos_version"),
+            "python": env.get("python"),
+            "host": env.get("host"),
+            **{f"camera.{key}": value for key, value in env.get("camera", {}).items()},
+            **{
+                f"storage.{key}": env.get("storage", {}).get(key)
+                for key in ("device", "filesystem")
+            },
+        }
+
+    old, new = flatten(baseline[-1]), flatten(current[-1])
+    return {key: (old.get(key), new.get(key)) for key in new if old.get(key) != new.get(key)}
+
+
+def print_comparison(comparison: list[BenchComparison], changes: dict[str, tuple]):
+    for key, (old, new) in changes.items():
+        print(f"{key}: {old} -> {new}")
+    for result in comparison:
+        old, new = result.baseline_median, result.current_median
+        change = (new - old) / old if old else 0.0
+        flag = "  REGRESSION" if result.regressed else ""
+        print(
+            f"{result.shutter:12} {old:8.3f}s -> {new:8.3f}s ({change:+.0%}, p={result.p_value:.3f})"
+            f"{flag}"
+        )
+
+
+def recommend_dark_time(records: list[dict], percentile=99.0, margin=0.1, step=0.5) -> float:
+    """The `dark_time` to configure: the given percentile of the slowest shutter speed's dark
+    times, plus `margin` (as a fraction), rounded up to a multiple of `step` seconds
+    """
+    samples = merge_samples(records)
+    if not samples:
+        raise ValueError("No dark time samples to go on")
+    worst = max(float(np.percentile(dark_times, percentile)) for dark_times in samples.values())
+    return math.ceil(worst * (1 + margin) / step) * step
+
+
+def write_dark_time(config_path: Path, dark_time: float, percentile: float, runs: int):
+    """Set `dark_time` in a config file, keeping the rest of it (comments included) as it is"""
+    with open(config_path) as file:
+        document = tomlkit.load(file)
+    document["dark_time"] = dark_time
+    document["dark_time"].comment(
+        f"p{percentile:g} of {runs} benchmark run(s), plus margin; see `chrophos bench-dark-time`"
+    )
+    with open(config_path, "w") as file:
+        tomlkit.dump(document, file)
+
+
 def bench(
     trials: int,
     shutters: list[str],
     mode: str,
     camera: Camera,
     output_dir: Path,
+    samples_path: Union[Path, None] = None,
+    results_dir: Union[Path, None] = DEFAULT_RESULTS_DIR,
 ):
     camera.set_config_value("auto_exposure_mode", mode)
     dark_times_per_shutter: dict[str, list[float]] = {}
@@ -89,3 +304,11 @@ def bench(
         t for dts_for_shutter in dark_times_per_shutter.values() for t in dts_for_shutter
     ]
     print_stats("Overall dark time across all shutter speeds:", all_dark_times)
+    if samples_path:
+        # Raw samples for e.g. `chrophos simulate --dark-times`
+        with open(samples_path, "w") as file:
+            json.dump(dark_times_per_shutter, file, indent=2)
+        print(f"Wrote dark time samples to {samples_path}")
+    if results_dir:
+        record = make_record(trials, mode, dark_times_per_shutter, camera, output_dir)
+        print(f"Saved benchmark record to {save_record(record, results_dir)}")
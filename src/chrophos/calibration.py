@@ -0,0 +1,521 @@
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import rawpy
+
+from chrophos.image import load_frame, save_ppm
+from chrophos.stack import Source, read_source
+
+logger = logging.getLogger(__name__)
+
+CALIBRATION_INFO_NAME = "calibration.json"
+
+# Rows of the raw plane processed at a time, to bound the size of float32 temporaries
+BAND_ROWS = 512
+
+
+class Combine:
+    MEAN = "mean"
+    # The mean of the per-pixel medians of each group of frames
+    MEDIAN = "median"
+
+
+@dataclass
+class RawInfo:
+    shape: tuple[int, int]
+    pattern: Union[np.ndarray, None]
+    black_levels: list
+    white_level: int
+
+
+def _raw_info(raw) -> RawInfo:
+    pattern = raw.raw_pattern
+    return RawInfo(
+        shape=raw.raw_image_visible.shape,
+        pattern=None if pattern is None else np.asarray(pattern),
+        black_levels=list(raw.black_level_per_channel),
+        white_level=raw.white_level,
+    )
+
+
+def read_raw(source: Source) -> tuple[np.ndarray, RawInfo]:
+    """A frame's (visible) raw plane, and what's needed to make sense of it"""
+    data, _ = read_source(source)
+    with rawpy.imread(str(data) if isinstance(data, Path) else io.BytesIO(data)) as raw:
+        return raw.raw_image_visible.copy(), _raw_info(raw)
+
+
+def _sites(pattern: Union[np.ndarray, None]):
+    """(row, column) offset, step and colour index of each photosite of the mosaic
+
+    Sensors without a 2x2 pattern (e.g. X-Trans) are treated as if monochrome.
+    """
+    if pattern is None or pattern.shape != (2, 2):
+        return [((0, 0), 1, None)]
+    return [((dy, dx), 2, int(pattern[dy, dx])) for dy, dx in np.ndindex(2, 2)]
+
+
+def _black(black_levels: list, index: Union[int, None]) -> float:
+    return float(np.mean(black_levels)) if index is None else float(black_levels[index])
+
+
+def _step(pattern: Union[np.ndarray, None]) -> int:
+    return _sites(pattern)[0][1]
+
+
+def local_excess(plane: np.ndarray, step=2) -> np.ndarray:
+    """How far each pixel is above the median of its four nearest neighbours of the same colour
+
+    Stars and lights spread over several pixels, so only single-pixel defects stand out.
+    """
+    height, width = plane.shape
+    padded = np.pad(plane, step, mode="reflect")
+    excess = np.empty(plane.shape, dtype=np.float32)
+    for start in range(0, height, BAND_ROWS):
+        end = min(start + BAND_ROWS, height)
+
+        def shifted(dy, dx, start=start, end=end):
+            rows = slice(start + step + dy, end + step + dy)
+            return padded[rows, step + dx : step + dx + width].astype(np.float32)
+
+        up, down, left, right = (
+            shifted(-step, 0),
+            shifted(step, 0),
+            shifted(0, -step),
+            shifted(0, step),
+        )
+        low = np.minimum(np.minimum(up, down), np.minimum(left, right))
+        high = np.maximum(np.maximum(up, down), np.maximum(left, right))
+        # The median of four is the mean of the middle two
+        median = (up + down + left + right - low - high) / 2
+        np.subtract(shifted(0, 0), median, out=excess[start:end])
+    return excess
+
+
+def _robust_sigma(values: np.ndarray, subsample=7) -> float:
+    """Standard deviation from the median absolute deviation of every `subsample`-th value"""
+    sample = values[::subsample, ::subsample]
+    return max(1.4826 * float(np.median(np.abs(sample - np.median(sample)))), 1e-6)
+
+
+@dataclass
+class Calibration:
+    """Corrections for the raw plane of every frame of a sequence
+
+    `dark` is the dark signal above the black level (in raw units), `flat` the relative response
+    of each photosite (with a mean of 1 for each colour, so white balance is left alone) and
+    `hot_pixels` the rows and columns of defective photosites, which are replaced by the median of
+    their nearest neighbours of the same colour.
+    """
+
+    shape: tuple[int, int]
+    pattern: Union[np.ndarray, None] = None
+    dark: Union[np.ndarray, None] = None
+    flat: Union[np.ndarray, None] = None
+    hot_pixels: Union[np.ndarray, None] = None
+    info: dict = field(default_factory=dict)
+    # Where it was saved to (or loaded from), if anywhere
+    path: Union[Path, None] = None
+
+    def save(self, path: Path):
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ("dark", "flat", "hot_pixels"):
+            array = getattr(self, name)
+            if array is not None:
+                np.save(path / f"{name}.npy", array)
+            else:
+                (path / f"{name}.npy").unlink(missing_ok=True)
+        info = {
+            **self.info,
+            "shape": list(self.shape),
+            "pattern": None if self.pattern is None else self.pattern.tolist(),
+        }
+        (path / CALIBRATION_INFO_NAME).write_text(json.dumps(info, indent=2) + "\n")
+        self.path = path
+        return path
+
+    @classmethod
+    def load(cls, path: Path) -> "Calibration":
+        """Load a saved calibration; its arrays are memory-mapped, and so shared between the
+        processes that load it
+        """
+        info = json.loads((path / CALIBRATION_INFO_NAME).read_text())
+        shape = tuple(info.pop("shape"))
+        pattern = info.pop("pattern")
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r")
+            if (path / f"{name}.npy").exists()
+            else None
+            for name in ("dark", "flat", "hot_pixels")
+        }
+        pattern = None if pattern is None else np.array(pattern)
+        return cls(shape, pattern, **arrays, info=info, path=path)
+
+    def __getstate__(self):
+        # Pickle a saved calibration (e.g. for a pool's workers) as just its path
+        if self.path is not None:
+            return {"path": self.path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if set(state) == {"path"}:
+            state = Calibration.load(state["path"]).__dict__
+        self.__dict__.update(state)
+
+    def apply(self, raw):
+        """Correct the raw plane of a `rawpy.RawPy` in place, before it's developed"""
+        correct_plane(
+            raw.raw_image_visible, self, list(raw.black_level_per_channel), raw.white_level
+        )
+
+
+def correct_plane(plane: np.ndarray, calibration: Calibration, black_levels: list, white_level):
+    """Subtract the dark, divide by the flat and fill in hot pixels, in place
+
+    Each photosite of the mosaic is corrected (band by band) through a strided view, so no more
+    than a band of float32 is ever held. Clipped photosites stay clipped.
+    """
+    if plane.shape != calibration.shape:
+        raise ValueError(f"Calibration is for {calibration.shape} raw planes, not {plane.shape}")
+    height = plane.shape[0]
+    if calibration.dark is not None or calibration.flat is not None:
+        for start in range(0, height, BAND_ROWS):
+            end = min(start + BAND_ROWS, height)
+            for (dy, dx), step, index in _sites(calibration.pattern):
+                site = (slice(start + dy, end, step), slice(dx, None, step))
+                view = plane[site]
+                values = view.astype(np.float32)
+                if calibration.dark is not None:
+                    values -= calibration.dark[site]
+                if calibration.flat is not None:
+                    black = _black(black_levels, index)
+                    values -= black
+                    values /= calibration.flat[site]
+                    values += black
+                np.clip(values, 0, white_level, out=values)
+                view[...] = np.where(view >= white_level, view, np.rint(values))
+    if calibration.hot_pixels is not None and calibration.hot_pixels.size:
+        fill_hot_pixels(plane, calibration.hot_pixels, _step(calibration.pattern))
+
+
+def fill_hot_pixels(plane: np.ndarray, hot_pixels: np.ndarray, step=2):
+    """Replace each of `hot_pixels` (rows and columns) with the median of its four nearest
+    neighbours of the same colour
+    """
+    rows, columns = np.asarray(hot_pixels)
+    height, width = plane.shape
+    up = np.where(rows >= step, rows - step, rows + step)
+    down = np.where(rows + step < height, rows + step, rows - step)
+    left = np.where(columns >= step, columns - step, columns + step)
+    right = np.where(columns + step < width, columns + step, columns - step)
+    neighbours = np.stack(
+        [plane[up, columns], plane[down, columns], plane[rows, left], plane[rows, right]]
+    )
+    plane[rows, columns] = np.rint(np.median(neighbours, axis=0)).astype(plane.dtype)
+
+
+# State of a worker process (or of the main process, which uses the same functions)
+_worker: dict = {}
+
+
+def _init_worker(state: dict):
+    _worker.update(state)
+
+
+def _chunks(sources: list[Source], parts: int, multiple=1) -> list[list[Source]]:
+    """`sources` split into (at most) `parts` contiguous chunks, of a multiple of `multiple`"""
+    size = max(math.ceil(len(sources) / parts / multiple), 1) * multiple
+    return [sources[start : start + size] for start in range(0, len(sources), size)]
+
+
+def _map(function, tasks: list, workers: int, state: dict, chunksize=1):
+    """`function` of each of `tasks`, in any order, in a pool of `workers` processes"""
+    if workers == 1 or len(tasks) == 1:
+        _init_worker(state)
+        try:
+            yield from map(function, tasks)
+        finally:
+            _worker.clear()
+        return
+    context = multiprocessing.get_context()
+    with context.Pool(workers, initializer=_init_worker, initargs=(state,)) as pool:
+        yield from pool.imap_unordered(function, tasks, chunksize=chunksize)
+
+
+def _reduce_chunk(chunk: list[Source]):
+    """Sum of the frames (or of the medians of each group of frames) of a chunk, and its count"""
+    total = None
+    count = 0
+    info = None
+    group = _worker["group"] if _worker["combine"] == Combine.MEDIAN else 1
+    for start in range(0, len(chunk), group):
+        planes = []
+        for source in chunk[start : start + group]:
+            plane, info = read_raw(source)
+            planes.append(plane)
+        if total is None:
+            total = np.zeros(planes[0].shape, dtype=np.float32)
+        if any(plane.shape != total.shape for plane in planes):
+            raise ValueError("Calibration frames aren't all the same size")
+        if len(planes) == 1:
+            total += planes[0]
+        else:
+            stacked = np.stack(planes)
+            for band in range(0, total.shape[0], BAND_ROWS):
+                rows = slice(band, band + BAND_ROWS)
+                total[rows] += np.median(stacked[:, rows], axis=0)
+        count += 1
+    return total, count, info
+
+
+def master_frame(
+    sources: list[Source], combine=Combine.MEDIAN, group=5, workers: Union[int, None] = None
+) -> tuple[np.ndarray, RawInfo]:
+    """Combine calibration frames into a master frame (in raw units), streaming
+
+    Frames are read in contiguous chunks, one per worker process, and never held more than a
+    `group` at a time: a mean just sums them, and a median takes the per-pixel median of each
+    group of `group` frames (rejecting e.g. cosmic ray hits) and averages those.
+    """
+    if not sources:
+        raise ValueError("No calibration frames")
+    if combine not in (Combine.MEAN, Combine.MEDIAN):
+        raise ValueError(f"Unknown way of combining frames {combine!r}")
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    multiple = group if combine == Combine.MEDIAN else 1
+    chunks = _chunks(sources, workers, multiple)
+    total = None
+    count = 0
+    info = None
+    for chunk_total, chunk_count, chunk_info in _map(
+        _reduce_chunk, chunks, workers, {"combine": combine, "group": group}
+    ):
+        if total is None:
+            total = chunk_total
+        elif chunk_total.shape != total.shape:
+            raise ValueError("Calibration frames aren't all the same size")
+        else:
+            total += chunk_total
+        count += chunk_count
+        info = chunk_info
+    return total / count, info
+
+
+def _per_site(plane: np.ndarray, info: RawInfo, function):
+    """Apply `function(view, colour index)` to each photosite of the mosaic, in place"""
+    for (dy, dx), step, index in _sites(info.pattern):
+        function(plane[dy::step, dx::step], index)
+    return plane
+
+
+def master_dark(sources: list[Source], **kwargs) -> tuple[np.ndarray, RawInfo]:
+    """The dark signal above the black level, from dark frames"""
+    dark, info = master_frame(sources, **kwargs)
+
+    def subtract_black(view, index):
+        view -= _black(info.black_levels, index)
+
+    return _per_site(dark, info, subtract_black), info
+
+
+def master_flat(
+    sources: list[Source], dark: Union[np.ndarray, None] = None, floor=0.05, **kwargs
+) -> tuple[np.ndarray, RawInfo]:
+    """The relative response of each photosite, from flat frames (less `dark`, the dark signal of
+    flat darks if given), normalized to a mean of 1 for each colour
+
+    Photosites that respond less than `floor` are left uncorrected rather than blown up.
+    """
+    flat, info = master_frame(sources, **kwargs)
+    if dark is not None:
+        flat -= dark
+
+    def normalize(view, index):
+        view -= _black(info.black_levels, index)
+        view /= max(float(view.mean(dtype=np.float64)), 1e-6)
+        view[view < floor] = 1
+
+    return _per_site(flat, info, normalize), info
+
+
+@dataclass
+class HotPixelStats:
+    """Per-pixel running statistics of how far each pixel stands out from its neighbours
+
+    Partial statistics (from chunks of a sequence) are merged by adding them.
+    """
+
+    excess: np.ndarray
+    # Frames in which the pixel was more than `kappa` sigma above its neighbours
+    hits: np.ndarray
+    frames: int = 0
+
+    @classmethod
+    def empty(cls, shape, frames: int):
+        count_dtype = "uint16" if frames <= np.iinfo(np.uint16).max else "uint32"
+        return cls(np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=count_dtype))
+
+    def add(self, plane: np.ndarray, step=2, kappa=5.0):
+        excess = local_excess(plane, step)
+        self.excess += excess
+        self.hits += excess > kappa * _robust_sigma(excess)
+        self.frames += 1
+
+    def merge(self, other: "HotPixelStats"):
+        self.excess += other.excess
+        self.hits += other.hits
+        self.frames += other.frames
+
+    def hot_pixels(self, kappa=5.0, min_fraction=0.5) -> np.ndarray:
+        """Rows and columns of the pixels that stood out in at least `min_fraction` of the frames,
+        and by more than `kappa` sigma on average
+        """
+        mean = self.excess / max(self.frames, 1)
+        hot = (self.hits >= min_fraction * self.frames) & (mean > kappa * _robust_sigma(mean))
+        return np.array(np.nonzero(hot), dtype=np.int32)
+
+
+def _detect_chunk(chunk: list[Source]):
+    stats = None
+    info = None
+    for source in chunk:
+        plane, info = read_raw(source)
+        if stats is None:
+            stats = HotPixelStats.empty(plane.shape, _worker["frames"])
+        elif plane.shape != stats.excess.shape:
+            raise ValueError(f"{source} isn't the same size as the other frames")
+        stats.add(plane, _step(info.pattern), _worker["kappa"])
+    return stats, info
+
+
+def detect_hot_pixels(
+    sources: list[Source], kappa=5.0, min_fraction=0.5, workers: Union[int, None] = None
+) -> tuple[np.ndarray, RawInfo]:
+    """Find hot (and stuck) pixels across a whole sequence, light frames or dark
+
+    A pixel is hot if it stands out from its neighbours of the same colour in most frames, which
+    stars (that move and spread over several pixels) and lights (that spread) don't.
+    """
+    if not sources:
+        raise ValueError("No frames to find hot pixels in")
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    stats = None
+    info = None
+    for chunk_stats, chunk_info in _map(
+        _detect_chunk, _chunks(sources, workers), workers, {"kappa": kappa, "frames": len(sources)}
+    ):
+        if stats is None:
+            stats = chunk_stats
+        else:
+            stats.merge(chunk_stats)
+        info = chunk_info
+    hot_pixels = stats.hot_pixels(kappa, min_fraction)
+    logger.info(
+        f"Found {hot_pixels.shape[1]:,} hot pixel(s) in {stats.frames:,} frames"
+        f" ({hot_pixels.shape[1] / math.prod(stats.excess.shape):.4%})"
+    )
+    return hot_pixels, info
+
+
+def build_calibration(
+    darks: Union[list[Source], None] = None,
+    flats: Union[list[Source], None] = None,
+    flat_darks: Union[list[Source], None] = None,
+    hot_pixel_frames: Union[list[Source], None] = None,
+    combine=Combine.MEDIAN,
+    group=5,
+    kappa=5.0,
+    min_fraction=0.5,
+    workers: Union[int, None] = None,
+) -> Calibration:
+    """Build a calibration from whichever calibration sequences are given"""
+    start_time = time.perf_counter()
+    arrays = {}
+    infos = []
+    counts = {}
+    if darks:
+        arrays["dark"], info = master_dark(darks, combine=combine, group=group, workers=workers)
+        infos.append(info)
+        counts["darks"] = len(darks)
+    if flats:
+        flat_dark = None
+        if flat_darks:
+            flat_dark, _ = master_dark(flat_darks, combine=combine, group=group, workers=workers)
+            counts["flat_darks"] = len(flat_darks)
+        arrays["flat"], info = master_flat(
+            flats, flat_dark, combine=combine, group=group, workers=workers
+        )
+        infos.append(info)
+        counts["flats"] = len(flats)
+    if hot_pixel_frames:
+        arrays["hot_pixels"], info = detect_hot_pixels(
+            hot_pixel_frames, kappa, min_fraction, workers
+        )
+        infos.append(info)
+        counts["hot_pixel_frames"] = len(hot_pixel_frames)
+    if not infos:
+        raise ValueError("No calibration frames")
+    if len({info.shape for info in infos}) > 1:
+        raise ValueError("Calibration sequences aren't all the same size")
+    logger.info(f"Built calibration in {time.perf_counter() - start_time:.1f}s")
+    info = {**counts, "combine": combine, "white_level": infos[0].white_level}
+    return Calibration(infos[0].shape, infos[0].pattern, **arrays, info=info)
+
+
+def _source_name(source: Source) -> str:
+    return source.stem if isinstance(source, Path) else Path(source[1].name).stem
+
+
+def _develop(task: tuple[int, Source]):
+    index, source = task
+    try:
+        data, suffix = read_source(source)
+        frame = load_frame(
+            data, suffix, half_size=_worker["half_size"], calibration=_worker["calibration"]
+        )
+    except (OSError, ValueError, rawpy.LibRawError) as error:
+        return index, f"Couldn't develop {_source_name(source)}: {error}"
+    save_ppm(_worker["output_dir"] / f"{_source_name(source)}.ppm", frame)
+    return index, None
+
+
+def develop(
+    sources: list[Source],
+    output_dir: Path,
+    calibration: Calibration,
+    half_size=False,
+    workers: Union[int, None] = None,
+    batch=4,
+):
+    """Develop calibrated frames to 16-bit PPMs, for tools that can't read RAWs themselves
+
+    Frames are handed to a pool of `workers` processes `batch` at a time; a saved calibration is
+    memory-mapped, rather than copied, by each of them.
+    """
+    if not sources:
+        raise ValueError("No frames to develop")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    tasks = list(enumerate(sources))
+    start_time = time.perf_counter()
+    state = {"calibration": calibration, "half_size": half_size, "output_dir": output_dir}
+    developed = 0
+    for _index, error in _map(_develop, tasks, workers, state, chunksize=batch):
+        if error:
+            logger.warning(error)
+        else:
+            developed += 1
+    logger.info(
+        f"Developed {developed:,}/{len(tasks):,} calibrated frames into {output_dir} in"
+        f" {time.perf_counter() - start_time:.1f}s"
+    )
+    return developed
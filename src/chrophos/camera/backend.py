@@ -1,15 +1,23 @@
 import logging
+import queue
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 from time import sleep
-from typing import Union
+from typing import Any, Callable, Union
 
 import gphoto2 as gp
 
 from ..config import Complex
+from ..dedupe import Action, exposure_thumbnail, signature
+from ..storage import FrameWriter
 from ..utilities.benchmark import Benchmark
+from .bracket import BracketSet
+from .events import CapturedFile, EventPump, Exposure, SynchronizedCamera
+from .latency import exif_capture_time
 from .parameter import DiscreteParameter, Parameter, ReadonlyParameter, ValidationError
 
 logger = logging.getLogger("chrophos")
@@ -61,20 +69,51 @@ class Backend(ABC):
     iso: Iso
     shutter: Shutter
     light_meter: Union[ReadonlyParameter, None]
+    # Hands frames to other processes to store; see chrophos.pipeline
+    pipeline = None
 
     @abstractmethod
-    def __init__(self, config_map: dict[str, str]):
-        ...
+    def __init__(self, config_map: dict[str, str]): ...
 
     @abstractmethod
     def capture_and_download(
         self, output_dir: Path | None = None, stem: str | None = None
-    ) -> tuple[Path, datetime]:
-        ...
+    ) -> tuple[Path, datetime]: ...
 
     @abstractmethod
-    def exit(self):
-        ...
+    def exit(self): ...
+
+    def get_writer(self, output_dir: Path, **kwargs) -> FrameWriter:
+        """Get the writer for `output_dir`, creating it (with the given `kwargs`) if needed"""
+        output_dir = output_dir.resolve()
+        if output_dir not in self._writers or self._writers[output_dir].closed:
+            if self.pipeline is not None:
+                # Storage happens in the pipeline's own process
+                self._writers[output_dir] = self.pipeline.writer(output_dir, **kwargs)
+            else:
+                self._writers[output_dir] = FrameWriter(output_dir, **kwargs)
+        return self._writers[output_dir]
+
+    def close_writers(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def capture_bracket(self, output_dir: Path, stem: str) -> BracketSet:
+        raise BackendError(f"{type(self).__name__} doesn't support bracketing")
+
+    def capture_preview(self) -> bytes:
+        raise BackendError(f"{type(self).__name__} doesn't support live view")
+
+    def start_event_pump(self, **kwargs):
+        """Backends that support it drain camera events on a background thread"""
+        return None
+
+    def reconnect(self):
+        raise BackendError(f"{type(self).__name__} doesn't support reconnecting")
+
+    def stop_event_pump(self):
+        return None
 
 
 class Gphoto2Backend(Backend):
@@ -85,9 +124,20 @@ class Gphoto2Backend(Backend):
         target_aperture: float,
         target_iso: int,
         reset_camera_config_on_exit=False,
+        files_per_exposure: Union[int, None] = None,
+        camera=None,
+        camera_factory: Union[Callable[[], Any], None] = None,
     ):
+        """`camera` defaults to a real gphoto2 camera; pass e.g. a FakeCamera to run without one
+
+        `camera_factory` is called to open the camera again when reconnecting; by default, a new
+        gphoto2 camera (or `camera` itself, if given) is used.
+        """
+        if camera_factory is None:
+            camera_factory = gp.Camera if camera is None else lambda: camera
+        self._camera_factory = camera_factory
         try:
-            self._camera = gp.Camera()
+            self._camera = SynchronizedCamera(camera_factory() if camera is None else camera)
         except gp.GPhoto2Error as error:
             raise BackendError(
                 "Failed to initialize camera. Are you sure it's plugged in and turned on?"
@@ -97,6 +147,24 @@ class Gphoto2Backend(Backend):
 
         self.target_aperture = target_aperture
         self.target_iso = target_iso
+        self.config_map = config_map
+        self.files_per_exposure = files_per_exposure
+        self.bracket_count: Union[int, None] = None
+        self.bracket_step: Union[str, None] = None
+        self.event_pump: Union[EventPump, None] = None
+        self._event_pump_kwargs: dict = {}
+        self.last_exposure: Union[Exposure, None] = None
+        # Read each exposure's capture time from its first file; see `TriggerCalibration`
+        self.record_capture_times = False
+        # Keep the thumbnail signature of each exposure; see `AdaptiveInterval`
+        self.record_signatures = False
+        self.wall_clock: Callable[[], float] = time.time
+        # Decides what (if anything) to store of each exposure; see chrophos.dedupe
+        self.frame_filter = None
+        # Hands frames to other processes to store; see chrophos.pipeline
+        self.pipeline = None
+        self._early_file: Union[CapturedFile, None] = None
+        self._writers: dict[Path, FrameWriter] = {}
         self.pre_init_camera()
         camera_config = self._camera.get_config()
 
@@ -134,9 +202,9 @@ class Gphoto2Backend(Backend):
         )
         self.parameters["iso"] = self.iso
         if "light_meter" in config_map:
-            light_meter = camera_config.get_child_by_name("lightmeter")
+            light_meter = camera_config.get_child_by_name(config_map["light_meter"])
             self.light_meter = ReadonlyParameter(
-                "light_meter", "lightmeter", initial_value=light_meter.get_value()
+                "light_meter", config_map["light_meter"], initial_value=light_meter.get_value()
             )
             self.parameters["light_meter"] = self.light_meter
         else:
@@ -172,7 +240,7 @@ class Gphoto2Backend(Backend):
 
     def get_config_value(self, key, attempts=2):
         for i in range(1, attempts + 1):
-            logger.debug(f"Attempt #{i} to get {key}")
+            logger.debug("Attempt #%s to get %s", i, key)
             try:
                 config = self._camera.get_config()
                 return config.get_child_by_name(key).get_value()
@@ -180,11 +248,15 @@ class Gphoto2Backend(Backend):
                 if i == attempts:
                     raise
                 else:
-                    logger.debug(f"{error}; trying again")
+                    logger.debug("%s; trying again", error)
+
+    def get_single_config_value(self, key):
+        """Read a single config value, without fetching the whole config tree"""
+        return self._camera.get_single_config(key).get_value()
 
     def set_config_value(self, key, value, attempts=2):
         for i in range(1, attempts + 1):
-            logger.debug(f"Attempt #{i} to set {key} to {value}")
+            logger.debug("Attempt #%s to set %s to %s", i, key, value)
             try:
                 config = self._camera.get_config()
                 config.get_child_by_name(key).set_value(value)
@@ -193,7 +265,7 @@ class Gphoto2Backend(Backend):
                 if i == attempts:
                     raise
                 else:
-                    logger.debug(f"{error}; trying again")
+                    logger.debug("%s; trying again", error)
 
     def pull_config(self):
         camera_config = self._camera.get_config()
@@ -203,17 +275,17 @@ class Gphoto2Backend(Backend):
 
     def push_config(self, bulk=False, params: Union[list[Parameter], None] = None, attempts=2):
         if params is None:
-            params = self.parameters.values()
+            params = [p for p in self.parameters.values() if not isinstance(p, ReadonlyParameter)]
         else:
-            logger.debug(f"Pushing only {[p.name for p in params]}")
+            logger.debug("Pushing only %s", [p.name for p in params])
         for p in params:
-            logger.debug(f"Attempting to set {p.field} to {p.value}")
+            logger.debug("Attempting to set %s to %s", p.field, p.value)
             if bulk:
                 camera_config = self._camera.get_config()
                 camera_config.get_child_by_name(p.field).set_value(p.value)
             else:
                 self.set_config_value(p.field, p.value)
-                logger.debug(f"Successfully set {p.field} to {p.value}")
+                logger.debug("Successfully set %s to %s", p.field, p.value)
         if bulk:
             for i in range(attempts + 1, 1):
                 try:
@@ -223,44 +295,281 @@ class Gphoto2Backend(Backend):
                     if i == attempts:
                         raise
                     else:
-                        logger.debug(f"{error}; trying again")
+                        logger.debug("%s; trying again", error)
         logger.debug("Pushed config to camera")
 
+    def start_event_pump(self, **kwargs):
+        """Drain camera events on a background thread, so that triggers never wait on them"""
+        if self.event_pump is not None:
+            return self.event_pump
+        self.empty_event_queue()
+        self.event_pump = EventPump(
+            self._camera, files_per_exposure=self.files_per_exposure, **kwargs
+        )
+        self._event_pump_kwargs = kwargs
+        self.event_pump.start()
+        return self.event_pump
+
+    def stop_event_pump(self):
+        if self.event_pump is not None:
+            self.event_pump.stop()
+            self.event_pump = None
+
+    def wait_for_exposure(self, timeout=3_000, pair_timeout_ms=1_000):
+        """Wait for all of the files from a single trigger, without the event pump"""
+        exposure = Exposure(triggered_at=time.perf_counter())
+        if self._early_file is not None:
+            # The first file of this exposure arrived while waiting on the previous one
+            exposure.files.append(self._early_file)
+            self._early_file = None
+        while self.files_per_exposure is None or len(exposure.files) < self.files_per_exposure:
+            event_type, event_data = self._camera.wait_for_event(
+                pair_timeout_ms if exposure.files else timeout
+            )
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                captured_file = CapturedFile(
+                    event_data.folder, event_data.name, added_at=time.perf_counter()
+                )
+                if exposure.files and captured_file.stem != exposure.stem:
+                    self._early_file = captured_file
+                    break
+                exposure.files.append(captured_file)
+            elif exposure.files and event_type in (
+                gp.GP_EVENT_CAPTURE_COMPLETE,
+                gp.GP_EVENT_TIMEOUT,
+            ):
+                break
+        exposure.completed_at = time.perf_counter()
+        return exposure
+
+    def download(self, captured_file: CapturedFile):
+        """Download a file from the camera; returns a CameraFile"""
+        return self._camera.file_get(
+            captured_file.folder, captured_file.name, gp.GP_FILE_TYPE_NORMAL
+        )
+
+    def capture_preview(self) -> bytes:
+        """Grab a live view frame (a small JPEG); starts live view if it isn't already"""
+        return bytes(self._camera.capture_preview().get_data_and_size())
+
+    def _trigger(self, exposures=1):
+        if self.event_pump:
+            self.event_pump.drain()
+            self.event_pump.mark_trigger(exposures)
+        trigger_time = self.wall_clock()
+        # This method seems slightly faster than the capture() method
+        try:
+            self._camera.trigger_capture()
+        except gp.GPhoto2Error:
+            if self.event_pump:
+                self.event_pump.cancel_trigger(exposures)
+            raise
+        return trigger_time
+
+    def _next_exposure(self, timeout=3_000) -> Exposure:
+        if not self.event_pump:
+            return self.wait_for_exposure(timeout)
+        while True:
+            try:
+                return self.event_pump.next_exposure(timeout / 1000)
+            except queue.Empty:
+                if self.event_pump.error is not None:
+                    # Rather than waiting forever on a camera that has gone away
+                    raise self.event_pump.error from None
+                logger.debug("Still waiting for capture to complete")
+
+    def _save(self, camera_file, captured_file: CapturedFile, output_dir: Path, stem=None):
+        capture_dt = datetime.fromtimestamp(camera_file.get_mtime())
+        if stem:
+            stem = stem.format(capture_dt=capture_dt.isoformat())
+        else:
+            stem = captured_file.stem
+        output_path = output_dir / f"{stem}{captured_file.path.suffix}"
+        with Benchmark(f"Saved image from camera to {output_path}", logger=logger.debug):
+            self.get_writer(output_dir).write(output_path.name, camera_file.get_data_and_size())
+        logger.info("Capture to %s completed at %s", output_path, capture_dt)
+        return output_path, capture_dt
+
     def capture_and_download(
         self, output_dir: Path | None = None, stem: str | None = None, timeout=3_000
     ):
         logger.debug("Start capture")
         with Benchmark("Captured image", logger=logger.debug):
-            # This method seems slightly faster than the capture() method
-            self._camera.trigger_capture()
-            while True:
-                event_type, event_data = self._camera.wait_for_event(timeout)
-                if event_type == gp.GP_EVENT_FILE_ADDED:
-                    break
-        path_on_camera = Path(event_data.folder + event_data.name)
-        logger.info(f"Captured to camera path {path_on_camera}")
+            trigger_time = self._trigger()
+            exposure = self._next_exposure(timeout)
+        exposure.trigger_time = trigger_time
+        self.last_exposure = exposure
+        logger.info("Captured to camera path(s) %s", [str(f.path) for f in exposure.files])
+        output_path = None
+        capture_dt = None
         if output_dir:
-            output_dir.mkdir(parents=True, exist_ok=True)
-            with Benchmark("Downloaded image from camera", logger=logger.debug):
-                camera_file = self._camera.file_get(
-                    event_data.folder, event_data.name, gp.GP_FILE_TYPE_NORMAL
+            downloads = []
+            for captured_file in exposure.unrouted:
+                with Benchmark("Downloaded image from camera", logger=logger.debug):
+                    downloads.append((captured_file, self.download(captured_file)))
+            if self.record_capture_times and downloads:
+                captured_file, camera_file = downloads[0]
+                exposure.capture_time = exif_capture_time(
+                    camera_file.get_data_and_size(), captured_file.suffix
                 )
-            capture_dt = datetime.fromtimestamp(camera_file.get_mtime())
-            if stem:
-                stem = stem.format(capture_dt=capture_dt.isoformat())
-            else:
-                stem = path_on_camera.name
-            output_path = output_dir / f"{stem}{path_on_camera.suffix}"
-            with Benchmark(f"Saved image from camera to {output_path}", logger=logger.debug):
-                camera_file.save(str(output_path))
-            logger.info(f"Capture to {output_path} completed at {capture_dt}")
+            all_downloads = downloads
+            if self.frame_filter is not None and downloads:
+                output_path, capture_dt, downloads = self._filter(
+                    downloads, output_dir, stem, exposure
+                )
+            if self.record_signatures and exposure.signature is None and all_downloads:
+                thumbnail = exposure_thumbnail(
+                    [(file.path.suffix, data.get_data_and_size()) for file, data in all_downloads]
+                )
+                exposure.signature = signature(thumbnail) if thumbnail else None
+            for captured_file, camera_file in downloads:
+                file_output_path, file_capture_dt = self._save(
+                    camera_file, captured_file, output_dir, stem
+                )
+                # The first file of the exposure is the one reported to the caller
+                if output_path is None:
+                    output_path = file_output_path
+                    capture_dt = file_capture_dt
         else:
             logger.info("Capture completed")
-            output_path = None
-            capture_dt = None
         return output_path, capture_dt
 
+    def _filter(self, downloads: list, output_dir: Path, stem, exposure: Exposure):
+        """Apply `frame_filter` to an exposure's downloaded files; returns those still to be saved
+
+        Along with the path and capture time to report, if the filter stored a thumbnail in their
+        place (or dropped them).
+        """
+        captured_file, camera_file = downloads[0]
+        stem = stem or captured_file.stem
+        decision = self.frame_filter.decide(
+            stem, [(file.path.suffix, data.get_data_and_size()) for file, data in downloads]
+        )
+        exposure.signature = decision.signature
+        if decision.action == Action.KEEP:
+            return None, None, downloads
+        capture_dt = datetime.fromtimestamp(camera_file.get_mtime())
+        stem = stem.format(capture_dt=capture_dt.isoformat())
+        if decision.action == Action.THUMBNAIL:
+            output_path = output_dir / f"{stem}.THM"
+            self.get_writer(output_dir).write(output_path.name, decision.thumbnail)
+            logger.info("Near-duplicate; stored only its thumbnail, to %s", output_path)
+        else:
+            output_path = None
+            logger.info("Near-duplicate; dropped %s", [str(file.path) for file, _ in downloads])
+        return output_path, capture_dt, []
+
+    def configure_bracketing(self, count: int, step: Union[str, None] = None):
+        """Set up the camera's own exposure bracketing, so that one trigger fires `count` frames"""
+        for name in ("bracketing", "bracket_pattern"):
+            if name not in self.config_map:
+                raise BackendError(f"Can't bracket: config_map has no {name!r} entry")
+        bracketing = self.config_map["bracketing"]
+        pattern = self.config_map["bracket_pattern"]
+        try:
+            pattern_value = pattern.values[str(count)]
+        except KeyError as error:
+            raise BackendError(
+                f"Can't bracket {count} frames; supported counts: {list(pattern.values)}"
+            ) from error
+        self.set_config_value(bracketing.key, bracketing.values["on"])
+        self.set_config_value(pattern.key, pattern_value)
+        if step is not None and "bracket_step" in self.config_map:
+            self.set_config_value(self.config_map["bracket_step"], step)
+        if "capture_mode" in self.config_map:
+            capture_mode = self.config_map["capture_mode"]
+            self.set_config_value(capture_mode.key, capture_mode.values["burst"])
+        if "burst_number" in self.config_map:
+            self.set_config_value(self.config_map["burst_number"], count)
+        self.bracket_count = count
+        self.bracket_step = step
+        logger.info(f"Configured in-camera bracketing of {count} frames")
+
+    def disable_bracketing(self):
+        if not self.bracket_count:
+            return
+        bracketing = self.config_map["bracketing"]
+        self.set_config_value(bracketing.key, bracketing.values["off"])
+        if "capture_mode" in self.config_map:
+            capture_mode = self.config_map["capture_mode"]
+            self.set_config_value(capture_mode.key, capture_mode.values["single"])
+        if "burst_number" in self.config_map:
+            self.set_config_value(self.config_map["burst_number"], 1)
+        self.bracket_count = None
+        logger.info("Disabled in-camera bracketing")
+
+    def capture_bracket(self, output_dir: Path, stem: str, timeout=3_000) -> BracketSet:
+        """Fire one bracket burst and download all of its files
+
+        Downloads are pipelined: the next file is fetched from the camera while the previous one
+        is being written to storage.
+        """
+        if not self.bracket_count:
+            raise BackendError("Bracketing hasn't been configured; call configure_bracketing")
+        start = time.perf_counter()
+        bracket_set = BracketSet(stem=stem, triggered_at=datetime.now())
+        self._trigger(exposures=self.bracket_count)
+        exposures = [self._next_exposure(timeout) for _ in range(self.bracket_count)]
+        captured_files = []
+        for index, exposure in enumerate(exposures, 1):
+            bracket_set.exposure_latencies.append(exposure.files[-1].added_at - start)
+            captured_files.extend((index, f) for f in exposure.unrouted)
+        logger.info("Bracket %s exposed %s file(s)", stem, len(captured_files))
+
+        def download(captured_file: CapturedFile):
+            download_start = time.perf_counter()
+            camera_file = self.download(captured_file)
+            return camera_file, time.perf_counter() - download_start
+
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="chrophos-download") as pool:
+            downloads = pool.map(download, [f for _index, f in captured_files])
+            for (index, captured_file), (camera_file, seconds) in zip(captured_files, downloads):
+                output_path, capture_dt = self._save(
+                    camera_file, captured_file, output_dir, f"{stem}_b{index}"
+                )
+                bracket_set.files.append(output_path)
+                bracket_set.capture_times.append(capture_dt)
+                bracket_set.download_seconds.append(seconds)
+        bracket_set.total_seconds = time.perf_counter() - start
+        logger.info("Captured bracket %s in %.2fs", stem, bracket_set.total_seconds)
+        return bracket_set
+
+    def reconnect(self):
+        """Close the camera and open it again, restoring the exposure settings and bracketing
+
+        Frame writers, and the event pump (if it was running), carry on as before.
+        """
+        pump_was_running = self.event_pump is not None
+        self.stop_event_pump()
+        try:
+            self._camera.exit()
+        except gp.GPhoto2Error as error:
+            logger.debug(f"Failed to cleanly close camera before reconnecting: {error}")
+        self._camera = SynchronizedCamera(self._camera_factory())
+        self._early_file = None
+        self.pre_init_camera()
+        # Push parameters one by one, so that one the camera no longer accepts (e.g. because
+        # its mode was changed) doesn't stop the rest from being restored
+        for parameter in self.parameters.values():
+            if isinstance(parameter, ReadonlyParameter):
+                continue
+            try:
+                self.set_config_value(parameter.field, parameter.value)
+            except gp.GPhoto2Error as error:
+                logger.warning(f"Failed to restore {parameter} after reconnecting: {error}")
+        self.post_init_camera()
+        if self.bracket_count:
+            self.configure_bracketing(self.bracket_count, step=self.bracket_step)
+        if pump_was_running:
+            self.start_event_pump(**self._event_pump_kwargs)
+        else:
+            self.empty_event_queue()
+        logger.info(f"Reconnected to camera; restored {self.config}")
+
     def exit(self):
+        self.disable_bracketing()
+        self.stop_event_pump()
+        self.close_writers()
         if self.reset_camera_config_on_exit:
             logger.info("Resetting camera config to original state")
             self._camera.set_config(self.initial_camera_config)
@@ -273,13 +582,16 @@ class Gphoto2Backend(Backend):
         )
 
     def empty_event_queue(self, timeout=10):
+        self._early_file = None
+        if self.event_pump:
+            self.event_pump.drain()
+            return
         while True:
-            type_, data = self.wait_for_event(timeout)
+            type_, data = self._camera.wait_for_event(timeout)
             if type_ == gp.GP_EVENT_TIMEOUT:
                 return
             if type_ == gp.GP_EVENT_FILE_ADDED:
-                # get a second image if camera is set to raw + jpeg
-                logger.info("Unexpected new file", data.folder + data.name)
+                logger.info("Unexpected new file %s%s", data.folder, data.name)
 
 
 class Canon5DII(Gphoto2Backend):
@@ -344,6 +656,7 @@ class DummyBackend(Backend):
 
         self.target_aperture = target_aperture
         self.target_iso = target_iso
+        self._writers: dict[Path, FrameWriter] = {}
         self.pre_init_camera()
 
         self.parameters = {}
@@ -385,11 +698,9 @@ class DummyBackend(Backend):
         # Pull the config from the camera, in case things changed as a result of post_init_camera
         self.pull_config()
 
-    def capture_and_download(self, output_dir: Path, stem: str) -> tuple[Path, datetime]:
-        ...
+    def capture_and_download(self, output_dir: Path, stem: str) -> tuple[Path, datetime]: ...
 
     def exit(self):
-        ...
+        self.close_writers()
 
-    def empty_event_queue(camera):
-        ...
+    def empty_event_queue(camera): ...
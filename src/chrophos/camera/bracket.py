@@ -0,0 +1,36 @@
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Union
+
+
+@dataclass
+class BracketSet:
+    """The files and timings from a single in-camera bracket burst"""
+
+    stem: str
+    triggered_at: datetime
+    files: list[Path] = field(default_factory=list)
+    capture_times: list[Union[datetime, None]] = field(default_factory=list)
+    # Seconds from the trigger until the camera reported each exposure's files
+    exposure_latencies: list[float] = field(default_factory=list)
+    download_seconds: list[float] = field(default_factory=list)
+    total_seconds: Union[float, None] = None
+
+    def as_dict(self):
+        return {
+            "stem": self.stem,
+            "triggered_at": self.triggered_at.isoformat(),
+            "files": [str(path) for path in self.files],
+            "capture_times": [dt.isoformat() if dt else None for dt in self.capture_times],
+            "exposure_latencies": self.exposure_latencies,
+            "download_seconds": self.download_seconds,
+            "total_seconds": self.total_seconds,
+        }
+
+
+def record_bracket_set(path: Path, bracket_set: BracketSet):
+    """Append `bracket_set` to the JSON Lines log at `path`"""
+    with open(path, "a") as file:
+        file.write(json.dumps(bracket_set.as_dict()) + "\n")
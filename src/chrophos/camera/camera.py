@@ -3,17 +3,17 @@ import math
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from time import sleep
+from typing import Union
 
 from chrophos.camera.backend import Backend
+from chrophos.camera.lightmeter import LightMeterSampler
 from chrophos.camera.parameter import ValidationError
 from chrophos.config import CameraConfig, Complex
 
 logger = logging.getLogger(__name__)
 
 
-class CameraError(ValueError):
-    ...
+class CameraError(ValueError): ...
 
 
 def exposure_value(aperture: float, iso: int, shutter: float):
@@ -125,14 +125,24 @@ class Camera:
 
     # TODO: Step size is configurable in camera; need to make sure these are synced up
     # TODO: This really needs to be a feedback loop where it checks the results along the way
-    def step_exposure(self, stop: int, step_size=1 / 3):
+    def step_exposure(
+        self, stop: int, step_size=1 / 3, max_shutter: Union[float, None] = None, partial=False
+    ):
+        """Step the exposure by `stop` stops: the shutter first, then the aperture, then the ISO
+        (the other way around when reducing it)
+
+        The shutter is never lengthened past `max_shutter` seconds. If the exposure can't be
+        stepped all the way, a ValueError is raised; unless `partial`, in which case (as on
+        success) the stops actually stepped are returned.
+        """
         if step_size < 0:
             raise ValueError("Doesn't work like that; must always be positive step size")
         if stop == 0:
             raise ValueError("Can't step by 0, dumbass")
-        total_steps = int(stop // step_size)
-        logger.warning(
-            f"Stepping exposure by {stop:.1f} stops (in {total_steps} steps of {step_size})"
+        # Allowing for e.g. 5 * (1 / 3) // (1 / 3) == 4
+        total_steps = math.floor(abs(stop) / step_size + 1e-9)
+        logger.debug(
+            "Stepping exposure by %.1f stops (in %s steps of %s)", stop, total_steps, step_size
         )
         parameter_order = [self.shutter, self.aperture, self.iso]
         steps_remaining = total_steps
@@ -140,24 +150,56 @@ class Camera:
             parameter_order = reversed(parameter_order)
         for parameter in parameter_order:
             for i in range(steps_remaining):
-                logger.info(f"Step {i}, param {parameter.name}")
+                logger.debug("Step %s, param %s", i, parameter.name)
                 previous_value = parameter.actual_value
+                if (
+                    stop > 0
+                    and parameter is self.shutter
+                    and max_shutter is not None
+                    and self._next_shutter() > max_shutter
+                ):
+                    logger.info(
+                        "Can't lengthen the shutter past %.2fs; moving on to next parameter",
+                        max_shutter,
+                    )
+                    break
+                # A step up the aperture's choices (f-numbers) stops it down
+                direction = -1 if parameter is self.aperture else 1
                 try:
-                    parameter.step_value(-1 if stop < 0 else 1)
+                    parameter.step_value(-direction if stop < 0 else direction)
                 except ValidationError:
-                    logger.info(f"Can't step value for {parameter}; moving on to next parameter")
+                    logger.info("Can't step value for %s; moving on to next parameter", parameter)
                     break
                 else:
                     steps_remaining -= 1
-                    self.backend.push_config([parameter])
-                    logger.warning(
-                        f"Stepped {parameter.name} from {previous_value} to"
-                        f" {parameter.actual_value}. EV: {self.exposure.ev:.1f}; {steps_remaining=}"
+                    if parameter.setter is None:
+                        # Otherwise, the parameter has already pushed itself to the camera
+                        self.backend.push_config(params=[parameter])
+                    logger.info(
+                        "Stepped %s from %s to %s; %s step(s) remaining",
+                        parameter.name,
+                        previous_value,
+                        parameter.actual_value,
+                        steps_remaining,
                     )
                     if steps_remaining == 0:
-                        return True
+                        return math.copysign(total_steps * step_size, stop) if partial else True
+        if partial:
+            return math.copysign((total_steps - steps_remaining) * step_size, stop)
         raise ValueError("Failed to step exposure!")
 
+    def _next_shutter(self) -> float:
+        """The shutter speed one step longer than the current one (or the current one, if it's
+        the longest)
+        """
+        choices = self.shutter.choices
+        index = choices.index(self.shutter.value)
+        try:
+            return self.shutter.parse(choices[min(index + 1, len(choices) - 1)])
+        except ValidationError:
+            # e.g. "Bulb"
+            return math.inf
+
     def determine_good_exposure(self, mode=MODE.PROGRAM):
         inv = {v: k for k, v in self.config.config_map["auto_exposure_mode"].values.items()}
         original_mode = inv[self.backend.auto_exposure_mode.value]
@@ -193,45 +235,82 @@ class Camera:
         self.backend.auto_exposure_mode.value = aem.values[mode]
         self.backend.push_config(params=[self.backend.auto_exposure_mode], bulk=False)
 
-    def auto_expose_via_light_meter(self, target_bounds=(-5, 5), delay=0.05):
+    def auto_expose_via_light_meter(
+        self,
+        target_bounds=(-5, 5),
+        sampler: Union[LightMeterSampler, None] = None,
+        units_per_stop=1.0,
+        max_adjustments=5,
+        min_confidence=0.6,
+        settle_timeout=5.0,
+    ):
+        """Adjust the exposure until the light meter reads within `target_bounds`
+
+        Rather than stepping a third of a stop at a time, each adjustment aims for the middle of
+        the bounds, so this takes at most `max_adjustments` rounds of pushing config to the
+        camera. After each, the meter is given up to `settle_timeout` seconds to settle (see
+        `LightMeterSampler.wait_for`). Returns the final (smoothed) reading.
+        """
         if not self.light_meter:
             raise ValueError(f"Unsupported auto-exposure method; {self} has no light meter!")
-        logger.debug(f"auto exposing! initial {self.light_meter.value=}")
+        if sampler is None:
+            with LightMeterSampler(self.backend) as sampler:
+                return self.auto_expose_via_light_meter(
+                    target_bounds,
+                    sampler,
+                    units_per_stop=units_per_stop,
+                    max_adjustments=max_adjustments,
+                    min_confidence=min_confidence,
+                    settle_timeout=settle_timeout,
+                )
         lower_exposure_bound, upper_exposure_bound = target_bounds
-        if self.light_meter.value < lower_exposure_bound:
-            step = 1
-        elif self.light_meter.value > upper_exposure_bound:
-            step = -1
-        else:
-            logger.debug("DOING NOTHING; ALREADY EXPOSED PROPERLY")
-            return self.light_meter.value
-        while True:
-            logger.debug(
-                f"CONT: {lower_exposure_bound} > {self.light_meter=} > {upper_exposure_bound}"
-            )
-            if lower_exposure_bound <= self.light_meter.value <= upper_exposure_bound:
-                logger.debug(
-                    f"DONE: {lower_exposure_bound} <= {self.light_meter=} <= {upper_exposure_bound}"
+        target = (lower_exposure_bound + upper_exposure_bound) / 2
+        step_size = 1 / 3
+        for adjustment in range(max_adjustments + 1):
+            reading = sampler.wait_for(min_confidence=min_confidence, timeout=settle_timeout)
+            if reading is None:
+                raise CameraError("Got no reading from the light meter")
+            if reading.confidence < min_confidence:
+                logger.warning(
+                    f"Light meter hasn't settled (confidence {reading.confidence:.2f});"
+                    f" going by {reading.value:.2f}"
+                )
+            if lower_exposure_bound <= reading.value <= upper_exposure_bound:
+                logger.info(
+                    f"Light meter reads {reading.value:.2f} after {adjustment} adjustment(s):"
+                    f" {self.exposure.description()}"
                 )
+                return reading.value
+            if adjustment == max_adjustments:
                 break
-            logger.debug(
-                f"Shutter speed: {self.shutter.value} | Aperture:"
-                f" {self.aperture.value} | ISO: {self.iso.value} |"
-                f" Exposure: {self.light_meter.value}"
-            )
+            # A meter reading under the bounds calls for more exposure
+            stop = round((target - reading.value) / units_per_stop / step_size) * step_size
+            if stop == 0:
+                stop = math.copysign(step_size, target - reading.value)
+            logger.debug("Light meter reads %.2f; stepping by %+.2f stop(s)", reading.value, stop)
             try:
-                self.step_exposure(step=step)
+                self.step_exposure(stop, step_size=step_size)
             except ValueError as error:
                 raise ValueError("Can't adjust exposure anymore!") from error
-
-            sleep(delay)
-        return self.light_meter.value
+            sampler.reset()
+        raise CameraError(
+            f"Light meter still reads {reading.value:.2f} after {max_adjustments} adjustment(s),"
+            f" outside of {target_bounds}"
+        )
 
     def capture(self, output_dir: Path | None = None, stem: str | None = None):
         """Capture an image and save to to `output_dir` using `stem` as the basis for its name"""
 
         return self.backend.capture_and_download(output_dir=output_dir, stem=stem)
 
+    def configure_bracketing(self, count: int, step: str | None = None):
+        return self.backend.configure_bracketing(count=count, step=step)
+
+    def capture_bracket(self, output_dir: Path, stem: str):
+        """Fire a single in-camera bracket burst and save every frame of it to `output_dir`"""
+
+        return self.backend.capture_bracket(output_dir=output_dir, stem=stem)
+
 
 @contextmanager
 def open_camera(backend: Backend, config: CameraConfig):
@@ -0,0 +1,251 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import PurePosixPath
+from typing import Iterable, Union
+
+import gphoto2 as gp
+
+from ..dedupe import Signature
+from ..utilities.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class SynchronizedCamera:
+    """Wrap a gphoto2 camera so that only one thread talks to it at a time"""
+
+    def __init__(self, camera, lock: Union[threading.RLock, None] = None):
+        self.camera = camera
+        self.lock = threading.RLock() if lock is None else lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.camera, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+@dataclass
+class CapturedFile:
+    """A file that the camera has reported as added to its storage"""
+
+    folder: str
+    name: str
+    added_at: float
+
+    @property
+    def path(self):
+        return PurePosixPath(self.folder) / self.name
+
+    @property
+    def stem(self):
+        return self.path.stem
+
+    @property
+    def suffix(self):
+        return self.path.suffix.upper()
+
+
+@dataclass
+class Exposure:
+    """All of the files (e.g. RAW + JPEG) produced by a single trigger"""
+
+    files: list[CapturedFile] = field(default_factory=list)
+    triggered_at: Union[float, None] = None
+    completed_at: Union[float, None] = None
+    # Timestamps of the trigger (by the host's clock) and of the start of the exposure (by the
+    # camera's, if recorded; see `TriggerCalibration`)
+    trigger_time: Union[float, None] = None
+    capture_time: Union[float, None] = None
+    # Of its thumbnail, if recorded; see `AdaptiveInterval`
+    signature: Union[Signature, None] = None
+    # Files that were routed to a consumer other than storage
+    routed: list[CapturedFile] = field(default_factory=list)
+
+    @property
+    def stem(self):
+        return self.files[0].stem if self.files else None
+
+    @property
+    def unrouted(self):
+        return [f for f in self.files if f not in self.routed]
+
+
+class EventPump(threading.Thread):
+    """Continuously drain the camera's event queue, grouping added files into exposures
+
+    Files are grouped by stem; an exposure is considered complete once the camera reports that the
+    capture is complete, a file with a different stem arrives, or `pair_timeout` seconds pass
+    after its first file (or, if `files_per_exposure` is given, once that many files have
+    arrived).
+
+    Completed exposures are put on the `exposures` queue. Files whose suffix has been subscribed
+    to (see `subscribe`) are additionally put on that consumer's queue.
+
+    The camera is locked for as long as `wait_for_event` blocks, so the pump only waits
+    `poll_timeout_ms` on the camera, and sleeps up to `idle_interval` seconds between polls with
+    the camera unlocked; otherwise every trigger and download would queue behind the pump. While
+    a trigger's files are outstanding, it polls without sleeping; once they're in, it leaves the
+    camera to whoever downloads them before polling again.
+    """
+
+    def __init__(
+        self,
+        camera: SynchronizedCamera,
+        files_per_exposure: Union[int, None] = None,
+        poll_timeout_ms=1,
+        idle_interval=0.005,
+        pair_timeout=1.0,
+        max_exposures=8,
+    ):
+        super().__init__(name="chrophos-event-pump", daemon=True)
+        self.camera = camera
+        self.files_per_exposure = files_per_exposure
+        self.poll_timeout_ms = poll_timeout_ms
+        self.idle_interval = idle_interval
+        self.pair_timeout = pair_timeout
+        self.exposures: queue.Queue[Exposure] = queue.Queue(maxsize=max_exposures)
+
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._triggers: deque[float] = deque()
+        self._pending: Union[Exposure, None] = None
+        # (suffixes, queue, whether storage should skip those files)
+        self._routes: list[tuple[frozenset[str], queue.Queue, bool]] = []
+
+        self.trigger_latency = LatencyHistogram("trigger to file added")
+        self.pairing_latency = LatencyHistogram("first to last file")
+        self.dropped = 0
+        self.stale = 0
+        self.completed = 0
+        # The error from the last attempt to read an event, if it failed
+        self.error: Union[gp.GPhoto2Error, None] = None
+
+    def subscribe(self, suffixes: Iterable[str], maxsize=4, claim=True) -> queue.Queue:
+        """Route files with the given suffixes (e.g. [".JPG"]) to the returned queue
+
+        If `claim` is True, those files won't be downloaded to storage by `capture_and_download`.
+        If the consumer falls behind, the oldest file in its queue is dropped.
+        """
+        route_queue: queue.Queue[CapturedFile] = queue.Queue(maxsize=maxsize)
+        self._routes.append((frozenset(s.upper() for s in suffixes), route_queue, claim))
+        return route_queue
+
+    def mark_trigger(self, exposures=1):
+        """Note that a trigger is about to produce `exposures` exposures (more than 1 for bursts)"""
+        now = time.perf_counter()
+        self._triggers.extend([now] * exposures)
+        self._wake.set()
+
+    def cancel_trigger(self, exposures=1):
+        """Forget the most recent trigger, e.g. because it failed"""
+        for _ in range(min(exposures, len(self._triggers))):
+            self._triggers.pop()
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def run(self):
+        logger.debug("Event pump started")
+        while not self._stop_event.is_set():
+            try:
+                event_type, event_data = self.camera.wait_for_event(self.poll_timeout_ms)
+            except gp.GPhoto2Error as error:
+                logger.warning("Event pump failed to read event: %s", error)
+                self.error = error
+                self._stop_event.wait(self.idle_interval)
+                continue
+            self.error = None
+            now = time.perf_counter()
+            completed = self.completed
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                self._add_file(CapturedFile(event_data.folder, event_data.name, added_at=now))
+            elif event_type == gp.GP_EVENT_CAPTURE_COMPLETE and self._pending:
+                self._complete()
+            elif event_type == gp.GP_EVENT_TIMEOUT:
+                if self._pending and now - self._pending.files[0].added_at > self.pair_timeout:
+                    logger.debug("Timed out waiting for more files for %s", self._pending.stem)
+                    self._complete()
+            idle = event_type == gp.GP_EVENT_TIMEOUT or self.completed != completed
+            if idle and not self._triggers:
+                self._wake.wait(self.idle_interval)
+                self._wake.clear()
+        logger.debug("Event pump stopped")
+
+    def _add_file(self, captured_file: CapturedFile):
+        if self._pending and self._pending.stem != captured_file.stem:
+            self._complete()
+        if self._pending is None:
+            triggered_at = self._triggers.popleft() if self._triggers else None
+            if triggered_at is None:
+                self.stale += 1
+                logger.warning("File %s was added without a trigger", captured_file.path)
+            else:
+                self.trigger_latency.record(captured_file.added_at - triggered_at)
+            self._pending = Exposure(triggered_at=triggered_at)
+        self._pending.files.append(captured_file)
+        logger.debug("Camera added %s", captured_file.path)
+        if self.files_per_exposure and len(self._pending.files) >= self.files_per_exposure:
+            self._complete()
+
+    def _complete(self):
+        exposure = self._pending
+        self._pending = None
+        self.completed += 1
+        exposure.completed_at = time.perf_counter()
+        self.pairing_latency.record(exposure.files[-1].added_at - exposure.files[0].added_at)
+        for captured_file in exposure.files:
+            for suffixes, route_queue, claim in self._routes:
+                if captured_file.suffix in suffixes:
+                    self._put(route_queue, captured_file)
+                    if claim:
+                        exposure.routed.append(captured_file)
+        self._put(self.exposures, exposure)
+
+    def _put(self, target: queue.Queue, item):
+        while True:
+            try:
+                target.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    target.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def next_exposure(self, timeout: float) -> Exposure:
+        return self.exposures.get(timeout=timeout)
+
+    def drain(self):
+        """Discard any exposures that completed without having been waited for"""
+        while True:
+            try:
+                exposure = self.exposures.get_nowait()
+            except queue.Empty:
+                return
+            self.stale += 1
+            logger.warning(
+                f"Discarding unexpected exposure {[str(f.path) for f in exposure.files]}"
+            )
+
+    def metrics(self):
+        return {
+            "trigger_latency": self.trigger_latency.as_dict(),
+            "pairing_latency": self.pairing_latency.as_dict(),
+            "dropped": self.dropped,
+            "stale": self.stale,
+            "completed": self.completed,
+            "queued_exposures": self.exposures.qsize(),
+        }
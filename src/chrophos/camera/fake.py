@@ -0,0 +1,296 @@
+import io
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Union
+
+import gphoto2 as gp
+from PIL import Image
+
+from ..config import parse_config, parse_config_raw
+from .backend import Gphoto2Backend
+from .camera import Camera
+from .latency import DATE_TIME_ORIGINAL, EXIF_IFD, SUB_SEC_TIME_ORIGINAL
+
+
+class FakeWidget:
+    """Stand-in for a gphoto2 CameraWidget; supports the subset of the API that chrophos uses"""
+
+    def __init__(
+        self,
+        name: str,
+        label="",
+        value: Any = None,
+        choices: Union[list, None] = None,
+        read_only=False,
+        children: Union[list["FakeWidget"], None] = None,
+    ):
+        self.name = name
+        self.label = label
+        self.value = value
+        self.choices = choices
+        self.read_only = read_only
+        self.children = children or []
+        self._by_name = {child.name: child for child in self.children}
+        self._changed = False
+
+    def copy(self):
+        return FakeWidget(
+            self.name,
+            label=self.label,
+            value=self.value,
+            choices=self.choices,
+            read_only=self.read_only,
+            children=[child.copy() for child in self.children],
+        )
+
+    def get_name(self):
+        return self.name
+
+    def get_label(self):
+        return self.label
+
+    def get_readonly(self):
+        return self.read_only
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self, value):
+        if self.choices is not None and value not in self.choices:
+            raise gp.GPhoto2Error(gp.GP_ERROR_BAD_PARAMETERS)
+        self.value = value
+        self._changed = True
+
+    def changed(self):
+        return self._changed
+
+    def get_choices(self):
+        if self.choices is None:
+            raise gp.GPhoto2Error(gp.GP_ERROR_NOT_SUPPORTED)
+        return iter(self.choices)
+
+    def count_children(self):
+        return len(self.children)
+
+    def get_children(self):
+        return iter(self.children)
+
+    def get_child_by_name(self, name: str):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            for child in self.children:
+                try:
+                    return child.get_child_by_name(name)
+                except gp.GPhoto2Error:
+                    pass
+        raise gp.GPhoto2Error(gp.GP_ERROR_BAD_PARAMETERS)
+
+
+class FakeCameraFile:
+    def __init__(self, data: bytes, mtime: int):
+        self.data = data
+        self.mtime = mtime
+
+    def get_data_and_size(self):
+        return memoryview(self.data)
+
+    def get_mtime(self):
+        return self.mtime
+
+    def save(self, path: str):
+        Path(path).write_bytes(self.data)
+
+
+class FakeCamera:
+    """In-process stand-in for gphoto2.Camera, so chrophos can run without hardware
+
+    Each trigger "exposes" one file per entry of `suffixes` (e.g. [".NEF", ".JPG"] for RAW + JPEG),
+    each `file_size` bytes long.
+
+    If `clock_widget` is given, that widget reads as the camera's own clock (in whole seconds),
+    which runs `clock_offset` seconds ahead of `clock` and gains `clock_drift` seconds a second.
+    Exposures start `trigger_latency` seconds after their trigger; with `exif`, every file is a
+    tiny JPEG whose EXIF records that time (by the camera's clock, to the millisecond).
+
+    Live view previews are uniformly `preview_level` (an 8-bit sRGB value; 118 is mid-grey).
+
+    If `burst_widget` is given, each trigger exposes as many frames as that widget reads (as an
+    in-camera bracket would).
+    """
+
+    def __init__(
+        self,
+        widgets: list[FakeWidget],
+        suffixes=(".NEF",),
+        file_size=1024,
+        clock=time.time,
+        clock_widget: Union[str, None] = None,
+        clock_offset=0.0,
+        clock_drift=0.0,
+        trigger_latency=0.0,
+        exif=False,
+        preview_level=118,
+        burst_widget: Union[str, None] = None,
+    ):
+        self._root = FakeWidget("main", children=widgets)
+        self.suffixes = suffixes
+        self.file_size = file_size
+        self.clock = clock
+        self.clock_widget = clock_widget
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self.trigger_latency = trigger_latency
+        self.exif = exif
+        self.preview_level = preview_level
+        self.burst_widget = burst_widget
+        self.previews = 0
+        self._clock_start = clock()
+        self._exposed_at: dict[str, float] = {}
+        self.captures = 0
+        self._data = bytes(file_size)
+        self._events: deque = deque()
+        self._event_added = threading.Condition()
+        self._faults: deque[int] = deque()
+
+    @classmethod
+    def from_config(cls, path: Path, **kwargs):
+        """Build a camera from the `[config]` section of a camera profile (e.g. nikon_z6.toml)"""
+        widgets = []
+        for name, spec in parse_config_raw(path).get("config", {}).items():
+            value = spec.get("value")
+            if isinstance(value, datetime):
+                value = int(value.timestamp())
+            widgets.append(
+                FakeWidget(
+                    name,
+                    label=spec.get("label", ""),
+                    value=value,
+                    choices=list(spec["choices"]) if "choices" in spec else None,
+                    read_only=spec.get("read_only", False),
+                )
+            )
+        return cls(widgets, **kwargs)
+
+    def camera_time(self):
+        now = self.clock()
+        return now + self.clock_offset + self.clock_drift * (now - self._clock_start)
+
+    def _tick(self):
+        if self.clock_widget is not None:
+            self._root.get_child_by_name(self.clock_widget).value = int(self.camera_time())
+
+    def _set(self, name: str, value):
+        if name == self.clock_widget:
+            # The camera's clock starts counting from the given second
+            self.clock_offset += value - self.camera_time()
+        self._root.get_child_by_name(name).value = value
+
+    def get_config(self):
+        self._tick()
+        return self._root.copy()
+
+    def set_config(self, config: FakeWidget):
+        for widget in self._walk(config):
+            if not widget.read_only and widget.name in self._root._by_name:
+                # Otherwise, writing back a stale reading would set the clock back
+                if widget.name != self.clock_widget or widget.changed():
+                    self._set(widget.name, widget.value)
+
+    def get_single_config(self, name: str):
+        self._tick()
+        return self._root.get_child_by_name(name).copy()
+
+    def set_single_config(self, name: str, widget: FakeWidget):
+        self._set(name, widget.value)
+
+    def _walk(self, widget: FakeWidget):
+        yield widget
+        for child in widget.children:
+            yield from self._walk(child)
+
+    def fail_next(self, code: int, count=1):
+        """Make the next `count` triggers fail with the given gphoto2 error code"""
+        self._faults.extend([code] * count)
+
+    def trigger_capture(self):
+        if self._faults:
+            raise gp.GPhoto2Error(self._faults.popleft())
+        burst = 1
+        if self.burst_widget is not None:
+            burst = int(self._root.get_child_by_name(self.burst_widget).value)
+        with self._event_added:
+            for _ in range(burst):
+                self.captures += 1
+                stem = f"DSC_{self.captures:04d}"
+                self._exposed_at[stem] = self.camera_time() + self.trigger_latency
+                for suffix in self.suffixes:
+                    self._events.append(
+                        (
+                            gp.GP_EVENT_FILE_ADDED,
+                            SimpleNamespace(folder="/store_00010001/", name=f"{stem}{suffix}"),
+                        )
+                    )
+            self._events.append((gp.GP_EVENT_CAPTURE_COMPLETE, None))
+            self._event_added.notify_all()
+
+    def wait_for_event(self, timeout: int):
+        with self._event_added:
+            if not self._events:
+                self._event_added.wait(timeout / 1000)
+            if self._events:
+                return self._events.popleft()
+        return gp.GP_EVENT_TIMEOUT, None
+
+    def file_get(self, folder: str, name: str, type_):
+        stem = Path(name).stem
+        if self.exif and stem in self._exposed_at:
+            exposed_at = datetime.fromtimestamp(self._exposed_at[stem])
+            exif = Image.Exif()
+            exif.get_ifd(EXIF_IFD).update(
+                {
+                    DATE_TIME_ORIGINAL: exposed_at.strftime("%Y:%m:%d %H:%M:%S"),
+                    SUB_SEC_TIME_ORIGINAL: f"{exposed_at.microsecond // 1000:03d}",
+                }
+            )
+            output = io.BytesIO()
+            Image.new("RGB", (8, 8)).save(output, "JPEG", exif=exif)
+            return FakeCameraFile(output.getvalue(), mtime=int(exposed_at.timestamp()))
+        return FakeCameraFile(self._data, mtime=int(self.clock()))
+
+    def capture_preview(self):
+        self.previews += 1
+        if "viewfinder" in self._root._by_name:
+            # Grabbing a preview starts live view
+            self._root.get_child_by_name("viewfinder").value = 1
+        output = io.BytesIO()
+        Image.new("L", (640, 480), self.preview_level).save(output, "JPEG")
+        return FakeCameraFile(output.getvalue(), mtime=int(self.clock()))
+
+    def exit(self):
+        pass
+
+
+def fake_camera(profile: Path, **kwargs) -> Camera:
+    """A Camera for the given profile whose backend talks to a FakeCamera built from `kwargs`"""
+    config = parse_config(profile)
+    backend = Gphoto2Backend(
+        config_map=config.config_map,
+        target_shutter=config.target_shutter,
+        target_aperture=config.target_aperture,
+        target_iso=config.target_iso,
+        files_per_exposure=config.files_per_exposure,
+        camera=FakeCamera.from_config(
+            profile,
+            **{
+                "clock_widget": config.config_map["current_time"],
+                "burst_widget": config.config_map.get("burst_number"),
+                **kwargs,
+            },
+        ),
+    )
+    return Camera(backend=backend, config=config)
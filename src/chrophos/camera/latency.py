@@ -0,0 +1,228 @@
+import io
+import json
+import logging
+import statistics
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from PIL import Image
+
+from ..clock import SYSTEM_CLOCK, Clock
+from ..utilities.histogram import LatencyHistogram
+from .events import Exposure
+
+logger = logging.getLogger(__name__)
+
+LATENCY_LOG_NAME = "latency.jsonl"
+
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+SUB_SEC_TIME_ORIGINAL = 0x9291
+
+
+def exif_capture_time(data: Union[bytes, memoryview], suffix: str) -> Union[float, None]:
+    """The time (by the camera's clock, as a timestamp) at which a frame was exposed, from its
+    EXIF DateTimeOriginal and SubSecTimeOriginal; None if it doesn't have both
+
+    Works for JPEGs, and for those RAWs (e.g. NEF, CR2, DNG) that are TIFFs underneath.
+    """
+    try:
+        exif = Image.open(io.BytesIO(data)).getexif()
+    except Exception as error:
+        logger.debug(f"Can't read EXIF from a {suffix} file: {error}")
+        return None
+    tags = {**exif, **exif.get_ifd(EXIF_IFD)}
+    original, sub_sec = tags.get(DATE_TIME_ORIGINAL), tags.get(SUB_SEC_TIME_ORIGINAL)
+    if not original or not sub_sec:
+        return None
+    try:
+        whole = datetime.strptime(str(original).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        digits = str(sub_sec).strip("\x00 ")
+        # SubSecTime holds the digits after the decimal point
+        return whole.timestamp() + int(digits) / 10 ** len(digits)
+    except ValueError:
+        return None
+
+
+@dataclass
+class ClockSample:
+    """The camera's clock minus the host's (in seconds), as of host timestamp `host`"""
+
+    host: float
+    offset: float
+    # Half the width of the window the camera's second rolled over in
+    uncertainty: float
+
+
+class CameraClock:
+    """Track the camera's clock against the host's, to well under the second that it reports
+
+    The camera's clock can only be read to the second, so each measurement polls it until the
+    second rolls over: the rollover must have happened between the start of the last read of the
+    old second and the end of the first read of the new one. Offsets measured over the course of
+    a run are fitted with a line, weighted by their uncertainty, to account for drift.
+    """
+
+    def __init__(self, backend, key: str, clock: Clock = SYSTEM_CLOCK, max_samples=100):
+        self.backend = backend
+        self.key = key
+        self.clock = clock
+        self.samples: deque[ClockSample] = deque(maxlen=max_samples)
+        self._fit: tuple[float, float, float] = (0.0, 0.0, 0.0)
+
+    def _read(self):
+        return int(self.backend.get_single_config_value(self.key))
+
+    def measure(self, timeout=2.5) -> Union[ClockSample, None]:
+        deadline = self.clock.monotonic() + timeout
+        previous_start = self.clock.timestamp()
+        previous = self._read()
+        while self.clock.monotonic() < deadline:
+            start = self.clock.timestamp()
+            value = self._read()
+            end = self.clock.timestamp()
+            if value != previous:
+                rollover = (previous_start + end) / 2
+                sample = ClockSample(
+                    host=rollover, offset=value - rollover, uncertainty=(end - previous_start) / 2
+                )
+                self.samples.append(sample)
+                self._refit()
+                logger.debug(f"Camera clock sample: {sample}")
+                return sample
+            previous, previous_start = value, start
+        logger.warning(f"Camera's clock didn't tick within {timeout}s; can't measure its offset")
+        return None
+
+    def _refit(self):
+        hosts = np.array([sample.host for sample in self.samples])
+        offsets = np.array([sample.offset for sample in self.samples])
+        weights = 1 / np.maximum([sample.uncertainty for sample in self.samples], 1e-3)
+        reference = hosts[0]
+        if len(self.samples) < 2 or np.ptp(hosts) < 60:
+            # Too soon to tell drift from noise
+            self._fit = (reference, float(np.average(offsets, weights=weights**2)), 0.0)
+            return
+        drift, offset = np.polyfit(hosts - reference, offsets, 1, w=weights)
+        self._fit = (reference, float(offset), float(drift))
+
+    @property
+    def drift(self):
+        """Seconds gained by the camera per second of host time"""
+        return self._fit[2]
+
+    def offset_at(self, host: float):
+        reference, offset, drift = self._fit
+        return offset + drift * (host - reference)
+
+    def to_host(self, camera_time: float):
+        return camera_time - self.offset_at(camera_time)
+
+
+class TriggerCalibration:
+    """Measure trigger-to-exposure latency, so that triggers can be fired that much early
+
+    The latency of a frame is the time from the trigger to the start of its exposure: the latter
+    by the camera's clock, from the frame's EXIF (which needs sub-second capture times), brought
+    onto the host's clock with a `CameraClock`. The lead is the median latency of the last
+    `window` frames, and is only applied once `min_samples` frames have been measured. The camera
+    clock is re-measured every `resync_every`, when there's time between frames to do so.
+    """
+
+    def __init__(
+        self,
+        camera,
+        clock: Clock = SYSTEM_CLOCK,
+        window=25,
+        min_samples=3,
+        max_lead=timedelta(seconds=2),
+        resync_every=timedelta(minutes=10),
+        log_path: Union[Path, None] = None,
+    ):
+        self.camera = camera
+        self.clock = clock
+        self.window = window
+        self.min_samples = min_samples
+        self.max_lead = max_lead
+        self.resync_every = resync_every
+        self.log_path = log_path
+        self.camera_clock = CameraClock(
+            camera.backend, camera.config.config_map["current_time"], clock=clock
+        )
+        self.latency = LatencyHistogram("trigger latency")
+        self.error = LatencyHistogram("exposure error")
+        self.unmeasured = 0
+        self._recent: deque[float] = deque(maxlen=window)
+        self._last_sync: Union[float, None] = None
+
+    def start(self):
+        """Measure the camera's clock; call once it has been set"""
+        self.camera.backend.record_capture_times = True
+        self.camera.backend.wall_clock = self.clock.timestamp
+        self.resync()
+
+    def stop(self):
+        self.camera.backend.record_capture_times = False
+        logger.info(self.latency.summary())
+        logger.info(self.error.summary())
+        if self.unmeasured:
+            logger.warning(f"{self.unmeasured} frame(s) had no sub-second capture time")
+
+    def resync(self):
+        sample = self.camera_clock.measure()
+        self._last_sync = self.clock.monotonic()
+        if sample is not None:
+            logger.info(
+                f"Camera's clock is {self.camera_clock.offset_at(sample.host):+.3f}s"
+                f" (±{sample.uncertainty:.3f}s) ahead of the computer's;"
+                f" drift {self.camera_clock.drift * 86400:+.2f}s/day"
+            )
+
+    def between_frames(self, deadline: datetime, measure_time=timedelta(seconds=1.5)):
+        """Re-measure the camera's clock if it's due, and can be done before `deadline`"""
+        if self.clock.monotonic() - self._last_sync < self.resync_every.total_seconds():
+            return
+        if self.clock.now() + measure_time < deadline:
+            self.resync()
+
+    def lead(self) -> timedelta:
+        if len(self._recent) < self.min_samples:
+            return timedelta(0)
+        seconds = min(max(statistics.median(self._recent), 0.0), self.max_lead.total_seconds())
+        return timedelta(seconds=seconds)
+
+    def observe(self, frame: int, exposure: Exposure, commanded_capture_time: datetime):
+        """Record the latency of a frame's `exposure`; returns how far off the exposure started
+        from `commanded_capture_time`, in seconds (None if that can't be told)
+        """
+        if exposure.capture_time is None or exposure.trigger_time is None:
+            self.unmeasured += 1
+            return None
+        lead = self.lead()
+        started = self.camera_clock.to_host(exposure.capture_time)
+        latency = started - exposure.trigger_time
+        error = started - commanded_capture_time.timestamp()
+        self._recent.append(latency)
+        self.latency.record(max(latency, 0.0))
+        self.error.record(abs(error))
+        logger.debug(
+            f"Frame #{frame}: trigger latency {latency:.3f}s, exposure off by {error:+.3f}s"
+        )
+        if self.log_path is not None:
+            entry = {
+                "frame": frame,
+                "commanded_capture_time": commanded_capture_time.isoformat(),
+                "trigger_time": exposure.trigger_time,
+                "capture_time": exposure.capture_time,
+                "offset": self.camera_clock.offset_at(exposure.trigger_time),
+                "latency": latency,
+                "error": error,
+                "lead": lead.total_seconds(),
+            }
+            with open(self.log_path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+        return error
@@ -0,0 +1,153 @@
+import logging
+import statistics
+import threading
+from collections import deque
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Union
+
+from ..clock import SYSTEM_CLOCK, Clock
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LightMeterReading:
+    # When the latest sample was read (by `clock.timestamp()`)
+    time: float
+    # Smoothed, in the light meter's own units
+    value: float
+    # The latest sample, as read
+    raw: float
+    # 0 (nothing to go on) to 1 (a full window of samples that agree)
+    confidence: float
+    samples: int
+
+
+class LightMeterSampler:
+    """Poll the camera's light meter on a background thread, and smooth what it reads
+
+    Only the light meter's own widget is read, `rate` times a second, rather than the whole
+    config tree. Readings are smoothed with an exponential moving average (weighting each new
+    sample by `smoothing`). Their confidence grows with the number of samples since the last
+    `reset` (up to `window`), and shrinks with how much those samples disagree compared to
+    `tolerance`; it drops to 0 once no sample has been read for `stale_after` seconds.
+
+    Backends that only meter while the shutter is half-pressed (e.g. `Canon5DII`) are held
+    half-pressed for as long as the sampler runs.
+    """
+
+    def __init__(
+        self,
+        backend,
+        rate=5.0,
+        smoothing=0.3,
+        window=10,
+        tolerance=1.0,
+        stale_after=2.0,
+        half_press: Union[bool, None] = None,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        if backend.light_meter is None:
+            raise ValueError(f"{type(backend).__name__} has no light meter to sample")
+        self.backend = backend
+        self.field = backend.light_meter.field
+        self.rate = rate
+        self.smoothing = smoothing
+        self.window = window
+        self.tolerance = tolerance
+        self.stale_after = stale_after
+        if half_press is None:
+            half_press = hasattr(backend, "half_press_shutter_during")
+        self.half_press = half_press
+        self.clock = clock
+        self.errors = 0
+
+        self._recent: deque[float] = deque(maxlen=window)
+        self._smoothed: Union[float, None] = None
+        self._latest: Union[tuple[float, float], None] = None
+        self._updated = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="chrophos-lightmeter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        period = 1 / self.rate
+        metering = self.backend.half_press_shutter_during() if self.half_press else nullcontext()
+        with metering:
+            while not self._stop.is_set():
+                try:
+                    self.sample()
+                except Exception as error:
+                    self.errors += 1
+                    logger.debug(f"Failed to read the light meter: {error}")
+                self.clock.wait(self._stop, period)
+
+    def sample(self) -> float:
+        """Read the light meter once, and fold the reading in"""
+        value = float(self.backend.get_single_config_value(self.field))
+        now = self.clock.timestamp()
+        with self._updated:
+            self._recent.append(value)
+            if self._smoothed is None:
+                self._smoothed = value
+            else:
+                self._smoothed += self.smoothing * (value - self._smoothed)
+            self._latest = (now, value)
+            self._updated.notify_all()
+        # Keep the parameter current, for anything else that looks at it
+        self.backend.light_meter._value = value
+        return value
+
+    def reset(self):
+        """Forget every sample so far; call after changing the exposure, which they predate"""
+        with self._updated:
+            self._recent.clear()
+            self._smoothed = None
+            self._latest = None
+
+    def reading(self) -> Union[LightMeterReading, None]:
+        with self._updated:
+            return self._reading()
+
+    def _reading(self):
+        if self._latest is None:
+            return None
+        time, raw = self._latest
+        confidence = min(len(self._recent) / self.window, 1.0)
+        if len(self._recent) > 1:
+            confidence /= 1 + statistics.pstdev(self._recent) / self.tolerance
+        if self.clock.timestamp() - time > self.stale_after:
+            confidence = 0.0
+        return LightMeterReading(time, self._smoothed, raw, confidence, len(self._recent))
+
+    def wait_for(self, min_confidence=0.6, timeout=5.0) -> Union[LightMeterReading, None]:
+        """Wait for a reading with at least `min_confidence`; returns the latest reading (if any)
+        should that not come within `timeout` seconds
+        """
+        deadline = self.clock.monotonic() + timeout
+        with self._updated:
+            while True:
+                reading = self._reading()
+                remaining = deadline - self.clock.monotonic()
+                if (reading and reading.confidence >= min_confidence) or remaining <= 0:
+                    return reading
+                self._updated.wait(min(remaining, 1 / self.rate))
@@ -0,0 +1,263 @@
+import io
+import json
+import logging
+import math
+import statistics
+from collections import deque
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from PIL import Image
+
+from ..clock import SYSTEM_CLOCK, Clock
+
+logger = logging.getLogger(__name__)
+
+LIVEVIEW_LOG_NAME = "liveview.jsonl"
+
+# sRGB-encoded 8-bit value -> linear light, as a lookup table
+_SRGB = np.arange(256) / 255
+SRGB_TO_LINEAR = np.where(_SRGB <= 0.04045, _SRGB / 12.92, ((_SRGB + 0.055) / 1.055) ** 2.4)
+
+
+@dataclass
+class PreviewStats:
+    # Linear (not gamma-encoded) luminance, from 0 to 1
+    mean: float
+    p50: float
+    p95: float
+    # Fraction of pixels at or above `clip_level`
+    clipped: float
+    pixels: int
+
+
+def preview_stats(data: Union[bytes, memoryview], max_size=(320, 240), clip_level=250):
+    """Luminance statistics of a live view JPEG
+
+    The JPEG is decoded straight to greyscale at reduced size (letting the decoder skip most of
+    the work), and every statistic is read off its 256-bin histogram.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", max_size)
+    pixels = np.asarray(image.convert("L"))
+    histogram = np.bincount(pixels.ravel(), minlength=256)
+    total = int(histogram.sum())
+    cumulative = np.cumsum(histogram)
+    p50, p95 = np.searchsorted(cumulative, [0.5 * total, 0.95 * total])
+    return PreviewStats(
+        mean=float(histogram @ SRGB_TO_LINEAR / total),
+        p50=float(SRGB_TO_LINEAR[p50]),
+        p95=float(SRGB_TO_LINEAR[p95]),
+        clipped=float(histogram[clip_level:].sum() / total),
+        pixels=total,
+    )
+
+
+@dataclass
+class MeterDecision:
+    frame: int
+    time: datetime
+    seconds: float
+    stats: Union[PreviewStats, None]
+    # Stops of exposure to add (negative: take away)
+    correction: float
+    applied: float
+
+    def as_dict(self):
+        entry = {**asdict(self), "time": self.time.isoformat()}
+        entry["stats"] = asdict(self.stats) if self.stats else None
+        return entry
+
+
+class LiveViewMeter:
+    """Meter from live view previews grabbed in the dark part of each interval
+
+    At most once every `period`, a preview is grabbed before a frame, provided that it can be
+    (by the recent cost of grabbing one) with `guard` to spare before the frame is due. The
+    exposure is then corrected for the next frame by however many stops put the preview's mean
+    (linear) luminance at `target`, in thirds of a stop and at most `max_step` at a time;
+    corrections within `deadband` are ignored. While over `highlight_limit` of the preview is
+    clipped, the exposure is only ever reduced.
+
+    If there's no time for a preview `suspend_after` times in a row, metering is suspended for
+    `suspend_for`, rather than trying (and failing) to fit it in before every frame.
+
+    The shutter is never lengthened past the `interval` (as of the latest frame) less the
+    `dark_time` (by default, the camera's), so that frames keep fitting in their interval; past
+    that, the aperture and then the ISO are stepped instead, and the correction is capped once
+    those run out too.
+
+    This assumes that live view simulates the exposure settings (e.g. Nikon's "exposure
+    preview"), rather than brightening the preview on its own.
+    """
+
+    def __init__(
+        self,
+        camera,
+        period=timedelta(seconds=60),
+        target=0.18,
+        deadband=1 / 3,
+        max_step=1.0,
+        highlight_limit=0.02,
+        guard=timedelta(seconds=1),
+        initial_cost=timedelta(seconds=1),
+        suspend_after=3,
+        suspend_for=timedelta(minutes=10),
+        clock: Clock = SYSTEM_CLOCK,
+        log_path: Union[Path, None] = None,
+        interval: Union[timedelta, None] = None,
+        dark_time: Union[timedelta, None] = None,
+    ):
+        self.camera = camera
+        self.period = period
+        self.target = target
+        self.deadband = deadband
+        self.max_step = max_step
+        self.highlight_limit = highlight_limit
+        self.guard = guard
+        self.suspend_after = suspend_after
+        self.suspend_for = suspend_for
+        self.clock = clock
+        self.log_path = log_path
+        self.interval = interval
+        self.dark_time = camera.config.dark_time if dark_time is None else dark_time
+        self.counts = {
+            "metered": 0,
+            "adjusted": 0,
+            "capped": 0,
+            "no_time": 0,
+            "suspended": 0,
+            "failed": 0,
+        }
+        self._costs: deque[float] = deque([initial_cost.total_seconds()], maxlen=10)
+        self._last_metered: Union[float, None] = None
+        self._no_time_in_a_row = 0
+        self._suspended_until: Union[float, None] = None
+        viewfinder = camera.config.config_map.get("viewfinder")
+        self._viewfinder = viewfinder.key if hasattr(viewfinder, "key") else viewfinder
+
+    def cost(self) -> timedelta:
+        """How long grabbing and metering a preview is expected to take"""
+        return timedelta(seconds=statistics.median(self._costs))
+
+    def max_shutter(self) -> Union[float, None]:
+        """The longest shutter speed (in seconds) that still fits in the interval"""
+        if self.interval is None:
+            return None
+        return (self.interval - self.dark_time).total_seconds()
+
+    def correction(self, stats: PreviewStats) -> float:
+        """Stops of exposure to add for the next frame, going by a preview's `stats`"""
+        stops = math.log2(self.target / max(stats.mean, 1e-6))
+        if stats.clipped > self.highlight_limit:
+            stops = min(stops, -1 / 3)
+        if abs(stops) < self.deadband:
+            return 0.0
+        stops = max(-self.max_step, min(self.max_step, stops))
+        return round(stops * 3) / 3
+
+    def between_frames(
+        self, frame: int, deadline: datetime, interval: Union[timedelta, None] = None
+    ) -> Union[MeterDecision, None]:
+        """Meter (and correct the exposure) before `frame`, due at `deadline`, if it's time to and
+        there's time to; `interval` is the current interval, if it has changed
+        """
+        if interval is not None:
+            self.interval = interval
+        monotonic = self.clock.monotonic()
+        if self._suspended_until is not None:
+            if monotonic < self._suspended_until:
+                return None
+            self._suspended_until = None
+            logger.info("Resuming live view metering")
+        if self._last_metered is not None and (
+            monotonic - self._last_metered < self.period.total_seconds()
+        ):
+            return None
+        if self.clock.now() + self.cost() + self.guard > deadline:
+            self.counts["no_time"] += 1
+            self._no_time_in_a_row += 1
+            if self._no_time_in_a_row >= self.suspend_after:
+                self._no_time_in_a_row = 0
+                self.counts["suspended"] += 1
+                self._suspended_until = monotonic + self.suspend_for.total_seconds()
+                logger.warning(
+                    f"No time for live view metering (~{self.cost().total_seconds():.2f}s) before"
+                    f" {self.suspend_after} frames in a row; suspending it for {self.suspend_for}"
+                )
+            return None
+        self._no_time_in_a_row = 0
+        return self.meter(frame)
+
+    def meter(self, frame: int) -> Union[MeterDecision, None]:
+        start = self.clock.monotonic()
+        self._last_metered = start
+        try:
+            data = self.camera.backend.capture_preview()
+            stats = preview_stats(data)
+        except Exception as error:
+            self.counts["failed"] += 1
+            logger.warning(f"Failed to meter from live view: {error}")
+            return None
+        finally:
+            self._end_liveview()
+        self._costs.append(self.clock.monotonic() - start)
+        self.counts["metered"] += 1
+        correction = self.correction(stats)
+        applied = 0.0
+        if correction:
+            try:
+                applied = self.camera.step_exposure(
+                    correction, max_shutter=self.max_shutter(), partial=True
+                )
+            except ValueError as error:
+                logger.warning(f"Can't correct the exposure by {correction:+.2f} stops: {error}")
+            else:
+                if applied:
+                    self.counts["adjusted"] += 1
+                if abs(applied) < abs(correction) - 1e-6:
+                    self.counts["capped"] += 1
+                    limit = "the exposure is at its limits"
+                    if self.max_shutter() is not None:
+                        limit = (
+                            f"the shutter can't go past {self.max_shutter():.2f}s (the interval"
+                            " less the dark time), and the aperture and ISO are at their limits"
+                        )
+                    logger.warning(
+                        f"Capped the live view correction at {applied:+.2f} of"
+                        f" {correction:+.2f} stops: {limit}"
+                    )
+        decision = MeterDecision(
+            frame, self.clock.now(), self.clock.monotonic() - start, stats, correction, applied
+        )
+        logger.info(
+            f"Live view: mean {stats.mean:.3f}, p95 {stats.p95:.3f}, {stats.clipped:.1%} clipped;"
+            f" corrected exposure by {applied:+.2f} stops"
+        )
+        self._record(decision)
+        return decision
+
+    def _end_liveview(self):
+        # So that the next frame isn't shot out of live view, which changes its dark time
+        if self._viewfinder is None:
+            return
+        try:
+            self.camera.backend.set_config_value(self._viewfinder, 0)
+        except Exception as error:
+            logger.debug(f"Failed to turn off live view: {error}")
+
+    def _record(self, decision: MeterDecision):
+        if self.log_path is None:
+            return
+        with open(self.log_path, "a") as file:
+            file.write(json.dumps(decision.as_dict()) + "\n")
+
+    def close(self):
+        logger.info(
+            f"Live view metering: metered {self.counts['metered']:,} time(s), adjusted"
+            f" {self.counts['adjusted']:,}, capped {self.counts['capped']:,}; no time {self.counts['no_time']:,} time(s), suspended"
+            f" {self.counts['suspended']:,}, failed {self.counts['failed']:,}"
+        )
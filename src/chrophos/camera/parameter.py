@@ -37,9 +37,14 @@ class Parameter:
         self._value = value
         self.validate()
         if self.setter:
-            logger.warning(f"Calling setter function {self.setter.__name__}({self.field}, {value})")
+            # Runs on every change, so leave the formatting to the log listener
+            logger.debug(
+                "Calling setter function %s(%s, %s)", self.setter.__name__, self.field, value
+            )
             self.setter(params=[self])
-            logger.debug(f"Changed {self.name} ({self.field}) from {original_value} to {value}")
+            logger.debug(
+                "Changed %s (%s) from %s to %s", self.name, self.field, original_value, value
+            )
 
     @abstractmethod
     def parse(self, value: str):
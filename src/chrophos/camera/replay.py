@@ -0,0 +1,476 @@
+import base64
+import gzip
+import io
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Union
+
+import gphoto2 as gp
+from PIL import Image
+
+from .fake import FakeCameraFile, FakeWidget
+
+logger = logging.getLogger(__name__)
+
+TRACE_VERSION = 1
+
+
+class ReplayError(RuntimeError):
+    """The code being replayed asked for something that the trace has no record of"""
+
+
+def _open(path: Path, mode: str):
+    return gzip.open(path, mode + "t") if path.suffix == ".gz" else open(path, mode)
+
+
+def serialize_widget(widget) -> dict:
+    """A gphoto2 widget (and its children) as compact JSON; values and choices only where set"""
+    entry = {"n": widget.get_name()}
+    if widget.get_label():
+        entry["l"] = widget.get_label()
+    if widget.get_readonly():
+        entry["r"] = 1
+    try:
+        value = widget.get_value()
+    except gp.GPhoto2Error:
+        value = None
+    if value is not None:
+        entry["v"] = value
+    try:
+        entry["c"] = list(widget.get_choices())
+    except gp.GPhoto2Error:
+        pass
+    children = [serialize_widget(child) for child in widget.get_children()]
+    if children:
+        entry["k"] = children
+    return entry
+
+
+def deserialize_widget(entry: dict) -> FakeWidget:
+    return FakeWidget(
+        entry["n"],
+        label=entry.get("l", ""),
+        value=entry.get("v"),
+        choices=entry.get("c"),
+        read_only=bool(entry.get("r")),
+        children=[deserialize_widget(child) for child in entry.get("k", [])],
+    )
+
+
+def _values(entry: dict, values: Union[dict, None] = None) -> dict:
+    values = {} if values is None else values
+    values[entry["n"]] = entry.get("v")
+    for child in entry.get("k", []):
+        _values(child, values)
+    return values
+
+
+def _shape(entry: dict) -> list:
+    return [entry["n"], entry.get("c"), entry.get("r"), [_shape(c) for c in entry.get("k", [])]]
+
+
+def _apply(entry: dict, changes: dict):
+    if entry["n"] in changes:
+        entry["v"] = changes[entry["n"]]
+    for child in entry.get("k", []):
+        _apply(child, changes)
+
+
+class SessionRecorder:
+    """Write every call chrophos makes to a camera, with its result and timing, to a trace
+
+    The trace is JSON lines (gzipped if `path` ends in .gz). Config trees are written in full
+    only when their shape changes, and otherwise as the values that changed since the last one;
+    downloaded files are recorded by size, and only kept if `keep_payloads`; and each run of
+    consecutive event timeouts is one entry, with how many there were and their total time. See
+    `ReplayCamera`.
+    """
+
+    def __init__(self, path: Path, keep_payloads=False):
+        self.path = path
+        self.keep_payloads = keep_payloads
+        self.calls = 0
+        self._file = _open(path, "w")
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._tree: Union[dict, None] = None
+        self._timeouts: Union[dict, None] = None
+        self._write({"version": TRACE_VERSION, "keep_payloads": keep_payloads})
+
+    def wrap(self, camera) -> "RecordingCamera":
+        return RecordingCamera(camera, self)
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def _flush_timeouts(self):
+        if self._timeouts is not None:
+            self._timeouts["s"] = round(self._timeouts["s"], 6)
+            self._write(self._timeouts)
+            self._timeouts = None
+
+    def record(self, call: str, start: float, seconds: float, **fields):
+        with self._lock:
+            if self._file.closed:
+                return
+            self.calls += 1
+            if call == "wait_for_event" and fields.get("event") == gp.GP_EVENT_TIMEOUT:
+                # Idle polls are most of a session's calls: record each run of them as one entry
+                timeout = fields.get("timeout")
+                if self._timeouts is not None and self._timeouts["timeout"] != timeout:
+                    self._flush_timeouts()
+                if self._timeouts is None:
+                    self._timeouts = {
+                        "call": call,
+                        "t": round(start - self._start, 6),
+                        "s": 0.0,
+                        "timeouts": 0,
+                        "timeout": timeout,
+                    }
+                self._timeouts["s"] += seconds
+                self._timeouts["timeouts"] += 1
+                return
+            self._flush_timeouts()
+            self._write(
+                {"call": call, "t": round(start - self._start, 6), "s": round(seconds, 6), **fields}
+            )
+
+    def tree(self, entry: dict) -> dict:
+        """How to record a config tree: in full, or as the changes since the last"""
+        with self._lock:
+            previous, self._tree = self._tree, entry
+        if previous is None or _shape(previous) != _shape(entry):
+            return {"tree": entry}
+        old, new = _values(previous), _values(entry)
+        return {"changes": {name: value for name, value in new.items() if old[name] != value}}
+
+    def written(self, widget) -> dict:
+        """The values in a config tree handed to set_config that differ from the last one read"""
+        new = _values(serialize_widget(widget))
+        with self._lock:
+            old = _values(self._tree) if self._tree is not None else {}
+        return {name: value for name, value in new.items() if old.get(name) != value}
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._flush_timeouts()
+                self._file.close()
+                logger.info(f"Recorded {self.calls:,} camera call(s) to {self.path}")
+
+
+class RecordingCamera:
+    """Wraps a gphoto2 camera, recording each call to a `SessionRecorder`"""
+
+    def __init__(self, camera, recorder: SessionRecorder):
+        self.camera = camera
+        self.recorder = recorder
+
+    def _call(self, call: str, func, *args, describe=None, **fields):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except gp.GPhoto2Error as error:
+            self.recorder.record(
+                call, start, time.perf_counter() - start, error=error.code, **fields
+            )
+            raise
+        seconds = time.perf_counter() - start
+        if describe is not None:
+            fields.update(describe(result))
+        self.recorder.record(call, start, seconds, **fields)
+        return result
+
+    def get_config(self):
+        return self._call(
+            "get_config",
+            self.camera.get_config,
+            describe=lambda config: self.recorder.tree(serialize_widget(config)),
+        )
+
+    def set_config(self, config):
+        return self._call(
+            "set_config", self.camera.set_config, config, values=self.recorder.written(config)
+        )
+
+    def get_single_config(self, name: str):
+        return self._call(
+            "get_single_config",
+            self.camera.get_single_config,
+            name,
+            describe=lambda widget: {"widget": serialize_widget(widget)},
+            name=name,
+        )
+
+    def set_single_config(self, name: str, widget):
+        return self._call(
+            "set_single_config",
+            self.camera.set_single_config,
+            name,
+            widget,
+            name=name,
+            value=widget.get_value(),
+        )
+
+    def trigger_capture(self):
+        return self._call("trigger_capture", self.camera.trigger_capture)
+
+    def wait_for_event(self, timeout: int):
+        def describe(event):
+            event_type, data = event
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                return {"event": event_type, "folder": data.folder, "name": data.name}
+            if data is not None:
+                return {"event": event_type, "data": str(data)}
+            return {"event": event_type}
+
+        return self._call(
+            "wait_for_event",
+            self.camera.wait_for_event,
+            timeout,
+            describe=describe,
+            timeout=timeout,
+        )
+
+    def file_get(self, folder: str, name: str, type_):
+        def describe(camera_file):
+            data = memoryview(camera_file.get_data_and_size()).cast("B")
+            fields = {"size": data.nbytes, "mtime": camera_file.get_mtime()}
+            if self.recorder.keep_payloads:
+                fields["data"] = base64.b64encode(data).decode()
+            return fields
+
+        return self._call(
+            "file_get",
+            self.camera.file_get,
+            folder,
+            name,
+            type_,
+            describe=describe,
+            folder=folder,
+            name=name,
+        )
+
+    def capture_preview(self):
+        def describe(camera_file):
+            data = memoryview(camera_file.get_data_and_size()).cast("B")
+            fields = {"size": data.nbytes}
+            if self.recorder.keep_payloads:
+                fields["data"] = base64.b64encode(data).decode()
+            return fields
+
+        return self._call("capture_preview", self.camera.capture_preview, describe=describe)
+
+    def exit(self):
+        return self._call("exit", self.camera.exit)
+
+
+class ReplayCamera:
+    """Stand-in for gphoto2.Camera that plays back a trace written by `SessionRecorder`
+
+    Each kind of call is answered from the recorded calls of that kind, in order: config reads
+    return the recorded trees, downloads the recorded files (zero-filled, unless their payloads
+    were kept), and recorded errors are raised again. An event isn't delivered until as many
+    triggers have been fired as had been by when it was recorded, so that the code being
+    replayed can't see a frame before asking for it. With `speed`, each call also takes as long
+    as it did when recorded (divided by `speed`); otherwise replay is as fast as possible.
+
+    Calls that differ from the recording (e.g. a different value written) are counted in
+    `divergences`, rather than failing the replay.
+    """
+
+    def __init__(self, trace_path: Path, speed: Union[float, None] = None):
+        self.trace_path = trace_path
+        self.speed = speed
+        self.divergences = 0
+        self.calls: dict[str, deque] = defaultdict(deque)
+        self._files: dict[tuple[str, str], deque] = defaultdict(deque)
+        self._triggers = 0
+        self._lock = threading.Lock()
+        self._last_tree: Union[dict, None] = None
+        self._load()
+
+    def _load(self):
+        tree = None
+        triggers = 0
+        with _open(self.trace_path, "r") as file:
+            header = json.loads(file.readline())
+            if header.get("version") != TRACE_VERSION:
+                raise ReplayError(f"Unsupported trace version {header.get('version')}")
+            for line in file:
+                entry = json.loads(line)
+                call = entry["call"]
+                if call == "get_config" and "error" not in entry:
+                    # Rebuild each tree now, so that replaying one is just a copy
+                    if "tree" in entry:
+                        tree = entry.pop("tree")
+                    else:
+                        tree = json.loads(json.dumps(tree))
+                        _apply(tree, entry.pop("changes"))
+                    entry["config"] = tree
+                elif call == "trigger_capture":
+                    triggers += 1
+                elif call == "wait_for_event":
+                    entry["after_triggers"] = triggers
+                if call == "file_get":
+                    self._files[(entry["folder"], entry["name"])].append(entry)
+                else:
+                    self.calls[call].append(entry)
+        loaded = sum(entry.get("timeouts", 1) for calls in self.calls.values() for entry in calls)
+        logger.info(
+            f"Loaded {loaded + sum(map(len, self._files.values())):,} camera call(s) from"
+            f" {self.trace_path}"
+        )
+
+    def _next(self, call: str, calls: Union[deque, None] = None) -> dict:
+        calls = self.calls[call] if calls is None else calls
+        with self._lock:
+            if not calls:
+                raise ReplayError(f"The trace has no more {call} calls")
+            return calls.popleft()
+
+    def _take(self, entry: dict, seconds: Union[float, None] = None):
+        """Take as long as the recorded call did, and fail as it did"""
+        seconds = entry["s"] if seconds is None else seconds
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        if "error" in entry:
+            raise gp.GPhoto2Error(entry["error"])
+
+    def get_config(self):
+        try:
+            entry = self._next("get_config")
+        except ReplayError:
+            if self._last_tree is None:
+                raise
+            # Reads beyond the recording get the last state the camera was seen in
+            self.divergences += 1
+            return deserialize_widget(self._last_tree)
+        self._take(entry)
+        self._last_tree = entry["config"]
+        return deserialize_widget(entry["config"])
+
+    def set_config(self, config: FakeWidget):
+        entry = self._next("set_config")
+        read = _values(self._last_tree) if self._last_tree is not None else {}
+        written = {
+            name: value
+            for name, value in _values(serialize_widget(config)).items()
+            if read.get(name) != value
+        }
+        if written != entry.get("values", {}):
+            logger.debug(f"set_config diverged: wrote {written}, recorded {entry.get('values')}")
+            self.divergences += 1
+        self._take(entry)
+
+    def get_single_config(self, name: str):
+        entry = self._next("get_single_config")
+        if entry.get("name") != name:
+            self.divergences += 1
+        self._take(entry)
+        return deserialize_widget(entry["widget"])
+
+    def set_single_config(self, name: str, widget: FakeWidget):
+        entry = self._next("set_single_config")
+        if (entry.get("name"), entry.get("value")) != (name, widget.get_value()):
+            self.divergences += 1
+        self._take(entry)
+
+    def trigger_capture(self):
+        entry = self._next("trigger_capture")
+        self._take(entry)
+        with self._lock:
+            self._triggers += 1
+
+    def _next_event(self) -> Union[dict, None]:
+        """The next recorded event, if it could have happened yet; one at a time from a run of
+        timeouts"""
+        calls = self.calls["wait_for_event"]
+        with self._lock:
+            if not calls or calls[0]["after_triggers"] > self._triggers:
+                return None
+            entry = calls[0]
+            if "timeouts" not in entry:
+                return calls.popleft()
+            seconds = entry["s"] / entry["timeouts"]
+            entry["s"] -= seconds
+            entry["timeouts"] -= 1
+            if not entry["timeouts"]:
+                calls.popleft()
+            return {"event": gp.GP_EVENT_TIMEOUT, "s": seconds}
+
+    def wait_for_event(self, timeout: int):
+        entry = self._next_event()
+        if entry is None:
+            # Nothing that was recorded could have happened yet
+            if self.speed:
+                time.sleep(timeout / 1000 / self.speed)
+            return gp.GP_EVENT_TIMEOUT, None
+        self._take(entry, min(entry["s"], timeout / 1000))
+        if entry["event"] == gp.GP_EVENT_FILE_ADDED:
+            return entry["event"], SimpleNamespace(folder=entry["folder"], name=entry["name"])
+        return entry["event"], entry.get("data")
+
+    def file_get(self, folder: str, name: str, type_):
+        entry = self._next("file_get", self._files[(folder, name)])
+        self._take(entry)
+        if "data" in entry:
+            data = base64.b64decode(entry["data"])
+        else:
+            data = bytes(entry["size"])
+        return FakeCameraFile(data, mtime=entry["mtime"])
+
+    def capture_preview(self):
+        entry = self._next("capture_preview")
+        self._take(entry)
+        if "data" in entry:
+            data = base64.b64decode(entry["data"])
+        else:
+            # Not much use for metering, but a valid (mid-grey) preview
+            output = io.BytesIO()
+            Image.new("L", (640, 480), 118).save(output, "JPEG")
+            data = output.getvalue()
+        return FakeCameraFile(data, mtime=0)
+
+    def exit(self):
+        if self.calls["exit"]:
+            self._take(self._next("exit"))
+        if self.divergences:
+            logger.warning(f"Replay diverged from {self.trace_path} {self.divergences:,} time(s)")
+
+
+def summarize_trace(trace_path: Path) -> dict[str, dict]:
+    """Count, total and median time, errors and bytes downloaded, per kind of call"""
+    seconds: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    payload_bytes = 0
+    with _open(trace_path, "r") as file:
+        file.readline()
+        for line in file:
+            entry = json.loads(line)
+            if "timeouts" in entry:
+                seconds[entry["call"]].extend([entry["s"] / entry["timeouts"]] * entry["timeouts"])
+            else:
+                seconds[entry["call"]].append(entry["s"])
+            if "error" in entry:
+                errors[entry["call"]] += 1
+            payload_bytes += entry.get("size", 0)
+    summary = {
+        call: {
+            "n": len(samples),
+            "total": sum(samples),
+            "median": statistics.median(samples),
+            "max": max(samples),
+            "errors": errors[call],
+        }
+        for call, samples in seconds.items()
+    }
+    if "file_get" in summary:
+        summary["file_get"]["bytes"] = payload_bytes
+    return summary
@@ -0,0 +1,173 @@
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Union
+
+import gphoto2 as gp
+
+from ..clock import SYSTEM_CLOCK, Clock
+from .backend import Backend, BackendError
+
+logger = logging.getLogger(__name__)
+
+INCIDENT_LOG_NAME = "incidents.jsonl"
+
+
+class ErrorKind:
+    # Worth trying again as-is: the camera is busy, or a single capture failed
+    RETRY = "retry"
+    # The USB connection itself is broken; the camera has to be closed and opened again
+    RECONNECT = "reconnect"
+    # Trying again won't help (e.g. an invalid setting, or the card is full)
+    FATAL = "fatal"
+
+
+RETRY_ERRORS = {
+    gp.GP_ERROR,
+    gp.GP_ERROR_TIMEOUT,
+    gp.GP_ERROR_CAMERA_BUSY,
+    gp.GP_ERROR_CORRUPTED_DATA,
+}
+RECONNECT_ERRORS = {
+    gp.GP_ERROR_IO,
+    gp.GP_ERROR_IO_INIT,
+    gp.GP_ERROR_IO_READ,
+    gp.GP_ERROR_IO_WRITE,
+    gp.GP_ERROR_IO_UPDATE,
+    gp.GP_ERROR_IO_USB_CLEAR_HALT,
+    gp.GP_ERROR_IO_USB_FIND,
+    gp.GP_ERROR_IO_USB_CLAIM,
+    gp.GP_ERROR_IO_LOCK,
+    gp.GP_ERROR_UNKNOWN_PORT,
+    gp.GP_ERROR_MODEL_NOT_FOUND,
+    gp.GP_ERROR_CAMERA_ERROR,
+    gp.GP_ERROR_OS_FAILURE,
+}
+
+
+def classify(error: gp.GPhoto2Error):
+    """Decide how to recover from a gphoto2 error; see `ErrorKind`
+
+    For example, -53 (Could not claim the USB device) needs a reconnect, while a failed
+    release (a generic PTP I/O error, -1) is usually fine on the next attempt.
+    """
+    if error.code in RETRY_ERRORS:
+        return ErrorKind.RETRY
+    if error.code in RECONNECT_ERRORS:
+        return ErrorKind.RECONNECT
+    return ErrorKind.FATAL
+
+
+@dataclass
+class Incident:
+    """A gphoto2 failure, and what it took to recover from it"""
+
+    started_at: datetime
+    code: int
+    message: str
+    kind: str
+    attempts: int = 0
+    reconnects: int = 0
+    recovered: bool = False
+    ended_at: Union[datetime, None] = None
+
+    def as_dict(self):
+        return {
+            "started_at": self.started_at.isoformat(),
+            "ended_at": self.ended_at.isoformat() if self.ended_at else None,
+            "code": self.code,
+            "message": self.message,
+            "kind": self.kind,
+            "attempts": self.attempts,
+            "reconnects": self.reconnects,
+            "recovered": self.recovered,
+        }
+
+
+class CameraSupervisor:
+    """Run camera operations, recovering from gphoto2 errors in place
+
+    Retryable errors are retried as-is up to `retries_before_reconnect` times, after which (and
+    for USB errors straight away) the backend is reconnected; see `Gphoto2Backend.reconnect`.
+    Waits between attempts back off exponentially from `initial_backoff` to `max_backoff`. After
+    `max_attempts`, or on a fatal error, the error is raised as a BackendError.
+
+    Every incident is appended to `log_path`, if given.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        max_attempts=8,
+        retries_before_reconnect=2,
+        initial_backoff=timedelta(seconds=1),
+        max_backoff=timedelta(seconds=60),
+        log_path: Union[Path, None] = None,
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.retries_before_reconnect = retries_before_reconnect
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.log_path = log_path
+        self.clock = clock
+        self.incidents: list[Incident] = []
+
+    def backoff(self, attempt: int):
+        return min(self.initial_backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Call `func(*args, **kwargs)`, recovering from any gphoto2 errors it raises"""
+        incident = None
+        attempt = 0
+        while True:
+            try:
+                result = func(*args, **kwargs)
+            except gp.GPhoto2Error as error:
+                attempt += 1
+                kind = classify(error)
+                if incident is None:
+                    incident = Incident(
+                        started_at=self.clock.now(), code=error.code, message=str(error), kind=kind
+                    )
+                    self.incidents.append(incident)
+                incident.attempts = attempt
+                if kind == ErrorKind.FATAL or attempt >= self.max_attempts:
+                    self._end(incident)
+                    raise BackendError(
+                        f"Giving up on camera after {attempt} attempt(s): {error}"
+                    ) from error
+                backoff = self.backoff(attempt)
+                logger.warning(
+                    f"Camera error ({kind}) on attempt {attempt}/{self.max_attempts}: {error};"
+                    f" trying again in {backoff}"
+                )
+                self.clock.sleep(backoff.total_seconds())
+                if kind == ErrorKind.RECONNECT or attempt > self.retries_before_reconnect:
+                    self._reconnect(incident)
+            else:
+                if incident is not None:
+                    incident.recovered = True
+                    self._end(incident)
+                    logger.warning(
+                        f"Recovered from camera error after {incident.attempts} attempt(s) and"
+                        f" {incident.reconnects} reconnect(s)"
+                    )
+                return result
+
+    def _reconnect(self, incident: Incident):
+        incident.reconnects += 1
+        try:
+            self.backend.reconnect()
+        except gp.GPhoto2Error as error:
+            # Still unplugged, most likely; the next attempt will fail and reconnect again
+            logger.warning(f"Failed to reconnect to camera: {error}")
+
+    def _end(self, incident: Incident):
+        incident.ended_at = self.clock.now()
+        if self.log_path:
+            with open(self.log_path, "a") as file:
+                file.write(json.dumps(incident.as_dict()) + "\n")
@@ -1,10 +1,14 @@
 import argparse
+import io
 from datetime import datetime, timedelta
 from pathlib import Path
 
 import numpy as np
 from PIL import Image
 
+from chrophos.archive import ArchiveReader, is_archive
+from chrophos.layout import open_layout
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -15,10 +19,12 @@ def parse_args():
 
 def check_timestamps(path: Path, interval: int, threshold=0.1):
     creation_times = []
-    for image_path in path.iterdir():
-        create_date = Image.open(image_path).getxmp()["xmpmeta"]["RDF"]["Description"][0][
-            "CreateDate"
-        ]
+    if is_archive(path):
+        images = (io.BytesIO(data) for _entry, data in ArchiveReader(path).frames())
+    else:
+        images = open_layout(path).frame_paths()
+    for image in images:
+        create_date = Image.open(image).getxmp()["xmpmeta"]["RDF"]["Description"][0]["CreateDate"]
         creation_times.append(datetime.fromisoformat(create_date))
     actual_intervals = np.diff(creation_times)
     # print(actual_intervals)
@@ -1,18 +1,40 @@
+import json
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Annotated, Optional
+from typing import Annotated, Optional, Union
 
+import gphoto2 as gp
 import typer
 
+import chrophos.adaptive
+import chrophos.archive
 import chrophos.bench
+import chrophos.calibration
+import chrophos.control
+import chrophos.dedupe
+import chrophos.layout
+import chrophos.logs
+import chrophos.metering
+import chrophos.overview
+import chrophos.perf
+import chrophos.pipeline
 import chrophos.plan
+import chrophos.profiling
 import chrophos.query
+import chrophos.retime
 import chrophos.seq
 import chrophos.shell
+import chrophos.soak
+import chrophos.stack
+import chrophos.storage
 import chrophos.timelapse
 from chrophos.camera.backend import Canon5DII, Gphoto2Backend
 from chrophos.camera.camera import Camera
+from chrophos.camera.latency import LATENCY_LOG_NAME, TriggerCalibration
+from chrophos.camera.liveview import LIVEVIEW_LOG_NAME, LiveViewMeter
+from chrophos.camera.replay import ReplayCamera, SessionRecorder, summarize_trace
+from chrophos.camera.supervisor import INCIDENT_LOG_NAME, CameraSupervisor
 from chrophos.config import CameraConfig, parse_config
 
 app = typer.Typer()
@@ -21,8 +43,31 @@ logger = logging.getLogger(__name__)
 
 state = {"config": None, "dry_run": False}
 
+# Commands that don't talk to a camera, and so shouldn't require one to be plugged in
+OFFLINE_COMMANDS = {
+    "plan",
+    "recover",
+    "simulate",
+    "perf",
+    "perf-compare",
+    "bench-compare",
+    "bench-dark-time",
+    "trace-summary",
+    "soak",
+    "migrate-layout",
+    "frames",
+    "pack",
+    "overview",
+    "stack",
+    "meter",
+    "build-calibration",
+    "develop",
+    "retime",
+    "ctl",
+}
 
-def init_logging(verbosity: int):
+
+def init_logging(verbosity: int, log_path: Union[Path, None] = None):
     if verbosity == 0:
         log_level = logging.WARNING
     elif verbosity == 1:
@@ -32,15 +77,8 @@ def init_logging(verbosity: int):
     else:
         raise ValueError(f"Invalid verbosity level: {verbosity}")
 
-    module_logger = logging.getLogger("chrophos")
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(log_level)
-    formatter = logging.Formatter(
-        "[%(asctime)s - %(module)s.%(funcName)s - %(levelname)s] %(message)s"
-    )
-    console_handler.setFormatter(formatter)
-    module_logger.addHandler(console_handler)
-    module_logger.setLevel(log_level)
+    # Written from a background thread, so that a slow console or disk never holds up a capture
+    return chrophos.logs.LogPipeline(log_level, jsonl_path=log_path).start()
 
 
 @app.command()
@@ -54,6 +92,42 @@ def plan(
     )
 
 
+@app.command()
+def simulate(
+    interval: Annotated[float, typer.Option("-i", "--capture-interval")],
+    duration_days: Annotated[float, typer.Option("-d", "--days")] = 30,
+    dark_times_path: Annotated[Optional[Path], typer.Option("--dark-times")] = None,
+    file_size_mb: Annotated[Optional[float], typer.Option("--file-size-mb")] = None,
+    sizes_from: Annotated[Optional[Path], typer.Option("--sizes-from")] = None,
+    storage_gb: Annotated[Optional[float], typer.Option("--storage-gb")] = None,
+    write_mb_per_s: Annotated[Optional[float], typer.Option("--write-mbps")] = None,
+    transfer_mb_per_s: Annotated[Optional[float], typer.Option("--transfer-mbps")] = None,
+    trials: Annotated[Optional[int], typer.Option("-t", "--trials")] = None,
+):
+    config: CameraConfig = state["config"]
+    if config is None:
+        raise typer.BadParameter("--config is required for simulate", param_hint="--config")
+    if sizes_from:
+        file_sizes = chrophos.plan.file_sizes_from_dir(sizes_from)
+    elif file_size_mb:
+        file_sizes = [file_size_mb * 1e6]
+    else:
+        raise typer.BadParameter("One of --file-size-mb or --sizes-from is required")
+    interval_td = timedelta(seconds=interval)
+    estimate = chrophos.plan.simulate_session(
+        config=config,
+        interval=interval_td,
+        duration=timedelta(days=duration_days),
+        file_sizes=file_sizes,
+        dark_times=chrophos.plan.load_samples(dark_times_path) if dark_times_path else None,
+        storage_capacity=storage_gb * 1e9 if storage_gb else None,
+        write_bandwidth=write_mb_per_s * 1e6 if write_mb_per_s else None,
+        transfer_bandwidth=transfer_mb_per_s * 1e6 if transfer_mb_per_s else None,
+        trials=trials,
+    )
+    chrophos.plan.session_summary(estimate, interval_td)
+
+
 @app.command()
 def seq(action: str, output_dir: Path):
     config: CameraConfig = state["config"]
@@ -81,6 +155,11 @@ def bench(
     shutters: list[str],
     mode: Annotated[str, typer.Option("-m", "--mode")],
     output_dir: Annotated[Path, typer.Option("-o", "--output")] = Path("./raw_bench_images"),
+    samples_path: Annotated[Optional[Path], typer.Option("-s", "--samples-output")] = None,
+    results_dir: Annotated[
+        Path, typer.Option("-r", "--results-dir")
+    ] = chrophos.bench.DEFAULT_RESULTS_DIR,
+    no_results: Annotated[bool, typer.Option("--no-results")] = False,
 ):
     chrophos.bench.bench(
         trials=trials,
@@ -88,9 +167,120 @@ def bench(
         shutters=shutters,
         camera=state["camera"],
         output_dir=output_dir,
+        samples_path=samples_path,
+        results_dir=None if no_results else results_dir,
+    )
+
+
+@app.command("bench-compare")
+def bench_compare(
+    baseline: Annotated[list[Path], typer.Option("-b", "--baseline")],
+    current: Annotated[list[Path], typer.Option("-c", "--current")],
+    threshold: Annotated[float, typer.Option("-t", "--threshold")] = 0.1,
+    alpha: Annotated[float, typer.Option("-a", "--alpha")] = 0.05,
+):
+    """Compare benchmark records (or directories of them); exits 1 on any regression"""
+    baseline_records = chrophos.bench.load_records(baseline)
+    current_records = chrophos.bench.load_records(current)
+    if not baseline_records or not current_records:
+        print("Need at least one benchmark record on each side")
+        raise typer.Exit(code=1)
+    comparison = chrophos.bench.compare(
+        baseline_records, current_records, threshold=threshold, alpha=alpha
+    )
+    chrophos.bench.print_comparison(
+        comparison, chrophos.bench.environment_changes(baseline_records, current_records)
+    )
+    if any(result.regressed for result in comparison):
+        raise typer.Exit(code=1)
+
+
+@app.command("bench-dark-time")
+def bench_dark_time(
+    records: list[Path],
+    percentile: Annotated[float, typer.Option("-p", "--percentile")] = 99.0,
+    margin: Annotated[float, typer.Option("-m", "--margin")] = 0.1,
+    step: Annotated[float, typer.Option("--step")] = 0.5,
+    write_config: Annotated[Optional[Path], typer.Option("-w", "--write-config")] = None,
+):
+    """Derive the `dark_time` config value from benchmark records (or directories of them)"""
+    loaded = chrophos.bench.load_records(records)
+    try:
+        dark_time = chrophos.bench.recommend_dark_time(
+            loaded, percentile=percentile, margin=margin, step=step
+        )
+    except ValueError as error:
+        print(error)
+        raise typer.Exit(code=1) from None
+    print(f"dark_time = {dark_time:g}")
+    if write_config:
+        chrophos.bench.write_dark_time(write_config, dark_time, percentile, len(loaded))
+        print(f"Wrote dark_time to {write_config}")
+
+
+@app.command()
+def perf(
+    output: Annotated[Optional[Path], typer.Option("-o", "--output")] = None,
+    baseline: Annotated[Optional[Path], typer.Option("-b", "--baseline")] = None,
+    threshold: Annotated[float, typer.Option("-t", "--threshold")] = 0.25,
+    select: Annotated[Optional[str], typer.Option("-k", "--select")] = None,
+    profile: Annotated[Path, typer.Option("--profile")] = chrophos.perf.DEFAULT_PROFILE,
+    repeat: Annotated[int, typer.Option("-r", "--repeat")] = 7,
+):
+    results = chrophos.perf.run(profile=profile, repeat=repeat, select=select)
+    if output:
+        chrophos.perf.save_results(results, output)
+    if baseline:
+        _perf_compare(chrophos.perf.load_results(baseline), results, threshold)
+
+
+@app.command("perf-compare")
+def perf_compare(
+    baseline: Path,
+    current: Path,
+    threshold: Annotated[float, typer.Option("-t", "--threshold")] = 0.25,
+):
+    _perf_compare(
+        chrophos.perf.load_results(baseline), chrophos.perf.load_results(current), threshold
     )
 
 
+def _perf_compare(baseline: dict, current: dict, threshold: float):
+    comparison = chrophos.perf.compare(baseline, current, threshold=threshold)
+    chrophos.perf.print_comparison(comparison)
+    if any(regressed for *_, regressed in comparison):
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def soak(
+    interval: Annotated[float, typer.Option("-i", "--capture-interval")] = 20,
+    duration_days: Annotated[float, typer.Option("-d", "--days")] = 30,
+    num_frames: Annotated[Optional[int], typer.Option("-f", "--frames")] = None,
+    sample_every: Annotated[Optional[int], typer.Option("--sample-every")] = None,
+    suffixes: Annotated[list[str], typer.Option("--suffix")] = [".NEF"],  # noqa: B006
+    file_size: Annotated[int, typer.Option("--file-size")] = 64,
+    profile: Annotated[Path, typer.Option("--profile")] = chrophos.perf.DEFAULT_PROFILE,
+    output: Annotated[Optional[Path], typer.Option("-o", "--output")] = None,
+):
+    if num_frames is None:
+        num_frames = int(timedelta(days=duration_days) / timedelta(seconds=interval))
+    report = chrophos.soak.soak(
+        num_frames=num_frames,
+        interval=timedelta(seconds=interval),
+        profile=profile,
+        sample_every=sample_every,
+        file_size=file_size,
+        suffixes=tuple(suffixes),
+    )
+    chrophos.soak.summary(report)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report.as_dict(), file, indent=2)
+    if not report.passed:
+        raise typer.Exit(code=1)
+
+
 @app.command()
 def shell():
     chrophos.shell.shell(camera=state["camera"])
@@ -102,7 +292,129 @@ def timelapse(
     mode: Annotated[str, typer.Option("-m", "--mode")],
     num_frames: Optional[int] = None,
     output_dir: Annotated[Path, typer.Option("-o", "--output")] = Path("./raw_timelapse_images"),
+    overwrite: Annotated[bool, typer.Option("--overwrite")] = False,
+    commit_frames: Annotated[int, typer.Option("--commit-frames")] = 10,
+    commit_seconds: Annotated[float, typer.Option("--commit-seconds")] = 30,
+    bracket: Annotated[Optional[int], typer.Option("--bracket")] = None,
+    bracket_step: Annotated[Optional[str], typer.Option("--bracket-step")] = None,
+    profile_dir: Annotated[Optional[Path], typer.Option("--profile-dir")] = None,
+    profile_top_k: Annotated[int, typer.Option("--profile-top-k")] = 10,
+    profile_threshold: Annotated[Optional[float], typer.Option("--profile-threshold")] = None,
+    profile_memory: Annotated[bool, typer.Option("--profile-memory")] = False,
+    max_attempts: Annotated[int, typer.Option("--max-attempts")] = 8,
+    shard_frames: Annotated[Optional[int], typer.Option("--shard-frames")] = None,
+    shard_by_hour: Annotated[bool, typer.Option("--shard-by-hour")] = False,
+    archive_dir: Annotated[Optional[Path], typer.Option("--archive-dir")] = None,
+    archive_frames: Annotated[int, typer.Option("--archive-frames")] = 1000,
+    archive_gb: Annotated[float, typer.Option("--archive-gb")] = 4,
+    archive_mb_per_s: Annotated[Optional[float], typer.Option("--archive-mbps")] = None,
+    archive_remove: Annotated[bool, typer.Option("--archive-remove")] = False,
+    dedupe: Annotated[Optional[str], typer.Option("--dedupe")] = None,
+    dedupe_distance: Annotated[int, typer.Option("--dedupe-distance")] = 4,
+    dedupe_luminance: Annotated[float, typer.Option("--dedupe-luminance")] = 0.01,
+    dedupe_keep_every: Annotated[int, typer.Option("--dedupe-keep-every")] = 30,
+    overview_dir: Annotated[Optional[Path], typer.Option("--overview-dir")] = None,
+    control_socket: Annotated[Optional[Path], typer.Option("--control-socket")] = None,
+    calibrate_trigger: Annotated[bool, typer.Option("--calibrate-trigger")] = False,
+    pipeline: Annotated[bool, typer.Option("--pipeline")] = False,
+    analysis_workers: Annotated[int, typer.Option("--analysis-workers")] = 1,
+    pipeline_slots: Annotated[int, typer.Option("--pipeline-slots")] = 8,
+    slot_mb: Annotated[int, typer.Option("--slot-mb")] = 64,
+    adaptive_min: Annotated[Optional[float], typer.Option("--adaptive-min")] = None,
+    adaptive_max: Annotated[Optional[float], typer.Option("--adaptive-max")] = None,
+    adaptive_factor: Annotated[float, typer.Option("--adaptive-factor")] = 1.5,
+    adaptive_patience: Annotated[int, typer.Option("--adaptive-patience")] = 5,
+    liveview_meter: Annotated[bool, typer.Option("--liveview-meter")] = False,
+    liveview_period: Annotated[float, typer.Option("--liveview-period")] = 60,
+    liveview_target: Annotated[float, typer.Option("--liveview-target")] = 0.18,
 ):
+    if profile_dir:
+        profiler = chrophos.profiling.FrameProfiler(
+            profile_dir,
+            top_k=profile_top_k,
+            threshold=timedelta(seconds=profile_threshold) if profile_threshold else None,
+            trace_memory=profile_memory,
+        )
+    else:
+        profiler = None
+    if max_attempts:
+        supervisor = CameraSupervisor(
+            state["backend"],
+            max_attempts=max_attempts,
+            log_path=output_dir / INCIDENT_LOG_NAME,
+        )
+    else:
+        supervisor = None
+    if shard_frames or shard_by_hour:
+        layout = chrophos.layout.ShardedLayout(
+            output_dir, frames_per_shard=shard_frames, by_hour=shard_by_hour
+        )
+    else:
+        layout = None
+    if archive_dir:
+        packer = chrophos.archive.ArchivePacker(
+            archive_dir,
+            frames_per_chunk=archive_frames,
+            max_chunk_bytes=int(archive_gb * 2**30),
+            bandwidth=archive_mb_per_s * 2**20 if archive_mb_per_s else None,
+            remove_packed=archive_remove,
+        )
+    else:
+        packer = None
+    if dedupe:
+        # e.g. --dedupe thumbnail; see chrophos.dedupe.Action
+        duplicate_filter = chrophos.dedupe.DuplicateFilter(
+            action=dedupe,
+            max_distance=dedupe_distance,
+            max_luminance_delta=dedupe_luminance,
+            keep_every=dedupe_keep_every,
+            log_path=output_dir / chrophos.dedupe.DEDUPE_LOG_NAME,
+        )
+    else:
+        duplicate_filter = None
+    if overview_dir:
+        overview = chrophos.overview.LiveOverview(chrophos.overview.OverviewBuilder(overview_dir))
+    else:
+        overview = None
+    if control_socket:
+        control = chrophos.control.ControlServer(control_socket)
+    else:
+        control = None
+    if calibrate_trigger:
+        calibration = TriggerCalibration(state["camera"], log_path=output_dir / LATENCY_LOG_NAME)
+    else:
+        calibration = None
+    if pipeline:
+        frame_pipeline = chrophos.pipeline.FramePipeline(
+            analyzers=[chrophos.pipeline.thumbnail_stats] if analysis_workers else [],
+            analysis_workers=analysis_workers,
+            slots=pipeline_slots,
+            slot_bytes=slot_mb * 2**20,
+            results_path=output_dir / chrophos.pipeline.ANALYSIS_LOG_NAME,
+        )
+    else:
+        frame_pipeline = None
+    if adaptive_min or adaptive_max:
+        # Either bound defaults to the interval itself
+        adaptive = chrophos.adaptive.AdaptiveInterval(
+            min_interval=timedelta(seconds=adaptive_min or interval),
+            max_interval=timedelta(seconds=adaptive_max or interval),
+            factor=adaptive_factor,
+            patience=adaptive_patience,
+            log_path=output_dir / chrophos.adaptive.INTERVAL_LOG_NAME,
+        )
+    else:
+        adaptive = None
+    if liveview_meter:
+        liveview = LiveViewMeter(
+            state["camera"],
+            period=timedelta(seconds=liveview_period),
+            target=liveview_target,
+            log_path=output_dir / LIVEVIEW_LOG_NAME,
+            interval=timedelta(seconds=interval),
+        )
+    else:
+        liveview = None
     chrophos.timelapse.timelapse(
         camera=state["camera"],
         mode=mode,
@@ -110,26 +422,380 @@ def timelapse(
         interval=timedelta(seconds=interval),
         output_dir=output_dir,
         dry_run=state["dry_run"],
+        overwrite=overwrite,
+        commit_frames=commit_frames,
+        commit_interval=timedelta(seconds=commit_seconds),
+        bracket=bracket,
+        bracket_step=bracket_step,
+        profiler=profiler,
+        supervisor=supervisor,
+        layout=layout,
+        packer=packer,
+        dedupe=duplicate_filter,
+        overview=overview,
+        control=control,
+        calibration=calibration,
+        pipeline=frame_pipeline,
+        adaptive=adaptive,
+        liveview=liveview,
+    )
+
+
+@app.command()
+def recover(output_dir: Path):
+    last_consistent, quarantined = chrophos.storage.recover(output_dir)
+    print(f"Last consistent frame: {last_consistent}")
+    for path in quarantined:
+        print(f"  Quarantined incomplete frame {path}")
+
+
+@app.command("migrate-layout")
+def migrate_layout(
+    source: Path,
+    destination: Annotated[Optional[Path], typer.Option("-o", "--output")] = None,
+    shard_frames: Annotated[int, typer.Option("--shard-frames")] = 1000,
+    shard_by_hour: Annotated[bool, typer.Option("--shard-by-hour")] = False,
+    copy: Annotated[bool, typer.Option("--copy")] = False,
+):
+    layout = chrophos.layout.migrate(
+        source, destination, frames_per_shard=shard_frames, by_hour=shard_by_hour, copy=copy
+    )
+    print(f"Migrated {source} into {len(layout.shards())} shard(s) in {layout.root}")
+
+
+@app.command()
+def frames(
+    output_dir: Path,
+    first: Annotated[Optional[int], typer.Option("--first")] = None,
+    last: Annotated[Optional[int], typer.Option("--last")] = None,
+    since: Annotated[Optional[datetime], typer.Option("--since")] = None,
+    until: Annotated[Optional[datetime], typer.Option("--until")] = None,
+):
+    layout = chrophos.layout.open_layout(output_dir)
+    if not isinstance(layout, chrophos.layout.ShardedLayout):
+        raise typer.BadParameter(f"{output_dir} isn't sharded; see migrate-layout")
+    for record in layout.records(first_frame=first, last_frame=last, start=since, end=until):
+        for path in record.files:
+            print(f"{record.frame}\t{record.time.isoformat()}\t{path}")
+
+
+@app.command()
+def pack(
+    output_dir: Path,
+    archive_dir: Path,
+    archive_frames: Annotated[int, typer.Option("--archive-frames")] = 1000,
+    archive_gb: Annotated[float, typer.Option("--archive-gb")] = 4,
+    remove: Annotated[bool, typer.Option("--remove")] = False,
+):
+    count = chrophos.archive.pack_directory(
+        output_dir,
+        archive_dir,
+        frames_per_chunk=archive_frames,
+        max_chunk_bytes=int(archive_gb * 2**30),
+        remove_packed=remove,
+    )
+    print(f"Packed {count:,} frame(s) from {output_dir} into {archive_dir}")
+
+
+@app.command()
+def overview(
+    output_dir: Path,
+    overview_dir: Path,
+    keogram_height: Annotated[int, typer.Option("--keogram-height")] = 480,
+    keogram_columns: Annotated[int, typer.Option("--keogram-columns")] = 4320,
+    tile_width: Annotated[int, typer.Option("--tile-width")] = 192,
+    tile_height: Annotated[int, typer.Option("--tile-height")] = 128,
+    columns: Annotated[int, typer.Option("--columns")] = 12,
+    rows: Annotated[int, typer.Option("--rows")] = 9,
+):
+    builder = chrophos.overview.OverviewBuilder(
+        overview_dir,
+        keogram_height=keogram_height,
+        keogram_columns=keogram_columns,
+        tile_size=(tile_width, tile_height),
+        columns=columns,
+        rows=rows,
+    )
+    added = chrophos.overview.build_overview(output_dir, builder)
+    print(f"Added {added:,} frame(s) to the overview in {overview_dir} ({builder.frames:,} in all)")
+
+
+@app.command()
+def meter(
+    paths: list[Path],
+    stride: Annotated[int, typer.Option("--stride")] = 8,
+    target: Annotated[float, typer.Option("--target")] = 0.18,
+    horizon: Annotated[Optional[float], typer.Option("--horizon")] = None,
+):
+    """Meter raw frames from their raw plane; with --horizon, also the sky and foreground apart"""
+    regions = {}
+    if horizon is not None:
+        regions = {
+            "sky": chrophos.metering.sky_mask(horizon),
+            "foreground": chrophos.metering.foreground_mask(horizon),
+        }
+    raw_meter = chrophos.metering.RawMeter(stride=stride, target=target, regions=regions)
+    for path in paths:
+        reading = chrophos.metering.meter_file(path, raw_meter)
+        percentiles = ", ".join(f"p{q:g} {v:.3f}" for q, v in reading.percentiles.items())
+        print(
+            f"{path.name}: mean {reading.mean:.3f} ({percentiles}), {reading.clipped:.2%} clipped;"
+            f" {reading.compensation:+.2f} EV from target, correct by {reading.correction:+.2f}"
+            f" ({reading.seconds * 1e3:.0f}ms)"
+        )
+        for name, region in reading.regions.items():
+            print(f"  {name}: mean {region.mean:.3f}, {region.clipped:.2%} clipped")
+
+
+@app.command("build-calibration")
+def build_calibration(
+    calibration_dir: Path,
+    darks: Annotated[Optional[Path], typer.Option("--darks")] = None,
+    flats: Annotated[Optional[Path], typer.Option("--flats")] = None,
+    flat_darks: Annotated[Optional[Path], typer.Option("--flat-darks")] = None,
+    hot_pixels_from: Annotated[Optional[Path], typer.Option("--hot-pixels-from")] = None,
+    suffix: Annotated[Optional[str], typer.Option("--suffix")] = None,
+    combine: Annotated[str, typer.Option("--combine")] = chrophos.calibration.Combine.MEDIAN,
+    group: Annotated[int, typer.Option("--group")] = 5,
+    kappa: Annotated[float, typer.Option("--kappa")] = 5.0,
+    min_fraction: Annotated[float, typer.Option("--min-fraction")] = 0.5,
+    workers: Annotated[Optional[int], typer.Option("--workers")] = None,
+):
+    """Build a calibration from directories of dark and flat frames, finding hot pixels in the
+    frames of --hot-pixels-from (e.g. the sequence itself); give it to stack, retime or develop
+    as --calibration
+    """
+
+    def sources(root):
+        return None if root is None else chrophos.stack.frame_sources(root, suffix)
+
+    calibration = chrophos.calibration.build_calibration(
+        darks=sources(darks),
+        flats=sources(flats),
+        flat_darks=sources(flat_darks),
+        hot_pixel_frames=sources(hot_pixels_from),
+        combine=combine,
+        group=group,
+        kappa=kappa,
+        min_fraction=min_fraction,
+        workers=workers,
+    )
+    calibration.save(calibration_dir)
+    hot_pixels = 0 if calibration.hot_pixels is None else calibration.hot_pixels.shape[1]
+    parts = [name for name in ("dark", "flat") if getattr(calibration, name) is not None]
+    parts.append(f"{hot_pixels:,} hot pixel(s)")
+    print(f"Saved calibration ({', '.join(parts)}) to {calibration_dir}")
+
+
+def _calibration(calibration_dir: Optional[Path]):
+    if calibration_dir is None:
+        return None
+    return chrophos.calibration.Calibration.load(calibration_dir)
+
+
+@app.command()
+def develop(
+    output_dir: Path,
+    destination: Path,
+    calibration_dir: Annotated[Path, typer.Option("--calibration")],
+    suffix: Annotated[Optional[str], typer.Option("--suffix")] = None,
+    first: Annotated[Optional[int], typer.Option("--first")] = None,
+    last: Annotated[Optional[int], typer.Option("--last")] = None,
+    half_size: Annotated[bool, typer.Option("--half-size")] = False,
+    workers: Annotated[Optional[int], typer.Option("--workers")] = None,
+    batch: Annotated[int, typer.Option("--batch")] = 4,
+):
+    """Develop calibrated frames to 16-bit PPMs in DESTINATION"""
+    sources = chrophos.stack.frame_sources(output_dir, suffix, first_frame=first, last_frame=last)
+    developed = chrophos.calibration.develop(
+        sources,
+        destination,
+        _calibration(calibration_dir),
+        half_size=half_size,
+        workers=workers,
+        batch=batch,
+    )
+    print(f"Developed {developed:,}/{len(sources):,} frames to {destination}")
+
+
+@app.command()
+def stack(
+    output_dir: Path,
+    output_path: Path,
+    method: Annotated[str, typer.Option("--method")] = chrophos.stack.Method.MAX,
+    suffix: Annotated[Optional[str], typer.Option("--suffix")] = None,
+    first: Annotated[Optional[int], typer.Option("--first")] = None,
+    last: Annotated[Optional[int], typer.Option("--last")] = None,
+    workers: Annotated[Optional[int], typer.Option("--workers")] = None,
+    memory_gb: Annotated[float, typer.Option("--memory-gb")] = 2,
+    dtype: Annotated[str, typer.Option("--dtype")] = "uint16",
+    decay: Annotated[float, typer.Option("--decay")] = 0.97,
+    kappa: Annotated[float, typer.Option("--kappa")] = 3.0,
+    median_bins: Annotated[int, typer.Option("--median-bins")] = 64,
+    half_size: Annotated[bool, typer.Option("--half-size")] = False,
+    calibration_dir: Annotated[Optional[Path], typer.Option("--calibration")] = None,
+):
+    sources = chrophos.stack.frame_sources(output_dir, suffix, first_frame=first, last_frame=last)
+    chrophos.stack.stack(
+        sources,
+        output_path,
+        method=method,
+        workers=workers,
+        memory_limit=int(memory_gb * 2**30),
+        dtype=dtype,
+        decay=decay,
+        kappa=kappa,
+        median_bins=median_bins,
+        half_size=half_size,
+        calibration=_calibration(calibration_dir),
+    )
+
+
+@app.command()
+def retime(
+    output_dir: Path,
+    interval: Annotated[float, typer.Option("-i", "--interval")],
+    speedups: Annotated[list[float], typer.Option("--speedup")],
+    output: Annotated[str, typer.Option("-o", "--output")] = "timelapse_{speedup:g}x.mp4",
+    fps: Annotated[float, typer.Option("--fps")] = 30,
+    blend: Annotated[int, typer.Option("--blend")] = 1,
+    suffix: Annotated[Optional[str], typer.Option("--suffix")] = None,
+    width: Annotated[Optional[int], typer.Option("--width")] = None,
+    half_size: Annotated[bool, typer.Option("--half-size")] = False,
+    workers: Annotated[int, typer.Option("--workers")] = 4,
+    frame_times: Annotated[Optional[Path], typer.Option("--frame-times")] = None,
+    calibration_dir: Annotated[Optional[Path], typer.Option("--calibration")] = None,
+):
+    """Render the sequence at each --speedup; a --blend of 0 blends every frame spanned
+
+    An --output without a suffix (e.g. "frames_{speedup:g}x") is a directory of 16-bit PPMs.
+    For a sequence shot with an adaptive interval, give its intervals.jsonl as --frame-times;
+    it's then resampled to a fixed --interval first.
+    """
+    outputs = []
+    paths = []
+    for speedup in speedups:
+        variant = chrophos.retime.Variant(speedup, fps=fps, blend=blend or None)
+        path = Path(output.format(speedup=speedup))
+        if path.suffix:
+            sink = chrophos.retime.FfmpegSink(path, fps=fps, width=width)
+        else:
+            sink = chrophos.retime.FrameDirectorySink(path)
+        outputs.append((variant, sink))
+        paths.append(path)
+    sources = chrophos.stack.frame_sources(output_dir, suffix)
+    if frame_times:
+        sources = chrophos.adaptive.uniform_sources(
+            sources,
+            chrophos.adaptive.load_frame_times(frame_times),
+            timedelta(seconds=interval),
+        )
+    counts = chrophos.retime.retime(
+        sources,
+        timedelta(seconds=interval),
+        outputs,
+        half_size=half_size,
+        workers=workers,
+        calibration=_calibration(calibration_dir),
     )
+    for speedup, path, count in zip(speedups, paths, counts):
+        print(f"{speedup:g}x: {count:,} frames to {path}")
+
+
+@app.command()
+def ctl(
+    socket_path: Path,
+    method: str,
+    params: Annotated[Optional[list[str]], typer.Argument()] = None,
+):
+    """Send a command to a timelapse started with --control-socket, e.g. `set_exposure iso=800`
+
+    Values are parsed as JSON where possible, and otherwise passed as strings.
+    """
+    parsed = {}
+    for param in params or []:
+        key, sep, value = param.partition("=")
+        if not sep:
+            raise typer.BadParameter(f"Expected key=value, got {param!r}", param_hint="PARAMS")
+        try:
+            parsed[key] = json.loads(value)
+        except json.JSONDecodeError:
+            parsed[key] = value
+    try:
+        result = chrophos.control.request(socket_path, method, parsed)
+    except OSError as error:
+        print(f"Couldn't reach a timelapse on {socket_path}: {error}")
+        raise typer.Exit(1) from None
+    except chrophos.control.ControlError as error:
+        print(f"Error {error.code}: {error}")
+        raise typer.Exit(1) from None
+    print(json.dumps(result, indent=2))
+
+
+@app.command("trace-summary")
+def trace_summary(trace: Path):
+    """Time spent in each kind of camera call, in a trace from `--record-trace`"""
+    for call, stats in sorted(summarize_trace(trace).items()):
+        line = (
+            f"{call:18} {stats['n']:7,} call(s), {stats['total']:9.3f}s total,"
+            f" median {stats['median'] * 1e3:8.1f}ms, max {stats['max'] * 1e3:8.1f}ms"
+        )
+        if stats["errors"]:
+            line += f", {stats['errors']:,} error(s)"
+        if "bytes" in stats:
+            line += f", {stats['bytes'] / 2**20:,.1f} MiB"
+        print(line)
 
 
 @app.callback()
 def main(
-    config_path: Annotated[Path, typer.Option("--config", "-c")],
+    ctx: typer.Context,
+    config_path: Annotated[Optional[Path], typer.Option("--config", "-c")] = None,
     verbosity: Annotated[int, typer.Option("-v")] = 1,
     dry_run: Annotated[bool, typer.Option("-D", "--dry-run")] = False,
+    log_path: Annotated[Optional[Path], typer.Option("--log-file")] = None,
+    record_trace: Annotated[Optional[Path], typer.Option("--record-trace")] = None,
+    record_payloads: Annotated[bool, typer.Option("--record-payloads")] = False,
+    replay_trace: Annotated[Optional[Path], typer.Option("--replay-trace")] = None,
+    replay_speed: Annotated[float, typer.Option("--replay-speed")] = 0.0,
 ):
-    config = parse_config(config_path)
-    state["config"] = config
+    log_pipeline = init_logging(verbosity, log_path)
+    ctx.call_on_close(log_pipeline.stop)
+    if config_path is not None:
+        state["config"] = parse_config(config_path)
+    if ctx.invoked_subcommand in OFFLINE_COMMANDS:
+        return
+    if config_path is None:
+        raise typer.BadParameter(
+            f"--config is required for {ctx.invoked_subcommand}", param_hint="--config"
+        )
+    config = state["config"]
+    # `--record-trace` records every call made to the camera, and `--replay-trace` plays such a
+    # recording back in its place: at the recorded speed (scaled by `--replay-speed`), or as fast
+    # as possible if that's 0. See chrophos.camera.replay
+    camera = None
+    camera_factory = None
+    if replay_trace is not None:
+        camera = ReplayCamera(replay_trace, speed=replay_speed or None)
+    elif record_trace is not None:
+        recorder = SessionRecorder(record_trace, keep_payloads=record_payloads)
+        ctx.call_on_close(recorder.close)
+        camera = recorder.wrap(gp.Camera())
+
+        def camera_factory():
+            return recorder.wrap(gp.Camera())
+
     state["backend"] = Gphoto2Backend(
         config_map=config.config_map,
         target_aperture=config.target_aperture,
         target_iso=config.target_iso,
         target_shutter=config.target_shutter,
+        files_per_exposure=config.files_per_exposure,
+        camera=camera,
+        camera_factory=camera_factory,
     )
     state["camera"] = Camera(backend=state["backend"], config=state["config"])
     state["dry_run"] = dry_run
-    init_logging(verbosity)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Union
+
+
+class Clock:
+    """The real wall clock; the capture loop gets the time and sleeps only through a Clock"""
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def monotonic(self) -> float:
+        return time.perf_counter()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def timestamp(self) -> float:
+        return self.now().timestamp()
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        """Sleep until `event` is set, for at most `seconds`; returns whether it was set"""
+        return event.wait(max(seconds, 0))
+
+
+class AcceleratedClock(Clock):
+    """A clock on which work takes as long as it really does, but sleeping takes no time at all
+
+    Time passes at the real rate, plus however long everyone has asked to sleep. This lets a
+    capture loop run flat out, while anything it does between sleeps (including its own
+    overhead) still costs it "time", so missed frames are caught just as they would be for real.
+    """
+
+    def __init__(self, start: Union[datetime, None] = None):
+        self._real_start = time.perf_counter()
+        self._start = datetime.now() if start is None else start
+        self.skipped = 0.0
+
+    def monotonic(self) -> float:
+        return time.perf_counter() - self._real_start + self.skipped
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=self.monotonic())
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            self.skipped += seconds
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        # Anything that sets the event has to have done so already, as no real time passes
+        if event.is_set():
+            return True
+        self.sleep(seconds)
+        return event.is_set()
+
+
+SYSTEM_CLOCK = Clock()
@@ -38,6 +38,9 @@ class CameraConfig:
     iso_max: Iso
     config_map: dict[str, Union[str, Complex]]
     dark_time: timedelta
+    # e.g. 2 if the camera is set to RAW + JPEG; by default, an exposure's files are grouped by
+    # stem until the camera reports the capture complete
+    files_per_exposure: Union[int, None] = None
 
 
 def parse_config_raw(path: Path):
@@ -66,4 +69,5 @@ def parse_config(path: Path):
         iso_max=config["iso_max"],
         config_map={k: parse_param(v) for k, v in config["config_map"].items()},
         dark_time=timedelta(seconds=config["dark_time"]),
+        files_per_exposure=config.get("files_per_exposure"),
     )
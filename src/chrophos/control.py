@@ -0,0 +1,353 @@
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Callable, Union
+
+from chrophos.clock import SYSTEM_CLOCK, Clock
+from chrophos.utilities.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+COMMAND_FAILED = -32000
+# The command is still queued, and will run once the capture loop gets to it
+COMMAND_TIMEOUT = -32001
+
+
+class ControlError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class Command:
+    """A request that has to run on the capture loop's thread, between frames"""
+
+    def __init__(self, method: str, params: dict):
+        self.method = method
+        self.params = params
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Union[ControlError, None] = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.control.handle_line(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+                self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """JSON-RPC 2.0 server on a Unix domain socket, for inspecting and adjusting a running timelapse
+
+    Requests and responses are one JSON object per line. Queries (`status`, `metrics`) are
+    answered straight away from the socket's thread. Everything else is queued and run by the
+    capture loop itself in the gap between frames (see `between_frames`), so that it can never
+    hold up a trigger; the response is sent once it has run, or after `command_timeout` seconds
+    (it still runs later).
+    """
+
+    QUERIES = ("status", "metrics")
+    COMMANDS = ("pause", "resume", "set_exposure", "set_schedule", "stop")
+
+    def __init__(
+        self,
+        socket_path: Path,
+        command_timeout=60.0,
+        guard=timedelta(seconds=2),
+        clock: Clock = SYSTEM_CLOCK,
+    ):
+        self.socket_path = socket_path
+        self.command_timeout = command_timeout
+        # Commands aren't started any closer than this to a capture
+        self.guard = guard
+        self.clock = clock
+        self.paused = False
+        self.stop_requested = False
+        self.camera = None
+        self.schedule = None
+        self.dark_time: Union[timedelta, None] = None
+
+        self._commands: queue.Queue[Command] = queue.Queue()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._status: dict[str, Any] = {}
+        self._started_at = time.perf_counter()
+        self._capture_latency = LatencyHistogram("capture")
+        self._lag = LatencyHistogram("lag")
+        self._counts = {"frames": 0, "missed": 0, "paused_slots": 0, "commands": 0}
+        self._server: Union[_Server, None] = None
+        self._thread: Union[threading.Thread, None] = None
+
+    def attach(self, camera, schedule, dark_time: timedelta):
+        """Give the commands the run to act on"""
+        self.camera = camera
+        self.schedule = schedule
+        self.dark_time = dark_time
+
+    def start(self):
+        if self.socket_path.exists():
+            # Left behind by a run that didn't shut down cleanly, unless something is listening
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.socket_path))
+            except OSError:
+                self.socket_path.unlink()
+            else:
+                raise ValueError(f"Another run is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+        self._server = _Server(str(self.socket_path), _Handler)
+        self._server.control = self
+        os.chmod(self.socket_path, 0o600)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="chrophos-control", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Listening for control commands on {self.socket_path}")
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self.socket_path.unlink(missing_ok=True)
+        # Don't leave clients waiting on commands that will never run
+        while not self._commands.empty():
+            command = self._commands.get_nowait()
+            command.error = ControlError(COMMAND_FAILED, "The run ended before the command ran")
+            command.done.set()
+
+    def handle_line(self, line: bytes) -> Union[dict, None]:
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as error:
+            return _error_response(None, PARSE_ERROR, f"Invalid JSON: {error}")
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error_response(None, INVALID_REQUEST, "Expected a JSON-RPC request object")
+        request_id = request.get("id")
+        params = request.get("params") or {}
+        try:
+            if not isinstance(params, dict):
+                raise ControlError(INVALID_PARAMS, "Only named params are supported")
+            result = self.call(request["method"], params)
+        except ControlError as error:
+            response = _error_response(request_id, error.code, str(error))
+        else:
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        # Requests without an id are notifications, which get no response
+        return response if "id" in request else None
+
+    def call(self, method: str, params: dict):
+        if method in self.QUERIES:
+            # As for commands (see `run_pending`): anything raised here would otherwise take the
+            # connection's thread down, leaving the client without a response
+            try:
+                return getattr(self, f"_query_{method}")(**params)
+            except TypeError as error:
+                raise ControlError(INVALID_PARAMS, str(error)) from None
+            except Exception as error:
+                logger.exception(f"Control query {method} failed")
+                raise ControlError(COMMAND_FAILED, f"{type(error).__name__}: {error}") from None
+        if method not in self.COMMANDS:
+            raise ControlError(METHOD_NOT_FOUND, f"Unknown method {method!r}")
+        command = Command(method, params)
+        self._commands.put(command)
+        self._wake.set()
+        if not command.done.wait(self.command_timeout):
+            raise ControlError(
+                COMMAND_TIMEOUT,
+                f"{method} is queued, but the capture loop hasn't got to it yet",
+            )
+        if command.error:
+            raise command.error
+        return command.result
+
+    def run_pending(self):
+        """Run any queued commands; call only from the capture loop's thread"""
+        self._wake.clear()
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            handler: Callable = getattr(self, f"_command_{command.method}")
+            try:
+                command.result = handler(**command.params)
+            except ControlError as error:
+                command.error = error
+            except TypeError as error:
+                command.error = ControlError(INVALID_PARAMS, str(error))
+            except Exception as error:
+                logger.exception(f"Control command {command.method} failed")
+                command.error = ControlError(COMMAND_FAILED, f"{type(error).__name__}: {error}")
+            else:
+                logger.info(f"Ran control command {command.method}({command.params})")
+                with self._lock:
+                    self._counts["commands"] += 1
+            command.done.set()
+
+    def between_frames(self):
+        """Wait out the gap before the next frame, running commands as they arrive
+
+        Returns once the next frame is `guard` away, or straight away if a stop was requested.
+        While paused, this doesn't return at all until resumed (or stopped); slots that pass in
+        the meantime are skipped, without counting towards the number of frames.
+        """
+        while True:
+            self.run_pending()
+            if self.stop_requested:
+                return
+            if self.paused:
+                self.clock.wait(self._wake, 1.0)
+                continue
+            wait = (self.schedule.next_time - self.guard - self.clock.now()).total_seconds()
+            if wait <= 0:
+                return
+            self.clock.wait(self._wake, wait)
+
+    def frame_done(self, frame: int, commanded_capture_time, capture_seconds: float, lag: float):
+        with self._lock:
+            self._counts["frames"] += 1
+            self._capture_latency.record(capture_seconds)
+            self._lag.record(max(lag, 0.0))
+            self._status["last_frame"] = frame
+            self._status["last_commanded_capture_time"] = commanded_capture_time.isoformat()
+
+    def frame_missed(self, frame: int):
+        with self._lock:
+            self._counts["missed"] += 1
+            self._status["last_missed_frame"] = frame
+
+    def update(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def _query_status(self):
+        with self._lock:
+            status = dict(self._status)
+        status["paused"] = self.paused
+        if self.schedule is not None:
+            status["interval"] = self.schedule.interval.total_seconds()
+            status["next_capture_time"] = self.schedule.next_time.isoformat()
+            status["remaining_frames"] = self.schedule.remaining
+        if self.camera is not None:
+            status["exposure"] = {
+                "shutter": self.camera.shutter.value,
+                "aperture": self.camera.aperture.value,
+                "iso": self.camera.iso.value,
+            }
+        status["pending_commands"] = self._commands.qsize()
+        return status
+
+    def _query_metrics(self):
+        with self._lock:
+            return {
+                "uptime": time.perf_counter() - self._started_at,
+                **self._counts,
+                "capture": self._capture_latency.as_dict(),
+                "lag": self._lag.as_dict(),
+            }
+
+    def _command_pause(self):
+        self.paused = True
+        return {"paused": True}
+
+    def _command_resume(self):
+        if not self.paused:
+            return {"paused": False, "skipped_slots": 0}
+        self.paused = False
+        # Rejoin the schedule at the first slot that can still be made
+        skipped = self.schedule.skip_until(self.clock.now() + self.guard)
+        with self._lock:
+            self._counts["paused_slots"] += skipped
+        return {"paused": False, "skipped_slots": skipped}
+
+    def _command_stop(self):
+        self.stop_requested = True
+        return {"stopping": True}
+
+    def _command_set_exposure(self, shutter=None, aperture=None, iso=None):
+        """Change any of shutter, aperture and ISO, each given as one of the camera's choices"""
+        changes = {
+            name: str(value)
+            for name, value in (("shutter", shutter), ("aperture", aperture), ("iso", iso))
+            if value is not None
+        }
+        if not changes:
+            raise ControlError(INVALID_PARAMS, "Give at least one of shutter, aperture or iso")
+        for name, value in changes.items():
+            parameter = getattr(self.camera, name)
+            if value not in parameter.choices:
+                raise ControlError(
+                    INVALID_PARAMS, f"Invalid {name} {value!r}; choose from {parameter.choices}"
+                )
+        for name, value in changes.items():
+            # Pushed to the camera straight away, by the parameter's setter
+            setattr(self.camera, name, value)
+        return {name: getattr(self.camera, name).value for name in changes}
+
+    def _command_set_schedule(self, interval=None, num_frames=...):
+        """Change the interval (in seconds) and/or the total number of frames (null: no limit)"""
+        if interval is not None:
+            interval = timedelta(seconds=float(interval))
+            if self.dark_time is not None and interval < self.dark_time:
+                raise ControlError(
+                    INVALID_PARAMS,
+                    f"Interval of {interval} is shorter than the dark time of {self.dark_time}",
+                )
+            self.schedule.set_interval(interval, earliest=self.clock.now() + self.guard)
+        if num_frames is not ...:
+            if num_frames is not None and num_frames < self.schedule.frames:
+                raise ControlError(
+                    INVALID_PARAMS, f"{self.schedule.frames} frames have already been scheduled"
+                )
+            self.schedule.num_frames = num_frames
+        return {
+            "interval": self.schedule.interval.total_seconds(),
+            "num_frames": self.schedule.num_frames,
+            "next_capture_time": self.schedule.next_time.isoformat(),
+        }
+
+
+def _error_response(request_id, code: int, message: str):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+def request(socket_path: Path, method: str, params: Union[dict, None] = None, timeout=120.0):
+    """Send a single request to a running timelapse's `ControlServer`; returns its result"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        message = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as file:
+            line = file.readline()
+    if not line:
+        raise ControlError(COMMAND_FAILED, "The server closed the connection without responding")
+    response = json.loads(line)
+    if "error" in response:
+        raise ControlError(response["error"]["code"], response["error"]["message"])
+    return response["result"]
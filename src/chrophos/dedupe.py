@@ -0,0 +1,234 @@
+import io
+import json
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DEDUPE_LOG_NAME = "dedupe.jsonl"
+JPEG_SUFFIXES = {".JPG", ".JPEG"}
+# Thumbnails are decoded at (at least) this size; JPEG decoders can scale down by up to 8x for free
+DRAFT_SIZE = (160, 120)
+
+
+class Action:
+    KEEP = "keep"
+    # Store the frame's embedded thumbnail (as {stem}.THM) instead of the frame itself
+    THUMBNAIL = "thumbnail"
+    DROP = "drop"
+
+
+@dataclass
+class Signature:
+    """A 64-bit difference hash and the mean luminance (0 to 1) of a frame's thumbnail"""
+
+    dhash: int
+    mean: float
+
+    def distance(self, other: "Signature"):
+        return bin(self.dhash ^ other.dhash).count("1")
+
+
+@dataclass
+class Decision:
+    action: str
+    signature: Union[Signature, None]
+    thumbnail: Union[bytes, None] = None
+    distance: Union[int, None] = None
+    luminance_delta: Union[float, None] = None
+
+
+def _jpeg_end(data: bytes, start: int) -> Union[int, None]:
+    """The end of the JPEG whose SOI is at `start`, found by walking its segments
+
+    Segments are skipped by their lengths, so that the EOI of a JPEG nested in one (e.g. an EXIF
+    thumbnail in APP1) isn't taken for this one's. None if the data ends first; -1 if it turns out
+    not to be a JPEG at all.
+    """
+    position = start + 2
+    while position + 1 < len(data):
+        if data[position] != 0xFF:
+            return -1
+        marker = data[position + 1]
+        if marker == 0x00:
+            return -1
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+        elif marker == 0xD9:
+            return position + 2
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers, without a length
+            position += 2
+        elif position + 3 >= len(data):
+            return None
+        else:
+            position += 2 + int.from_bytes(data[position + 2 : position + 4], "big")
+            if marker == 0xDA:
+                # Entropy-coded data follows a SOS, up to the next marker other than a stuffed
+                # zero byte or a restart marker
+                while True:
+                    position = data.find(b"\xff", position)
+                    if position < 0 or position + 1 >= len(data):
+                        return None
+                    following = data[position + 1]
+                    if following != 0x00 and not 0xD0 <= following <= 0xD7:
+                        break
+                    position += 2
+    return None
+
+
+def find_embedded_jpeg(data: bytes) -> Union[bytes, None]:
+    """The first JPEG embedded in a RAW file (usually its thumbnail), found by its markers"""
+    data = bytes(data)
+    start = data.find(b"\xff\xd8\xff")
+    while start >= 0:
+        end = _jpeg_end(data, start)
+        if end is None:
+            return None
+        if end > 0:
+            return data[start:end]
+        start = data.find(b"\xff\xd8\xff", start + 1)
+    return None
+
+
+def extract_thumbnail(data: bytes, suffix: str) -> Union[bytes, None]:
+    """A JPEG preview of a frame: the frame itself for JPEGs, else the one embedded in the RAW"""
+    if suffix.upper() in JPEG_SUFFIXES:
+        return bytes(data)
+    try:
+        import rawpy
+    except ImportError:
+        return find_embedded_jpeg(data)
+    try:
+        with rawpy.imread(io.BytesIO(data)) as raw:
+            thumb = raw.extract_thumb()
+    except (rawpy.LibRawError, ValueError) as error:
+        logger.debug(f"LibRaw couldn't extract a thumbnail ({error}); searching for one instead")
+        return find_embedded_jpeg(data)
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        return bytes(thumb.data)
+    return find_embedded_jpeg(data)
+
+
+def exposure_thumbnail(files: list[tuple[str, bytes]]) -> Union[bytes, None]:
+    """A JPEG preview from any of the files (suffix, data) of a single exposure"""
+    # A camera JPEG is quicker to decode than a thumbnail is to dig out of a RAW
+    for suffix, data in sorted(files, key=lambda file: file[0].upper() not in JPEG_SUFFIXES):
+        thumbnail = extract_thumbnail(data, suffix)
+        if thumbnail is not None:
+            return thumbnail
+    return None
+
+
+def signature(jpeg: bytes) -> Signature:
+    image = Image.open(io.BytesIO(jpeg))
+    # Have the decoder downscale, rather than decoding the full image and then resizing it
+    image.draft("L", DRAFT_SIZE)
+    gray = image.convert("L")
+    mean = float(np.asarray(gray).mean()) / 255
+    pixels = np.asarray(gray.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    dhash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return Signature(dhash=dhash, mean=mean)
+
+
+class DuplicateFilter:
+    """Decide what to store of each frame, based on how much it differs from the last one kept
+
+    A frame is a near-duplicate if its thumbnail's hash is within `max_distance` bits of the last
+    kept frame's, and its mean luminance within `max_luminance_delta`. Near-duplicates are
+    handled according to `action` (see `Action`), except that every `keep_every`th one in a row
+    is kept regardless. Every decision is appended to `log_path`, if given.
+    """
+
+    def __init__(
+        self,
+        action=Action.THUMBNAIL,
+        max_distance=4,
+        max_luminance_delta=0.01,
+        keep_every: Union[int, None] = 30,
+        log_path: Union[Path, None] = None,
+    ):
+        if action not in (Action.KEEP, Action.THUMBNAIL, Action.DROP):
+            raise ValueError(f"Unknown near-duplicate action {action!r}")
+        self.action = action
+        self.max_distance = max_distance
+        self.max_luminance_delta = max_luminance_delta
+        self.keep_every = keep_every
+        self.log_path = log_path
+        self.reference: Union[Signature, None] = None
+        self.duplicates_in_a_row = 0
+        self.counts = {Action.KEEP: 0, Action.THUMBNAIL: 0, Action.DROP: 0}
+        self._log = None
+
+    def decide(self, stem: str, files: list[tuple[str, bytes]]) -> Decision:
+        """Decide what to do with the files (suffix, data) of a single exposure"""
+        start = time.perf_counter()
+        thumbnail = exposure_thumbnail(files)
+        if thumbnail is None:
+            logger.warning(f"No thumbnail found for {stem}; keeping it")
+            decision = Decision(Action.KEEP, signature=None)
+        else:
+            decision = self._decide(signature(thumbnail))
+            if decision.action == Action.THUMBNAIL:
+                decision.thumbnail = thumbnail
+        self.counts[decision.action] += 1
+        self._record(stem, decision, time.perf_counter() - start)
+        return decision
+
+    def _decide(self, current: Signature) -> Decision:
+        if self.reference is None:
+            self.reference = current
+            return Decision(Action.KEEP, signature=current)
+        distance = current.distance(self.reference)
+        luminance_delta = abs(current.mean - self.reference.mean)
+        duplicate = distance <= self.max_distance and luminance_delta <= self.max_luminance_delta
+        if duplicate:
+            self.duplicates_in_a_row += 1
+        if (
+            not duplicate
+            or self.action == Action.KEEP
+            or (self.keep_every and self.duplicates_in_a_row >= self.keep_every)
+        ):
+            action = Action.KEEP
+            self.reference = current
+            self.duplicates_in_a_row = 0
+        else:
+            action = self.action
+        return Decision(
+            action, signature=current, distance=distance, luminance_delta=luminance_delta
+        )
+
+    def _record(self, stem: str, decision: Decision, seconds: float):
+        if self.log_path is None:
+            return
+        if self._log is None:
+            self._log = open(self.log_path, "a")
+        record = {
+            "stem": stem,
+            "action": decision.action,
+            "distance": decision.distance,
+            "luminance_delta": decision.luminance_delta,
+            "dhash": f"{decision.signature.dhash:016x}" if decision.signature else None,
+            "mean": decision.signature.mean if decision.signature else None,
+            "seconds": seconds,
+        }
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+        logger.info(
+            f"Kept {self.counts[Action.KEEP]:,} frames; stored only the thumbnails of"
+            f" {self.counts[Action.THUMBNAIL]:,} and dropped {self.counts[Action.DROP]:,}"
+            " near-duplicates"
+        )
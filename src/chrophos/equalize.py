@@ -1,4 +1,4 @@
-import math
+import io
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -7,12 +7,10 @@ import rawpy
 from skimage.color import rgb2gray
 from skimage.util import img_as_float
 
+from chrophos.archive import ArchiveReader, is_archive
 from chrophos.exposure import equalize
-
-
-def get_exposure_compensation(mean_intensity: float, target_intensity=0.5):
-    steps_ev_compensation = math.log2(mean_intensity / target_intensity)
-    return steps_ev_compensation
+from chrophos.layout import open_layout
+from chrophos.metering import get_exposure_compensation  # noqa: F401
 
 
 def get_average_intensity(image):
@@ -38,13 +36,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("path", type=Path)
     args = parser.parse_args()
-    paths = sorted(args.path.glob("*.NEF"))[::2]
+    if is_archive(args.path):
+        # rawpy reads from file objects as well as paths
+        reader = ArchiveReader(args.path)
+        paths = [io.BytesIO(data) for _entry, data in reader.frames(".NEF")][::2]
+    else:
+        paths = open_layout(args.path).frame_paths(".NEF")[::2]
 
     fig: plt.Figure = plt.figure(figsize=(8, 8))
     axes = fig.subplots(len(paths), 4, sharey=False)
 
     for i, p in enumerate(paths):
-        raw: rawpy._rawpy.RawPy = rawpy.imread(str(p))
+        raw: rawpy._rawpy.RawPy = rawpy.imread(p if isinstance(p, io.BytesIO) else str(p))
         rgb: np.ndarray = raw.postprocess(use_camera_wb=True, half_size=True, no_auto_bright=True)
         r, g, b = rgb.T
         gray = rgb2gray(rgb)
@@ -38,10 +38,9 @@ def plot_img_and_hist(image, axes, bins=256):
 
 
 def auto_exposure2(raw, target_mean):
-    raw_data = raw.raw_image_visible.astype(np.float64)
-
-    # Calculate the mean brightness of the raw image
-    current_mean = np.mean(raw_data)
+    # Calculate the mean brightness of the raw image (accumulating in float64, rather than
+    # converting the whole image to it; see chrophos.metering for a cheaper estimate)
+    current_mean = np.mean(raw.raw_image_visible, dtype=np.float64)
 
     # Calculate the required exposure compensation factor
     exposure_compensation = np.log2(target_mean / current_mean)
@@ -1,11 +1,51 @@
+import io
 from pathlib import Path
 from typing import Union
 
 import numpy as np
 import rawpy
+from PIL import Image
+
+# Frames with any other suffix are decoded as RAWs
+RGB_SUFFIXES = {".JPG", ".JPEG", ".THM", ".PNG", ".TIF", ".TIFF"}
 
 
 def load_raw_file(path: Union[Path, str]):
     raw: rawpy._rawpy.RawPy = rawpy.imread(str(path))
     rgb: np.ndarray = raw.postprocess()
     return rgb
+
+
+def load_frame(
+    source: Union[Path, bytes], suffix: str, half_size=False, calibration=None
+) -> np.ndarray:
+    """Decode a frame (from its path or data) to a 16-bit RGB array
+
+    RAWs are developed with the camera's white balance and without auto-brightening, so that
+    frames of a sequence stay comparable with each other. A `calibration` (see
+    `chrophos.calibration`) corrects the raw plane as decoded, before it's developed.
+    """
+    if suffix.upper() in RGB_SUFFIXES:
+        if calibration is not None:
+            raise ValueError(f"Can only calibrate RAWs, not {suffix} frames")
+        image = Image.open(source if isinstance(source, Path) else io.BytesIO(source))
+        if half_size:
+            image.draft("RGB", (image.width // 2, image.height // 2))
+        rgb = np.asarray(image.convert("RGB"), dtype=np.uint16)
+        # Scale 0-255 to 0-65535
+        return rgb * 257
+    with rawpy.imread(str(source) if isinstance(source, Path) else io.BytesIO(source)) as raw:
+        if calibration is not None:
+            calibration.apply(raw)
+        return raw.postprocess(
+            output_bps=16, use_camera_wb=True, no_auto_bright=True, half_size=half_size
+        )
+
+
+def save_ppm(path: Path, rgb: np.ndarray):
+    """Save a 16-bit RGB array as a (binary, 16-bit) PPM, which PIL can't write"""
+    height, width = rgb.shape[:2]
+    with open(path, "wb") as file:
+        file.write(f"P6\n{width} {height}\n65535\n".encode())
+        # PPM samples are big-endian
+        file.write(rgb.astype(">u2").tobytes())
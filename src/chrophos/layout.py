@@ -0,0 +1,360 @@
+import json
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Union
+
+from chrophos.storage import INCOMPLETE_DIR_NAME, NON_FRAME_SUFFIXES, recover
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_NAME = "layout.json"
+SHARD_INDEX_NAME = "shards.jsonl"
+MANIFEST_NAME = "manifest.jsonl"
+FRAME_NAME_DIGITS = 8
+
+# TL{frame}, optionally with a bracket index (TL{frame}_b{k}), in either layout
+FRAME_NAME_PATTERN = re.compile(r"^TL(?P<frame>\d+)(?P<bracket>_b\d+)?(?P<suffix>\.[^.]+)$")
+
+
+def frame_number(path: Path):
+    match = FRAME_NAME_PATTERN.match(path.name)
+    return int(match["frame"]) if match else None
+
+
+def _has_suffix(path: Path, suffix: Union[str, None]):
+    if suffix is None:
+        return path.suffix.lower() not in NON_FRAME_SUFFIXES
+    return path.suffix.upper() == suffix.upper()
+
+
+def _natural_key(path: Path):
+    # DSC_10 after DSC_9
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path.name)]
+
+
+@dataclass
+class FrameRecord:
+    """A single frame, as listed in its shard's manifest"""
+
+    frame: int
+    time: datetime
+    files: list[Path] = field(default_factory=list)
+
+    def as_dict(self):
+        return {
+            "frame": self.frame,
+            "time": self.time.isoformat(),
+            "files": [path.name for path in self.files],
+        }
+
+
+class Layout:
+    """Every frame directly in `root`, named TL{i}: the original, flat layout"""
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def stem(self, frame: int):
+        return f"TL{frame}"
+
+    def frame_dir(self, frame: int, time: datetime):
+        return self.root
+
+    def record(self, frame: int, time: datetime, files: list[Path]):
+        """Note that `frame` has been written; only sharded layouts keep manifests"""
+        return None
+
+    def resume_dirs(self) -> list[Path]:
+        """The directories that may hold frames from an interrupted run"""
+        return [self.root]
+
+    def last_frame(self) -> Union[int, None]:
+        """The number of the last frame written, for runs that continue numbering on resume"""
+        return None
+
+    def frame_paths(self, suffix: Union[str, None] = None) -> list[Path]:
+        """The frames (with `suffix`, in any case) in frame order
+
+        A directory without any TL{i} frames (e.g. one of DSC_1234.NEF straight off a card) has
+        all of its files with `suffix` (or, without one, all but hidden and metadata files),
+        in natural order.
+        """
+        files = [
+            path
+            for path in self.root.iterdir()
+            if not path.name.startswith(".") and path.is_file() and _has_suffix(path, suffix)
+        ]
+        paths = [path for path in files if frame_number(path) is not None]
+        if not paths:
+            return sorted(files, key=_natural_key)
+        # TL10 sorts before TL9 lexically
+        return sorted(paths, key=lambda path: (frame_number(path), path.name))
+
+    def close(self):
+        return None
+
+
+class ShardedLayout(Layout):
+    """Frames spread over one subdirectory ("shard") per `frames_per_shard` frames, or per hour
+
+    Frames are named TL{i} with `i` zero-padded, so that they sort correctly. Each shard has a
+    manifest listing its frames and their commanded capture times, and `root` has an index of
+    the shards with the first frame and time of each. Resuming and range queries therefore only
+    read the index and the manifests of the shards they need, rather than listing every frame.
+    """
+
+    def __init__(self, root: Path, frames_per_shard: Union[int, None] = 1000, by_hour=False):
+        if not frames_per_shard and not by_hour:
+            raise ValueError("Shards need either a number of frames or to be by hour")
+        super().__init__(root)
+        self.frames_per_shard = None if by_hour else frames_per_shard
+        self.by_hour = by_hour
+        self._shard: Union[str, None] = None
+        self._manifest = None
+
+    @classmethod
+    def open(cls, root: Path):
+        with open(root / LAYOUT_NAME) as file:
+            spec = json.load(file)
+        return cls(root, frames_per_shard=spec["frames_per_shard"], by_hour=spec["by_hour"])
+
+    def spec(self):
+        return {
+            "type": "sharded",
+            "frames_per_shard": self.frames_per_shard,
+            "by_hour": self.by_hour,
+            "digits": FRAME_NAME_DIGITS,
+        }
+
+    def save(self):
+        """Write the layout's spec, or check that it matches the one already written
+
+        A resumed run must shard its frames as the original did, or they would be put in
+        different shards (and so be numbered and found differently).
+        """
+        path = self.root / LAYOUT_NAME
+        if path.exists():
+            with open(path) as file:
+                existing = json.load(file)
+            if existing != self.spec():
+                raise ValueError(
+                    f"{self.root} is sharded as {existing}, not as requested ({self.spec()})"
+                )
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(self.spec(), file, indent=2)
+
+    def stem(self, frame: int):
+        return f"TL{frame:0{FRAME_NAME_DIGITS}d}"
+
+    def shard_name(self, frame: int, time: datetime):
+        if self.by_hour:
+            return time.strftime("%Y%m%d_%H")
+        return f"{(frame - 1) // self.frames_per_shard:06d}"
+
+    def frame_dir(self, frame: int, time: datetime):
+        return self.root / self.shard_name(frame, time)
+
+    def record(self, frame: int, time: datetime, files: list[Path]):
+        shard = self.shard_name(frame, time)
+        if shard != self._shard:
+            self._open_shard(shard, frame, time)
+        self._manifest.write(json.dumps(FrameRecord(frame, time, files).as_dict()) + "\n")
+        self._manifest.flush()
+
+    def _open_shard(self, shard: str, frame: int, time: datetime):
+        if self._manifest:
+            self._manifest.close()
+        manifest_path = self.root / shard / MANIFEST_NAME
+        # A shard seen before (i.e. when resuming) is already in the index
+        if not manifest_path.exists():
+            with open(self.root / SHARD_INDEX_NAME, "a") as file:
+                record = {"shard": shard, "first_frame": frame, "first_time": time.isoformat()}
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        self._manifest = open(manifest_path, "a")
+        self._shard = shard
+
+    def shards(self) -> list[dict]:
+        """The shard index: name, first frame and first time of each shard, in order"""
+        return list(_read_jsonl(self.root / SHARD_INDEX_NAME))
+
+    def resume_dirs(self):
+        shards = self.shards()
+        return [self.root / shards[-1]["shard"]] if shards else []
+
+    def last_frame(self):
+        shards = self.shards()
+        if not shards:
+            return None
+        shard_dir = self.root / shards[-1]["shard"]
+        # The manifest isn't synced with the frames, so trust whichever has got further
+        frames = [record["frame"] for record in _read_jsonl(shard_dir / MANIFEST_NAME)]
+        frames.extend(
+            number for number in map(frame_number, shard_dir.iterdir()) if number is not None
+        )
+        return max(frames, default=shards[-1]["first_frame"] - 1)
+
+    def records(
+        self,
+        first_frame: Union[int, None] = None,
+        last_frame: Union[int, None] = None,
+        start: Union[datetime, None] = None,
+        end: Union[datetime, None] = None,
+    ) -> Iterator[FrameRecord]:
+        """The frames within the given (inclusive) frame number and time ranges, in order"""
+        shards = self.shards()
+        for i, shard in enumerate(shards):
+            following = shards[i + 1] if i + 1 < len(shards) else None
+            # Skip shards that lie entirely outside of the requested ranges
+            if last_frame is not None and shard["first_frame"] > last_frame:
+                break
+            if end is not None and datetime.fromisoformat(shard["first_time"]) > end:
+                break
+            if following is not None:
+                if first_frame is not None and following["first_frame"] <= first_frame:
+                    continue
+                if start is not None and datetime.fromisoformat(following["first_time"]) <= start:
+                    continue
+            shard_dir = self.root / shard["shard"]
+            for record in _read_jsonl(shard_dir / MANIFEST_NAME):
+                frame_record = FrameRecord(
+                    frame=record["frame"],
+                    time=datetime.fromisoformat(record["time"]),
+                    files=[shard_dir / name for name in record["files"]],
+                )
+                if first_frame is not None and frame_record.frame < first_frame:
+                    continue
+                if last_frame is not None and frame_record.frame > last_frame:
+                    continue
+                if start is not None and frame_record.time < start:
+                    continue
+                if end is not None and frame_record.time > end:
+                    continue
+                yield frame_record
+
+    def frame_paths(self, suffix: Union[str, None] = None):
+        paths = []
+        for shard in self.shards():
+            paths.extend(Layout(self.root / shard["shard"]).frame_paths(suffix))
+        return paths
+
+    def close(self):
+        if self._manifest:
+            self._manifest.close()
+            self._manifest = None
+            self._shard = None
+
+
+def _read_jsonl(path: Path):
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line is expected after a power loss
+                    logger.debug(f"Ignoring partial record {line!r} in {path}")
+                    return
+    except FileNotFoundError:
+        return
+
+
+def open_layout(root: Path) -> Layout:
+    """The layout of an existing output directory"""
+    if (root / LAYOUT_NAME).exists():
+        return ShardedLayout.open(root)
+    return Layout(root)
+
+
+def migrate(
+    source: Path,
+    destination: Union[Path, None] = None,
+    frames_per_shard: Union[int, None] = 1000,
+    by_hour=False,
+    copy=False,
+):
+    """Move (or copy) the frames of a flat output directory into a sharded layout
+
+    `destination` defaults to `source` itself. Frame times are taken from the files' modification
+    times. Any interrupted run in `source` is recovered first. Returns the new layout.
+
+    An interrupted migration can be run again (with the same sharding): frames already in the
+    destination's manifests are skipped, and any moved into a shard but not yet recorded are
+    recorded.
+    """
+    destination = source if destination is None else destination
+    if (source / LAYOUT_NAME).exists():
+        raise ValueError(f"{source} is already sharded")
+    if (destination / LAYOUT_NAME).exists():
+        raise ValueError(f"Destination {destination} is already sharded")
+    resuming = (destination / SHARD_INDEX_NAME).exists()
+    if destination != source and not resuming and any(destination.glob("*")):
+        raise ValueError(f"Destination {destination} already exists and is non-empty!")
+    recover(source)
+    layout = ShardedLayout(destination, frames_per_shard=frames_per_shard, by_hour=by_hour)
+    migrated = {record.frame for record in layout.records()} if resuming else set()
+    frames: dict[int, list[Path]] = {}
+    for path in Layout(source).frame_paths():
+        number = frame_number(path)
+        if number is not None and number not in migrated:
+            frames.setdefault(number, []).append(path)
+    # Moved into a shard, but interrupted before being recorded in its manifest
+    moved: dict[int, list[Path]] = {}
+    if resuming:
+        for shard_dir in destination.iterdir():
+            if not shard_dir.is_dir() or shard_dir.name == INCOMPLETE_DIR_NAME:
+                continue
+            for path in Layout(shard_dir).frame_paths():
+                number = frame_number(path)
+                if number is not None and number not in migrated:
+                    moved.setdefault(number, []).append(path)
+        logger.info(
+            f"Resuming migration into {destination}: {len(migrated):,} frames already migrated"
+        )
+    logger.info(f"Migrating {len(frames):,} frames from {source} to {destination}")
+    transfer = shutil.copy2 if copy else os.replace
+    shard_dirs = set()
+    try:
+        for number in sorted(frames.keys() | moved.keys()):
+            paths = frames.get(number, [])
+            new_paths = list(moved.get(number, []))
+            time = datetime.fromtimestamp((paths or new_paths)[0].stat().st_mtime)
+            shard_dir = layout.frame_dir(number, time)
+            if shard_dir not in shard_dirs:
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                shard_dirs.add(shard_dir)
+            for path in paths:
+                match = FRAME_NAME_PATTERN.match(path.name)
+                new_path = shard_dir / (
+                    f"{layout.stem(number)}{match['bracket'] or ''}{match['suffix']}"
+                )
+                transfer(path, new_path)
+                if new_path not in new_paths:
+                    new_paths.append(new_path)
+            layout.record(number, time, new_paths)
+    finally:
+        layout.close()
+    for shard_dir in shard_dirs:
+        _fsync_dir(shard_dir)
+    _fsync_dir(source)
+    # Written last: until it exists, the migration is unfinished, and can be run again
+    layout.save()
+    if (source / INCOMPLETE_DIR_NAME).exists():
+        logger.warning(f"Incomplete frames were left in {source / INCOMPLETE_DIR_NAME}")
+    return layout
+
+
+def _fsync_dir(path: Path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
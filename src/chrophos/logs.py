@@ -0,0 +1,214 @@
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Union
+
+CONSOLE_FORMAT = "[%(asctime)s - %(module)s.%(funcName)s - %(levelname)s] %(message)s"
+
+# What the current thread is working on; attached to every record it logs
+_frame: ContextVar[Union[int, None]] = ContextVar("frame", default=None)
+_stage: ContextVar[Union[str, None]] = ContextVar("stage", default=None)
+
+
+@contextmanager
+def log_context(frame: Union[int, None] = None, stage: Union[str, None] = None):
+    """Attach `frame` and/or `stage` to every record logged (by this thread) within the block"""
+    tokens = []
+    if frame is not None:
+        tokens.append((_frame, _frame.set(frame)))
+    if stage is not None:
+        tokens.append((_stage, _stage.set(stage)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the frame and stage of the thread that logged them"""
+
+    def filter(self, record: logging.LogRecord):
+        record.frame = _frame.get()
+        record.stage = _stage.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most `rate` records a second (with bursts of up to `burst`) from each call
+    site, plus 1 in every `sample` of the rest; records at `exempt_level` and above always pass
+
+    A call site is identified by its logger and line rather than its message, which is usually
+    an f-string. Whenever a record gets through, it's tagged with how many from its call site
+    were suppressed since the last one.
+    """
+
+    def __init__(self, rate=5.0, burst=20, sample=100, exempt_level=logging.ERROR):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.exempt_level = exempt_level
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        # (logger, line) -> [tokens, last refill, suppressed since the last record let through]
+        self._sites: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno >= self.exempt_level:
+            return True
+        with self._lock:
+            return self._admit(record)
+
+    def _admit(self, record: logging.LogRecord):
+        now = time.monotonic()
+        site = self._sites.get((record.name, record.lineno))
+        if site is None:
+            site = self._sites[(record.name, record.lineno)] = [float(self.burst), now, 0]
+        site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+        site[1] = now
+        if site[0] >= 1:
+            site[0] -= 1
+        elif not self.sample or (site[2] + 1) % self.sample:
+            site[2] += 1
+            self.suppressed += 1
+            return False
+        if site[2]:
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to a bounded queue without ever blocking; records that don't fit are dropped
+    and counted
+
+    Unlike `QueueHandler`, records are queued as they are, leaving all formatting (including of
+    any %-style args) to the listener's thread.
+    """
+
+    def __init__(self, maxsize=10_000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "frame": getattr(record, "frame", None),
+            "stage": getattr(record, "stage", None),
+            "thread": record.threadName,
+        }
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord):
+        message = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            message += f" (+{suppressed:,} similar suppressed)"
+        return message
+
+
+class LogPipeline:
+    """Logging for the "chrophos" logger that never holds up the thread doing the logging
+
+    Records are stamped with their frame and stage (see `log_context`), rate-limited per call
+    site, and handed to a bounded queue; a background listener writes them to the console and,
+    if `jsonl_path` is given, as JSON lines to that file.
+    """
+
+    def __init__(
+        self,
+        level=logging.INFO,
+        jsonl_path: Union[Path, None] = None,
+        console=True,
+        queue_size=10_000,
+        rate_limit: Union[RateLimitFilter, None] = None,
+    ):
+        self.level = level
+        self.handler = BoundedQueueHandler(queue_size)
+        self.handler.addFilter(ContextFilter())
+        self.rate_limit = RateLimitFilter() if rate_limit is None else rate_limit
+        self.handler.addFilter(self.rate_limit)
+        handlers = []
+        if console:
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(_ConsoleFormatter(CONSOLE_FORMAT))
+            handlers.append(console_handler)
+        if jsonl_path is not None:
+            jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+            file_handler = logging.FileHandler(jsonl_path)
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers)
+        self._logger = logging.getLogger("chrophos")
+
+    def start(self):
+        self._logger.addHandler(self.handler)
+        self._logger.setLevel(self.level)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        """Flush everything still queued, and report anything that was dropped"""
+        self._logger.removeHandler(self.handler)
+        # The listener is told to stop through the queue, so that has to have room
+        while self.handler.queue.full():
+            time.sleep(0.01)
+        self.listener.stop()
+        stats = self.stats()
+        dropped = sum(stats["dropped"].values())
+        if dropped or stats["suppressed"]:
+            # Straight to the listener's handlers, which are now idle
+            record = self._logger.makeRecord(
+                self._logger.name,
+                logging.WARNING,
+                __file__,
+                0,
+                f"Dropped {dropped:,} log record(s) with the queue full {stats['dropped']}, and"
+                f" rate-limited {stats['suppressed']:,}",
+                None,
+                None,
+            )
+            for handler in self.listener.handlers:
+                handler.handle(record)
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def stats(self):
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": dict(self.handler.dropped),
+            "suppressed": self.rate_limit.suppressed,
+        }
@@ -0,0 +1,368 @@
+import io
+import json
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Callable, Iterator, Union
+
+import numpy as np
+from PIL import Image
+
+from chrophos.archive import ArchiveReader, is_archive
+from chrophos.dedupe import JPEG_SUFFIXES, extract_thumbnail, find_embedded_jpeg
+from chrophos.layout import frame_number, open_layout
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "overview.json"
+# Of a frame's files, the first of these is used; any other file is a RAW
+PREVIEW_SUFFIXES = (".THM", ".JPG", ".JPEG")
+# RAW thumbnails are nearly always near the start of the file; look there before reading it all
+THUMBNAIL_SEARCH_BYTES = 4 * 2**20
+
+
+class Canvas:
+    """An RGB image backed by a memory-mapped file, so that only the pages being touched are
+    held in memory however large it is
+    """
+
+    def __init__(self, path: Path, width: int, height: int):
+        self.path = path
+        self.width = width
+        self.height = height
+        mode = "r+" if path.exists() else "w+"
+        self.pixels = np.memmap(path, dtype=np.uint8, mode=mode, shape=(height, width, 3))
+
+    def paste(self, x: int, y: int, image: Image.Image):
+        self.pixels[y : y + image.height, x : x + image.width] = np.asarray(image)
+
+    def flush(self):
+        self.pixels.flush()
+
+    def save(self, path: Path, width: Union[int, None] = None, height: Union[int, None] = None):
+        """Write the canvas (or just its top-left `width` x `height`) to an image file"""
+        pixels = self.pixels[: height or self.height, : width or self.width]
+        tmp_path = path.with_name(f".{path.name}")
+        Image.fromarray(np.ascontiguousarray(pixels)).save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+
+    def close(self, remove=False):
+        self.pixels.flush()
+        del self.pixels
+        if remove:
+            self.path.unlink()
+
+
+def load_preview(
+    source: Union[Path, bytes], suffix: str, size: tuple[int, int]
+) -> Union[Image.Image, None]:
+    """The cheapest decode of a frame that is at least `size`: a JPEG decoded at reduced scale,
+    else the RAW's embedded thumbnail, else the RAW demosaiced at half size (needs rawpy)
+    """
+    suffix = suffix.upper()
+    if suffix in PREVIEW_SUFFIXES:
+        jpeg = source.read_bytes() if isinstance(source, Path) else source
+    elif isinstance(source, Path):
+        with open(source, "rb") as file:
+            jpeg = find_embedded_jpeg(file.read(THUMBNAIL_SEARCH_BYTES))
+        if jpeg is None:
+            jpeg = extract_thumbnail(source.read_bytes(), suffix)
+    else:
+        jpeg = extract_thumbnail(source, suffix)
+    if jpeg is not None:
+        try:
+            image = Image.open(io.BytesIO(jpeg))
+            # Have the decoder downscale (by up to 8x), rather than decoding at full size
+            image.draft("RGB", size)
+            return image.convert("RGB")
+        except OSError as error:
+            logger.debug(f"Couldn't decode thumbnail ({error}); decoding the RAW instead")
+    if suffix in JPEG_SUFFIXES:
+        return None
+    try:
+        import rawpy
+    except ImportError:
+        logger.warning("No thumbnail found, and rawpy isn't installed to decode the RAW")
+        return None
+    data = source.read_bytes() if isinstance(source, Path) else source
+    with rawpy.imread(io.BytesIO(data)) as raw:
+        return Image.fromarray(raw.postprocess(half_size=True, use_camera_wb=True))
+
+
+def _pick_preview_file(names: list[str]) -> str:
+    for suffix in PREVIEW_SUFFIXES:
+        for name in names:
+            if name.upper().endswith(suffix):
+                return name
+    return names[0]
+
+
+def iter_frames(
+    root: Path, after: Union[int, None] = None
+) -> Iterator[tuple[int, str, Union[Path, bytes]]]:
+    """(frame number, file name, path or data) of a single file per frame, in frame order,
+    starting after frame `after` if given
+
+    `root` is an output directory (of any layout) or an archive directory. Of each frame's
+    files, the quickest to decode is chosen (see `PREVIEW_SUFFIXES`). Files that aren't named
+    by frame (e.g. DSC_1234.NEF) are numbered from 1 by stem, in the order they're listed.
+    """
+    if is_archive(root):
+        reader = ArchiveReader(root)
+        frames: dict[int, dict] = {}
+        for entry in reader.entries:
+            if entry.frame is not None and (after is None or entry.frame > after):
+                frames.setdefault(entry.frame, {})[entry.name] = entry
+        for number in sorted(frames):
+            name = _pick_preview_file(list(frames[number]))
+            yield number, name, reader.read(frames[number][name])
+        return
+    paths: dict[int, dict] = {}
+    stems: dict[str, int] = {}
+    for path in open_layout(root).frame_paths():
+        number = frame_number(path)
+        if number is None:
+            number = stems.setdefault(path.stem, len(stems) + 1)
+        if after is None or number > after:
+            paths.setdefault(number, {})[path.name] = path
+    for number in sorted(paths):
+        name = _pick_preview_file(list(paths[number]))
+        yield number, name, paths[number][name]
+
+
+class OverviewBuilder:
+    """Build a keogram and contact sheets of a timelapse, one frame at a time
+
+    Each frame contributes one column to the keogram (its centre column, `keogram_height`
+    pixels tall) and one `tile_size` tile to a contact sheet of `columns` x `rows` tiles. Both
+    are paged: a new keogram page is started every `keogram_columns` frames, and a new contact
+    sheet once the last is full. Pages are built in memory-mapped canvases and written out as
+    PNGs once full (and by `render`), so memory use doesn't depend on the number of frames.
+
+    Progress is checkpointed to `overview.json` every `checkpoint_every` frames and whenever a
+    page is finished; a later run with the same output directory skips the frames already done.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        keogram_height=480,
+        keogram_columns=4320,
+        tile_size=(192, 128),
+        columns=12,
+        rows=9,
+        checkpoint_every=100,
+    ):
+        self.output_dir = output_dir
+        self.keogram_height = keogram_height
+        self.keogram_columns = keogram_columns
+        self.tile_size = tuple(tile_size)
+        self.columns = columns
+        self.rows = rows
+        self.checkpoint_every = checkpoint_every
+        self.frames = 0
+        self.last_frame: Union[int, None] = None
+        self.skipped = 0
+        self._keogram: Union[Canvas, None] = None
+        self._sheet: Union[Canvas, None] = None
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint_path = self.output_dir / CHECKPOINT_NAME
+        if checkpoint_path.exists():
+            with open(checkpoint_path) as file:
+                checkpoint = json.load(file)
+            if checkpoint["settings"] != self.settings:
+                raise ValueError(
+                    f"{output_dir} was built with different settings: {checkpoint['settings']}"
+                )
+            self.frames = checkpoint["frames"]
+            self.last_frame = checkpoint["last_frame"]
+            logger.info(f"Resuming overview after frame {self.last_frame} ({self.frames:,} done)")
+
+    @property
+    def settings(self):
+        return {
+            "keogram_height": self.keogram_height,
+            "keogram_columns": self.keogram_columns,
+            "tile_size": list(self.tile_size),
+            "columns": self.columns,
+            "rows": self.rows,
+        }
+
+    @property
+    def tiles_per_sheet(self):
+        return self.columns * self.rows
+
+    def _keogram_canvas(self, page: int):
+        if self._keogram is None or self._keogram.path.name != f".keogram_{page:04d}.rgb":
+            if self._keogram is not None:
+                self._keogram.close()
+            self._keogram = Canvas(
+                self.output_dir / f".keogram_{page:04d}.rgb",
+                width=self.keogram_columns,
+                height=self.keogram_height,
+            )
+        return self._keogram
+
+    def _sheet_canvas(self, page: int):
+        if self._sheet is None or self._sheet.path.name != f".contact_{page:04d}.rgb":
+            if self._sheet is not None:
+                self._sheet.close()
+            tile_width, tile_height = self.tile_size
+            self._sheet = Canvas(
+                self.output_dir / f".contact_{page:04d}.rgb",
+                width=tile_width * self.columns,
+                height=tile_height * self.rows,
+            )
+        return self._sheet
+
+    def add(self, frame: int, name: str, source: Union[Path, bytes]):
+        """Add a single frame, from its path or data; frames already done are skipped"""
+        if self.last_frame is not None and frame <= self.last_frame:
+            return False
+        preview = load_preview(source, Path(name).suffix, self.tile_size)
+        if preview is None:
+            logger.warning(f"Couldn't decode a preview of {name}; leaving it out of the overview")
+            self.skipped += 1
+            return False
+
+        keogram_page, column = divmod(self.frames, self.keogram_columns)
+        centre = preview.width // 2
+        strip = preview.resize(
+            (1, self.keogram_height), Image.BILINEAR, box=(centre, 0, centre + 1, preview.height)
+        )
+        self._keogram_canvas(keogram_page).paste(column, 0, strip)
+
+        sheet_page, slot = divmod(self.frames, self.tiles_per_sheet)
+        row, tile_column = divmod(slot, self.columns)
+        tile_width, tile_height = self.tile_size
+        tile = preview.resize(self.tile_size, Image.BILINEAR)
+        self._sheet_canvas(sheet_page).paste(tile_column * tile_width, row * tile_height, tile)
+
+        self.frames += 1
+        self.last_frame = frame
+        keogram_full = column == self.keogram_columns - 1
+        sheet_full = slot == self.tiles_per_sheet - 1
+        if keogram_full:
+            self._keogram.save(self.output_dir / f"keogram_{keogram_page:04d}.png")
+        if sheet_full:
+            self._sheet.save(self.output_dir / f"contact_{sheet_page:04d}.png")
+        if keogram_full or sheet_full or self.frames % self.checkpoint_every == 0:
+            self.checkpoint()
+        # Only once the checkpoint says the page is done can its canvas go
+        if keogram_full:
+            self._keogram.close(remove=True)
+            self._keogram = None
+        if sheet_full:
+            self._sheet.close(remove=True)
+            self._sheet = None
+        return True
+
+    def checkpoint(self):
+        for canvas in (self._keogram, self._sheet):
+            if canvas is not None:
+                canvas.flush()
+        checkpoint = {
+            "frames": self.frames,
+            "last_frame": self.last_frame,
+            "settings": self.settings,
+        }
+        tmp_path = self.output_dir / f".{CHECKPOINT_NAME}"
+        with open(tmp_path, "w") as file:
+            json.dump(checkpoint, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.output_dir / CHECKPOINT_NAME)
+
+    def render(self):
+        """Write out the pages in progress (cropped to the frames so far) and checkpoint"""
+        if self.frames % self.keogram_columns:
+            page, width = divmod(self.frames, self.keogram_columns)
+            self._keogram_canvas(page).save(
+                self.output_dir / f"keogram_{page:04d}.png", width=width
+            )
+        if self.frames % self.tiles_per_sheet:
+            page, slot = divmod(self.frames, self.tiles_per_sheet)
+            rows = -(-slot // self.columns)
+            self._sheet_canvas(page).save(
+                self.output_dir / f"contact_{page:04d}.png", height=rows * self.tile_size[1]
+            )
+        self.checkpoint()
+
+    def close(self):
+        self.render()
+        for canvas in (self._keogram, self._sheet):
+            if canvas is not None:
+                canvas.close()
+        self._keogram = self._sheet = None
+        logger.info(
+            f"Overview of {self.frames:,} frames in {self.output_dir}"
+            + (f"; left out {self.skipped:,} that couldn't be decoded" if self.skipped else "")
+        )
+
+
+def build_overview(root: Path, builder: OverviewBuilder):
+    """Add every frame of an output (or archive) directory to `builder`; returns the number added"""
+    added = 0
+    try:
+        for number, name, source in iter_frames(root, after=builder.last_frame):
+            added += builder.add(number, name, source)
+    finally:
+        builder.close()
+    return added
+
+
+class LiveOverview(threading.Thread):
+    """Feed frames to an `OverviewBuilder` in the background, as they are committed to disk
+
+    Pass `submit` as a FrameWriter's `on_commit`. Paths are then passed on to `then` (e.g. an
+    `ArchivePacker`'s `submit`), so that they aren't removed before they've been read.
+    """
+
+    def __init__(
+        self, builder: OverviewBuilder, then: Union[Callable[[list[Path]], None], None] = None
+    ):
+        super().__init__(name="chrophos-overview", daemon=True)
+        self.builder = builder
+        self.then = then
+        self._queue: queue.Queue[Union[list[Path], None]] = queue.Queue()
+        self.error: Union[Exception, None] = None
+
+    def submit(self, paths: list[Path]):
+        self._queue.put(paths)
+
+    def run(self):
+        try:
+            while True:
+                paths = self._queue.get()
+                if paths is None:
+                    break
+                if self.error is None:
+                    self._add(paths)
+                if self.then:
+                    self.then(paths)
+        finally:
+            if self.error is None:
+                self.builder.close()
+
+    def _add(self, paths: list[Path]):
+        frames: dict[int, dict] = {}
+        for path in paths:
+            number = frame_number(path)
+            if number is not None:
+                frames.setdefault(number, {})[path.name] = path
+        try:
+            for number in sorted(frames):
+                name = _pick_preview_file(list(frames[number]))
+                self.builder.add(number, name, frames[number][name])
+        except Exception as error:
+            # The overview can be rebuilt afterwards; don't hold up packing for it
+            logger.exception(f"Overview failed: {error}")
+            self.error = error
+
+    def stop(self):
+        """Add everything submitted so far, render, then stop"""
+        self._queue.put(None)
+        self.join()
@@ -0,0 +1,315 @@
+import io
+import json
+import logging
+import platform
+import statistics
+import time
+import warnings
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Union
+
+import numpy as np
+
+from chrophos.camera.backend import Shutter
+from chrophos.camera.fake import fake_camera
+from chrophos.config import parse_config
+from chrophos.timelapse import gen_times, sleep_until
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = Path(__file__).parents[2] / "config" / "nikon_z6.toml"
+# Size of the synthetic frames given to the image analysis functions
+SYNTHETIC_FRAME_SHAPE = (1000, 1500)
+
+
+class SkipCase(Exception):
+    """Raised by a case whose optional dependencies aren't installed"""
+
+
+# name -> function(profile) returning either a callable to time, or a list of measured samples
+CASES: dict[str, Callable] = {}
+
+
+def case(name: str):
+    def register(func):
+        CASES[name] = func
+        return func
+
+    return register
+
+
+def synthetic_frame(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 2**14, size=SYNTHETIC_FRAME_SHAPE, dtype=np.uint16)
+
+
+def synthetic_rgb(seed=0):
+    """Half-size 8-bit RGB, as returned by `postprocess(half_size=True)`"""
+    frame = synthetic_frame(seed)[::2, ::2]
+    return (frame >> 6).astype(np.uint8)[..., None].repeat(3, axis=2)
+
+
+@case("sleep_until.lateness")
+def bench_sleep_until(profile: Path, trials=20):
+    lateness = []
+    for _ in range(trials):
+        target = datetime.now() + timedelta(milliseconds=20)
+        sleep_until(target)
+        lateness.append((datetime.now() - target).total_seconds())
+    return lateness
+
+
+@case("gen_times.100k")
+def bench_gen_times(profile: Path):
+    start = datetime.now()
+
+    def run():
+        for _ in gen_times(timedelta(seconds=5), num_frames=100_000, start=start):
+            pass
+
+    return run
+
+
+@case("gen_times.drift")
+def bench_gen_times_drift(profile: Path, num_frames=1_000_000):
+    """Worst error over a million scheduled times vs. a schedule built by adding up the interval,
+    in seconds
+
+    Both are exact to the microsecond that a timedelta holds the interval to (1/3s is stored as
+    333,333us), so anything but zero is a bug in `gen_times`: a frame out of place, or a time
+    worked out in floating point.
+    """
+    start = datetime(2024, 1, 1)
+    interval = timedelta(seconds=1 / 3)
+    expected = start
+    drift = 0.0
+    for actual in gen_times(interval, num_frames=num_frames, start=start):
+        drift = max(drift, abs((actual - expected).total_seconds()))
+        expected += interval
+    if drift:
+        raise RuntimeError(f"gen_times drifted up to {drift:.6f}s over {num_frames:,} frames")
+    return [drift]
+
+
+@case("parameter.step_and_validate")
+def bench_parameter_stepping(profile: Path):
+    choices = [f"1/{d}" for d in (8000, 4000, 2000, 1000, 500, 250, 125, 60, 30, 15, 8, 4, 2)]
+    shutter = Shutter("shutter", "shutterspeed", choices=choices, initial_value=choices[0])
+
+    def run():
+        for _ in range(len(choices) - 1):
+            shutter.step_value(1)
+        for _ in range(len(choices) - 1):
+            shutter.step_value(-1)
+
+    return run
+
+
+@case("camera.step_exposure")
+def bench_step_exposure(profile: Path):
+    camera = fake_camera(profile)
+
+    def run():
+        camera.step_exposure(1)
+        camera.step_exposure(-1)
+
+    return run
+
+
+@case("backend.push_config")
+def bench_push_config(profile: Path):
+    return fake_camera(profile).backend.push_config
+
+
+@case("backend.pull_config")
+def bench_pull_config(profile: Path):
+    return fake_camera(profile).backend.pull_config
+
+
+@case("config.parse_config")
+def bench_parse_config(profile: Path):
+    return lambda: parse_config(profile)
+
+
+@case("equalize.auto_exposure")
+def bench_equalize_auto_exposure(profile: Path):
+    try:
+        from chrophos import equalize
+    except ImportError as error:
+        raise SkipCase(error) from error
+    frame = synthetic_frame()
+    return lambda: equalize.auto_exposure(frame)
+
+
+@case("equalize.exposure_compensation")
+def bench_equalize_exposure_compensation(profile: Path):
+    try:
+        from chrophos import equalize
+    except ImportError as error:
+        raise SkipCase(error) from error
+    frame = synthetic_frame() / 2**14
+    return lambda: equalize.get_exposure_compensation(equalize.get_average_intensity(frame))
+
+
+@case("exposure.auto_exposure2")
+def bench_exposure_auto_exposure2(profile: Path):
+    try:
+        from chrophos import exposure
+    except ImportError as error:
+        raise SkipCase(error) from error
+    raw = SimpleNamespace(raw_image_visible=synthetic_frame())
+    return lambda: exposure.auto_exposure2(raw, target_mean=2**13)
+
+
+@case("exposure.auto_exposure")
+def bench_exposure_auto_exposure(profile: Path):
+    try:
+        from chrophos import exposure
+    except ImportError as error:
+        raise SkipCase(error) from error
+    rgb = synthetic_rgb()
+    # Only the analysis is measured, not the demosaicing
+    raw = SimpleNamespace(postprocess=lambda **kwargs: rgb)
+    return lambda: exposure.auto_exposure(raw)
+
+
+@case("exposure.equalize")
+def bench_exposure_equalize(profile: Path):
+    try:
+        from chrophos import exposure
+    except ImportError as error:
+        raise SkipCase(error) from error
+    rgb = synthetic_rgb()
+    return lambda: exposure.equalize(rgb)
+
+
+@case("metering.raw_meter")
+def bench_metering_raw_meter(profile: Path):
+    try:
+        from chrophos import metering
+    except ImportError as error:
+        raise SkipCase(error) from error
+    raw = SimpleNamespace(
+        raw_image_visible=synthetic_frame(),
+        raw_pattern=np.array([[0, 1], [3, 2]]),
+        color_desc=b"RGBG",
+        black_level_per_channel=[512] * 4,
+        white_level=2**14 - 1,
+        camera_whitebalance=[2.0, 1.0, 1.5, 0.0],
+    )
+    meter = metering.RawMeter(stride=2, regions={"sky": metering.sky_mask()})
+    return lambda: meter.meter(raw)
+
+
+def measure(func: Callable, repeat: int, min_time=0.05):
+    """Time `func`; each sample is the mean of enough calls to take at least `min_time` seconds"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+
+def summarize(samples: list[float]):
+    return {
+        "n": len(samples),
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "p95": float(np.percentile(samples, 95)),
+        "max": max(samples),
+    }
+
+
+def environment():
+    try:
+        chrophos_version = version("chrophos")
+    except PackageNotFoundError:
+        chrophos_version = None
+    return {
+        "chrophos_version": chrophos_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+def run(
+    profile: Path = DEFAULT_PROFILE, repeat=7, select: Union[str, None] = None
+) -> dict[str, dict]:
+    """Run the hardware-free benchmarks of chrophos's own overhead
+
+    Unlike `chrophos bench`, nothing here needs a camera: camera interaction goes through a
+    FakeCamera built from `profile`. Only cases whose name contains `select` are run, if given.
+    """
+    results = {}
+    chrophos_logger = logging.getLogger("chrophos")
+    original_level = chrophos_logger.level
+    # The hot paths log heavily; keep that from drowning out the results
+    chrophos_logger.setLevel(logging.ERROR)
+    try:
+        for name, make_case in CASES.items():
+            if select and select not in name:
+                continue
+            try:
+                subject = make_case(profile)
+            except SkipCase as error:
+                print(f"Skipping {name}: {error}")
+                continue
+            if isinstance(subject, list):
+                samples = subject
+            else:
+                # Some of the analysis functions print and warn as they go
+                with redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    samples = measure(subject, repeat)
+            results[name] = summarize(samples)
+            print(f"{name:32} median {results[name]['median'] * 1e6:12,.1f}us")
+    finally:
+        chrophos_logger.setLevel(original_level)
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline: dict, current: dict, threshold=0.25):
+    """Compare medians; returns (name, baseline median, current median, regressed?) per case"""
+    comparison = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["median"]
+        new = result["median"]
+        comparison.append((name, old, new, new > old * (1 + threshold)))
+    return comparison
+
+
+def print_comparison(comparison: list[tuple[str, float, float, bool]]):
+    for name, old, new, regressed in comparison:
+        change = (new - old) / old if old else 0.0
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:32} {old * 1e6:12,.1f}us -> {new * 1e6:12,.1f}us ({change:+.0%}){flag}")
+
+
+def load_results(path: Path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_results(results: dict, path: Path):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
@@ -0,0 +1,398 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Callable, Union
+
+from chrophos.camera.backend import BackendError
+from chrophos.dedupe import extract_thumbnail, signature
+from chrophos.storage import FrameWriter
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_LOG_NAME = "analysis.jsonl"
+
+# Releases come back tagged with who is done with the slot
+STORAGE = "storage"
+ANALYSIS = "analysis"
+
+# How often a capture process waiting for a slot checks that the storage process is still alive
+SLOT_POLL = 1.0
+
+
+def thumbnail_stats(name: str, data: memoryview) -> Union[dict, None]:
+    """Analyzer: the difference hash and mean luminance of a frame's thumbnail"""
+    thumbnail = extract_thumbnail(data, Path(name).suffix)
+    if thumbnail is None:
+        return None
+    frame_signature = signature(thumbnail)
+    return {"dhash": f"{frame_signature.dhash:016x}", "mean": frame_signature.mean}
+
+
+def _init_process(events, log_level: int):
+    # Spawned processes start with no logging set up; send everything back to the capture process
+    chrophos_logger = logging.getLogger("chrophos")
+    chrophos_logger.handlers = [logging.handlers.QueueHandler(events)]
+    chrophos_logger.setLevel(log_level)
+    chrophos_logger.propagate = False
+
+
+def _slot_view(block: shared_memory.SharedMemory, slot: int, slot_bytes: int, size: int):
+    start = slot * slot_bytes
+    return block.buf[start : start + size]
+
+
+def _storage_main(block_name: str, slot_bytes: int, tasks, events, log_level: int):
+    """Storage process: write frames from the ring with a `FrameWriter` per directory
+
+    A task that fails (e.g. on a full disk) is reported back as an "error" event rather than
+    taking the process down; a failed write still releases its slot.
+    """
+    _init_process(events, log_level)
+    block = shared_memory.SharedMemory(name=block_name)
+    writers: dict[str, FrameWriter] = {}
+
+    def on_commit(output_dir: str):
+        return lambda paths: events.put(("committed", output_dir, [str(path) for path in paths]))
+
+    try:
+        while (task := tasks.get()) is not None:
+            op, output_dir, *args = task
+            try:
+                if op == "open":
+                    (writer_kwargs,) = args
+                    writers[output_dir] = FrameWriter(
+                        Path(output_dir), on_commit=on_commit(output_dir), **writer_kwargs
+                    )
+                elif op == "write":
+                    name, slot, size = args
+                    try:
+                        with _slot_view(block, slot, slot_bytes, size) as view:
+                            _writer(writers, output_dir).write(name, view)
+                    finally:
+                        events.put(("release", slot, STORAGE))
+                elif op == "write_bytes":
+                    name, data = args
+                    _writer(writers, output_dir).write(name, data)
+                elif op == "commit":
+                    _writer(writers, output_dir).commit()
+                elif op == "close":
+                    writer = writers.pop(output_dir, None)
+                    if writer is not None:
+                        writer.close()
+                        events.put(("closed", output_dir, writer.stats()))
+            except Exception as error:
+                logging.getLogger(__name__).exception(f"Storage failed to {op} in {output_dir}")
+                events.put(("error", op, output_dir, f"{type(error).__name__}: {error}"))
+    finally:
+        for writer in writers.values():
+            try:
+                writer.close()
+            except Exception as error:
+                events.put(("error", "close", str(writer.output_dir), str(error)))
+        block.close()
+
+
+def _writer(writers: dict[str, FrameWriter], output_dir: str) -> FrameWriter:
+    if output_dir not in writers:
+        raise OSError(f"No writer for {output_dir}; it couldn't be opened")
+    return writers[output_dir]
+
+
+def _analysis_main(
+    block_name: str, slot_bytes: int, tasks, events, analyzers: list[Callable], log_level: int
+):
+    """Analysis process: run every analyzer on each frame it's handed"""
+    _init_process(events, log_level)
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        while (task := tasks.get()) is not None:
+            name, slot, size = task
+            start = time.perf_counter()
+            results = {}
+            with _slot_view(block, slot, slot_bytes, size) as view:
+                for analyzer in analyzers:
+                    try:
+                        results[analyzer.__name__] = analyzer(name, view)
+                    except Exception as error:
+                        logging.getLogger(__name__).exception(
+                            f"{analyzer.__name__} failed on {name}"
+                        )
+                        results[analyzer.__name__] = {"error": f"{type(error).__name__}: {error}"}
+            events.put(("release", slot, ANALYSIS))
+            events.put(("result", name, results, time.perf_counter() - start))
+    finally:
+        block.close()
+
+
+class RingWriter:
+    """Stands in for a `FrameWriter` on the capture side, handing frames to the storage process
+
+    `write` returns as soon as the frame is in the ring; the storage process journals, writes
+    and commits it exactly as a `FrameWriter` would (and `on_commit` is called back here).
+    """
+
+    def __init__(self, pipeline: "FramePipeline", output_dir: Path, on_commit=None, **kwargs):
+        self.pipeline = pipeline
+        self.output_dir = output_dir
+        self._closed = False
+        pipeline._open(output_dir, on_commit, kwargs)
+
+    def write(self, name: str, data) -> Path:
+        self.pipeline._submit(self.output_dir, name, data)
+        return self.output_dir / name
+
+    def commit(self):
+        self.pipeline._storage_tasks.put(("commit", str(self.output_dir)))
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.pipeline._storage_tasks.put(("close", str(self.output_dir)))
+
+    def stats(self):
+        return self.pipeline.writer_stats.get(str(self.output_dir), {})
+
+
+class FramePipeline:
+    """Move storage and analysis of frames out of the capture process
+
+    Downloaded frames are copied once, into a ring of `slots` shared memory slots of `slot_bytes`
+    each; the storage process and `analysis_workers` analysis processes read them from there in
+    place, and hand the slot back once done with it. Frames too big for a slot are sent to the
+    storage process over its queue instead.
+
+    Only storage is allowed to hold up the capture process, when every slot is waiting on the
+    disk. Frames aren't handed to analysis while it has more than half of the slots, so that it
+    can fall behind (and skip frames) without the capture process noticing. Each analyzer is a
+    picklable `analyzer(name, data) -> dict` (e.g. `thumbnail_stats`); its results are passed to
+    `on_result(name, results)` and/or logged as JSON lines to `results_path`.
+
+    Storage errors are raised (as a `BackendError`) from the next frame handed over, as is the
+    storage process dying while the capture process waits on it.
+    """
+
+    def __init__(
+        self,
+        analyzers: Union[list[Callable], tuple] = (),
+        analysis_workers=1,
+        slots=8,
+        slot_bytes=64 * 2**20,
+        on_result: Union[Callable[[str, dict], None], None] = None,
+        results_path: Union[Path, None] = None,
+    ):
+        self.analyzers = list(analyzers)
+        self.analysis_workers = analysis_workers if self.analyzers else 0
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.on_result = on_result
+        self.results_path = results_path
+        self.writer_stats: dict[str, dict] = {}
+        self.counts = {
+            "frames": 0,
+            "analyzed": 0,
+            "analysis_skipped": 0,
+            "oversize": 0,
+            "slot_waits": 0,
+            "storage_errors": 0,
+        }
+
+        self._block: Union[shared_memory.SharedMemory, None] = None
+        self._free: queue.Queue[int] = queue.Queue()
+        self._storage_errors: queue.Queue[str] = queue.Queue()
+        self._storage_process = None
+        self._references: dict[int, set] = {}
+        self._analysis_slots = 0
+        self._lock = threading.Lock()
+        self._on_commit: dict[str, Callable] = {}
+        self._processes: list = []
+        self._collector: Union[threading.Thread, None] = None
+        self._results_file = None
+
+    def start(self):
+        # Spawned rather than forked: the capture process is already running threads (the event
+        # pump, the log listener, ...) whose locks a fork could copy mid-use
+        context = multiprocessing.get_context("spawn")
+        self._block = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+        for slot in range(self.slots):
+            self._free.put(slot)
+        self._events = context.Queue()
+        self._storage_tasks = context.Queue()
+        self._analysis_tasks = context.Queue()
+        log_level = logging.getLogger("chrophos").getEffectiveLevel()
+        self._storage_process = context.Process(
+            target=_storage_main,
+            args=(self._block.name, self.slot_bytes, self._storage_tasks, self._events),
+            kwargs={"log_level": log_level},
+            name="chrophos-storage",
+        )
+        self._processes.append(self._storage_process)
+        for i in range(self.analysis_workers):
+            self._processes.append(
+                context.Process(
+                    target=_analysis_main,
+                    args=(
+                        self._block.name,
+                        self.slot_bytes,
+                        self._analysis_tasks,
+                        self._events,
+                        self.analyzers,
+                    ),
+                    kwargs={"log_level": log_level},
+                    name=f"chrophos-analysis-{i}",
+                )
+            )
+        for process in self._processes:
+            process.start()
+        if self.results_path is not None:
+            self._results_file = open(self.results_path, "a")
+        self._collector = threading.Thread(
+            target=self._collect, name="chrophos-pipeline", daemon=True
+        )
+        self._collector.start()
+        logger.info(
+            f"Started frame pipeline: {self.slots} x {self.slot_bytes / 2**20:.0f} MiB slots,"
+            f" {self.analysis_workers} analysis worker(s)"
+        )
+
+    def writer(self, output_dir: Path, **kwargs) -> RingWriter:
+        return RingWriter(self, output_dir, **kwargs)
+
+    def _open(self, output_dir: Path, on_commit, writer_kwargs: dict):
+        if on_commit is not None:
+            self._on_commit[str(output_dir)] = on_commit
+        self._storage_tasks.put(("open", str(output_dir), writer_kwargs))
+
+    def _check_storage(self):
+        """Raise any error from the storage process, or its having died"""
+        try:
+            error = self._storage_errors.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            raise BackendError(f"Failed to store a frame: {error}")
+        if not self._storage_process.is_alive():
+            raise BackendError(
+                f"Storage process died (exit code {self._storage_process.exitcode});"
+                " frames aren't being stored"
+            )
+
+    def _submit(self, output_dir: Path, name: str, data):
+        self._check_storage()
+        view = memoryview(data).cast("B")
+        self.counts["frames"] += 1
+        if view.nbytes > self.slot_bytes:
+            self.counts["oversize"] += 1
+            logger.warning(
+                f"{name} ({view.nbytes:,} bytes) doesn't fit in a slot; sending it by queue"
+            )
+            self._storage_tasks.put(("write_bytes", str(output_dir), name, bytes(view)))
+            return
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.counts["slot_waits"] += 1
+            logger.warning("Every slot is waiting on storage; waiting for one to free up")
+            while True:
+                try:
+                    slot = self._free.get(timeout=SLOT_POLL)
+                    break
+                except queue.Empty:
+                    self._check_storage()
+        start = slot * self.slot_bytes
+        self._block.buf[start : start + view.nbytes] = view
+        with self._lock:
+            analyze = self.analysis_workers and self._analysis_slots < self.slots // 2
+            self._references[slot] = {STORAGE, ANALYSIS} if analyze else {STORAGE}
+            if analyze:
+                self._analysis_slots += 1
+        self._storage_tasks.put(("write", str(output_dir), name, slot, view.nbytes))
+        if analyze:
+            self._analysis_tasks.put((name, slot, view.nbytes))
+        elif self.analysis_workers:
+            self.counts["analysis_skipped"] += 1
+
+    def _release(self, slot: int, holder: str):
+        with self._lock:
+            references = self._references[slot]
+            references.discard(holder)
+            if holder == ANALYSIS:
+                self._analysis_slots -= 1
+            if references:
+                return
+            del self._references[slot]
+        self._free.put(slot)
+
+    def _collect(self):
+        """Handle everything the worker processes send back"""
+        while (event := self._events.get()) is not None:
+            if isinstance(event, logging.LogRecord):
+                logging.getLogger(event.name).handle(event)
+                continue
+            kind, *args = event
+            try:
+                if kind == "release":
+                    self._release(*args)
+                elif kind == "committed":
+                    output_dir, paths = args
+                    on_commit = self._on_commit.get(output_dir)
+                    if on_commit:
+                        on_commit([Path(path) for path in paths])
+                elif kind == "closed":
+                    output_dir, stats = args
+                    self.writer_stats[output_dir] = stats
+                elif kind == "result":
+                    self._record_result(*args)
+                elif kind == "error":
+                    op, output_dir, error = args
+                    self.counts["storage_errors"] += 1
+                    self._storage_errors.put(f"{op} in {output_dir}: {error}")
+            except Exception:
+                logger.exception(f"Failed to handle {kind} from the pipeline")
+
+    def _record_result(self, name: str, results: dict, seconds: float):
+        self.counts["analyzed"] += 1
+        if self.on_result:
+            self.on_result(name, results)
+        if self._results_file is not None:
+            entry = {"name": name, "seconds": round(seconds, 4), **results}
+            self._results_file.write(json.dumps(entry) + "\n")
+            self._results_file.flush()
+
+    def stop(self, timeout=60.0):
+        """Finish storing (and analyzing) every frame handed over so far, and shut down"""
+        if self._block is None:
+            return
+        self._storage_tasks.put(None)
+        for _ in range(self.analysis_workers):
+            self._analysis_tasks.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f"{process.name} didn't finish within {timeout}s; terminating it")
+                process.terminate()
+        self._events.put(None)
+        self._collector.join()
+        if self._results_file is not None:
+            self._results_file.close()
+        self._block.close()
+        self._block.unlink()
+        self._block = None
+        self._processes = []
+        self._storage_process = None
+        logger.info(
+            f"Frame pipeline: {self.counts['frames']:,} frame(s);"
+            f" analyzed {self.counts['analyzed']:,}, skipped {self.counts['analysis_skipped']:,};"
+            f" waited for a slot {self.counts['slot_waits']:,} time(s);"
+            f" {self.counts['storage_errors']:,} storage error(s)"
+        )
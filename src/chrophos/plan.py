@@ -1,9 +1,25 @@
+import json
+import math
+from dataclasses import dataclass
 from datetime import timedelta
+from fractions import Fraction
+from pathlib import Path
+from typing import Sequence, Union
 
+import numpy as np
 import typer
 
+from chrophos.config import CameraConfig
+from chrophos.layout import ShardedLayout, open_layout
+
 app = typer.Typer()
 
+# Trials simulated by default, and the number of frames (slots x trials) the default aims for when
+# every frame has to be simulated
+MIN_TRIALS = 10
+MAX_TRIALS = 100
+SIMULATION_FRAME_BUDGET = 10_000_000
+
 
 def format_timedelta(td: timedelta, threshold=timedelta(seconds=60)):
     if td < threshold:
@@ -38,10 +54,10 @@ def summary(input_frames: int = 1000, input_interval: float = 5, output_fps: flo
     one_minute = timedelta(minutes=1)
     one_hour = timedelta(hours=1)
     one_day = timedelta(days=1)
-    print(f"  One second of real time will play back in {format_timedelta(one_second/speedup)}")
-    print(f"  One minute of real time will play back in {format_timedelta(one_minute/speedup)}")
-    print(f"  One hour of real time will play back in {format_timedelta(one_hour/speedup)}")
-    print(f"  One day of real time will play back in {format_timedelta(one_day/speedup)}")
+    print(f"  One second of real time will play back in {format_timedelta(one_second / speedup)}")
+    print(f"  One minute of real time will play back in {format_timedelta(one_minute / speedup)}")
+    print(f"  One hour of real time will play back in {format_timedelta(one_hour / speedup)}")
+    print(f"  One day of real time will play back in {format_timedelta(one_day / speedup)}")
 
 
 def output_summary(input_span: timedelta, output_span: timedelta, output_fps: float):
@@ -56,5 +72,209 @@ def output_summary(input_span: timedelta, output_span: timedelta, output_fps: fl
     )
 
 
+@dataclass
+class SessionEstimate:
+    trials: int
+    slots: int
+    expected_missed_frames: float
+    missed_frames_p95: float
+    storage_bytes_p50: float
+    storage_bytes_p95: float
+    # Median time until storage is full; None if it never fills in any trial
+    time_until_disk_full: Union[timedelta, None]
+    # Fraction of trials in which storage filled up
+    disk_full_probability: float
+    max_transfer_backlog_bytes_p95: Union[float, None]
+    recommended_min_interval: timedelta
+
+
+def load_samples(path: Path) -> list[float]:
+    """Load samples from a JSON list, a JSON object of lists, or a file with one value per line"""
+    text = path.read_text()
+    try:
+        samples = json.loads(text)
+    except json.JSONDecodeError:
+        return [float(line) for line in text.splitlines() if line.strip()]
+    if isinstance(samples, dict):
+        return [float(s) for values in samples.values() for s in values]
+    return [float(s) for s in samples]
+
+
+def file_sizes_from_dir(path: Path, pattern="*") -> list[int]:
+    layout = open_layout(path)
+    paths = layout.frame_paths() if isinstance(layout, ShardedLayout) else path.glob(pattern)
+    return [p.stat().st_size for p in paths if p.is_file()]
+
+
+def default_trials(slots: int, per_frame: bool) -> int:
+    """Number of trials to simulate when none is given
+
+    Sessions that need a per-frame simulation cost roughly 30 ns per frame per trial, so the
+    trials are capped to keep that to SIMULATION_FRAME_BUDGET frames; a long session varies little
+    from one trial to the next anyway
+    """
+    if not per_frame:
+        return MAX_TRIALS
+    return min(MAX_TRIALS, max(MIN_TRIALS, SIMULATION_FRAME_BUDGET // max(slots, 1)))
+
+
+def simulate_session(
+    config: CameraConfig,
+    interval: timedelta,
+    duration: timedelta,
+    file_sizes: Sequence[float],
+    dark_times: Union[Sequence[float], None] = None,
+    shutter: Union[float, None] = None,
+    storage_capacity: Union[float, None] = None,
+    write_bandwidth: Union[float, None] = None,
+    transfer_bandwidth: Union[float, None] = None,
+    trials: Union[int, None] = None,
+    percentile=99.9,
+    seed=None,
+) -> SessionEstimate:
+    """Monte Carlo simulation of an entire capture session
+
+    Every trial draws each frame's dark time and file size from the given empirical samples.
+    A frame whose shutter + dark time (+ write time, if `write_bandwidth` is given and the dark
+    time samples didn't include writing to this storage) overruns the interval causes the
+    following slot(s) to be missed, as they would be in `chrophos.timelapse`.
+
+    Only the frames that can overrun are drawn individually. Frame sizes are drawn for every frame
+    only when the disk can fill up or the transfer queue can back up; otherwise the storage
+    needed comes from the counts of each size. If `trials` isn't given, see `default_trials`.
+
+    Bandwidths are in bytes/second; sizes and capacity are in bytes.
+    """
+    rng = np.random.default_rng(seed)
+    if shutter is None:
+        shutter = float(Fraction(str(config.target_shutter)))
+    if dark_times is None:
+        dark_times = [config.dark_time.total_seconds()]
+    dark_times = np.asarray(dark_times, dtype=np.float64)
+    # float32 halves the memory traffic of the per-frame draws; sums are taken in float64
+    file_sizes = np.asarray(file_sizes, dtype=np.float32)
+    size_values, size_counts = np.unique(file_sizes, return_counts=True)
+    size_probabilities = size_counts / size_counts.sum()
+    max_size = float(size_values[-1])
+    interval_seconds = interval.total_seconds()
+    slots = math.floor(duration / interval)
+
+    # A frame can only overrun if its dark time could, even with the largest file
+    max_write_time = max_size / write_bandwidth if write_bandwidth else 0.0
+    overrun_dark_times = dark_times[shutter + dark_times + max_write_time > interval_seconds]
+    overrun_probability = len(overrun_dark_times) / len(dark_times)
+    drained = transfer_bandwidth * interval_seconds if transfer_bandwidth else None
+    track_disk = bool(storage_capacity) and slots * max_size > storage_capacity
+    # The queue never holds more than the current frame if every frame drains within its slot
+    track_backlog = drained is not None and max_size > drained
+    per_frame = track_disk or track_backlog
+    if trials is None:
+        trials = default_trials(slots, per_frame)
+
+    missed = np.empty(trials)
+    stored = np.empty(trials)
+    full_at_slot = np.full(trials, np.nan)
+    max_backlog = np.zeros(trials)
+    for trial in range(trials):
+        sizes = rng.choice(file_sizes, size=slots) if per_frame else None
+        # Frames that overrun and how many extra slots each one takes, in frame order
+        overruns = np.sort(
+            rng.choice(slots, size=rng.binomial(slots, overrun_probability), replace=False)
+        )
+        busy = shutter + rng.choice(overrun_dark_times, size=len(overruns))
+        if sizes is not None:
+            overrun_sizes = sizes[overruns]
+        else:
+            overrun_sizes = rng.choice(file_sizes, size=len(overruns))
+        if write_bandwidth:
+            busy += overrun_sizes / write_bandwidth
+        extra_slots = np.maximum(np.ceil(busy / interval_seconds), 1).astype(np.int64) - 1
+        # shift[j] is how many slots late every frame after overruns[j - 1] starts
+        shift = np.concatenate(([0], np.cumsum(extra_slots)))
+
+        # A frame is captured only if it starts within the session. Frame n after overrun j - 1
+        # starts at slot n + shift[j], so the first frame that doesn't is found per segment
+        segment_first = np.concatenate(([0], overruns + 1))
+        segment_last = np.concatenate((overruns, [slots]))
+        first_missed = np.maximum(segment_first, slots - shift)
+        captured = int(first_missed[first_missed <= segment_last][0])
+        missed[trial] = slots - captured
+        captured_overruns = overruns < captured
+
+        if sizes is None:
+            stored[trial] = overrun_sizes[captured_overruns].sum(dtype=np.float64) + (
+                rng.multinomial(captured - captured_overruns.sum(), size_probabilities)
+                @ size_values.astype(np.float64)
+            )
+            continue
+        cumulative_size = np.cumsum(sizes[:captured], dtype=np.float64)
+        stored[trial] = cumulative_size[-1] if captured else 0
+        if track_disk:
+            first_over = int(np.searchsorted(cumulative_size, storage_capacity, side="right"))
+            if first_over < captured:
+                full_at_slot[trial] = first_over + shift[np.searchsorted(overruns, first_over)]
+
+        if track_backlog:
+            # Lindley recursion for the transfer queue, vectorized: the backlog after frame n is
+            # S_n - min(0, min_{k<=n} S_k), where S is the running sum of (arrivals - drained)
+            slots_used = np.ones(captured)
+            slots_used[overruns[captured_overruns]] += extra_slots[captured_overruns]
+            running = cumulative_size - drained * np.cumsum(slots_used)
+            floor = np.minimum.accumulate(np.minimum(running, 0))
+            max_backlog[trial] = (running - floor).max(initial=0)
+
+    busy_percentile = shutter + float(np.percentile(dark_times, percentile))
+    if write_bandwidth:
+        busy_percentile += float(np.percentile(file_sizes, percentile)) / write_bandwidth
+    if transfer_bandwidth:
+        # The transfer queue is only stable if it drains faster than frames arrive
+        busy_percentile = max(busy_percentile, float(file_sizes.mean()) / transfer_bandwidth)
+
+    filled = ~np.isnan(full_at_slot)
+    return SessionEstimate(
+        trials=trials,
+        slots=slots,
+        expected_missed_frames=float(missed.mean()),
+        missed_frames_p95=float(np.percentile(missed, 95)),
+        storage_bytes_p50=float(np.percentile(stored, 50)),
+        storage_bytes_p95=float(np.percentile(stored, 95)),
+        time_until_disk_full=(
+            interval * float(np.median(full_at_slot[filled])) if filled.any() else None
+        ),
+        disk_full_probability=float(filled.mean()),
+        max_transfer_backlog_bytes_p95=(
+            float(np.percentile(max_backlog, 95)) if transfer_bandwidth else None
+        ),
+        recommended_min_interval=timedelta(seconds=math.ceil(busy_percentile * 10) / 10),
+    )
+
+
+def session_summary(estimate: SessionEstimate, interval: timedelta):
+    gigabyte = 1e9
+    print(
+        f"Simulated {estimate.trials:,} sessions of {estimate.slots:,} frames at"
+        f" {format_timedelta(interval)} interval"
+    )
+    print(
+        f"  Expected missed frames: {estimate.expected_missed_frames:,.1f}"
+        f" (95th percentile {estimate.missed_frames_p95:,.0f})"
+    )
+    print(
+        f"  Storage needed: {estimate.storage_bytes_p50 / gigabyte:,.1f} GB"
+        f" (95th percentile {estimate.storage_bytes_p95 / gigabyte:,.1f} GB)"
+    )
+    if estimate.time_until_disk_full is not None:
+        print(
+            f"  Disk fills after {format_timedelta(estimate.time_until_disk_full)}"
+            f" in {estimate.disk_full_probability:.0%} of sessions"
+        )
+    if estimate.max_transfer_backlog_bytes_p95 is not None:
+        print(
+            "  Max transfer backlog (95th percentile):"
+            f" {estimate.max_transfer_backlog_bytes_p95 / gigabyte:,.2f} GB"
+        )
+    print(f"  Recommended minimum interval: {format_timedelta(estimate.recommended_min_interval)}")
+
+
 if __name__ == "__main__":
     typer.run(summary)
@@ -0,0 +1,246 @@
+import heapq
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+from pathlib import Path
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+# (filename, function name, line number) from the outermost call to the innermost
+Stack = tuple[tuple[str, str, int], ...]
+
+
+class SamplingProfiler(threading.Thread):
+    """Periodically record the stack of a single thread while `recording` is set
+
+    Sampling costs the profiled thread nothing but the GIL hand-off, unlike a deterministic
+    profiler (cProfile), which slows down every function call.
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(name="chrophos-sampler", daemon=True)
+        self.interval = interval
+        self.target_thread_id: Union[int, None] = None
+        self.samples: list[Stack] = []
+        self.recording = threading.Event()
+        self._stop_event = threading.Event()
+
+    def start_recording(self, thread_id: int):
+        self.target_thread_id = thread_id
+        self.samples = []
+        self.recording.set()
+
+    def stop_recording(self) -> list[Stack]:
+        self.recording.clear()
+        return self.samples
+
+    def stop(self):
+        self._stop_event.set()
+        self.recording.set()
+        self.join()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.recording.wait()
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is not None and self.recording.is_set():
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                self.samples.append(tuple(reversed(stack)))
+            time.sleep(self.interval)
+
+
+@dataclass(order=True)
+class FrameProfile:
+    duration: float
+    frame_number: int = field(compare=False)
+    samples: list[Stack] = field(compare=False, repr=False)
+    sample_interval: float = field(compare=False)
+    # Traced memory (current, peak) in bytes over the course of the frame
+    traced_memory: Union[tuple[int, int], None] = field(compare=False, default=None)
+    memory_report: Union[list[str], None] = field(compare=False, default=None, repr=False)
+
+    def speedscope(self):
+        frames: list[dict] = []
+        frame_indices: dict[tuple[str, str, int], int] = {}
+        samples = []
+        for stack in self.samples:
+            indices = []
+            for location in stack:
+                if location not in frame_indices:
+                    frame_indices[location] = len(frames)
+                    filename, name, line = location
+                    frames.append({"name": name, "file": filename, "line": line})
+                indices.append(frame_indices[location])
+            samples.append(indices)
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": f"chrophos frame {self.frame_number}",
+            "exporter": "chrophos",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"frame {self.frame_number}",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": self.duration,
+                    "samples": samples,
+                    "weights": [self.sample_interval] * len(samples),
+                }
+            ],
+        }
+
+
+class FrameProfiler:
+    """Profile every frame, but keep only the slowest `top_k` and any slower than `threshold`
+
+    Profiles are written to `output_dir` as speedscope files (open them at
+    https://www.speedscope.app), alongside a report of where memory was allocated if
+    `trace_memory` is set. Each is listed, with its frame number and duration, in `profiles.jsonl`.
+
+    Outliers are written as soon as their frame ends; the top-K are written by `close`. Time
+    spent in `waiting` (e.g. for the frame's capture time) isn't sampled, and doesn't count
+    towards a frame's duration.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        top_k=10,
+        threshold: Union[timedelta, None] = None,
+        sample_interval=0.005,
+        trace_memory=False,
+    ):
+        self.output_dir = output_dir
+        self.top_k = top_k
+        self.threshold = threshold
+        self.trace_memory = trace_memory
+        self.sampler = SamplingProfiler(interval=sample_interval)
+        # Min-heap, so the fastest of the slowest frames is the one that gets evicted
+        self._slowest: list[FrameProfile] = []
+        self._last_snapshot: Union[tracemalloc.Snapshot, None] = None
+        # Whether tracemalloc was started here, rather than already running (e.g. with -X
+        # tracemalloc), in which case it's left running
+        self._started_tracing = False
+        self._waited = 0.0
+        self.frames_profiled = 0
+        self.outliers = 0
+
+    def start(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.sampler.start()
+
+    def _qualifies(self, duration: float):
+        if self.threshold is not None and duration > self.threshold.total_seconds():
+            return True
+        if len(self._slowest) < self.top_k:
+            return True
+        # With `top_k` of 0, only outliers are kept
+        return bool(self._slowest) and duration > self._slowest[0].duration
+
+    @contextmanager
+    def frame(self, frame_number: int):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.sampler.start_recording(threading.get_ident())
+        self._waited = 0.0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start - self._waited
+            samples = self.sampler.stop_recording()
+            self.frames_profiled += 1
+            if self._qualifies(duration):
+                self._keep(frame_number, duration, samples)
+
+    @contextmanager
+    def waiting(self):
+        """Leave a wait within a frame out of its profile"""
+        self.sampler.recording.clear()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._waited += time.perf_counter() - start
+            self.sampler.recording.set()
+
+    def _keep(self, frame_number: int, duration: float, samples: list[Stack]):
+        profile = FrameProfile(
+            duration=duration,
+            frame_number=frame_number,
+            samples=samples,
+            sample_interval=self.sampler.interval,
+        )
+        if self.trace_memory:
+            profile.traced_memory = tracemalloc.get_traced_memory()
+            # Snapshots are expensive, so they're only taken for frames being kept. Each is
+            # compared to the previous one, showing where memory grew in between
+            snapshot = tracemalloc.take_snapshot()
+            if self._last_snapshot is None:
+                stats = snapshot.statistics("lineno")
+            else:
+                stats = snapshot.compare_to(self._last_snapshot, "lineno")
+            profile.memory_report = [str(stat) for stat in stats[:25]]
+            self._last_snapshot = snapshot
+
+        if self.threshold is not None and duration > self.threshold.total_seconds():
+            self.outliers += 1
+            logger.warning(
+                f"Frame #{frame_number} took {duration:.3f}s (threshold {self.threshold});"
+                " saving its profile"
+            )
+            self.write(profile, reason="outlier")
+        elif len(self._slowest) < self.top_k:
+            heapq.heappush(self._slowest, profile)
+        else:
+            heapq.heapreplace(self._slowest, profile)
+
+    def write(self, profile: FrameProfile, reason: str):
+        stem = f"frame_{profile.frame_number:08d}"
+        speedscope_path = self.output_dir / f"{stem}.speedscope.json"
+        with open(speedscope_path, "w") as file:
+            json.dump(profile.speedscope(), file)
+        record = {
+            "frame_number": profile.frame_number,
+            "duration": profile.duration,
+            "reason": reason,
+            "samples": len(profile.samples),
+            "speedscope": speedscope_path.name,
+        }
+        if profile.memory_report is not None:
+            memory_path = self.output_dir / f"{stem}.memory.txt"
+            memory_path.write_text("\n".join(profile.memory_report) + "\n")
+            record["memory"] = memory_path.name
+            record["traced_memory"] = profile.traced_memory
+        with open(self.output_dir / "profiles.jsonl", "a") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.sampler.stop()
+        for profile in sorted(self._slowest, reverse=True):
+            self.write(profile, reason="top_k")
+        logger.info(
+            f"Profiled {self.frames_profiled:,} frames; wrote {len(self._slowest)} slowest and"
+            f" {self.outliers} outlier profile(s) to {self.output_dir}"
+        )
+        self._slowest = []
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
@@ -0,0 +1,254 @@
+import logging
+import math
+import shutil
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterator, Union
+
+import numpy as np
+
+from chrophos.image import load_frame, save_ppm
+from chrophos.plan import format_timedelta
+from chrophos.stack import Source, read_source
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Variant:
+    """An output of a retimed sequence: played back at `fps`, `speedup` times faster than real
+    time, with each output frame an average of `blend` consecutive input frames
+
+    A `blend` of 1 picks single frames; None blends every frame an output frame spans (i.e. a
+    360 degree "shutter").
+    """
+
+    speedup: float
+    fps: float = 30.0
+    blend: Union[int, None] = 1
+
+    def step(self, interval: timedelta):
+        """Input frames per output frame"""
+        return self.speedup / (self.fps * interval.total_seconds())
+
+    def window(self, interval: timedelta):
+        if self.blend is None:
+            return max(1, round(self.step(interval)))
+        return self.blend
+
+    def output_frames(self, input_frames: int, interval: timedelta):
+        """The number of output frames whose windows fit within `input_frames`"""
+        last_start = input_frames - self.window(interval)
+        if last_start < 0:
+            return 0
+        step = self.step(interval)
+        # i.e. the number of k with floor(k * step) <= last_start, allowing for rounding error
+        count = math.ceil((last_start + 1) / step)
+        while count > 0 and math.floor((count - 1) * step) > last_start:
+            count -= 1
+        while math.floor(count * step) <= last_start:
+            count += 1
+        return count
+
+
+class Retimer:
+    """Turn a stream of input frames into the output frames of a single `Variant`
+
+    Output frame k averages input frames [floor(k * step), floor(k * step) + window). Those are
+    summed into a single (uint32, so exact) accumulator as they arrive; where windows overlap,
+    the frames that fall out of the window are subtracted again rather than re-adding the rest.
+    """
+
+    def __init__(self, variant: Variant, interval: timedelta, sink):
+        self.variant = variant
+        self.interval = interval
+        self.step = variant.step(interval)
+        self.window = variant.window(interval)
+        self.sink = sink
+        self.output_frames = 0
+        self._sum: Union[np.ndarray, None] = None
+        # Index of the first input frame in the accumulator
+        self._sum_start = 0
+
+    def window_start(self, k: int):
+        return math.floor(k * self.step)
+
+    def used_frames(self, input_frames: int) -> np.ndarray:
+        """Which of `input_frames` input frames are part of any output frame"""
+        count = self.variant.output_frames(input_frames, self.interval)
+        starts = np.floor(np.arange(count) * self.step).astype(np.intp)
+        # +1 at the start of each window and -1 after its end; covered wherever the sum is > 0
+        edges = np.zeros(input_frames + 1, dtype=np.intp)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, starts + self.window, -1)
+        return np.cumsum(edges[:-1]) > 0
+
+    def add(self, index: int, frame: np.ndarray, history: dict[int, np.ndarray]):
+        """Add input frame `index`; `history` holds (at least) the last `window` frames"""
+        if index < self.window_start(self.output_frames):
+            return
+        if self._sum is None:
+            self._sum = np.zeros(frame.shape, dtype=np.uint32)
+            self._sum_start = index
+        np.add(self._sum, frame, out=self._sum)
+        # Emit every output frame whose window ends here; there's more than one when slowing down
+        while self.window_start(self.output_frames) + self.window - 1 == index:
+            self.sink.write(((self._sum + self.window // 2) // self.window).astype(np.uint16))
+            self.output_frames += 1
+            start = self.window_start(self.output_frames)
+            if start > index:
+                self._sum = None
+                break
+            for old in range(self._sum_start, start):
+                np.subtract(self._sum, history[old], out=self._sum)
+            self._sum_start = start
+
+
+class FfmpegSink:
+    """Encode frames to a video with ffmpeg, streaming them to it as raw 16-bit RGB
+
+    `width` scales the video (keeping its aspect ratio); `codec_args` are passed to ffmpeg as
+    output options.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        fps: float,
+        width: Union[int, None] = None,
+        codec_args=("-c:v", "libx264", "-crf", "18", "-pix_fmt", "yuv420p"),
+        ffmpeg="ffmpeg",
+    ):
+        if shutil.which(ffmpeg) is None:
+            raise ValueError(f"Can't encode {path}: {ffmpeg} isn't installed")
+        self.path = path
+        self.fps = fps
+        self.width = width
+        self.codec_args = list(codec_args)
+        self.ffmpeg = ffmpeg
+        self._process: Union[subprocess.Popen, None] = None
+
+    def _start(self, frame: np.ndarray):
+        height, width = frame.shape[:2]
+        command = [
+            self.ffmpeg,
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb48le",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(self.fps),
+            "-i",
+            "-",
+        ]
+        if self.width:
+            command += ["-vf", f"scale={self.width}:-2"]
+        command += [*self.codec_args, str(self.path)]
+        logger.debug(f"Starting {' '.join(command)}")
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray):
+        if self._process is None:
+            self._start(frame)
+        self._process.stdin.write(frame.astype("<u2").tobytes())
+
+    def close(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        if self._process.wait():
+            raise subprocess.CalledProcessError(self._process.returncode, self.ffmpeg)
+
+
+class FrameDirectorySink:
+    """Write frames to `output_dir` as numbered 16-bit PPMs, for some other renderer"""
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.frames = 0
+
+    def write(self, frame: np.ndarray):
+        self.frames += 1
+        save_ppm(self.output_dir / f"frame_{self.frames:06d}.ppm", frame)
+
+    def close(self):
+        return None
+
+
+def _decoded(
+    sources: list[Source], needed: np.ndarray, half_size: bool, workers: int, calibration=None
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Decode the needed frames in order, a few ahead of the consumer"""
+
+    def decode(source: Source):
+        data, suffix = read_source(source)
+        return load_frame(data, suffix, half_size=half_size, calibration=calibration)
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="chrophos-decode") as executor:
+        pending: deque = deque()
+        for index in np.flatnonzero(needed):
+            pending.append((int(index), executor.submit(decode, sources[index])))
+            if len(pending) > 2 * workers:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+
+def retime(
+    sources: list[Source],
+    interval: timedelta,
+    outputs: list[tuple[Variant, object]],
+    half_size=False,
+    workers=4,
+    calibration=None,
+):
+    """Render every variant in `outputs` (pairs of `Variant` and sink) in a single decode pass
+
+    Each input frame is decoded once (and only if some variant uses it) and handed to every
+    variant; at most the largest blend window's worth of frames is held in memory. Returns the
+    number of output frames of each variant.
+    """
+    retimers = [Retimer(variant, interval, sink) for variant, sink in outputs]
+    needed = np.zeros(len(sources), dtype=bool)
+    for retimer in retimers:
+        variant = retimer.variant
+        output_frames = variant.output_frames(len(sources), interval)
+        duration = timedelta(seconds=output_frames / variant.fps)
+        logger.info(
+            f"{variant.speedup:,}x at {variant.fps} fps: {retimer.step:.2f} input frames per"
+            f" output frame, blending {retimer.window}; {output_frames:,} output frames"
+            f" ({format_timedelta(duration)})"
+        )
+        needed |= retimer.used_frames(len(sources))
+    history_size = max(retimer.window for retimer in retimers)
+    history: dict[int, np.ndarray] = {}
+    start = time.perf_counter()
+    decoded = 0
+    try:
+        for index, frame in _decoded(sources, needed, half_size, workers, calibration):
+            history[index] = frame
+            for old in [old for old in history if old <= index - history_size]:
+                del history[old]
+            for retimer in retimers:
+                retimer.add(index, frame, history)
+            decoded += 1
+    finally:
+        for retimer in retimers:
+            retimer.sink.close()
+    logger.info(
+        f"Decoded {decoded:,} of {len(sources):,} frames in {time.perf_counter() - start:.1f}s"
+    )
+    return [retimer.output_frames for retimer in retimers]
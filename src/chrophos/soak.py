@@ -0,0 +1,292 @@
+import gc
+import logging
+import os
+import resource
+import statistics
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Union
+
+from chrophos.camera.fake import fake_camera
+from chrophos.clock import AcceleratedClock
+from chrophos.layout import frame_number
+from chrophos.perf import DEFAULT_PROFILE
+from chrophos.timelapse import timelapse
+from chrophos.utilities.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# Samples taken before this fraction of the run are ignored when looking for growth, since caches,
+# histograms, etc. are still filling up
+WARMUP_FRACTION = 0.2
+
+# metric -> (relative, absolute) growth that is tolerated between the first and last third of the
+# run (after warmup)
+GROWTH_TOLERANCES = {
+    "rss": (0.10, 16 * 2**20),
+    "open_fds": (0.0, 2),
+    "objects": (0.05, 10_000),
+    "frame_seconds": (0.50, 0.001),
+    # The worst of a window, so it jumps by milliseconds whenever the scheduler stalls
+    "lag_seconds": (0.50, 0.01),
+}
+
+
+def rss_bytes():
+    """Current resident set size; falls back to the peak where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is in kB on Linux but bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+
+def open_fds():
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            pass
+    return None
+
+
+@dataclass
+class SoakSample:
+    frame: int
+    virtual_time: str
+    rss: int
+    open_fds: Union[int, None]
+    objects: Union[int, None]
+    # Mean real seconds spent on each frame since the previous sample, i.e. chrophos's overhead
+    frame_seconds: float
+    # Worst lag of the end of a frame behind its commanded capture time since the previous sample
+    lag_seconds: float
+
+
+@dataclass
+class SoakReport:
+    frames: int
+    interval: timedelta
+    virtual_duration: timedelta
+    real_seconds: float
+    samples: list[SoakSample] = field(default_factory=list)
+    failures: list[str] = field(default_factory=list)
+    frame_latency: Union[LatencyHistogram, None] = None
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "interval": self.interval.total_seconds(),
+            "virtual_duration": self.virtual_duration.total_seconds(),
+            "real_seconds": self.real_seconds,
+            "frames_per_second": self.frames / self.real_seconds if self.real_seconds else None,
+            "passed": self.passed,
+            "failures": self.failures,
+            "frame_latency": self.frame_latency.as_dict() if self.frame_latency else None,
+            "samples": [asdict(sample) for sample in self.samples],
+        }
+
+
+class SoakMonitor:
+    """`on_frame` callback for `timelapse` that samples resource usage every `sample_every` frames
+
+    Frames (TL* files) written to `prune_dir` are deleted at every sample (as an offload job
+    would), so that a million-frame run doesn't need a million frames' worth of disk.
+    """
+
+    def __init__(
+        self,
+        clock: AcceleratedClock,
+        sample_every=1000,
+        count_objects=True,
+        prune_dir: Union[Path, None] = None,
+    ):
+        self.clock = clock
+        self.sample_every = sample_every
+        self.count_objects = count_objects
+        self.prune_dir = prune_dir
+        self.samples: list[SoakSample] = []
+        self.frame_latency = LatencyHistogram("frame overhead")
+        self.frames = 0
+        self._last_frame_end = time.perf_counter()
+        self._window_seconds = 0.0
+        self._window_frames = 0
+        self._window_lag = 0.0
+
+    def __call__(self, frame: int, commanded_capture_time: datetime):
+        now = time.perf_counter()
+        frame_seconds = now - self._last_frame_end
+        self._last_frame_end = now
+        self.frames = frame
+        self.frame_latency.record(frame_seconds)
+        self._window_seconds += frame_seconds
+        self._window_frames += 1
+        lag = (self.clock.now() - commanded_capture_time).total_seconds()
+        self._window_lag = max(self._window_lag, lag)
+        if frame % self.sample_every == 0:
+            self.sample(frame)
+            # Don't count the sampling itself as frame overhead
+            self._last_frame_end = time.perf_counter()
+
+    def sample(self, frame: int):
+        if self.prune_dir:
+            self.prune()
+        sample = SoakSample(
+            frame=frame,
+            virtual_time=self.clock.now().isoformat(),
+            rss=rss_bytes(),
+            open_fds=open_fds(),
+            objects=len(gc.get_objects()) if self.count_objects else None,
+            frame_seconds=self._window_seconds / self._window_frames,
+            lag_seconds=self._window_lag,
+        )
+        self.samples.append(sample)
+        logger.info(
+            f"Frame {frame:,} ({sample.virtual_time}): RSS {sample.rss / 2**20:.1f} MiB,"
+            f" {sample.open_fds} fds, {sample.objects} objects,"
+            f" {sample.frame_seconds * 1e3:.3f} ms/frame"
+        )
+        self._window_seconds = 0.0
+        self._window_frames = 0
+        self._window_lag = 0.0
+
+    def prune(self):
+        for entry in os.scandir(self.prune_dir):
+            if entry.is_file() and frame_number(Path(entry.name)) is not None:
+                os.unlink(entry.path)
+
+
+def grows_without_bound(values: list[float], relative: float, absolute: float):
+    """Whether `values` keep rising through the run, rather than levelling off
+
+    Warmup is discarded and the rest is split into thirds: the metric is growing if the median of
+    each third is higher than the last, and the last third exceeds the first by more than both
+    tolerances. Medians, so that a few one-off spikes (e.g. the worst lag of a window in which the
+    scheduler stalled) don't look like growth.
+    """
+    values = values[int(len(values) * WARMUP_FRACTION) :]
+    if len(values) < 6:
+        return False
+    third = len(values) // 3
+    first, middle, last = (
+        statistics.median(values[:third]),
+        statistics.median(values[third : 2 * third]),
+        statistics.median(values[-third:]),
+    )
+    return first < middle < last and last - first > absolute and last > first * (1 + relative)
+
+
+def check_growth(samples: list[SoakSample], tolerances=GROWTH_TOLERANCES):
+    failures = []
+    for metric, (relative, absolute) in tolerances.items():
+        values = [getattr(sample, metric) for sample in samples]
+        if any(value is None for value in values):
+            continue
+        if grows_without_bound(values, relative, absolute):
+            failures.append(
+                f"{metric} grew from {values[0]:,} to {values[-1]:,} over {samples[-1].frame:,}"
+                " frames without levelling off"
+            )
+    return failures
+
+
+def soak(
+    num_frames: int,
+    interval: timedelta,
+    profile: Path = DEFAULT_PROFILE,
+    output_dir: Union[Path, None] = None,
+    mode="manual",
+    sample_every: Union[int, None] = None,
+    file_size=64,
+    suffixes=(".NEF",),
+    commit_frames=10,
+    count_objects=True,
+) -> SoakReport:
+    """Run `num_frames` frames of a timelapse against a FakeCamera on an accelerated clock
+
+    Nothing waits for real, and frames aren't fsync'd: a month of capture at a 20s interval takes
+    minutes. Resource usage is sampled `sample_every` frames (by default, 100 samples over the
+    run) and the run fails if any of it grows without bound.
+    """
+    if sample_every is None:
+        sample_every = max(num_frames // 100, 1)
+    clock = AcceleratedClock()
+    camera = fake_camera(profile, suffixes=suffixes, file_size=file_size, clock=clock.timestamp)
+    camera.backend.files_per_exposure = len(suffixes)
+    with tempfile.TemporaryDirectory(prefix="chrophos-soak-") as temp_dir:
+        output_dir = Path(temp_dir) if output_dir is None else output_dir
+        monitor = SoakMonitor(
+            clock, sample_every=sample_every, count_objects=count_objects, prune_dir=output_dir
+        )
+        failures = []
+        chrophos_logger = logging.getLogger("chrophos")
+        original_level = chrophos_logger.level
+        # Per-frame logging would swamp everything else (and dominate the overhead being
+        # measured); only the samples are logged
+        chrophos_logger.setLevel(logging.WARNING)
+        logger.setLevel(original_level)
+        start_time = clock.now()
+        real_start = time.perf_counter()
+        try:
+            timelapse(
+                camera=camera,
+                num_frames=num_frames,
+                interval=interval,
+                output_dir=output_dir,
+                mode=mode,
+                overwrite=True,
+                commit_frames=commit_frames,
+                sync=False,
+                clock=clock,
+                on_frame=monitor,
+            )
+        except ValueError as error:
+            failures.append(f"Timelapse failed after {monitor.frames:,} frames: {error}")
+        finally:
+            camera.backend.exit()
+            chrophos_logger.setLevel(original_level)
+            logger.setLevel(logging.NOTSET)
+        real_seconds = time.perf_counter() - real_start
+    failures.extend(check_growth(monitor.samples))
+    return SoakReport(
+        frames=monitor.frames,
+        interval=interval,
+        virtual_duration=clock.now() - start_time,
+        real_seconds=real_seconds,
+        samples=monitor.samples,
+        failures=failures,
+        frame_latency=monitor.frame_latency,
+    )
+
+
+def summary(report: SoakReport):
+    print(
+        f"Soaked {report.frames:,} frames at {report.interval.total_seconds()}s interval:"
+        f" {report.virtual_duration} of capture in {report.real_seconds:.1f}s"
+        f" ({report.frames / report.real_seconds:,.0f} frames/s)"
+    )
+    if report.samples:
+        first, last = report.samples[0], report.samples[-1]
+        print(f"  RSS: {first.rss / 2**20:.1f} -> {last.rss / 2**20:.1f} MiB")
+        print(f"  Open file descriptors: {first.open_fds} -> {last.open_fds}")
+        print(f"  GC-tracked objects: {first.objects} -> {last.objects}")
+        print(
+            f"  Overhead per frame: {first.frame_seconds * 1e3:.3f} ->"
+            f" {last.frame_seconds * 1e3:.3f} ms"
+        )
+    if report.frame_latency:
+        print(f"  {report.frame_latency.summary()}")
+    if report.passed:
+        print("PASSED")
+    else:
+        for failure in report.failures:
+            print(f"FAILED: {failure}")
@@ -0,0 +1,511 @@
+import logging
+import math
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import rawpy
+from PIL import Image
+
+from chrophos.archive import ArchiveEntry, ArchiveReader, is_archive, read_entry
+from chrophos.image import load_frame
+from chrophos.layout import frame_number, open_layout
+
+logger = logging.getLogger(__name__)
+
+# Pixel values are 16-bit throughout
+WHITE = 65535
+
+# A frame to stack: a path, or a frame within an archive
+Source = Union[Path, tuple[Path, ArchiveEntry]]
+# name -> (shape, dtype) of each of the arrays making up a reducer's state
+StateSpec = dict[str, tuple[tuple, str]]
+
+
+class Method:
+    MAX = "max"
+    MEAN = "mean"
+    SIGMA_CLIP = "sigma-clip"
+    MEDIAN = "median"
+    # Max, with each frame fading the older it is: star trails with comet-like tails
+    COMET = "comet"
+
+
+def _unit(frame: np.ndarray):
+    return frame.astype(np.float32) / WHITE
+
+
+class Reducer:
+    """A way of reducing a stack of frames to one, a frame at a time
+
+    The state is a dict of arrays, which `stack` keeps in shared memory: one partial state per
+    worker, which are merged pairwise at the end. `constants` are read-only arrays (e.g. the
+    result of a previous pass) that every worker can see.
+    """
+
+    def state(self, shape: tuple) -> StateSpec:
+        raise NotImplementedError
+
+    def constants(self, shape: tuple) -> StateSpec:
+        return {}
+
+    def reset(self, state: dict[str, np.ndarray]):
+        for array in state.values():
+            array.fill(0)
+
+    def add(self, state: dict, frame: np.ndarray, index: int, constants: dict):
+        raise NotImplementedError
+
+    def merge(self, into: dict, other: dict):
+        for name, array in into.items():
+            array += other[name]
+
+    def result(self, state: dict) -> np.ndarray:
+        """The reduced frame, as float32 from 0 to 1"""
+        raise NotImplementedError
+
+    def bytes_per_pixel(self):
+        spec = self.state((1, 1, 3))
+        return sum(math.prod(shape) * np.dtype(dtype).itemsize for shape, dtype in spec.values())
+
+
+class MaxReducer(Reducer):
+    def __init__(self, dtype="uint16"):
+        self.dtype = dtype
+
+    def state(self, shape):
+        return {"max": (shape, self.dtype)}
+
+    def add(self, state, frame, index, constants):
+        np.maximum(
+            state["max"], frame if self.dtype == "uint16" else _unit(frame), out=state["max"]
+        )
+
+    def merge(self, into, other):
+        np.maximum(into["max"], other["max"], out=into["max"])
+
+    def result(self, state):
+        if self.dtype == "uint16":
+            return _unit(state["max"])
+        return state["max"].copy()
+
+
+class CometReducer(MaxReducer):
+    """Max of the frames, each faded by `decay` for every frame that follows it
+
+    A frame's weight depends only on its position in the sequence, so frames can still be added
+    in any order (and partials merged) like a plain max.
+    """
+
+    def __init__(self, frames: int, decay=0.97, dtype="uint16"):
+        super().__init__(dtype)
+        self.frames = frames
+        self.decay = decay
+
+    def add(self, state, frame, index, constants):
+        faded = _unit(frame) * self.decay ** (self.frames - 1 - index)
+        if self.dtype == "uint16":
+            faded = np.rint(faded * WHITE).astype(np.uint16)
+        np.maximum(state["max"], faded, out=state["max"])
+
+
+class MeanReducer(Reducer):
+    def state(self, shape):
+        return {"sum": (shape, "float32"), "count": ((1,), "uint32")}
+
+    def add(self, state, frame, index, constants):
+        state["sum"] += _unit(frame)
+        state["count"] += 1
+
+    def result(self, state):
+        return state["sum"] / max(int(state["count"][0]), 1)
+
+
+class MomentsReducer(MeanReducer):
+    """Mean and standard deviation; the first pass of a sigma-clipped mean"""
+
+    def state(self, shape):
+        return {**super().state(shape), "sum_squares": (shape, "float32")}
+
+    def add(self, state, frame, index, constants):
+        unit = _unit(frame)
+        state["sum"] += unit
+        state["sum_squares"] += unit * unit
+        state["count"] += 1
+
+    def result(self, state):
+        count = max(int(state["count"][0]), 1)
+        mean = state["sum"] / count
+        variance = np.maximum(state["sum_squares"] / count - mean * mean, 0)
+        return mean, np.sqrt(variance)
+
+
+class ClippedMeanReducer(Reducer):
+    """Mean of only the values within `kappa` standard deviations of the mean
+
+    Needs the mean and standard deviation (the constants "mean" and "std") from a first pass.
+    Those are only as exact as float32 sums over `frames` frames, so values within that error
+    (or within a step of the 16-bit input) of the mean are always kept: otherwise a pixel that's
+    the same in every frame, with a std of 0, would have every value clipped.
+    """
+
+    def __init__(self, kappa=3.0, frames=WHITE):
+        self.kappa = kappa
+        self.tolerance = np.float32(1 / WHITE + frames * np.finfo(np.float32).eps)
+        # Per-pixel counts only need to be as wide as the number of frames
+        self.count_dtype = "uint16" if frames <= np.iinfo(np.uint16).max else "uint32"
+
+    def state(self, shape):
+        return {"sum": (shape, "float32"), "count": (shape, self.count_dtype)}
+
+    def constants(self, shape):
+        return {"mean": (shape, "float32"), "std": (shape, "float32")}
+
+    def add(self, state, frame, index, constants):
+        unit = _unit(frame)
+        keep = np.abs(unit - constants["mean"]) <= self.kappa * constants["std"] + self.tolerance
+        state["sum"] += np.where(keep, unit, 0)
+        state["count"] += keep
+
+    def result(self, state):
+        return state["sum"] / np.maximum(state["count"], 1)
+
+
+class MedianReducer(Reducer):
+    """Approximate median, from a histogram of each pixel's values
+
+    Bins are evenly spaced on a square-root scale, to give dark pixels (most of a night sky)
+    finer bins; within its bin, the median is interpolated linearly.
+    """
+
+    def __init__(self, bins=64, frames=WHITE):
+        self.bins = bins
+        self.count_dtype = "uint16" if frames <= np.iinfo(np.uint16).max else "uint32"
+
+    def state(self, shape):
+        return {"histogram": ((math.prod(shape), self.bins), self.count_dtype)}
+
+    def add(self, state, frame, index, constants):
+        histogram = state["histogram"]
+        bins = np.minimum(np.sqrt(_unit(frame)) * self.bins, self.bins - 1).astype(np.intp)
+        # Every pixel increments exactly one of its own bins, so there are no repeated indices
+        flat = np.arange(bins.size, dtype=np.intp) * self.bins + bins.ravel()
+        histogram.reshape(-1)[flat] += 1
+
+    def result(self, state):
+        histogram = state["histogram"]
+        cumulative = np.cumsum(histogram, axis=1, dtype=np.uint32)
+        half = cumulative[:, -1:] / 2
+        median_bin = np.minimum((cumulative < half).sum(axis=1), self.bins - 1)
+        pixels = np.arange(len(histogram))
+        in_bin = histogram[pixels, median_bin].astype(np.float32)
+        below = cumulative[pixels, median_bin] - in_bin
+        fraction = np.where(in_bin > 0, (half[:, 0] - below) / np.maximum(in_bin, 1), 0.5)
+        return ((median_bin + fraction) / self.bins).astype(np.float32) ** 2
+
+
+def reducers(method: str, frames: int, dtype="uint16", decay=0.97, kappa=3.0, median_bins=64):
+    """The reducer for each pass over the frames that `method` takes"""
+    if method == Method.MAX:
+        return [MaxReducer(dtype)]
+    if method == Method.COMET:
+        return [CometReducer(frames, decay=decay, dtype=dtype)]
+    if method == Method.MEAN:
+        return [MeanReducer()]
+    if method == Method.SIGMA_CLIP:
+        return [MomentsReducer(), ClippedMeanReducer(kappa=kappa, frames=frames)]
+    if method == Method.MEDIAN:
+        return [MedianReducer(bins=median_bins, frames=frames)]
+    raise ValueError(f"Unknown stacking method {method!r}")
+
+
+# State of a worker process (or of the main process, which uses the same functions)
+_worker: dict = {}
+
+
+def _attach(spec: dict[str, tuple[str, tuple, str]]):
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, (block, _, _) in spec.items()}
+    arrays = {
+        name: np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+        for name, (_, shape, dtype) in spec.items()
+    }
+    return blocks, arrays
+
+
+def _init_worker(
+    reducer: Reducer, partials: list, constants: dict, rows, width, half_size, calibration, slots
+):
+    _worker["reducer"] = reducer
+    _worker["rows"] = rows
+    _worker["width"] = width
+    _worker["half_size"] = half_size
+    _worker["calibration"] = calibration
+    _worker["blocks"] = []
+    _worker["partials"] = []
+    for spec in partials:
+        blocks, arrays = _attach(spec)
+        _worker["blocks"].append(blocks)
+        _worker["partials"].append(arrays)
+    constant_blocks, _worker["constants"] = _attach(constants)
+    _worker["blocks"].append(constant_blocks)
+    _worker["slot"] = slots.get() if slots is not None else 0
+
+
+def _release_worker():
+    blocks = _worker.get("blocks", [])
+    # The arrays have to go before the memory under them can be closed
+    _worker.clear()
+    for group in blocks:
+        for block in group.values():
+            block.close()
+
+
+def read_source(source: Source) -> tuple[Union[Path, bytes], str]:
+    """The path or data of a frame, and its suffix, for `load_frame`"""
+    if isinstance(source, Path):
+        return source, source.suffix
+    archive_dir, entry = source
+    return read_entry(archive_dir, entry), Path(entry.name).suffix
+
+
+def _name(source: Source):
+    return str(source) if isinstance(source, Path) else f"{source[1].name} in {source[0]}"
+
+
+def _add_frame(task: tuple[int, Source]):
+    index, source = task
+    try:
+        data, suffix = read_source(source)
+        frame = load_frame(
+            data, suffix, half_size=_worker["half_size"], calibration=_worker["calibration"]
+        )
+    except (OSError, ValueError, rawpy.LibRawError) as error:
+        return index, f"Couldn't decode {_name(source)}: {error}"
+    start, end = _worker["rows"]
+    if frame.shape[0] < end or frame.shape[1] != _worker["width"]:
+        size = f"{frame.shape[1]}x{frame.shape[0]}"
+        return index, f"{_name(source)} is {size}, unlike the other frames"
+    state = _worker["partials"][_worker["slot"]]
+    _worker["reducer"].add(state, frame[start:end], index, _worker["constants"])
+    return index, None
+
+
+def _merge(pair: tuple[int, int]):
+    into, other = pair
+    _worker["reducer"].merge(_worker["partials"][into], _worker["partials"][other])
+
+
+def _allocate(spec: StateSpec, created: list) -> dict[str, tuple[str, tuple, str]]:
+    allocated = {}
+    for name, (shape, dtype) in spec.items():
+        size = max(math.prod(shape) * np.dtype(dtype).itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        created.append(block)
+        allocated[name] = (block.name, shape, dtype)
+    return allocated
+
+
+def _run_pass(
+    reducer: Reducer,
+    sources: list[Source],
+    rows: tuple[int, int],
+    width: int,
+    workers: int,
+    half_size=False,
+    constants: Union[dict[str, np.ndarray], None] = None,
+    calibration=None,
+):
+    """Reduce `rows` of every frame, with one partial state per worker; returns the result"""
+    shape = (rows[1] - rows[0], width, 3)
+    created: list[shared_memory.SharedMemory] = []
+    try:
+        partials = [_allocate(reducer.state(shape), created) for _ in range(workers)]
+        constant_spec = _allocate(reducer.constants(shape), created)
+        _init_worker(
+            reducer, partials, constant_spec, rows, width, half_size, calibration, slots=None
+        )
+        for state in _worker["partials"]:
+            reducer.reset(state)
+        for name, array in (constants or {}).items():
+            _worker["constants"][name][...] = array
+        tasks = list(enumerate(sources))
+        if workers == 1:
+            _log_progress(map(_add_frame, tasks), len(tasks))
+        else:
+            context = multiprocessing.get_context()
+            slots = context.Queue()
+            for slot in range(workers):
+                slots.put(slot)
+            initargs = (
+                reducer,
+                partials,
+                constant_spec,
+                rows,
+                width,
+                half_size,
+                calibration,
+                slots,
+            )
+            with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                _log_progress(pool.imap_unordered(_add_frame, tasks), len(tasks))
+                # Merge the partials pairwise, in parallel, until only the first is left
+                step = 1
+                while step < workers:
+                    pool.map(_merge, [(i, i + step) for i in range(0, workers - step, 2 * step)])
+                    step *= 2
+        return reducer.result(_worker["partials"][0])
+    finally:
+        _release_worker()
+        for block in created:
+            block.close()
+            block.unlink()
+
+
+def _log_progress(results, total: int):
+    start = time.perf_counter()
+    for done, (_index, error) in enumerate(results, 1):
+        if error:
+            logger.warning(error)
+        if done % 100 == 0 or done == total:
+            elapsed = time.perf_counter() - start
+            logger.info(f"Stacked {done:,}/{total:,} frames ({done / elapsed:.1f} frames/s)")
+
+
+class _Output:
+    """Write the stacked image a band of rows at a time
+
+    16-bit PPMs and float32 .npy files are streamed to disk; any other format that PIL can
+    write is 8-bit, and held in memory until `close`.
+    """
+
+    def __init__(self, path: Path, width: int, height: int):
+        self.path = path
+        self.suffix = path.suffix.lower()
+        if self.suffix == ".ppm":
+            self.file = open(path, "wb")
+            self.file.write(f"P6\n{width} {height}\n{WHITE}\n".encode())
+        elif self.suffix == ".npy":
+            self.pixels = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=(height, width, 3)
+            )
+        else:
+            self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def write(self, start: int, band: np.ndarray):
+        band = np.clip(band, 0, 1)
+        if self.suffix == ".ppm":
+            # PPM samples are big-endian
+            self.file.write(np.rint(band * WHITE).astype(">u2").tobytes())
+        elif self.suffix == ".npy":
+            self.pixels[start : start + len(band)] = band
+        else:
+            self.pixels[start : start + len(band)] = np.rint(band * 255).astype(np.uint8)
+
+    def close(self):
+        if self.suffix == ".ppm":
+            self.file.close()
+        elif self.suffix == ".npy":
+            self.pixels.flush()
+        else:
+            Image.fromarray(self.pixels).save(self.path)
+
+
+def stack(
+    sources: list[Source],
+    output_path: Path,
+    method=Method.MAX,
+    workers: Union[int, None] = None,
+    memory_limit=2 * 2**30,
+    dtype="uint16",
+    decay=0.97,
+    kappa=3.0,
+    median_bins=64,
+    half_size=False,
+    calibration=None,
+):
+    """Stack `sources` (see `frame_sources`) into a single image, using `method` (see `Method`)
+
+    Frames are decoded and added to partial results in a pool of `workers` processes (by default,
+    one per core), which are then merged pairwise. The partials are held in shared memory; if all
+    of them won't fit in `memory_limit` bytes, the image is stacked in bands of rows, each a
+    separate pass over the frames. Sigma-clipped means also take two passes per band.
+
+    `dtype` (uint16 or float32) is that of the max and comet accumulators; means and medians
+    always accumulate in float32 and counts.
+
+    A `calibration` (see `chrophos.calibration`) corrects each RAW as it's decoded.
+    """
+    if not sources:
+        raise ValueError("No frames to stack")
+    if dtype not in ("uint16", "float32"):
+        raise ValueError(f"Can only stack in uint16 or float32, not {dtype}")
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    passes = reducers(method, len(sources), dtype, decay, kappa, median_bins)
+    data, suffix = read_source(sources[0])
+    first = load_frame(data, suffix, half_size=half_size, calibration=calibration)
+    height, width = first.shape[:2]
+    bytes_per_pixel = max(
+        workers * reducer.bytes_per_pixel() + 4 * len(reducer.constants((1, 1, 3))) * 3
+        for reducer in passes
+    )
+    rows_per_band = max(1, min(height, memory_limit // (width * bytes_per_pixel)))
+    bands = -(-height // rows_per_band)
+    logger.info(
+        f"Stacking {len(sources):,} {width}x{height} frames by {method} with {workers}"
+        f" worker(s), in {bands} band(s) of {rows_per_band} rows"
+    )
+    start_time = time.perf_counter()
+    output = _Output(output_path, width, height)
+    try:
+        for start in range(0, height, rows_per_band):
+            rows = (start, min(start + rows_per_band, height))
+            shape = (rows[1] - rows[0], width, 3)
+            constants = None
+            for reducer in passes:
+                result = _run_pass(
+                    reducer, sources, rows, width, workers, half_size, constants, calibration
+                )
+                if isinstance(reducer, MomentsReducer):
+                    mean, std = result
+                    constants = {"mean": mean, "std": std}
+            output.write(start, np.asarray(result).reshape(shape))
+    finally:
+        output.close()
+    logger.info(
+        f"Stacked {len(sources):,} frames into {output_path} in"
+        f" {time.perf_counter() - start_time:.1f}s"
+    )
+    return output_path
+
+
+def frame_sources(
+    root: Path,
+    suffix: Union[str, None] = None,
+    first_frame: Union[int, None] = None,
+    last_frame: Union[int, None] = None,
+) -> list[Source]:
+    """The frames (with the given suffix and in the given range) of an output or archive
+    directory, in frame order
+    """
+    if is_archive(root):
+        entries = [
+            entry
+            for entry in ArchiveReader(root).entries
+            if suffix is None or entry.name.endswith(suffix)
+        ]
+        entries.sort(key=lambda entry: (entry.frame is None, entry.frame, entry.name))
+        sources = [(root, entry) for entry in entries]
+        numbers = [entry.frame for entry in entries]
+    else:
+        sources = open_layout(root).frame_paths(suffix)
+        numbers = [frame_number(path) for path in sources]
+    return [
+        source
+        for source, number in zip(sources, numbers)
+        if (first_frame is None or (number is not None and number >= first_frame))
+        and (last_frame is None or (number is not None and number <= last_frame))
+    ]
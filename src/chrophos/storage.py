@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable, Union
+
+from chrophos.utilities.histogram import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = ".chrophos_journal"
+INCOMPLETE_DIR_NAME = ".incomplete"
+# Suffixes of the files written alongside frames (logs, indexes, etc.)
+NON_FRAME_SUFFIXES = {".json", ".jsonl", ".gz", ".log", ".txt", ".toml", ".tmp"}
+# How far a file's mtime can be behind the time it was written: FAT only stores it to 2s
+MTIME_SLACK = 2.0
+
+
+class FrameWriter:
+    """Write frames to `output_dir`, fsync'ing them in groups rather than one at a time
+
+    Every frame is recorded in a small append-only journal before it is written. Once a group of
+    frames has been fsync'd (every `commit_frames` frames, or `commit_interval` after the first
+    uncommitted frame, whichever comes first) a commit record is appended, and only then is the
+    journal itself fsync'd. After a power loss, `recover` uses the journal to find the last
+    consistent frame. With `sync` off nothing is fsync'd at all, which is only of use where
+    durability doesn't matter (e.g. `chrophos.soak`).
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        commit_frames=10,
+        commit_interval=timedelta(seconds=30),
+        preallocate=True,
+        checksum=True,
+        max_journal_bytes=1_000_000,
+        on_commit: Union[Callable[[list[Path]], None], None] = None,
+        sync=True,
+    ):
+        self.output_dir = output_dir
+        self.commit_frames = commit_frames
+        self.commit_interval = commit_interval
+        self.preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self.checksum = checksum
+        self.max_journal_bytes = max_journal_bytes
+        # Called with the paths of each group of frames once they have been committed
+        self.on_commit = on_commit
+        self.sync = sync
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.output_dir / JOURNAL_NAME
+        self._journal = open(self.journal_path, "a")
+        # (path, file descriptor) of every frame written since the last commit
+        self._pending: list[tuple[Path, int]] = []
+        self._first_pending_time: Union[float, None] = None
+        self.last_committed: Union[str, None] = None
+        # (time, names) of the commits within MTIME_SLACK of the last one; see `compact_journal`
+        self._recent_commits: list[tuple[float, list[str]]] = []
+        # Anything written from here on that isn't committed is suspect; see `recover`
+        self._append_journal({"op": "open", "time": time.time()}, sync=True)
+
+        self.write_latency = LatencyHistogram("write")
+        self.commit_latency = LatencyHistogram("commit")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _append_journal(self, record: dict, sync=False):
+        self._journal.write(json.dumps(record) + "\n")
+        # Handed to the OS straight away, so that it survives chrophos crashing, but only synced
+        # (to survive a power loss) when asked
+        self._journal.flush()
+        if sync and self.sync:
+            os.fsync(self._journal.fileno())
+
+    def write(self, name: str, data) -> Path:
+        start = time.perf_counter()
+        view = memoryview(data).cast("B")
+        size = view.nbytes
+        path = self.output_dir / name
+        record = {"op": "write", "name": name, "size": size}
+        if self.checksum:
+            record["crc32"] = zlib.crc32(view)
+        # Not synced: if the record is lost, `recover` still finds the frame, as one written since
+        # the last commit
+        self._append_journal(record)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if self.preallocate and size:
+                try:
+                    # Reserve all of the frame's blocks up front, so that the filesystem doesn't
+                    # have to update its allocation metadata on every chunk
+                    os.posix_fallocate(fd, 0, size)
+                except OSError as error:
+                    logger.debug(f"Preallocation not supported in {self.output_dir}: {error}")
+                    self.preallocate = False
+            written = 0
+            while written < size:
+                written += os.write(fd, view[written:])
+        except BaseException:
+            os.close(fd)
+            raise
+        self._pending.append((path, fd))
+        if self._first_pending_time is None:
+            self._first_pending_time = time.monotonic()
+        self.write_latency.record(time.perf_counter() - start)
+
+        if self.commit_due():
+            self.commit()
+        return path
+
+    def commit_due(self):
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.commit_frames:
+            return True
+        return time.monotonic() - self._first_pending_time >= self.commit_interval.total_seconds()
+
+    def commit(self):
+        if not self._pending:
+            return
+        start = time.perf_counter()
+        # Every pending frame was written before now, so any frame file older than this is
+        # covered by this commit or an earlier one
+        commit_time = time.time()
+        for _path, fd in self._pending:
+            if self.sync:
+                os.fsync(fd)
+            os.close(fd)
+        if self.sync:
+            # New directory entries aren't durable until the directory itself is synced
+            dir_fd = os.open(self.output_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.last_committed = self._pending[-1][0].name
+        names = [path.name for path, _fd in self._pending]
+        self._append_journal({"op": "commit", "names": names, "time": commit_time}, sync=True)
+        self._recent_commits = [
+            (other_time, other_names)
+            for other_time, other_names in self._recent_commits
+            if other_time >= commit_time - MTIME_SLACK
+        ] + [(commit_time, names)]
+        logger.debug("Committed %s frame(s) through %s", len(self._pending), self.last_committed)
+        if self.on_commit:
+            self.on_commit([path for path, _fd in self._pending])
+        self._pending = []
+        self._first_pending_time = None
+        self.commit_latency.record(time.perf_counter() - start)
+
+        if self._journal.tell() > self.max_journal_bytes:
+            self.compact_journal()
+
+    def compact_journal(self):
+        """Replace the journal with a single checkpoint record; only valid right after a commit
+
+        The checkpoint keeps the names of the frames committed too recently for their mtimes to
+        tell `recover` that they're older than the last commit.
+        """
+        self._journal.close()
+        _write_checkpoint(
+            self.journal_path,
+            self.last_committed,
+            self._recent_commits[-1][0],
+            [name for _time, names in self._recent_commits for name in names],
+        )
+        self._journal = open(self.journal_path, "a")
+        logger.debug(f"Compacted journal {self.journal_path}")
+
+    @property
+    def closed(self):
+        return self._journal.closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.commit()
+        self._journal.close()
+        logger.info(self.write_latency.summary())
+        logger.info(self.commit_latency.summary())
+
+    def stats(self):
+        return {
+            "write": self.write_latency.as_dict(),
+            "commit": self.commit_latency.as_dict(),
+        }
+
+
+def _write_checkpoint(journal_path: Path, name: Union[str, None], time_: float, names: list[str]):
+    tmp_path = journal_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        record = {"op": "checkpoint", "name": name, "time": time_, "names": names}
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def _frame_files(output_dir: Path):
+    for path in output_dir.iterdir():
+        if (
+            not path.name.startswith(".")
+            and path.suffix.lower() not in NON_FRAME_SUFFIXES
+            and path.is_file()
+        ):
+            yield path
+
+
+def recover(output_dir: Path):
+    """Bring `output_dir` back to a consistent state after an unclean shutdown
+
+    Frames that were journaled but never committed are kept only if their size and checksum match
+    the journal. Frames written since the last commit that aren't in the journal at all (their
+    records not having been synced) can't be checked, so are treated as incomplete. Incomplete
+    frames are moved into an `.incomplete` directory for inspection.
+
+    Returns the name of the last consistent frame (or None) and a list of the quarantined paths
+    """
+
+    journal_path = output_dir / JOURNAL_NAME
+    if not journal_path.exists():
+        return None, []
+
+    last_consistent = None
+    uncommitted: dict[str, dict] = {}
+    committed: set[str] = set()
+    # When the journal was last known to be consistent with the directory
+    since: Union[float, None] = None
+    with open(journal_path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line is expected after a power loss
+                logger.debug(f"Ignoring partial journal record {line!r}")
+                break
+            if record["op"] == "write":
+                uncommitted[record["name"]] = record
+            elif record["op"] == "commit":
+                for name in record["names"]:
+                    uncommitted.pop(name, None)
+                committed.update(record["names"])
+                last_consistent = record["names"][-1]
+            elif record["op"] == "checkpoint":
+                committed.update(record.get("names", []))
+                last_consistent = record["name"]
+            since = record.get("time", since)
+
+    if since is not None:
+        for path in _frame_files(output_dir):
+            if path.name in committed or path.name in uncommitted:
+                continue
+            if path.stat().st_mtime >= since - MTIME_SLACK:
+                uncommitted[path.name] = {"name": path.name, "size": None}
+
+    quarantined = []
+    for name, record in uncommitted.items():
+        path = output_dir / name
+        if not path.exists():
+            continue
+        data = path.read_bytes()
+        if len(data) == record["size"] and zlib.crc32(data) == record.get(
+            "crc32", zlib.crc32(data)
+        ):
+            logger.info(f"Uncommitted frame {path} is intact; keeping it")
+            last_consistent = name
+            continue
+        incomplete_dir = output_dir / INCOMPLETE_DIR_NAME
+        incomplete_dir.mkdir(exist_ok=True)
+        quarantine_path = incomplete_dir / name
+        os.replace(path, quarantine_path)
+        logger.warning(f"Frame {path} is incomplete; moved it to {quarantine_path}")
+        quarantined.append(quarantine_path)
+
+    # Start the next run from a clean journal. Everything left is consistent, but the newest
+    # frames have to be named, as their mtimes can be as late as now
+    now = time.time()
+    recent = [
+        path.name for path in _frame_files(output_dir) if path.stat().st_mtime >= now - MTIME_SLACK
+    ]
+    _write_checkpoint(journal_path, last_consistent, now, recent)
+    return last_consistent, quarantined
@@ -1,36 +1,70 @@
+import itertools
+import json
 import logging
-import time
+import math
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from pathlib import Path
-from time import sleep
-from typing import Union
+from typing import Callable, Union
 
 import typer
 
+from chrophos.adaptive import AdaptiveInterval
+from chrophos.archive import ArchivePacker
+from chrophos.camera.bracket import record_bracket_set
 from chrophos.camera.camera import Camera
-from chrophos.plan import format_timedelta
+from chrophos.camera.latency import TriggerCalibration
+from chrophos.camera.liveview import LiveViewMeter
+from chrophos.camera.supervisor import CameraSupervisor
+from chrophos.clock import SYSTEM_CLOCK, Clock
+from chrophos.control import ControlServer
+from chrophos.dedupe import DuplicateFilter
+from chrophos.layout import Layout, ShardedLayout, open_layout
+from chrophos.logs import log_context
+from chrophos.overview import LiveOverview
+from chrophos.pipeline import FramePipeline
+from chrophos.profiling import FrameProfiler
+from chrophos.storage import recover
 
 logger = logging.getLogger(__name__)
 
 app = typer.Typer()
 
+BRACKET_LOG_NAME = "brackets.jsonl"
+MISSED_LOG_NAME = "missed.jsonl"
+
 
 ZERO_DELTA = timedelta(0)
 
 
-def sleep_until(dt: datetime, precision=0.01):
-    logger.debug(f"Sleeping until {dt}")
+def sleep_until(dt: datetime, precision=0.01, clock: Clock = SYSTEM_CLOCK):
+    logger.debug("Sleeping until %s", dt)
     while True:
-        now = datetime.now()
+        now = clock.now()
         delta = dt - now
         if delta <= ZERO_DELTA:
-            logger.debug(
-                "Done sleeping. Missed target by"
-                f" {format_timedelta(timedelta(seconds=abs(delta.total_seconds())))}"
-            )
+            logger.debug("Done sleeping. Missed target by %s", -delta)
             return delta
         else:
-            sleep(precision)
+            remaining = delta.total_seconds()
+            # Sleep through most of a long wait in one go, then poll for the rest
+            clock.sleep(remaining - precision if remaining > 2 * precision else precision)
+
+
+def record_missed_slot(path: Path, frame: int, commanded_capture_time: datetime, now: datetime):
+    """Append a frame that was skipped because its capture window had passed to `path`"""
+    record = {
+        "frame": frame,
+        "commanded_capture_time": commanded_capture_time.isoformat(),
+        "detected_at": now.isoformat(),
+        "late_by": (now - commanded_capture_time).total_seconds(),
+    }
+    with open(path, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+def _call(func: Callable, *args, **kwargs):
+    return func(*args, **kwargs)
 
 
 def get_nearest_shutter_under(camera: Camera, value):
@@ -50,16 +84,72 @@ def gen_times(
     interval: timedelta,
     num_frames: Union[int, None] = None,
     start: Union[datetime, None] = None,
+    clock: Clock = SYSTEM_CLOCK,
 ):
     if start is None:
-        start = datetime.now()
-    if num_frames is None:
-        while True:
-            start += interval
-            yield start
-    else:
-        for i in range(num_frames):
-            yield start + interval * i
+        start = clock.now()
+    # Both ways start at `start`, and work out each time from its index
+    frames = itertools.count() if num_frames is None else range(num_frames)
+    for i in frames:
+        yield start + interval * i
+
+
+class Schedule:
+    """The capture times of a run, as (frame number, commanded capture time), which (unlike
+    `gen_times`) can be changed while it's being iterated over
+    """
+
+    def __init__(
+        self,
+        interval: timedelta,
+        num_frames: Union[int, None],
+        start: datetime,
+        first_frame: int = 1,
+    ):
+        self.interval = interval
+        self.num_frames = num_frames
+        self.next_time = start
+        self.next_frame = first_frame
+        self.first_frame = first_frame
+
+    @property
+    def frames(self):
+        """How many frames have been scheduled so far"""
+        return self.next_frame - self.first_frame
+
+    @property
+    def remaining(self):
+        return None if self.num_frames is None else max(self.num_frames - self.frames, 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining == 0:
+            raise StopIteration
+        slot = (self.next_frame, self.next_time)
+        self.next_frame += 1
+        self.next_time += self.interval
+        return slot
+
+    def set_interval(self, interval: timedelta, earliest: Union[datetime, None] = None):
+        """Change the interval, starting with the gap before the next frame (which, if that's now
+        in the past, is instead moved to `earliest`)
+        """
+        self.next_time += interval - self.interval
+        if earliest is not None:
+            self.next_time = max(self.next_time, earliest)
+        self.interval = interval
+
+    def skip_until(self, dt: datetime):
+        """Skip ahead to the first slot at or after `dt`, keeping to the same phase; the frame
+        numbers carry on where they were. Returns the number of slots skipped.
+        """
+        if self.next_time >= dt:
+            return 0
+        skipped = math.ceil((dt - self.next_time) / self.interval)
+        self.next_time += self.interval * skipped
+        return skipped
 
 
 def timelapse(
@@ -72,9 +162,91 @@ def timelapse(
     start_delay=timedelta(seconds=1),
     dry_run=False,
     overwrite=False,
+    commit_frames=10,
+    commit_interval=timedelta(seconds=30),
+    sync=True,
+    bracket: Union[int, None] = None,
+    bracket_step: Union[str, None] = None,
+    profiler: Union[FrameProfiler, None] = None,
+    clock: Clock = SYSTEM_CLOCK,
+    on_frame: Union[Callable[[int, datetime], None], None] = None,
+    supervisor: Union[CameraSupervisor, None] = None,
+    layout: Union[Layout, None] = None,
+    packer: Union[ArchivePacker, None] = None,
+    dedupe: Union[DuplicateFilter, None] = None,
+    overview: Union[LiveOverview, None] = None,
+    control: Union[ControlServer, None] = None,
+    calibration: Union[TriggerCalibration, None] = None,
+    pipeline: Union[FramePipeline, None] = None,
+    adaptive: Union[AdaptiveInterval, None] = None,
+    liveview: Union[LiveViewMeter, None] = None,
 ):
-    if not overwrite and output_dir.is_dir() and any(output_dir.iterdir()):
-        raise ValueError(f"Given output directory {output_dir} already exists and is non-empty!")
+    """Capture `num_frames` frames (forever, if None) at the given `interval`
+
+    If `bracket` is given, each frame is an in-camera exposure bracket of that many shots, fired
+    as a single burst; the files and timings of each set are logged to `brackets.jsonl`.
+
+    If a `profiler` is given, every frame iteration is profiled, less the wait for its capture
+    time; see `FrameProfiler`.
+
+    All timekeeping goes through `clock`; `on_frame(i, commanded_capture_time)` is called after
+    every frame. Both exist so that `chrophos.soak` can drive the loop far faster than real time,
+    as does `sync` (see `FrameWriter`).
+
+    If a `supervisor` is given, captures that fail with a gphoto2 error are retried (reconnecting
+    the camera if need be; see `CameraSupervisor`). Rather than ending the run, any frames whose
+    capture windows pass in the meantime are skipped and logged to `missed.jsonl`, and the run
+    rejoins the original schedule.
+
+    Frames are written according to `layout`: by default, that of an existing `output_dir`, or
+    else flat. With a `ShardedLayout`, a resumed run continues numbering from the last frame; it
+    must be sharded as the original run was.
+
+    If a `packer` is given, frames are packed into its archive as they are committed, pausing
+    whenever a frame is being captured.
+
+    If `dedupe` is given, frames that barely differ from the last one kept are stored only as a
+    thumbnail, or not at all; see `DuplicateFilter`.
+
+    If an `overview` is given, committed frames are added to its keogram and contact sheets in the
+    background (before being handed on to the `packer`, if any).
+
+    If a `control` server is given, the run can be inspected, paused, re-exposed and rescheduled
+    while it's running; its commands are run between frames. See `ControlServer`.
+
+    If a `calibration` is given, each trigger is fired early by the predicted trigger-to-exposure
+    latency, so that exposures start on the commanded grid; see `TriggerCalibration`.
+
+    If a `pipeline` is given, frames are stored (and analyzed) by its worker processes, rather
+    than by the capture loop's; see `FramePipeline`.
+
+    If `adaptive` is given, the interval is lengthened while the scene is static and shortened
+    when it changes (starting from `interval`); see `AdaptiveInterval`.
+
+    If `liveview` is given, the exposure is corrected from live view previews grabbed between
+    frames, whenever there's time to; see `LiveViewMeter`.
+    """
+    existing_layout = open_layout(output_dir)
+    if layout is None:
+        layout = existing_layout
+    if output_dir.is_dir() and any(output_dir.iterdir()):
+        if not overwrite:
+            raise ValueError(
+                f"Given output directory {output_dir} already exists and is non-empty!"
+            )
+        if isinstance(existing_layout, ShardedLayout):
+            if not isinstance(layout, ShardedLayout):
+                raise ValueError(f"{output_dir} is sharded; it can't be resumed flat")
+            # Checked before recovering anything
+            layout.save()
+        for resume_dir in layout.resume_dirs():
+            last_consistent, quarantined = recover(resume_dir)
+            if quarantined:
+                logger.warning(
+                    f"Recovered {resume_dir} to last consistent frame {last_consistent};"
+                    f" quarantined {len(quarantined)} incomplete frame(s)"
+                )
+    first_frame = (layout.last_frame() or 0) + 1
     config = camera.config
     backend = camera.backend
     if dark_time is None:
@@ -87,51 +259,229 @@ def timelapse(
         raise ValueError(
             f"Requested interval of {interval} is longer than expected dark time of {dark_time}"
         )
+    if adaptive:
+        if adaptive.min_interval < dark_time:
+            raise ValueError(
+                f"Minimum interval of {adaptive.min_interval} is shorter than expected dark time"
+                f" of {dark_time}"
+            )
+        if adaptive.clamp(interval) != interval:
+            raise ValueError(
+                f"Interval of {interval} is outside of {adaptive.min_interval} to"
+                f" {adaptive.max_interval}"
+            )
 
     logger.debug(f"{backend=}")
     output_dir.mkdir(exist_ok=True, parents=True)
-    start = datetime.now() + start_delay
-    times = gen_times(interval, num_frames, start)
-    template = "TL{i}"
+    if isinstance(layout, ShardedLayout):
+        layout.save()
+    writer_kwargs = {
+        "commit_frames": commit_frames,
+        "commit_interval": commit_interval,
+        "sync": sync,
+    }
+    if pipeline:
+        backend.pipeline = pipeline
+        pipeline.start()
+    on_commit = packer.submit if packer else None
+    if overview:
+        overview.then = on_commit
+        on_commit = overview.submit
+        overview.start()
+    if on_commit:
+        writer_kwargs["on_commit"] = on_commit
+    if packer:
+        packer.start()
+    writer = None
+    writer_dir = None
     camera_current_time = datetime.fromtimestamp(
         camera.backend.get_config_value(config.config_map["current_time"])
     )
-    computer_current_time = round(datetime.now().timestamp())
+    computer_current_time = round(clock.timestamp())
 
     logger.info(
-        f"Computer's current time is {camera_current_time - camera_current_time} ahead of camera's"
+        f"Computer's current time is"
+        f" {datetime.fromtimestamp(computer_current_time) - camera_current_time} ahead of camera's"
     )
 
     camera.backend.set_config_value(config.config_map["current_time"], computer_current_time)
     logger.info("Set camera time")
-    camera.backend.set_config_value(
-        config.config_map["auto_exposure_mode"].key,
-        config.config_map["auto_exposure_mode"].values[mode],
-    )
-    for i, commanded_capture_time in enumerate(times, 1):
-        shutter_speed = timedelta(seconds=camera.shutter.actual_value)
-        total_shot_time = shutter_speed + dark_time
-        buffer = interval - total_shot_time
-        logger.debug(
-            f"Required shot time: {format_timedelta(shutter_speed)} +"
-            f" {format_timedelta(dark_time)} = {format_timedelta(total_shot_time)}. This"
-            f" yields a {format_timedelta(buffer)} buffer vs. given interval {interval}"
-        )
-        now = datetime.now()
-        if commanded_capture_time < now:
-            raise ValueError(f"Missed capture window #{i} by {now - commanded_capture_time}")
-        sleep_until(commanded_capture_time)
-        if not dry_run:
-            start_time = time.perf_counter()
-            output_path, actual_capture_time = camera.capture(output_dir, stem=template.format(i=i))
-            logger.info(
-                f"Saved #{i} to PC at {output_path}. Delta:"
-                f" {actual_capture_time - commanded_capture_time}"
-            )
-            end_time = time.perf_counter()
-            actual_dark_time = timedelta(
-                seconds=end_time - start_time - shutter_speed.total_seconds()
-            )
-            logger.debug(
-                f"Actual dark time: {actual_dark_time} (vs. estimated dark time {dark_time})"
-            )
+    if calibration:
+        calibration.start()
+    # Only once the camera is set up, which can take a while
+    start = clock.now() + start_delay
+    schedule = Schedule(interval, num_frames, start, first_frame)
+    auto_exposure_mode = config.config_map["auto_exposure_mode"]
+    camera.backend.set_config_value(auto_exposure_mode.key, auto_exposure_mode.values[mode])
+    # Keep the parameter in step, so that the mode is restored if the camera is reconnected
+    camera.backend.auto_exposure_mode.value = auto_exposure_mode.values[mode]
+    run = supervisor.call if supervisor else _call
+    if bracket:
+        camera.configure_bracketing(bracket, step=bracket_step)
+    if profiler:
+        profiler.start()
+    if control:
+        control.attach(camera, schedule, dark_time)
+        control.start()
+    backend.frame_filter = dedupe
+    backend.record_signatures = adaptive is not None
+    backend.start_event_pump()
+    try:
+        while True:
+            if control:
+                with log_context(stage="wait"):
+                    control.between_frames()
+                if control.stop_requested:
+                    logger.info("Stopping the run, as requested over the control socket")
+                    break
+            slot = next(schedule, None)
+            if slot is None:
+                break
+            i, commanded_capture_time = slot
+            interval = schedule.interval
+            with log_context(frame=i), profiler.frame(i) if profiler else nullcontext():
+                if liveview and not dry_run:
+                    with log_context(stage="meter"):
+                        liveview.between_frames(i, commanded_capture_time, interval)
+                shutter_speed = timedelta(seconds=camera.shutter.actual_value)
+                if bracket:
+                    # Ignores the longer shutter speeds of the over-exposed frames
+                    shutter_speed *= bracket
+                total_shot_time = shutter_speed + dark_time
+                buffer = interval - total_shot_time
+                logger.debug(
+                    "Required shot time: %s + %s = %s. This yields a %s buffer vs. given interval"
+                    " %s",
+                    shutter_speed,
+                    dark_time,
+                    total_shot_time,
+                    buffer,
+                    interval,
+                )
+                if calibration:
+                    with log_context(stage="calibrate"):
+                        calibration.between_frames(commanded_capture_time)
+                now = clock.now()
+                if commanded_capture_time < now:
+                    if not supervisor:
+                        raise ValueError(
+                            f"Missed capture window #{i} by {now - commanded_capture_time}"
+                        )
+                    logger.warning(
+                        "Skipping frame #%s; missed its capture window by %s",
+                        i,
+                        now - commanded_capture_time,
+                    )
+                    record_missed_slot(output_dir / MISSED_LOG_NAME, i, commanded_capture_time, now)
+                    if control:
+                        control.frame_missed(i)
+                    continue
+                frame_dir = layout.frame_dir(i, commanded_capture_time)
+                if frame_dir != writer_dir:
+                    # Moving on to a new shard
+                    if writer is not None:
+                        writer.close()
+                    writer = backend.get_writer(frame_dir, **writer_kwargs)
+                    writer_dir = frame_dir
+                with log_context(stage="wait"), profiler.waiting() if profiler else nullcontext():
+                    lead = calibration.lead() if calibration else timedelta(0)
+                    sleep_until(commanded_capture_time - lead, clock=clock)
+                if not dry_run:
+                    start_time = clock.monotonic()
+                    lag = (clock.now() - commanded_capture_time).total_seconds()
+                    # Keep the archive packer's I/O out of the way of the download
+                    with packer.paused() if packer else nullcontext(), log_context(stage="capture"):
+                        if bracket:
+                            bracket_set = run(
+                                camera.capture_bracket, frame_dir, stem=layout.stem(i)
+                            )
+                            record_bracket_set(output_dir / BRACKET_LOG_NAME, bracket_set)
+                            layout.record(i, commanded_capture_time, bracket_set.files)
+                            logger.info(
+                                "Saved bracket #%s (%s files) to PC. Delta: %s",
+                                i,
+                                len(bracket_set.files),
+                                bracket_set.triggered_at - commanded_capture_time,
+                            )
+                        else:
+                            output_path, actual_capture_time = run(
+                                camera.capture, frame_dir, stem=layout.stem(i)
+                            )
+                            if output_path is None:
+                                # Dropped as a near-duplicate
+                                layout.record(i, commanded_capture_time, [])
+                            else:
+                                layout.record(i, commanded_capture_time, [output_path])
+                                logger.info(
+                                    "Saved #%s to PC at %s. Delta: %s",
+                                    i,
+                                    output_path,
+                                    actual_capture_time - commanded_capture_time,
+                                )
+                            if adaptive:
+                                next_interval = adaptive.observe(
+                                    i,
+                                    commanded_capture_time,
+                                    backend.last_exposure.signature,
+                                    schedule.interval,
+                                )
+                                if next_interval != schedule.interval:
+                                    # Leave the camera its dark time, or a shorter interval could
+                                    # move the next frame to now, which would then count as missed
+                                    schedule.set_interval(
+                                        next_interval, earliest=clock.now() + dark_time
+                                    )
+                            if calibration:
+                                error = calibration.observe(
+                                    i, backend.last_exposure, commanded_capture_time
+                                )
+                                if error is not None:
+                                    logger.info(
+                                        "Exposure #%s started %+.3fs from its commanded time"
+                                        " (triggered %.3fs early)",
+                                        i,
+                                        error,
+                                        lead.total_seconds(),
+                                    )
+                    end_time = clock.monotonic()
+                    actual_dark_time = timedelta(
+                        seconds=end_time - start_time - shutter_speed.total_seconds()
+                    )
+                    logger.debug(
+                        "Actual dark time: %s (vs. estimated dark time %s)",
+                        actual_dark_time,
+                        dark_time,
+                    )
+                    if control:
+                        control.frame_done(i, commanded_capture_time, end_time - start_time, lag)
+                if on_frame:
+                    on_frame(i, commanded_capture_time)
+    finally:
+        if control:
+            control.stop()
+        if calibration:
+            calibration.stop()
+        if profiler:
+            profiler.close()
+        backend.stop_event_pump()
+        if bracket:
+            backend.disable_bracketing()
+        if dedupe:
+            backend.frame_filter = None
+            dedupe.close()
+        if adaptive:
+            backend.record_signatures = False
+            adaptive.close()
+        if liveview:
+            liveview.close()
+        if writer is not None:
+            writer.close()
+        layout.close()
+        if pipeline:
+            # Storing what's left can still commit frames to the overview and packer
+            pipeline.stop()
+            backend.pipeline = None
+        if overview:
+            overview.stop()
+        if packer:
+            packer.stop()
@@ -13,4 +13,7 @@ class Benchmark:
     def __exit__(self, type, value, traceback):
         _end = time.perf_counter()
         total_time = _end - self._initial_time
-        self._logger(f"{self.description} in {total_time:.3f} seconds ")
+        if self._logger is print:
+            print(f"{self.description} in {total_time:.3f} seconds ")
+        else:
+            self._logger("%s in %.3f seconds ", self.description, total_time)
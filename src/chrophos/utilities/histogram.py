@@ -0,0 +1,70 @@
+import math
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram; cheap enough to update on every frame
+
+    Buckets are powers of two starting at `resolution` seconds, so percentiles are accurate to
+    within a factor of two of the true value, which is plenty for spotting stalls
+    """
+
+    def __init__(self, name: str, resolution=0.0001, num_buckets=24):
+        self.name = name
+        self.resolution = resolution
+        self.buckets = [0] * num_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def bucket_upper_bound(self, index: int):
+        return self.resolution * 2**index
+
+    def record(self, seconds: float):
+        if seconds <= self.resolution:
+            index = 0
+        else:
+            index = min(math.ceil(math.log2(seconds / self.resolution)), len(self.buckets) - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float):
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "min": self.min if self.count else 0.0,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": {
+                f"{self.bucket_upper_bound(i):g}": c for i, c in enumerate(self.buckets) if c
+            },
+        }
+
+    def summary(self):
+        if not self.count:
+            return f"{self.name}: no samples"
+        return (
+            f"{self.name}: n={self.count:,} min={self.min * 1000:.1f}ms"
+            f" mean={self.mean * 1000:.1f}ms p50<={self.percentile(50) * 1000:.1f}ms"
+            f" p99<={self.percentile(99) * 1000:.1f}ms max={self.max * 1000:.1f}ms"
+        )
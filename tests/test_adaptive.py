@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from chrophos.adaptive import (
+    AdaptiveInterval,
+    Change,
+    load_frame_times,
+    uniform_sources,
+)
+from chrophos.dedupe import Signature
+
+START = datetime(2024, 6, 1, 20)
+SECOND = timedelta(seconds=1)
+
+
+def adaptive(**kwargs):
+    return AdaptiveInterval(5 * SECOND, 60 * SECOND, factor=2, patience=3, **kwargs)
+
+
+def run(finder, signatures, interval=20 * SECOND):
+    intervals = []
+    time = START
+    for frame, current in enumerate(signatures, 1):
+        interval = finder.observe(frame, time, current, interval)
+        intervals.append(interval.total_seconds())
+        time += interval
+    return intervals
+
+
+def test_classify():
+    finder = adaptive()
+
+    assert finder.classify(12, 0) == Change.BUSY
+    assert finder.classify(0, 0.05) == Change.BUSY
+    assert finder.classify(2, 0.001) == Change.CALM
+    assert finder.classify(5, 0.001) == Change.STEADY
+    assert finder.classify(2, 0.01) == Change.STEADY
+
+
+def test_interval_shortens_at_once_and_lengthens_after_patience():
+    still = Signature(0, 0.5)
+    moved = Signature(2**20 - 1, 0.5)
+
+    intervals = run(adaptive(), [still, still, still, still, moved, moved, moved])
+
+    # The first frame has nothing to compare with; three calm frames double it; a busy one
+    # halves it again, and resets the run of calm frames
+    assert intervals == [20, 20, 20, 40, 20, 20, 20]
+
+
+def test_interval_stays_within_bounds():
+    flicker = [Signature(0, 0.1), Signature(0, 0.9)] * 3
+    still = [Signature(0, 0.5)] * 12
+
+    assert run(adaptive(), flicker)[-1] == 5
+    assert run(adaptive(), still)[-1] == 60
+
+
+def test_frames_without_a_signature_are_unknown(tmp_path):
+    finder = adaptive(log_path=tmp_path / "intervals.jsonl")
+
+    intervals = run(finder, [Signature(0, 0.5), None, Signature(0, 0.5)])
+    finder.close()
+
+    assert intervals == [20, 20, 20]
+    assert finder.counts[Change.UNKNOWN] == 2
+    assert finder.counts[Change.CALM] == 1
+    assert load_frame_times(tmp_path / "intervals.jsonl") == {
+        frame: START + (frame - 1) * 20 * SECOND for frame in (1, 2, 3)
+    }
+
+
+def test_bounds_are_checked():
+    with pytest.raises(ValueError, match="over the maximum"):
+        AdaptiveInterval(60 * SECOND, 5 * SECOND)
+    with pytest.raises(ValueError, match="must be over 1"):
+        AdaptiveInterval(5 * SECOND, 60 * SECOND, factor=1)
+
+
+def test_uniform_sources_holds_and_skips_frames():
+    sources = [Path(f"TL{frame}.NEF") for frame in range(1, 7)]
+    seconds = {1: 0, 2: 40, 3: 50, 4: 55, 5: 60, 6: 100}
+    frame_times = {frame: START + offset * SECOND for frame, offset in seconds.items()}
+    del frame_times[4]
+
+    resampled = uniform_sources(sources, frame_times, 20 * SECOND)
+
+    assert [source.name for source in resampled] == [
+        "TL1.NEF",
+        "TL1.NEF",
+        "TL2.NEF",
+        "TL5.NEF",
+        "TL5.NEF",
+        "TL6.NEF",
+    ]
+    assert uniform_sources(sources, {}, 20 * SECOND) == []
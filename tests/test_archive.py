@@ -0,0 +1,110 @@
+import pytest
+
+from chrophos.archive import (
+    RECORD_HEADER,
+    ArchiveError,
+    ArchivePacker,
+    ArchiveReader,
+    ArchiveWriter,
+    is_archive,
+    pack_directory,
+)
+
+
+def write_archive(archive_dir, frames, **kwargs):
+    writer = ArchiveWriter(archive_dir, **kwargs)
+    for name, data in frames:
+        writer.add(name, data)
+    writer.close()
+
+
+def test_frames_are_split_into_chunks_and_read_back(tmp_path):
+    frames = [(f"TL{number}.NEF", bytes([number]) * 100) for number in range(1, 6)]
+    write_archive(tmp_path, frames, frames_per_chunk=2)
+
+    assert is_archive(tmp_path)
+    reader = ArchiveReader(tmp_path)
+    assert len(reader) == 5
+    assert sorted({entry.chunk for entry in reader.entries}) == [
+        "chunk_000000.tlc",
+        "chunk_000001.tlc",
+        "chunk_000002.tlc",
+    ]
+    assert reader.read("TL4.NEF") == bytes([4]) * 100
+    assert [(entry.frame, data) for entry, data in reader.frames()] == [
+        (number, data) for number, (_name, data) in enumerate(frames, 1)
+    ]
+
+
+def test_frames_are_listed_in_frame_order(tmp_path):
+    write_archive(tmp_path, [("TL10.NEF", b"10"), ("TL9.NEF", b"9"), ("TL9.JPG", b"9j")])
+
+    assert [entry.name for entry, _data in ArchiveReader(tmp_path).frames(".NEF")] == [
+        "TL9.NEF",
+        "TL10.NEF",
+    ]
+
+
+def test_unindexed_data_is_truncated_on_reopening(tmp_path):
+    writer = ArchiveWriter(tmp_path, sync_frames=2)
+    for number in range(1, 4):
+        writer.add(f"TL{number}.NEF", b"x" * 100)
+    # Crash: TL3 was written to the chunk, but never indexed
+    writer._data.flush()
+    chunk = tmp_path / "chunk_000000.tlc"
+    record_size = RECORD_HEADER.size + len("TL3.NEF") + 100
+    indexed_size = chunk.stat().st_size - record_size
+
+    writer = ArchiveWriter(tmp_path)
+    writer.add("TL3.NEF", b"y" * 100)
+    writer.close()
+
+    reader = ArchiveReader(tmp_path)
+    assert [entry.name for entry in reader.entries] == ["TL1.NEF", "TL2.NEF", "TL3.NEF"]
+    assert reader.read("TL3.NEF") == b"y" * 100
+    # Written where the unindexed copy was, rather than after it
+    assert chunk.stat().st_size == indexed_size + record_size
+
+
+def test_corrupt_frame_is_detected(tmp_path):
+    write_archive(tmp_path, [("TL1.NEF", b"x" * 100)])
+    entry = ArchiveReader(tmp_path).find("TL1.NEF")
+    with open(tmp_path / entry.chunk, "r+b") as file:
+        file.seek(entry.offset)
+        file.write(b"y")
+
+    with pytest.raises(ArchiveError, match="bad checksum"):
+        ArchiveReader(tmp_path).read("TL1.NEF")
+    with pytest.raises(ArchiveError, match="No frame named"):
+        ArchiveReader(tmp_path).read("TL2.NEF")
+
+
+def test_packer_packs_and_removes_submitted_frames(tmp_path):
+    paths = []
+    for number in range(1, 4):
+        path = tmp_path / f"TL{number}.NEF"
+        path.write_bytes(bytes([number]) * 100)
+        paths.append(path)
+    packer = ArchivePacker(tmp_path / "archive", remove_packed=True)
+    packer.start()
+
+    with packer.paused():
+        packer.submit(paths[:2])
+    packer.submit(paths[2:])
+    packer.stop()
+
+    assert packer.packed_frames == 3
+    assert not any(path.exists() for path in paths)
+    assert ArchiveReader(tmp_path / "archive").read("TL2.NEF") == bytes([2]) * 100
+
+
+def test_pack_directory_skips_frames_already_packed(tmp_path):
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    for number in range(1, 3):
+        (frames_dir / f"TL{number}.NEF").write_bytes(bytes([number]))
+
+    assert pack_directory(frames_dir, tmp_path / "archive") == 2
+    (frames_dir / "TL3.NEF").write_bytes(b"3")
+    assert pack_directory(frames_dir, tmp_path / "archive") == 1
+    assert len(ArchiveReader(tmp_path / "archive")) == 3
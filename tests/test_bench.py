@@ -0,0 +1,97 @@
+import pytest
+import tomlkit
+
+from chrophos.bench import (
+    OVERALL,
+    compare,
+    environment_changes,
+    load_records,
+    make_record,
+    mann_whitney_u,
+    recommend_dark_time,
+    save_record,
+    write_dark_time,
+)
+
+
+def record(samples, **camera):
+    result = make_record(len(next(iter(samples.values()))), "manual", samples)
+    result["environment"]["camera"] = camera
+    return result
+
+
+def test_mann_whitney_u():
+    # As from scipy.stats.mannwhitneyu(..., method="asymptotic")
+    assert mann_whitney_u([1, 2, 3, 4, 5], [6, 7, 8, 9, 10]) == pytest.approx(0.01219, abs=1e-5)
+    assert mann_whitney_u([1, 2, 3, 4, 5], [5, 4, 3, 2, 1]) == 1.0
+    assert mann_whitney_u([2, 2, 2], [2, 2]) == 1.0
+    assert mann_whitney_u([], [1.0]) == 1.0
+
+
+def test_mann_whitney_u_is_rank_based():
+    baseline = [1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
+    current = [1.6, 1.7, 1.8, 1.9, 2.0, 2.1]
+    outlier = [*current[:-1], 1000.0]
+
+    assert mann_whitney_u(baseline, current) == mann_whitney_u(baseline, outlier)
+
+
+def test_compare_flags_significant_slowdowns_only():
+    baseline = [record({"1/100": [1.0, 1.1, 1.0, 1.2, 1.1, 1.0, 1.1, 1.2]})]
+    slower = [record({"1/100": [1.5, 1.6, 1.5, 1.7, 1.6, 1.5, 1.6, 1.7], "1/50": [2.0]})]
+    similar = [record({"1/100": [1.0, 1.2, 1.1, 1.1, 1.0, 1.2, 1.1, 1.0]})]
+
+    comparison = compare(baseline, slower)
+    assert [result.shutter for result in comparison] == ["1/100", OVERALL]
+    assert all(result.regressed for result in comparison)
+    assert comparison[0].current_median == 1.6
+    assert not any(result.regressed for result in compare(baseline, similar))
+    assert compare(baseline, [record({"30": [31.0]})]) == []
+
+
+def test_environment_changes():
+    baseline = [record({"1/100": [1.0]}, cameramodel="Z 6", deviceversion="1.0")]
+    current = [record({"1/100": [1.0]}, cameramodel="Z 6", deviceversion="1.1")]
+
+    assert environment_changes(baseline, current) == {"camera.deviceversion": ("1.0", "1.1")}
+
+
+def test_records_round_trip(tmp_path):
+    first = record({"1/100": [1.0, 2.0]}, cameramodel="Nikon Z 6")
+    second = record({"1/100": [3.0]})
+    second["environment"]["timestamp"] = "2030-01-01T00:00:00"
+
+    path = save_record(first, tmp_path)
+    save_record(second, tmp_path)
+
+    assert path.name.endswith("_Nikon_Z_6.json")
+    assert load_records([tmp_path]) == [first, second]
+    assert load_records([path]) == [first]
+    assert first["summary"][OVERALL]["n"] == 2
+
+
+def test_recommend_dark_time():
+    records = [
+        record({"1/100": [1.0] * 90 + [1.8] * 10, "1/10": [1.2] * 100}),
+        record({"1/100": [1.0] * 100}),
+    ]
+
+    # p99 of the slowest shutter speed (pooled across runs), plus 10%, rounded up to 0.5s
+    assert recommend_dark_time(records) == 2.0
+    assert recommend_dark_time(records, percentile=50, margin=0, step=0.1) == pytest.approx(1.2)
+    with pytest.raises(ValueError):
+        recommend_dark_time([])
+
+
+def test_write_dark_time_keeps_the_rest_of_the_config(tmp_path):
+    config_path = tmp_path / "camera.toml"
+    config_path.write_text('# My camera\ndark_time = 5.0\ntarget_shutter = "1/100"\n')
+
+    write_dark_time(config_path, 2.5, 99.0, 3)
+
+    text = config_path.read_text()
+    assert text.startswith("# My camera\n")
+    assert "p99 of 3 benchmark run(s)" in text
+    document = tomlkit.parse(text)
+    assert document["dark_time"] == 2.5
+    assert document["target_shutter"] == "1/100"
@@ -0,0 +1,36 @@
+import json
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from chrophos.camera.backend import BackendError
+from chrophos.camera.fake import fake_camera
+from chrophos.clock import AcceleratedClock
+from chrophos.timelapse import BRACKET_LOG_NAME, timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+
+
+def test_each_frame_is_a_bracket_burst(tmp_path):
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp)
+    timelapse(camera, 2, timedelta(seconds=10), tmp_path, mode="manual", bracket=3, clock=clock)
+
+    assert sorted(path.name for path in tmp_path.glob("TL*")) == [
+        f"TL{frame}_b{index}.NEF" for frame in (1, 2) for index in (1, 2, 3)
+    ]
+    with open(tmp_path / BRACKET_LOG_NAME) as file:
+        bracket_sets = [json.loads(line) for line in file]
+    assert [bracket_set["stem"] for bracket_set in bracket_sets] == ["TL1", "TL2"]
+    assert all(len(bracket_set["files"]) == 3 for bracket_set in bracket_sets)
+    # Back to single shots once the run is over
+    assert camera.backend.bracket_count is None
+    assert camera.backend.get_config_value("burstnumber") == 1
+
+
+def test_unsupported_bracket_count_is_refused():
+    camera = fake_camera(PROFILE)
+
+    with pytest.raises(BackendError, match="supported counts"):
+        camera.configure_bracketing(4)
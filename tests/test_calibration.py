@@ -0,0 +1,145 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from chrophos import calibration
+from chrophos.calibration import (
+    Calibration,
+    Combine,
+    HotPixelStats,
+    RawInfo,
+    build_calibration,
+    correct_plane,
+    fill_hot_pixels,
+    local_excess,
+    master_frame,
+)
+
+BLACK = 100
+WHITE = 4095
+SHAPE = (16, 24)
+PATTERN = np.array([[0, 1], [3, 2]])
+INFO = RawInfo(SHAPE, PATTERN, [BLACK] * 4, WHITE)
+
+
+@pytest.fixture
+def frames(monkeypatch):
+    """Calibration frames, as raw planes standing in for files: sources are their indices"""
+    planes = []
+    monkeypatch.setattr(calibration, "read_raw", lambda source: (planes[source].copy(), INFO))
+    return planes
+
+
+def test_master_frame_median_rejects_outliers(frames):
+    frames.extend(np.full(SHAPE, BLACK + 10, dtype=np.uint16) for _ in range(10))
+    frames[3][5, 5] = WHITE
+
+    median, info = master_frame(list(range(10)), combine=Combine.MEDIAN, group=5, workers=1)
+    mean, _ = master_frame(list(range(10)), combine=Combine.MEAN, workers=1)
+
+    assert info is INFO
+    assert median[5, 5] == BLACK + 10
+    assert mean[5, 5] > BLACK + 400
+    with pytest.raises(ValueError, match="Unknown way"):
+        master_frame([0], combine="sum")
+
+
+def test_dark_and_flat_correct_a_plane(frames):
+    rng = np.random.default_rng(0)
+    dark_signal = rng.integers(0, 20, SHAPE)
+    response = rng.uniform(0.8, 1.2, SHAPE)
+    # The flat's response is made to average 1 for each colour, as the master flat will
+    for dy, dx in np.ndindex(2, 2):
+        response[dy::2, dx::2] /= response[dy::2, dx::2].mean()
+    frames.extend([(BLACK + dark_signal).astype(np.uint16)] * 3)
+    frames.extend([np.rint(BLACK + 2000 * response).astype(np.uint16)] * 3)
+
+    built = build_calibration(darks=[0, 1, 2], flats=[3, 4, 5], group=3, workers=1)
+    light = np.rint(BLACK + dark_signal + 1000 * response).astype(np.uint16)
+    light[0, 0] = WHITE
+    correct_plane(light, built, [BLACK] * 4, WHITE)
+
+    assert built.info["darks"] == 3
+    assert built.dark == pytest.approx(dark_signal, abs=1e-3)
+    assert light[0, 0] == WHITE
+    assert np.abs(light[1:].astype(int) - (BLACK + 1000)).max() <= 2
+
+
+def test_hot_pixels_are_found_and_filled(frames):
+    rng = np.random.default_rng(1)
+    for _ in range(6):
+        plane = rng.normal(BLACK + 200, 5, SHAPE).astype(np.uint16)
+        plane[7, 9] = 3000
+        frames.append(plane)
+    # Not hot, but a star that moved through in one frame
+    frames[2][4, 4] = 3000
+
+    built = build_calibration(hot_pixel_frames=list(range(6)), workers=1)
+    plane = frames[0].copy()
+    correct_plane(plane, built, [BLACK] * 4, WHITE)
+
+    assert built.hot_pixels.tolist() == [[7], [9]]
+    assert abs(int(plane[7, 9]) - (BLACK + 200)) < 20
+
+
+def test_local_excess_stands_out_single_pixels():
+    plane = np.full(SHAPE, 500, dtype=np.uint16)
+    plane[6, 6] = 900
+    # Spread over neighbouring photosites of the same colour
+    plane[10:15:2, 10:15:2] = 900
+
+    excess = local_excess(plane)
+
+    assert excess[6, 6] == 400
+    assert excess[12, 12] == 0
+    assert excess[0, 0] == 0
+
+
+def test_hot_pixel_stats_merge():
+    plane = np.full(SHAPE, 500, dtype=np.uint16)
+    plane[6, 6] = 900
+    first, second = HotPixelStats.empty(SHAPE, 4), HotPixelStats.empty(SHAPE, 4)
+    for stats in (first, first, second):
+        stats.add(plane)
+
+    first.merge(second)
+
+    assert first.frames == 3
+    assert first.hits[6, 6] == 3
+    assert first.hot_pixels().tolist() == [[6], [6]]
+
+
+def test_fill_hot_pixels_at_the_edges():
+    plane = np.arange(36, dtype=np.uint16).reshape(6, 6)
+
+    fill_hot_pixels(plane, np.array([[0, 5], [0, 2]]))
+
+    # Neighbours off the edge are reflected back in: the median of (12, 12, 2, 2), and of
+    # (20, 20, 30, 34)
+    assert plane[0, 0] == 7
+    assert plane[5, 2] == 25
+
+
+def test_calibration_round_trips(tmp_path):
+    built = Calibration(
+        SHAPE,
+        PATTERN,
+        dark=np.ones(SHAPE, dtype=np.float32),
+        hot_pixels=np.array([[1], [2]], dtype=np.int32),
+        info={"darks": 5},
+    )
+
+    built.save(tmp_path / "calibration")
+    loaded = Calibration.load(tmp_path / "calibration")
+    unpickled = pickle.loads(pickle.dumps(loaded))
+
+    for each in (loaded, unpickled):
+        assert each.shape == SHAPE
+        assert each.pattern.tolist() == PATTERN.tolist()
+        assert each.flat is None
+        assert each.dark.sum() == np.prod(SHAPE)
+        assert each.info == {"darks": 5}
+    assert isinstance(loaded.dark, np.memmap)
+    with pytest.raises(ValueError, match="raw planes"):
+        correct_plane(np.zeros((4, 4), dtype=np.uint16), loaded, [BLACK] * 4, WHITE)
@@ -0,0 +1,215 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from chrophos.clock import AcceleratedClock
+from chrophos.control import (
+    COMMAND_TIMEOUT,
+    INVALID_PARAMS,
+    INVALID_REQUEST,
+    METHOD_NOT_FOUND,
+    PARSE_ERROR,
+    Command,
+    ControlError,
+    ControlServer,
+    request,
+)
+from chrophos.timelapse import Schedule
+
+START = datetime(2024, 1, 1, 12)
+SECOND = timedelta(seconds=1)
+
+
+class Parameter:
+    def __init__(self, value, choices):
+        self.value = value
+        self.choices = choices
+
+
+class StubCamera:
+    def __init__(self):
+        self._parameters = {
+            "shutter": Parameter("1/100", ["1/200", "1/100", "1/50"]),
+            "aperture": Parameter("8", ["5.6", "8"]),
+            "iso": Parameter("100", ["100", "200"]),
+        }
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["_parameters"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__.get("_parameters", {}):
+            self._parameters[name].value = value
+        else:
+            super().__setattr__(name, value)
+
+
+def server(tmp_path, num_frames=10, **kwargs):
+    clock = AcceleratedClock(START)
+    control = ControlServer(tmp_path / "control.sock", clock=clock, **kwargs)
+    control.attach(StubCamera(), Schedule(10 * SECOND, num_frames, START), 2 * SECOND)
+    return control
+
+
+def send(control, method, params=None, request_id=1):
+    """Send a request as a client would, running queued commands as the capture loop would"""
+    message = {"jsonrpc": "2.0", "method": method, "params": params or {}}
+    if request_id is not None:
+        message["id"] = request_id
+    responses = []
+    client = threading.Thread(
+        target=lambda: responses.append(control.handle_line(json.dumps(message).encode()))
+    )
+    client.start()
+    while client.is_alive():
+        control._wake.wait(0.01)
+        control.run_pending()
+    client.join()
+    return responses[0]
+
+
+def test_schedule_set_interval_applies_from_next_gap():
+    schedule = Schedule(10 * SECOND, 5, START)
+    next(schedule)
+
+    schedule.set_interval(30 * SECOND)
+
+    assert next(schedule) == (2, START + 30 * SECOND)
+    assert next(schedule) == (3, START + 60 * SECOND)
+
+
+def test_schedule_set_interval_no_earlier_than_earliest():
+    schedule = Schedule(10 * SECOND, 5, START)
+    next(schedule)
+
+    schedule.set_interval(SECOND, earliest=START + 5 * SECOND)
+
+    assert schedule.next_time == START + 5 * SECOND
+
+
+def test_schedule_skip_until_keeps_phase_and_numbering():
+    schedule = Schedule(10 * SECOND, 5, START)
+    next(schedule)
+
+    assert schedule.skip_until(START + 25 * SECOND) == 2
+    assert next(schedule) == (2, START + 30 * SECOND)
+    assert schedule.skip_until(START) == 0
+    assert schedule.remaining == 3
+
+
+def test_malformed_requests(tmp_path):
+    control = server(tmp_path)
+
+    assert control.handle_line(b"{")["error"]["code"] == PARSE_ERROR
+    assert control.handle_line(b"[1]")["error"]["code"] == INVALID_REQUEST
+    assert send(control, "reboot")["error"]["code"] == METHOD_NOT_FOUND
+    assert send(control, "status", params=[1])["error"]["code"] == INVALID_PARAMS
+    assert send(control, "status", {"verbose": True})["error"]["code"] == INVALID_PARAMS
+
+
+def test_notifications_get_no_response(tmp_path):
+    control = server(tmp_path)
+
+    assert send(control, "pause", request_id=None) is None
+    assert control.paused
+
+
+def test_status(tmp_path):
+    control = server(tmp_path)
+    control.frame_done(1, START, 0.5, 0.1)
+    control.frame_missed(2)
+
+    status = send(control, "status")["result"]
+
+    assert status["last_frame"] == 1
+    assert status["last_missed_frame"] == 2
+    assert status["interval"] == 10
+    assert status["remaining_frames"] == 10
+    assert status["exposure"] == {"shutter": "1/100", "aperture": "8", "iso": "100"}
+    metrics = send(control, "metrics")["result"]
+    assert (metrics["frames"], metrics["missed"]) == (1, 1)
+
+
+def test_set_exposure(tmp_path):
+    control = server(tmp_path)
+
+    response = send(control, "set_exposure", {"shutter": "1/50", "iso": 200})
+
+    assert response["result"] == {"shutter": "1/50", "iso": "200"}
+    assert control.camera.shutter.value == "1/50"
+    assert send(control, "set_exposure", {"aperture": "2"})["error"]["code"] == INVALID_PARAMS
+    assert send(control, "set_exposure")["error"]["code"] == INVALID_PARAMS
+    assert send(control, "set_exposure", {"focus": 1})["error"]["code"] == INVALID_PARAMS
+
+
+def test_set_schedule(tmp_path):
+    control = server(tmp_path)
+    next(control.schedule)
+    next(control.schedule)
+
+    result = send(control, "set_schedule", {"interval": 20, "num_frames": None})["result"]
+
+    assert result["interval"] == 20
+    assert result["num_frames"] is None
+    assert control.schedule.next_time == START + 30 * SECOND
+    error = send(control, "set_schedule", {"interval": 1})["error"]
+    assert error["code"] == INVALID_PARAMS
+    assert "dark time" in error["message"]
+    assert send(control, "set_schedule", {"num_frames": 1})["error"]["code"] == INVALID_PARAMS
+
+
+def test_resume_skips_slots_missed_while_paused(tmp_path):
+    control = server(tmp_path)
+    send(control, "pause")
+    control.clock.sleep(35)
+
+    result = send(control, "resume")["result"]
+
+    # Back in time for the 40 s slot, at least `guard` away
+    assert result == {"paused": False, "skipped_slots": 4}
+    assert control.schedule.next_time == START + 40 * SECOND
+    assert send(control, "metrics")["result"]["paused_slots"] == 4
+
+
+def test_command_times_out_while_still_queued(tmp_path):
+    control = server(tmp_path, command_timeout=0.01)
+
+    assert control.handle_line(b'{"id": 1, "method": "stop"}')["error"]["code"] == COMMAND_TIMEOUT
+    assert not control.stop_requested
+
+    control.run_pending()
+    assert control.stop_requested
+
+
+def test_between_frames_runs_commands_and_waits_for_guard(tmp_path):
+    control = server(tmp_path)
+    next(control.schedule)
+    command = Command("set_schedule", {"interval": 5})
+    control._commands.put(command)
+
+    control.between_frames()
+
+    assert command.done.is_set()
+    assert control.schedule.next_time == START + 5 * SECOND
+    # Returns `guard` before the next frame
+    assert abs(control.clock.now() - (START + 3 * SECOND)) < SECOND
+
+
+def test_over_the_socket(tmp_path):
+    control = server(tmp_path)
+    control.start()
+    try:
+        assert request(control.socket_path, "status")["remaining_frames"] == 10
+        with pytest.raises(ControlError, match="Unknown method"):
+            request(control.socket_path, "reboot")
+        with pytest.raises(ValueError, match="already listening"):
+            ControlServer(control.socket_path).start()
+    finally:
+        control.stop()
+
+    assert not control.socket_path.exists()
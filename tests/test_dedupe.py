@@ -0,0 +1,75 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from chrophos.dedupe import Action, DuplicateFilter, find_embedded_jpeg
+
+
+def jpeg(pixels, **kwargs):
+    output = io.BytesIO()
+    Image.fromarray(np.asarray(pixels, dtype=np.uint8)).save(output, "JPEG", **kwargs)
+    return output.getvalue()
+
+
+GRADIENT = np.tile(np.linspace(0, 200, 320), (240, 1))
+SCENE = jpeg(GRADIENT)
+SAME_SCENE = jpeg(GRADIENT, quality=90)
+OTHER_SCENE = jpeg(GRADIENT[:, ::-1])
+BRIGHTER_SCENE = jpeg(GRADIENT + 40)
+
+
+def actions(dedupe, frames):
+    return [dedupe.decide(f"TL{i}", [(".JPG", data)]).action for i, data in enumerate(frames, 1)]
+
+
+def test_near_duplicates_are_stored_as_thumbnails(tmp_path):
+    dedupe = DuplicateFilter(log_path=tmp_path / "dedupe.jsonl")
+
+    decisions = [dedupe.decide(f"TL{i}", [(".JPG", SCENE)]) for i in (1, 2)]
+    dedupe.close()
+
+    assert [decision.action for decision in decisions] == [Action.KEEP, Action.THUMBNAIL]
+    assert decisions[1].thumbnail == SCENE
+    records = [json.loads(line) for line in (tmp_path / "dedupe.jsonl").open()]
+    assert [record["action"] for record in records] == [Action.KEEP, Action.THUMBNAIL]
+
+
+def test_changed_frames_are_kept():
+    dedupe = DuplicateFilter(action=Action.DROP, keep_every=None)
+
+    assert actions(dedupe, [SCENE, SAME_SCENE, OTHER_SCENE, BRIGHTER_SCENE]) == [
+        Action.KEEP,
+        Action.DROP,
+        Action.KEEP,
+        Action.KEEP,
+    ]
+
+
+def test_every_nth_duplicate_in_a_row_is_kept():
+    dedupe = DuplicateFilter(action=Action.DROP, keep_every=3)
+
+    # The third duplicate in a row is kept, and becomes the new reference
+    assert actions(dedupe, [SCENE] * 7) == [
+        Action.KEEP,
+        *[Action.DROP, Action.DROP, Action.KEEP] * 2,
+    ]
+
+
+def test_unknown_action_is_refused():
+    with pytest.raises(ValueError):
+        DuplicateFilter(action="compress")
+
+
+def test_embedded_jpeg_isnt_cut_short_by_its_exif_thumbnail():
+    thumbnail = jpeg(GRADIENT[::8, ::8])
+    app1 = b"Exif\0\0" + thumbnail
+    preview = SCENE[:2] + b"\xff\xe1" + (len(app1) + 2).to_bytes(2, "big") + app1 + SCENE[2:]
+    raw = b"II*\0" + bytes(100) + preview + bytes(100)
+
+    assert find_embedded_jpeg(raw) == preview
+    # Cut off partway through the preview
+    assert find_embedded_jpeg(raw[: len(raw) // 2]) is None
+    assert find_embedded_jpeg(bytes(100)) is None
@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import gphoto2 as gp
+
+from chrophos.camera.events import EventPump
+
+
+class ScriptedCamera:
+    """Replays the given events, then stops the pump"""
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.pump = None
+
+    def wait_for_event(self, timeout_ms):
+        if not self.events:
+            self.pump._stop_event.set()
+            return gp.GP_EVENT_TIMEOUT, None
+        return self.events.pop(0)
+
+
+def added(name):
+    return gp.GP_EVENT_FILE_ADDED, SimpleNamespace(
+        folder="/store_00010001/DCIM/100NIKON", name=name
+    )
+
+
+def run_pump(events, triggers=0, **kwargs):
+    camera = ScriptedCamera(events)
+    pump = EventPump(camera, idle_interval=0, **kwargs)
+    camera.pump = pump
+    if triggers:
+        pump.mark_trigger(triggers)
+    pump.run()
+    exposures = []
+    while not pump.exposures.empty():
+        exposures.append(pump.exposures.get_nowait())
+    return pump, exposures
+
+
+def names(exposure):
+    return [captured_file.name for captured_file in exposure.files]
+
+
+def test_files_are_paired_by_stem():
+    pump, exposures = run_pump(
+        [
+            added("DSC_0001.NEF"),
+            added("DSC_0001.JPG"),
+            added("DSC_0002.NEF"),
+            added("DSC_0002.JPG"),
+            (gp.GP_EVENT_CAPTURE_COMPLETE, None),
+        ],
+        triggers=2,
+    )
+
+    assert [names(exposure) for exposure in exposures] == [
+        ["DSC_0001.NEF", "DSC_0001.JPG"],
+        ["DSC_0002.NEF", "DSC_0002.JPG"],
+    ]
+    assert all(exposure.triggered_at is not None for exposure in exposures)
+    assert pump.completed == 2
+    assert pump.stale == 0
+
+
+def test_exposure_completes_once_all_files_arrive():
+    _pump, exposures = run_pump(
+        [added("DSC_0001.NEF"), added("DSC_0001.JPG")], triggers=1, files_per_exposure=2
+    )
+
+    assert [names(exposure) for exposure in exposures] == [["DSC_0001.NEF", "DSC_0001.JPG"]]
+
+
+def test_exposure_completes_after_pair_timeout():
+    _pump, exposures = run_pump(
+        [added("DSC_0001.NEF"), (gp.GP_EVENT_TIMEOUT, None)], triggers=1, pair_timeout=0
+    )
+
+    assert [names(exposure) for exposure in exposures] == [["DSC_0001.NEF"]]
+
+
+def test_subscribed_files_are_routed():
+    camera = ScriptedCamera([added("DSC_0001.NEF"), added("DSC_0001.JPG")])
+    pump = EventPump(camera, idle_interval=0, files_per_exposure=2)
+    camera.pump = pump
+    previews = pump.subscribe([".jpg"])
+    pump.mark_trigger()
+    pump.run()
+
+    exposure = pump.exposures.get_nowait()
+    assert previews.get_nowait().name == "DSC_0001.JPG"
+    assert [captured_file.name for captured_file in exposure.unrouted] == ["DSC_0001.NEF"]
+
+
+def test_file_without_trigger_is_stale():
+    pump, exposures = run_pump([added("DSC_0001.NEF"), (gp.GP_EVENT_CAPTURE_COMPLETE, None)])
+
+    assert len(exposures) == 1
+    assert exposures[0].triggered_at is None
+    assert pump.stale == 1
@@ -0,0 +1,133 @@
+import io
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from chrophos.camera.events import Exposure
+from chrophos.camera.fake import fake_camera
+from chrophos.camera.latency import (
+    DATE_TIME_ORIGINAL,
+    EXIF_IFD,
+    SUB_SEC_TIME_ORIGINAL,
+    CameraClock,
+    TriggerCalibration,
+    exif_capture_time,
+)
+from chrophos.clock import AcceleratedClock
+from chrophos.timelapse import timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+SECOND = timedelta(seconds=1)
+
+
+def jpeg(original=None, sub_sec=None):
+    exif = Image.Exif()
+    if original is not None:
+        exif.get_ifd(EXIF_IFD)[DATE_TIME_ORIGINAL] = original
+    if sub_sec is not None:
+        exif.get_ifd(EXIF_IFD)[SUB_SEC_TIME_ORIGINAL] = sub_sec
+    output = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(output, "JPEG", exif=exif)
+    return output.getvalue()
+
+
+class TickingBackend:
+    """A camera clock `offset` seconds ahead of `clock`, each read of which takes 10 ms"""
+
+    def __init__(self, clock, offset, drift=0.0):
+        self.clock = clock
+        self.offset = offset
+        self.drift = drift
+        self.start = clock.timestamp()
+
+    def get_single_config_value(self, _key):
+        self.clock.sleep(0.01)
+        now = self.clock.timestamp()
+        return str(int(now + self.offset + self.drift * (now - self.start)))
+
+
+def test_exif_capture_time():
+    expected = datetime(2024, 3, 1, 21, 30, 5).timestamp() + 0.25
+
+    assert exif_capture_time(jpeg("2024:03:01 21:30:05", "25"), ".JPG") == pytest.approx(expected)
+    assert exif_capture_time(jpeg("2024:03:01 21:30:05"), ".JPG") is None
+    assert exif_capture_time(jpeg("yesterday", "25"), ".JPG") is None
+    assert exif_capture_time(b"not an image", ".NEF") is None
+
+
+def test_camera_clock_offset_is_measured_to_a_read():
+    clock = AcceleratedClock()
+    camera_clock = CameraClock(TickingBackend(clock, offset=3.7), "datetime", clock=clock)
+
+    sample = camera_clock.measure()
+
+    assert sample.uncertainty <= 0.02
+    assert sample.offset == pytest.approx(3.7, abs=0.02)
+    assert camera_clock.to_host(clock.timestamp() + 3.7) == pytest.approx(
+        clock.timestamp(), abs=0.02
+    )
+
+
+def test_camera_clock_drift_is_fitted():
+    clock = AcceleratedClock()
+    camera_clock = CameraClock(TickingBackend(clock, 0.4, drift=1e-4), "datetime", clock=clock)
+
+    for _ in range(5):
+        camera_clock.measure()
+        clock.sleep(600)
+
+    assert camera_clock.drift == pytest.approx(1e-4, rel=0.2)
+
+
+def test_camera_clock_that_does_not_tick():
+    clock = AcceleratedClock()
+    backend = TickingBackend(clock, 0)
+    backend.get_single_config_value = lambda _key: "0"
+
+    assert CameraClock(backend, "datetime", clock=clock).measure(timeout=0.1) is None
+
+
+def test_lead_is_the_median_latency_once_there_are_enough_samples():
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp)
+    calibration = TriggerCalibration(camera, clock=clock, min_samples=3, max_lead=SECOND)
+    now = clock.timestamp()
+    commanded = datetime.fromtimestamp(now)
+
+    leads = []
+    for latency in (0.2, 0.4, 0.3, 5.0, 5.0, 5.0):
+        exposure = Exposure(trigger_time=now, capture_time=now + latency)
+        calibration.observe(1, exposure, commanded)
+        leads.append(calibration.lead().total_seconds())
+
+    assert leads == pytest.approx([0, 0, 0.3, 0.35, 0.4, 1.0])
+    assert calibration.observe(1, Exposure(), commanded) is None
+    assert calibration.unmeasured == 1
+
+
+def test_triggers_are_fired_early_by_the_latency(tmp_path):
+    clock = AcceleratedClock()
+    camera = fake_camera(
+        PROFILE, clock=clock.timestamp, clock_offset=2.5, trigger_latency=0.3, exif=True
+    )
+    calibration = TriggerCalibration(camera, clock=clock, log_path=tmp_path / "latency.jsonl")
+
+    timelapse(
+        camera,
+        8,
+        timedelta(seconds=20),
+        tmp_path,
+        mode="manual",
+        clock=clock,
+        calibration=calibration,
+    )
+
+    entries = [json.loads(line) for line in (tmp_path / "latency.jsonl").read_text().splitlines()]
+    assert len(entries) == 8
+    assert [entry["latency"] for entry in entries] == pytest.approx([0.3] * 8, abs=0.05)
+    # Exposures start on the commanded grid once the lead kicks in
+    assert entries[0]["error"] == pytest.approx(0.3, abs=0.05)
+    assert [entry["error"] for entry in entries[3:]] == pytest.approx([0] * 5, abs=0.05)
@@ -0,0 +1,159 @@
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from chrophos.camera.fake import fake_camera
+from chrophos.clock import AcceleratedClock
+from chrophos.layout import (
+    LAYOUT_NAME,
+    Layout,
+    ShardedLayout,
+    frame_number,
+    migrate,
+    open_layout,
+)
+from chrophos.timelapse import timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+START = datetime(2024, 6, 1, 12, 0)
+
+
+def write_frames(layout, numbers, interval=timedelta(minutes=10)):
+    for number in numbers:
+        time = START + interval * (number - 1)
+        frame_dir = layout.frame_dir(number, time)
+        frame_dir.mkdir(parents=True, exist_ok=True)
+        path = frame_dir / f"{layout.stem(number)}.NEF"
+        path.write_bytes(b"x")
+        layout.record(number, time, [path])
+    layout.close()
+
+
+def test_frames_are_sharded_by_count(tmp_path):
+    layout = ShardedLayout(tmp_path, frames_per_shard=3)
+    layout.save()
+    write_frames(layout, range(1, 8))
+
+    layout = open_layout(tmp_path)
+    assert isinstance(layout, ShardedLayout)
+    assert [shard["shard"] for shard in layout.shards()] == ["000000", "000001", "000002"]
+    assert [path.name for path in layout.frame_paths()][:2] == ["TL00000001.NEF", "TL00000002.NEF"]
+    assert layout.last_frame() == 7
+
+
+def test_frames_are_sharded_by_hour(tmp_path):
+    layout = ShardedLayout(tmp_path, by_hour=True)
+    write_frames(layout, range(1, 14))
+
+    assert [shard["shard"] for shard in layout.shards()] == [
+        "20240601_12",
+        "20240601_13",
+        "20240601_14",
+    ]
+
+
+def test_records_are_filtered_by_frame_and_time(tmp_path):
+    layout = ShardedLayout(tmp_path, frames_per_shard=3)
+    write_frames(layout, range(1, 11))
+
+    assert [record.frame for record in layout.records(first_frame=4, last_frame=6)] == [4, 5, 6]
+    since = START + timedelta(minutes=75)
+    assert [record.frame for record in layout.records(start=since)] == [9, 10]
+
+
+def test_last_frame_counts_frames_missing_from_the_manifest(tmp_path):
+    layout = ShardedLayout(tmp_path, frames_per_shard=10)
+    write_frames(layout, range(1, 4))
+    # Written, but the process died before its manifest record was
+    (tmp_path / "000000" / "TL00000004.NEF").write_bytes(b"x")
+
+    assert layout.last_frame() == 4
+
+
+def test_resaving_with_different_sharding_is_refused(tmp_path):
+    ShardedLayout(tmp_path, frames_per_shard=3).save()
+    ShardedLayout(tmp_path, frames_per_shard=3).save()
+
+    with pytest.raises(ValueError, match="sharded as"):
+        ShardedLayout(tmp_path, frames_per_shard=10).save()
+    with pytest.raises(ValueError, match="sharded as"):
+        ShardedLayout(tmp_path, by_hour=True).save()
+
+
+def test_flat_frames_are_listed_in_frame_order(tmp_path):
+    for name in ["TL10.NEF", "TL9.NEF", "TL9.JPG", "brackets.jsonl"]:
+        (tmp_path / name).write_bytes(b"x")
+
+    assert [path.name for path in Layout(tmp_path).frame_paths(".nef")] == ["TL9.NEF", "TL10.NEF"]
+    assert frame_number(tmp_path / "TL10_b2.NEF") == 10
+
+
+def test_migrate(tmp_path):
+    source = tmp_path / "flat"
+    source.mkdir()
+    for number in range(1, 6):
+        path = source / f"TL{number}.NEF"
+        path.write_bytes(bytes([number]))
+        mtime = (START + timedelta(minutes=number)).timestamp()
+        os.utime(path, (mtime, mtime))
+
+    layout = migrate(source, frames_per_shard=2)
+
+    assert (source / LAYOUT_NAME).exists()
+    assert not list(source.glob("TL*.NEF"))
+    records = list(layout.records())
+    assert [record.frame for record in records] == [1, 2, 3, 4, 5]
+    assert records[0].time == START + timedelta(minutes=1)
+    assert records[4].files == [source / "000002" / "TL00000005.NEF"]
+    assert records[4].files[0].read_bytes() == bytes([5])
+
+
+def test_interrupted_migration_can_be_resumed(tmp_path):
+    source = tmp_path / "flat"
+    destination = tmp_path / "sharded"
+    source.mkdir()
+    for number in range(1, 6):
+        (source / f"TL{number}.NEF").write_bytes(bytes([number]))
+    # Interrupted after recording frames 1 and 2, and moving (but not recording) frame 3
+    partial = ShardedLayout(destination, frames_per_shard=2)
+    for number in (1, 2):
+        shard_dir = partial.frame_dir(number, START)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        path = shard_dir / f"{partial.stem(number)}.NEF"
+        os.replace(source / f"TL{number}.NEF", path)
+        partial.record(number, START, [path])
+    partial.close()
+    (destination / "000001").mkdir()
+    os.replace(source / "TL3.NEF", destination / "000001" / "TL00000003.NEF")
+
+    layout = migrate(source, destination, frames_per_shard=2)
+
+    assert [record.frame for record in layout.records()] == [1, 2, 3, 4, 5]
+    assert [path.read_bytes() for path in layout.frame_paths()] == [bytes([n]) for n in range(1, 6)]
+
+
+def test_resumed_timelapse_continues_numbering_in_the_same_shards(tmp_path):
+    def run(layout):
+        clock = AcceleratedClock()
+        camera = fake_camera(PROFILE, clock=clock.timestamp)
+        timelapse(
+            camera,
+            2,
+            timedelta(seconds=20),
+            tmp_path,
+            mode="manual",
+            overwrite=True,
+            layout=layout,
+            clock=clock,
+        )
+
+    run(ShardedLayout(tmp_path, frames_per_shard=3))
+    run(None)
+
+    layout = open_layout(tmp_path)
+    assert [record.frame for record in layout.records()] == [1, 2, 3, 4]
+    assert [shard["shard"] for shard in layout.shards()] == ["000000", "000001"]
+    with pytest.raises(ValueError, match="sharded as"):
+        run(ShardedLayout(tmp_path, frames_per_shard=10))
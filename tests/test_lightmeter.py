@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from chrophos.camera.camera import CameraError
+from chrophos.camera.fake import fake_camera
+from chrophos.camera.lightmeter import LightMeterReading, LightMeterSampler
+from chrophos.clock import AcceleratedClock
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+
+
+class MeterBackend:
+    """Reads the light meter as each of `values` in turn, then the last of them"""
+
+    def __init__(self, *values):
+        self.light_meter = SimpleNamespace(field="lightmeter", _value=None)
+        self.values = list(values)
+        self.reads = 0
+
+    def get_single_config_value(self, key):
+        assert key == "lightmeter"
+        self.reads += 1
+        return self.values.pop(0) if len(self.values) > 1 else self.values[0]
+
+
+class HalfPressBackend(MeterBackend):
+    def __init__(self, *values):
+        super().__init__(*values)
+        self.half_pressed = []
+
+    @contextmanager
+    def half_press_shutter_during(self):
+        self.half_pressed.append(True)
+        yield
+        self.half_pressed.append(False)
+
+
+class MeterScript:
+    """Stands in for a sampler: the meter reads how far (in stops) the camera's exposure is off
+    from what the scene needs
+    """
+
+    def __init__(self, camera, stops_under, confidence=1.0):
+        self.camera = camera
+        self.target_ev = camera.exposure.ev - stops_under
+        self.confidence = confidence
+        self.resets = 0
+
+    def wait_for(self, min_confidence, timeout):
+        value = self.target_ev - self.camera.exposure.ev
+        return LightMeterReading(0.0, value, value, self.confidence, 10)
+
+    def reset(self):
+        self.resets += 1
+
+
+def test_readings_are_smoothed():
+    sampler = LightMeterSampler(MeterBackend("0", "0", "0", "1"), smoothing=0.5, window=4)
+
+    assert sampler.reading() is None
+    for _ in range(3):
+        sampler.sample()
+    settled = sampler.reading()
+    sampler.sample()
+    moved = sampler.reading()
+
+    assert (settled.value, settled.confidence, settled.samples) == (0, 0.75, 3)
+    assert (moved.value, moved.raw) == (0.5, 1)
+    # A full window, but one that disagrees
+    assert moved.confidence == pytest.approx(1 / (1 + 0.433), abs=1e-3)
+    assert sampler.backend.light_meter._value == 1
+
+
+def test_readings_go_stale_and_reset():
+    clock = AcceleratedClock()
+    sampler = LightMeterSampler(MeterBackend("2"), window=2, stale_after=2.0, clock=clock)
+    sampler.sample()
+    sampler.sample()
+
+    assert sampler.reading().confidence == 1
+    clock.sleep(3)
+    assert sampler.reading().confidence == 0
+    sampler.reset()
+    assert sampler.reading() is None
+
+
+def test_sampler_polls_in_the_background_while_half_pressed():
+    backend = HalfPressBackend("oops", "-1", "-1")
+
+    with LightMeterSampler(backend, rate=200, window=3) as sampler:
+        reading = sampler.wait_for(min_confidence=1.0, timeout=5.0)
+        assert backend.half_pressed == [True]
+
+    assert reading.value == -1
+    assert sampler.errors == 1
+    assert backend.half_pressed == [True, False]
+
+
+def test_sampler_needs_a_light_meter():
+    backend = MeterBackend("0")
+    backend.light_meter = None
+
+    with pytest.raises(ValueError, match="no light meter"):
+        LightMeterSampler(backend)
+
+
+def test_auto_exposure_aims_for_the_middle_of_the_bounds():
+    camera = fake_camera(PROFILE)
+    camera.light_meter = True
+    start_ev = camera.exposure.ev
+    meter = MeterScript(camera, stops_under=3)
+
+    reading = camera.auto_expose_via_light_meter((-0.5, 0.5), meter)
+
+    assert reading == pytest.approx(0, abs=0.1)
+    assert camera.exposure.ev == pytest.approx(start_ev - 3, abs=0.1)
+    # In one adjustment, rather than a third of a stop at a time
+    assert meter.resets == 1
+
+
+def test_auto_exposure_gives_up():
+    camera = fake_camera(PROFILE)
+    camera.light_meter = True
+    meter = MeterScript(camera, stops_under=3)
+    # Nothing the camera does changes what the meter reads
+    meter.wait_for = lambda min_confidence, timeout: LightMeterReading(0.0, -3, -3, 1.0, 10)
+
+    with pytest.raises(CameraError, match="after 2 adjustment"):
+        camera.auto_expose_via_light_meter((-0.5, 0.5), meter, max_adjustments=2)
+    meter.wait_for = lambda min_confidence, timeout: None
+    with pytest.raises(CameraError, match="no reading"):
+        camera.auto_expose_via_light_meter((-0.5, 0.5), meter)
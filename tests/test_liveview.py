@@ -0,0 +1,137 @@
+import io
+import json
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from chrophos.camera.fake import fake_camera
+from chrophos.camera.liveview import LiveViewMeter, PreviewStats, preview_stats
+from chrophos.clock import AcceleratedClock
+from chrophos.timelapse import timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+SECOND = timedelta(seconds=1)
+
+
+def jpeg(level):
+    output = io.BytesIO()
+    Image.new("L", (640, 480), level).save(output, "JPEG")
+    return output.getvalue()
+
+
+@pytest.fixture(scope="module")
+def meter():
+    return LiveViewMeter(fake_camera(PROFILE))
+
+
+def stats(mean, clipped=0.0):
+    return PreviewStats(mean=mean, p50=mean, p95=mean, clipped=clipped, pixels=100)
+
+
+def test_preview_stats_are_linear():
+    grey = preview_stats(jpeg(118))
+    white = preview_stats(jpeg(255))
+
+    assert grey.mean == pytest.approx(0.18, abs=0.01)
+    assert grey.p50 == pytest.approx(grey.mean, abs=0.01)
+    assert grey.clipped == 0
+    assert grey.pixels == 320 * 240
+    assert white.clipped == 1
+
+
+@pytest.mark.parametrize(
+    ("preview", "expected"),
+    [
+        (stats(0.09), 1.0),
+        (stats(0.01), 1.0),
+        (stats(0.36), -1.0),
+        (stats(0.16), 0.0),
+        (stats(0.11), 2 / 3),
+        # Too many highlights clipped to brighten, however dark the rest is
+        (stats(0.05, clipped=0.1), -1 / 3),
+    ],
+)
+def test_correction(meter, preview, expected):
+    assert meter.correction(preview) == pytest.approx(expected)
+
+
+def test_meters_once_a_period_and_only_with_time_to_spare():
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp)
+    meter = LiveViewMeter(camera, period=60 * SECOND, clock=clock)
+
+    assert meter.between_frames(1, clock.now() + 10 * SECOND) is not None
+    assert meter.between_frames(2, clock.now() + 10 * SECOND) is None
+    clock.sleep(60)
+    assert meter.between_frames(3, clock.now() + SECOND) is None
+    assert meter.counts["no_time"] == 1
+    assert meter.between_frames(4, clock.now() + 10 * SECOND) is not None
+    assert camera.backend._camera.camera.previews == 2
+
+
+def test_suspends_when_there_is_never_time():
+    clock = AcceleratedClock()
+    meter = LiveViewMeter(
+        fake_camera(PROFILE, clock=clock.timestamp),
+        suspend_after=2,
+        suspend_for=600 * SECOND,
+        clock=clock,
+    )
+
+    for _ in range(2):
+        meter.between_frames(1, clock.now())
+    clock.sleep(300)
+    suspended = meter.between_frames(2, clock.now() + 10 * SECOND)
+    clock.sleep(301)
+    resumed = meter.between_frames(3, clock.now() + 10 * SECOND)
+
+    assert meter.counts["suspended"] == 1
+    assert suspended is None
+    assert resumed is not None
+
+
+def test_corrects_exposure_and_leaves_live_view(tmp_path):
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp, preview_level=60)
+    fake = camera.backend._camera.camera
+    meter = LiveViewMeter(camera, clock=clock, log_path=tmp_path / "liveview.jsonl")
+    start_ev = camera.exposure.ev
+
+    decision = meter.meter(1)
+
+    assert decision.correction == 1.0
+    assert decision.applied == pytest.approx(1.0)
+    assert camera.exposure.ev == pytest.approx(start_ev - 1, abs=0.1)
+    assert fake.get_single_config("viewfinder").value == 0
+    logged = json.loads((tmp_path / "liveview.jsonl").read_text())
+    assert logged["frame"] == 1
+    assert logged["stats"]["mean"] == pytest.approx(decision.stats.mean)
+
+
+def test_shutter_stays_within_the_interval():
+    camera = fake_camera(PROFILE, preview_level=60)
+    camera.shutter = "1"
+    camera.backend.push_config()
+    start_ev = camera.exposure.ev
+    # A 1s shutter is as long as fits in 5s with a 4s dark time
+    meter = LiveViewMeter(camera, clock=AcceleratedClock(), interval=5 * SECOND)
+
+    decision = meter.meter(1)
+
+    assert camera.shutter.actual_value == 1
+    assert decision.applied == pytest.approx(1.0)
+    assert camera.exposure.ev == pytest.approx(start_ev - 1, abs=0.1)
+
+
+def test_timelapse_meters_between_frames(tmp_path):
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp, preview_level=60)
+    meter = LiveViewMeter(camera, period=30 * SECOND, clock=clock)
+
+    timelapse(camera, 4, 20 * SECOND, tmp_path, mode="manual", clock=clock, liveview=meter)
+
+    assert meter.counts["metered"] == 2
+    assert meter.counts["adjusted"] == 2
+    assert len(list(tmp_path.glob("TL*.NEF"))) == 4
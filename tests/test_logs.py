@@ -0,0 +1,98 @@
+import json
+import logging
+
+from chrophos.logs import (
+    BoundedQueueHandler,
+    ContextFilter,
+    JsonFormatter,
+    LogPipeline,
+    RateLimitFilter,
+    log_context,
+)
+
+
+def record(line=10, level=logging.INFO, msg="message %d", args=(1,)):
+    return logging.LogRecord("chrophos.test", level, __file__, line, msg, args, None)
+
+
+def test_rate_limit_lets_through_a_burst_then_a_sample():
+    rate_limit = RateLimitFilter(rate=0, burst=2, sample=3)
+    records = [record() for _ in range(8)]
+
+    admitted = [rate_limit.filter(each) for each in records]
+
+    assert admitted == [True, True, False, False, True, False, False, True]
+    assert rate_limit.suppressed == 4
+    assert records[4].suppressed == 2
+    assert not hasattr(records[1], "suppressed")
+
+
+def test_rate_limit_is_per_call_site():
+    rate_limit = RateLimitFilter(rate=0, burst=1, sample=0)
+
+    assert rate_limit.filter(record(line=1))
+    assert rate_limit.filter(record(line=2))
+    assert not rate_limit.filter(record(line=1))
+    # Errors always get through
+    assert rate_limit.filter(record(line=1, level=logging.ERROR))
+
+
+def test_records_are_stamped_with_context():
+    context_filter = ContextFilter()
+    with log_context(frame=7, stage="capture"):
+        with log_context(stage="download"):
+            inner = record()
+            context_filter.filter(inner)
+        outer = record()
+        context_filter.filter(outer)
+    after = record()
+    context_filter.filter(after)
+
+    assert (inner.frame, inner.stage) == (7, "download")
+    assert (outer.frame, outer.stage) == (7, "capture")
+    assert (after.frame, after.stage) == (None, None)
+
+
+def test_queue_handler_drops_rather_than_blocks():
+    handler = BoundedQueueHandler(maxsize=2)
+    message = record(msg="deferred %s", args=("formatting",))
+
+    for _ in range(3):
+        handler.handle(message)
+    handler.handle(record(level=logging.WARNING))
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == {"INFO": 1, "WARNING": 1}
+    # Queued as is, so the message is only formatted by the listener
+    assert handler.queue.get_nowait().args == ("formatting",)
+
+
+def test_json_formatter():
+    message = record()
+    message.frame = 3
+    message.suppressed = 5
+
+    entry = json.loads(JsonFormatter().format(message))
+
+    assert entry["message"] == "message 1"
+    assert entry["frame"] == 3
+    assert entry["suppressed"] == 5
+
+
+def test_pipeline_writes_jsonl(tmp_path):
+    path = tmp_path / "logs" / "run.jsonl"
+    pipeline = LogPipeline(
+        jsonl_path=path, console=False, rate_limit=RateLimitFilter(rate=0, burst=3, sample=0)
+    ).start()
+    logger = logging.getLogger("chrophos.test")
+
+    with log_context(frame=1, stage="capture"):
+        for number in range(5):
+            logger.info("Frame %d", number)
+    pipeline.stop()
+
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [entry["message"] for entry in entries[:3]] == ["Frame 0", "Frame 1", "Frame 2"]
+    assert entries[0]["stage"] == "capture"
+    assert "rate-limited 2" in entries[-1]["message"]
+    assert len(entries) == 4
@@ -0,0 +1,137 @@
+import math
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from chrophos.metering import (
+    LUMINANCE_WEIGHTS,
+    RawMeter,
+    bayer_luminance,
+    center_weighted_mask,
+    resample_mask,
+    sky_mask,
+)
+
+BLACK = 512
+WHITE = 2**14 - 1
+# RGGB, as laid out by rawpy: indices into "RGBG"
+PATTERN = np.array([[0, 1], [3, 2]])
+
+
+def plane(red, green, blue, shape=(64, 96)):
+    """A raw plane with every photosite of each color at the given level (0 to 1)"""
+    levels = np.empty(shape)
+    levels[0::2, 0::2] = red
+    levels[0::2, 1::2] = green
+    levels[1::2, 0::2] = green
+    levels[1::2, 1::2] = blue
+    return np.round(BLACK + levels * (WHITE - BLACK)).astype(np.uint16)
+
+
+def raw(image, white_balance=(1.0, 1.0, 1.0, 1.0)):
+    return SimpleNamespace(
+        raw_image_visible=image,
+        raw_pattern=PATTERN,
+        color_desc=b"RGBG",
+        black_level_per_channel=[BLACK] * 4,
+        white_level=WHITE,
+        camera_whitebalance=list(white_balance),
+    )
+
+
+def test_bayer_luminance_weights_each_color():
+    luminance, clipped = bayer_luminance(
+        plane(0.4, 0.2, 0.8), PATTERN, "RGBG", [BLACK] * 4, WHITE, stride=4
+    )
+
+    expected = (
+        LUMINANCE_WEIGHTS["R"] * 0.4 + LUMINANCE_WEIGHTS["G"] * 0.2 + LUMINANCE_WEIGHTS["B"] * 0.8
+    )
+    assert luminance.shape == (8, 12)
+    assert luminance == pytest.approx(np.full((8, 12), expected), abs=1e-4)
+    assert not clipped.any()
+
+
+def test_bayer_luminance_applies_white_balance_relative_to_green():
+    # The second green left out, as cameras often do
+    white_balance = [2.0, 1.0, 1.5, 0.0]
+
+    luminance, _ = bayer_luminance(
+        plane(0.2, 0.2, 0.2), PATTERN, "RGBG", [BLACK] * 4, WHITE, white_balance=white_balance
+    )
+
+    expected = (
+        LUMINANCE_WEIGHTS["R"] * 0.4 + LUMINANCE_WEIGHTS["G"] * 0.2 + LUMINANCE_WEIGHTS["B"] * 0.3
+    )
+    assert luminance == pytest.approx(np.full(luminance.shape, expected), abs=1e-4)
+
+
+def test_any_clipped_photosite_clips_its_cell():
+    image = plane(0.2, 0.2, 0.2)
+    image[1, 1] = WHITE
+
+    luminance, clipped = bayer_luminance(image, PATTERN, "RGBG", [BLACK] * 4, WHITE, stride=1)
+
+    assert clipped.sum() == 1
+    assert clipped[0, 0]
+    assert luminance.max() <= 1
+
+
+def test_sensors_without_a_bayer_pattern_are_sampled_as_monochrome():
+    image = np.full((32, 32), BLACK + (WHITE - BLACK) // 4, dtype=np.uint16)
+
+    luminance, clipped = bayer_luminance(image, None, "RGB", [BLACK] * 3, WHITE, stride=8)
+
+    assert luminance.shape == (4, 4)
+    assert luminance == pytest.approx(np.full((4, 4), 0.25), abs=1e-3)
+    assert not clipped.any()
+
+
+def test_masks():
+    mask = sky_mask(0.4, shape=(10, 10))
+
+    assert mask[:4].all()
+    assert not mask[4:].any()
+    assert resample_mask(mask, (5, 3)).tolist() == [[1] * 3, [1] * 3, [0] * 3, [0] * 3, [0] * 3]
+    center = center_weighted_mask((11, 11))
+    assert center[5, 5] == center.max()
+
+
+def test_correction_brings_the_mean_to_target():
+    reading = RawMeter(stride=2).meter(raw(plane(0.09, 0.09, 0.09)))
+
+    assert reading.mean == pytest.approx(0.09, abs=1e-3)
+    assert reading.compensation == pytest.approx(-1, abs=0.02)
+    assert reading.correction == pytest.approx(1, abs=0.02)
+    assert reading.percentiles[50] == pytest.approx(0.09, abs=1e-3)
+    assert reading.samples == 16 * 24
+
+
+def test_correction_is_held_back_by_highlights():
+    image = plane(0.01, 0.01, 0.01)
+    image[:8] = plane(0.9, 0.9, 0.9, shape=(8, 96))
+    clipped = image.copy()
+    clipped[:4] = WHITE
+
+    held_back = RawMeter(stride=1).meter(raw(image))
+    clipping = RawMeter(stride=1).meter(raw(clipped))
+
+    # Half a stop under, by the mean
+    assert held_back.compensation < -0.5
+    assert held_back.correction == pytest.approx(math.log2(0.95 / 0.9), abs=0.01)
+    assert clipping.clipped > 0.005
+    assert clipping.correction == -1 / 3
+
+
+def test_regions_and_weights():
+    image = plane(0.02, 0.02, 0.02)
+    image[:32] = plane(0.5, 0.5, 0.5, shape=(32, 96))
+    top = sky_mask(0.5)
+
+    reading = RawMeter(stride=1, regions={"sky": top}, weights=1 - top).meter(raw(image))
+
+    assert reading.regions["sky"].mean == pytest.approx(0.5, abs=1e-3)
+    assert reading.mean == pytest.approx(0.02, abs=1e-3)
+    with pytest.raises(ValueError, match="empty"):
+        RawMeter(weights=np.zeros((4, 4))).meter(raw(image))
@@ -0,0 +1,91 @@
+import io
+
+import pytest
+from PIL import Image
+
+from chrophos.archive import ArchiveWriter
+from chrophos.overview import OverviewBuilder, build_overview, iter_frames
+
+SETTINGS = {"keogram_height": 8, "keogram_columns": 3, "tile_size": (8, 6), "columns": 2, "rows": 2}
+
+
+def jpeg(level):
+    output = io.BytesIO()
+    Image.new("L", (32, 24), level).save(output, "JPEG")
+    return output.getvalue()
+
+
+def write_frames(root, numbers, stem="TL{}"):
+    root.mkdir(exist_ok=True)
+    for number in numbers:
+        (root / f"{stem.format(number)}.NEF").write_bytes(b"raw")
+        (root / f"{stem.format(number)}.JPG").write_bytes(jpeg(number * 40))
+
+
+def test_one_preview_file_per_frame(tmp_path):
+    write_frames(tmp_path, [1, 2, 10])
+
+    assert [(number, name) for number, name, _path in iter_frames(tmp_path)] == [
+        (1, "TL1.JPG"),
+        (2, "TL2.JPG"),
+        (10, "TL10.JPG"),
+    ]
+    assert [number for number, _name, _path in iter_frames(tmp_path, after=2)] == [10]
+
+
+def test_camera_named_files_are_numbered_by_stem(tmp_path):
+    write_frames(tmp_path, [1, 2, 3], stem="DSC_{:04d}")
+
+    assert [(number, name) for number, name, _path in iter_frames(tmp_path)] == [
+        (1, "DSC_0001.JPG"),
+        (2, "DSC_0002.JPG"),
+        (3, "DSC_0003.JPG"),
+    ]
+
+
+def test_frames_are_read_from_archives(tmp_path):
+    writer = ArchiveWriter(tmp_path)
+    for number in (1, 2, 3):
+        writer.add(f"TL{number}.NEF", b"raw")
+        writer.add(f"TL{number}.JPG", jpeg(number))
+    writer.close()
+
+    frames = list(iter_frames(tmp_path, after=1))
+
+    assert [(number, name) for number, name, _data in frames] == [(2, "TL2.JPG"), (3, "TL3.JPG")]
+    assert frames[0][2] == jpeg(2)
+
+
+def test_keogram_and_contact_sheets_are_paged(tmp_path):
+    write_frames(tmp_path / "frames", range(1, 6))
+    output_dir = tmp_path / "overview"
+
+    assert build_overview(tmp_path / "frames", OverviewBuilder(output_dir, **SETTINGS)) == 5
+
+    sizes = {path.name: Image.open(path).size for path in output_dir.glob("*.png")}
+    assert sizes == {
+        "keogram_0000.png": (3, 8),
+        "keogram_0001.png": (2, 8),
+        "contact_0000.png": (16, 12),
+        "contact_0001.png": (16, 6),
+    }
+    keogram = Image.open(output_dir / "keogram_0000.png").convert("L")
+    assert [keogram.getpixel((column, 4)) for column in range(3)] == pytest.approx(
+        [40, 80, 120], abs=2
+    )
+
+
+def test_overview_resumes_after_the_last_frame_done(tmp_path):
+    frames_dir = tmp_path / "frames"
+    write_frames(frames_dir, range(1, 4))
+    output_dir = tmp_path / "overview"
+    build_overview(frames_dir, OverviewBuilder(output_dir, **SETTINGS))
+    write_frames(frames_dir, range(4, 6))
+
+    builder = OverviewBuilder(output_dir, **SETTINGS)
+    assert builder.last_frame == 3
+    assert build_overview(frames_dir, builder) == 2
+    assert builder.frames == 5
+
+    with pytest.raises(ValueError, match="different settings"):
+        OverviewBuilder(output_dir, **{**SETTINGS, "columns": 3})
@@ -0,0 +1,36 @@
+from chrophos import perf
+
+
+def results(**medians):
+    return {"results": {name: {"median": median} for name, median in medians.items()}}
+
+
+def test_compare_flags_regressions_beyond_the_threshold():
+    baseline = results(fast=1.0, slow=1.0, removed=1.0)
+    current = results(fast=0.5, slow=1.3, added=1.0)
+
+    assert perf.compare(baseline, current, threshold=0.25) == [
+        ("fast", 1.0, 0.5, False),
+        ("slow", 1.0, 1.3, True),
+    ]
+
+
+def test_measure_returns_one_sample_per_repeat():
+    calls = []
+
+    samples = perf.measure(lambda: calls.append(None), repeat=3, min_time=0)
+
+    assert len(samples) == 3
+    assert len(calls) == 3
+
+
+def test_gen_times_has_no_drift():
+    assert perf.bench_gen_times_drift(perf.DEFAULT_PROFILE, num_frames=10_000) == [0.0]
+
+
+def test_run_only_selected_cases():
+    report = perf.run(repeat=2, select="gen_times.100k")
+
+    assert list(report["results"]) == ["gen_times.100k"]
+    assert report["results"]["gen_times.100k"]["n"] == 2
+    assert "python" in report["environment"]
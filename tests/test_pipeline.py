@@ -0,0 +1,110 @@
+import io
+import json
+import time
+
+import pytest
+from PIL import Image
+
+from chrophos.camera.backend import BackendError
+from chrophos.pipeline import FramePipeline, thumbnail_stats
+
+
+def jpeg(value):
+    output = io.BytesIO()
+    Image.new("L", (32, 32), value).save(output, "JPEG")
+    return output.getvalue()
+
+
+def slow_size(name, data):
+    """Analyzer that takes long enough for frames to pile up behind it"""
+    time.sleep(0.5)
+    return {"size": len(data)}
+
+
+def failing(name, data):
+    raise ValueError(f"can't analyze {name}")
+
+
+@pytest.fixture
+def pipeline():
+    pipelines = []
+
+    def start(**kwargs):
+        pipelines.append(FramePipeline(**kwargs))
+        pipelines[-1].start()
+        return pipelines[-1]
+
+    yield start
+    for each in pipelines:
+        each.stop()
+
+
+def test_frames_are_stored_and_analyzed(tmp_path, pipeline):
+    results = {}
+    frames = pipeline(
+        analyzers=[thumbnail_stats, failing],
+        slots=4,
+        slot_bytes=2**16,
+        on_result=results.__setitem__,
+        results_path=tmp_path / "analysis.jsonl",
+    )
+    committed = []
+    writer = frames.writer(tmp_path / "frames", commit_frames=2, on_commit=committed.extend)
+
+    paths = [writer.write(f"TL{number}.JPG", jpeg(value)) for number, value in ((1, 0), (2, 255))]
+    writer.close()
+    frames.stop()
+
+    assert (tmp_path / "frames" / "TL2.JPG").read_bytes() == jpeg(255)
+    assert committed == paths == [tmp_path / "frames" / "TL1.JPG", tmp_path / "frames" / "TL2.JPG"]
+    assert "write" in writer.stats()
+    dark, light = results["TL1.JPG"], results["TL2.JPG"]
+    assert dark["thumbnail_stats"]["mean"] < light["thumbnail_stats"]["mean"]
+    assert "ValueError" in dark["failing"]["error"]
+    logged = [json.loads(line) for line in (tmp_path / "analysis.jsonl").read_text().splitlines()]
+    assert sorted(entry["name"] for entry in logged) == ["TL1.JPG", "TL2.JPG"]
+
+
+def test_oversize_frames_are_sent_by_queue(tmp_path, pipeline):
+    frames = pipeline(slots=2, slot_bytes=100)
+    writer = frames.writer(tmp_path)
+
+    writer.write("TL1.NEF", b"x" * 1000)
+    writer.write("TL2.NEF", b"y" * 10)
+    writer.close()
+    frames.stop()
+
+    assert frames.counts["oversize"] == 1
+    assert (tmp_path / "TL1.NEF").read_bytes() == b"x" * 1000
+    assert (tmp_path / "TL2.NEF").read_bytes() == b"y" * 10
+
+
+def test_analysis_falls_behind_without_holding_up_capture(tmp_path, pipeline):
+    frames = pipeline(analyzers=[slow_size], slots=2, slot_bytes=100)
+    writer = frames.writer(tmp_path)
+
+    start = time.perf_counter()
+    for number in range(1, 5):
+        writer.write(f"TL{number}.NEF", b"x" * 10)
+    elapsed = time.perf_counter() - start
+    writer.close()
+    frames.stop()
+
+    assert elapsed < 0.5
+    # Analysis only ever gets half of the slots
+    assert frames.counts["analyzed"] + frames.counts["analysis_skipped"] == 4
+    assert frames.counts["analysis_skipped"] >= 2
+    assert len(list(tmp_path.glob("TL*.NEF"))) == 4
+
+
+def test_storage_errors_are_raised_from_the_next_frame(tmp_path, pipeline):
+    (tmp_path / "frames").write_text("not a directory")
+    frames = pipeline(slots=2, slot_bytes=100)
+    writer = frames.writer(tmp_path / "frames")
+
+    with pytest.raises(BackendError, match="Failed to store a frame"):
+        for _ in range(100):
+            writer.write("TL1.NEF", b"x")
+            time.sleep(0.05)
+
+    assert frames.counts["storage_errors"] >= 1
@@ -0,0 +1,99 @@
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from chrophos.config import parse_config
+from chrophos.plan import default_trials, simulate_session
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+
+
+@pytest.fixture(scope="module")
+def config():
+    return parse_config(PROFILE)
+
+
+def test_session_without_overruns(config):
+    estimate = simulate_session(
+        config,
+        interval=timedelta(seconds=10),
+        duration=timedelta(hours=1),
+        file_sizes=[10e6],
+        dark_times=[2.0],
+        shutter=0.5,
+        trials=5,
+        seed=0,
+    )
+
+    assert estimate.slots == 360
+    assert estimate.expected_missed_frames == 0
+    assert estimate.storage_bytes_p50 == estimate.storage_bytes_p95 == 360 * 10e6
+    assert estimate.time_until_disk_full is None
+    assert estimate.max_transfer_backlog_bytes_p95 is None
+    assert estimate.recommended_min_interval == timedelta(seconds=2.5)
+
+
+def test_overrunning_frames_miss_the_following_slots(config):
+    # Every frame takes 2.5 intervals, so it's captured in one slot and the next two are missed
+    estimate = simulate_session(
+        config,
+        interval=timedelta(seconds=2),
+        duration=timedelta(seconds=60),
+        file_sizes=[1e6],
+        dark_times=[4.5],
+        shutter=0.5,
+        trials=3,
+        seed=0,
+    )
+
+    assert estimate.slots == 30
+    assert estimate.expected_missed_frames == 20
+    assert estimate.storage_bytes_p50 == 10 * 1e6
+
+
+def test_occasional_overruns_match_their_probability(config):
+    # One frame in ten overruns into one extra slot
+    slots = 100_000
+    estimate = simulate_session(
+        config,
+        interval=timedelta(seconds=5),
+        duration=timedelta(seconds=5 * slots),
+        file_sizes=[1e6],
+        dark_times=[1.0] * 9 + [6.0],
+        shutter=0.0,
+        trials=20,
+        seed=0,
+    )
+
+    # n frames with 0.1n overruns fill n + 0.1n slots
+    assert estimate.expected_missed_frames == pytest.approx(slots - slots / 1.1, rel=0.01)
+
+
+def test_disk_full_and_transfer_backlog(config):
+    estimate = simulate_session(
+        config,
+        interval=timedelta(seconds=10),
+        duration=timedelta(hours=1),
+        file_sizes=[10e6],
+        dark_times=[1.0],
+        shutter=0.0,
+        storage_capacity=1e9,
+        transfer_bandwidth=0.5e6,
+        trials=5,
+        seed=0,
+    )
+
+    # The 101st frame (in slot 100) is the first that doesn't fit
+    assert estimate.time_until_disk_full == timedelta(seconds=1000)
+    assert estimate.disk_full_probability == 1
+    # Each frame leaves 5 MB behind in the queue
+    assert estimate.max_transfer_backlog_bytes_p95 == pytest.approx(360 * 5e6)
+    assert estimate.recommended_min_interval == timedelta(seconds=20)
+
+
+def test_default_trials_are_capped_for_long_per_frame_simulations():
+    assert default_trials(518_400, per_frame=False) == 100
+    assert default_trials(1_000, per_frame=True) == 100
+    assert default_trials(518_400, per_frame=True) == 19
+    assert default_trials(100_000_000, per_frame=True) == 10
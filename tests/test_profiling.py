@@ -0,0 +1,55 @@
+import json
+import time
+from datetime import timedelta
+
+from chrophos.profiling import FrameProfiler
+
+
+def read_records(output_dir):
+    with open(output_dir / "profiles.jsonl") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_only_the_slowest_frames_are_kept(tmp_path):
+    profiler = FrameProfiler(tmp_path, top_k=2, sample_interval=0.001)
+    profiler.start()
+    for frame_number, seconds in enumerate([0.0, 0.03, 0.0, 0.02, 0.01], 1):
+        with profiler.frame(frame_number):
+            time.sleep(seconds)
+    profiler.close()
+
+    records = read_records(tmp_path)
+    assert [(record["frame_number"], record["reason"]) for record in records] == [
+        (2, "top_k"),
+        (4, "top_k"),
+    ]
+    assert profiler.frames_profiled == 5
+    speedscope = json.loads((tmp_path / records[0]["speedscope"]).read_text())
+    assert speedscope["profiles"][0]["endValue"] == records[0]["duration"]
+
+
+def test_outliers_are_written_as_soon_as_their_frame_ends(tmp_path):
+    profiler = FrameProfiler(
+        tmp_path, top_k=0, threshold=timedelta(seconds=0.02), sample_interval=0.001
+    )
+    profiler.start()
+    with profiler.frame(1):
+        time.sleep(0.04)
+
+    assert [record["reason"] for record in read_records(tmp_path)] == ["outlier"]
+    assert profiler.outliers == 1
+    profiler.close()
+
+
+def test_waiting_doesnt_count_towards_a_frame(tmp_path):
+    profiler = FrameProfiler(
+        tmp_path, top_k=0, threshold=timedelta(seconds=0.02), sample_interval=0.001
+    )
+    profiler.start()
+    with profiler.frame(1):
+        with profiler.waiting():
+            time.sleep(0.04)
+    profiler.close()
+
+    assert profiler.outliers == 0
+    assert not (tmp_path / "profiles.jsonl").exists()
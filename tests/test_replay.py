@@ -0,0 +1,148 @@
+from datetime import timedelta
+from pathlib import Path
+
+import gphoto2 as gp
+import pytest
+
+from chrophos.camera.backend import Gphoto2Backend
+from chrophos.camera.camera import Camera
+from chrophos.camera.fake import FakeCamera, FakeWidget
+from chrophos.camera.replay import (
+    ReplayCamera,
+    ReplayError,
+    SessionRecorder,
+    deserialize_widget,
+    serialize_widget,
+    summarize_trace,
+)
+from chrophos.clock import AcceleratedClock
+from chrophos.config import parse_config
+from chrophos.timelapse import timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+
+
+def camera_on(gphoto2_camera):
+    config = parse_config(PROFILE)
+    backend = Gphoto2Backend(
+        config_map=config.config_map,
+        target_shutter=config.target_shutter,
+        target_aperture=config.target_aperture,
+        target_iso=config.target_iso,
+        files_per_exposure=config.files_per_exposure,
+        camera=gphoto2_camera,
+    )
+    return Camera(backend=backend, config=config)
+
+
+def tree():
+    return FakeWidget(
+        "main",
+        children=[
+            FakeWidget("iso", label="ISO", value="100", choices=["100", "200"]),
+            FakeWidget("serialnumber", value="1234", read_only=True),
+        ],
+    )
+
+
+class ScriptedCamera:
+    """Just enough of a gphoto2 camera to record single calls from"""
+
+    def __init__(self):
+        self.config = tree()
+        self.events = [(gp.GP_EVENT_TIMEOUT, None)] * 3
+
+    def get_config(self):
+        return self.config.copy()
+
+    def trigger_capture(self):
+        self.events.append((gp.GP_EVENT_CAPTURE_COMPLETE, None))
+
+    def wait_for_event(self, timeout):
+        return self.events.pop(0)
+
+    def file_get(self, folder, name, type_):
+        raise gp.GPhoto2Error(gp.GP_ERROR_IO)
+
+
+def test_widgets_round_trip():
+    entry = serialize_widget(tree())
+
+    assert serialize_widget(deserialize_widget(entry)) == entry
+    assert entry["k"][1] == {"n": "serialnumber", "r": 1, "v": "1234"}
+
+
+def test_config_trees_are_recorded_as_changes(tmp_path):
+    recorder = SessionRecorder(tmp_path / "trace.jsonl")
+    camera = ScriptedCamera()
+    recording = recorder.wrap(camera)
+
+    recording.get_config()
+    camera.config.get_child_by_name("iso").value = "200"
+    recording.get_config()
+    recorder.close()
+
+    lines = (tmp_path / "trace.jsonl").read_text().splitlines()
+    assert '"tree"' in lines[1]
+    assert '"changes":{"iso":"200"}' in lines[2]
+    replay = ReplayCamera(tmp_path / "trace.jsonl")
+    assert replay.get_config().get_child_by_name("iso").value == "100"
+    assert replay.get_config().get_child_by_name("iso").value == "200"
+    # Beyond the recording, reads get the last state seen
+    assert replay.get_config().get_child_by_name("iso").value == "200"
+    assert replay.divergences == 1
+
+
+def test_events_wait_for_their_trigger(tmp_path):
+    recorder = SessionRecorder(tmp_path / "trace.jsonl.gz")
+    recording = recorder.wrap(ScriptedCamera())
+    for _ in range(3):
+        recording.wait_for_event(100)
+    recording.trigger_capture()
+    recording.wait_for_event(100)
+    with pytest.raises(gp.GPhoto2Error):
+        recording.file_get("/", "DSC_0001.NEF", gp.GP_FILE_TYPE_NORMAL)
+    recorder.close()
+
+    summary = summarize_trace(tmp_path / "trace.jsonl.gz")
+    assert summary["wait_for_event"]["n"] == 4
+    assert summary["file_get"]["errors"] == 1
+
+    replay = ReplayCamera(tmp_path / "trace.jsonl.gz")
+    # The run of three timeouts is played back one at a time
+    assert [replay.wait_for_event(100)[0] for _ in range(3)] == [gp.GP_EVENT_TIMEOUT] * 3
+    # The capture completed event isn't seen before the trigger
+    assert replay.wait_for_event(100)[0] == gp.GP_EVENT_TIMEOUT
+    replay.trigger_capture()
+    assert replay.wait_for_event(100)[0] == gp.GP_EVENT_CAPTURE_COMPLETE
+    with pytest.raises(gp.GPhoto2Error):
+        replay.file_get("/", "DSC_0001.NEF", gp.GP_FILE_TYPE_NORMAL)
+    with pytest.raises(ReplayError):
+        replay.trigger_capture()
+
+
+def test_timelapse_replays_as_recorded(tmp_path):
+    clock = AcceleratedClock()
+    recorder = SessionRecorder(tmp_path / "trace.jsonl", keep_payloads=True)
+    fake = FakeCamera.from_config(PROFILE, clock=clock.timestamp, file_size=64)
+    recorded = camera_on(recorder.wrap(fake))
+    timelapse(recorded, 3, timedelta(seconds=20), tmp_path / "recorded", mode="manual", clock=clock)
+    recorder.close()
+
+    replay = ReplayCamera(tmp_path / "trace.jsonl")
+    clock = AcceleratedClock()
+    timelapse(
+        camera_on(replay),
+        3,
+        timedelta(seconds=20),
+        tmp_path / "replayed",
+        mode="manual",
+        clock=clock,
+    )
+
+    recorded_frames = sorted(path.name for path in (tmp_path / "recorded").glob("TL*"))
+    assert recorded_frames == ["TL1.NEF", "TL2.NEF", "TL3.NEF"]
+    assert sorted(path.name for path in (tmp_path / "replayed").glob("TL*")) == recorded_frames
+    assert replay.divergences == 0
+    assert not replay.calls["trigger_capture"]
+    assert summarize_trace(tmp_path / "trace.jsonl")["file_get"]["bytes"] == 3 * 64
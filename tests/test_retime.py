@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from chrophos.retime import FrameDirectorySink, Retimer, Variant, retime
+
+SECOND = timedelta(seconds=1)
+
+
+class ListSink:
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    def write(self, frame):
+        self.frames.append(frame)
+
+    def close(self):
+        self.closed = True
+
+
+def run(variant, values):
+    sink = ListSink()
+    retimer = Retimer(variant, SECOND, sink)
+    history = {}
+    for index in np.flatnonzero(retimer.used_frames(len(values))):
+        history[int(index)] = np.full((2, 2), values[index], dtype=np.uint16)
+        retimer.add(int(index), history[int(index)], history)
+    return [int(frame[0, 0]) for frame in sink.frames]
+
+
+def test_variant_windows():
+    assert Variant(speedup=60, fps=30).step(SECOND) == 2
+    assert Variant(speedup=60, fps=30, blend=None).window(SECOND) == 2
+    assert Variant(speedup=72, fps=30, blend=None).window(SECOND) == 2
+    assert Variant(speedup=10, fps=30, blend=None).window(SECOND) == 1
+    assert Variant(speedup=60, fps=30, blend=3).window(SECOND) == 3
+
+
+@pytest.mark.parametrize(
+    ("variant", "input_frames", "expected"),
+    [
+        (Variant(speedup=2, fps=1), 9, 5),
+        (Variant(speedup=2, fps=1, blend=3), 9, 4),
+        (Variant(speedup=2, fps=1, blend=3), 2, 0),
+        (Variant(speedup=0.5, fps=1), 3, 6),
+        (Variant(speedup=3, fps=10), 100, 334),
+    ],
+)
+def test_output_frames(variant, input_frames, expected):
+    assert variant.output_frames(input_frames, SECOND) == expected
+
+
+def test_only_frames_in_some_window_are_used():
+    retimer = Retimer(Variant(speedup=4, fps=1, blend=2), SECOND, ListSink())
+
+    assert retimer.used_frames(10).tolist() == [1, 1, 0, 0, 1, 1, 0, 0, 1, 1]
+
+
+def test_picks_single_frames():
+    assert run(Variant(speedup=3, fps=1), [10 * index for index in range(10)]) == [0, 30, 60, 90]
+
+
+def test_blends_overlapping_windows():
+    values = [10 * index for index in range(9)]
+
+    assert run(Variant(speedup=2, fps=1, blend=3), values) == [10, 30, 50, 70]
+
+
+def test_blends_whole_span():
+    values = [10 * index for index in range(9)]
+
+    assert run(Variant(speedup=3, fps=1, blend=None), values) == [10, 40, 70]
+
+
+def test_repeats_frames_when_slowing_down():
+    assert run(Variant(speedup=0.5, fps=1), [0, 10, 20]) == [0, 0, 10, 10, 20, 20]
+
+
+def test_retime_renders_every_variant(tmp_path):
+    sources = []
+    for number in range(1, 7):
+        path = tmp_path / f"TL{number}.PNG"
+        Image.fromarray(np.full((4, 6, 3), 40 * number, dtype=np.uint8)).save(path)
+        sources.append(path)
+    blended = ListSink()
+
+    counts = retime(
+        sources,
+        SECOND,
+        [
+            (Variant(speedup=2, fps=1), FrameDirectorySink(tmp_path / "picked")),
+            (Variant(speedup=2, fps=1, blend=None), blended),
+        ],
+        workers=2,
+    )
+
+    assert counts == [3, 3]
+    assert sorted(path.name for path in (tmp_path / "picked").iterdir()) == [
+        "frame_000001.ppm",
+        "frame_000002.ppm",
+        "frame_000003.ppm",
+    ]
+    assert blended.closed
+    # Averages of frames (1, 2), (3, 4) and (5, 6)
+    ratios = [frame.mean() / blended.frames[0].mean() for frame in blended.frames]
+    assert ratios == pytest.approx([1, 7 / 3, 11 / 3], rel=0.02)
@@ -0,0 +1,48 @@
+import time
+from datetime import timedelta
+
+from chrophos.clock import AcceleratedClock
+from chrophos.soak import SoakMonitor, grows_without_bound, soak
+
+
+def test_accelerated_clock_sleeps_without_waiting():
+    clock = AcceleratedClock()
+    start = clock.now()
+    real_start = time.perf_counter()
+
+    clock.sleep(3600)
+
+    assert time.perf_counter() - real_start < 1
+    assert clock.now() - start >= timedelta(hours=1)
+
+
+def test_growth_is_only_flagged_if_it_doesnt_level_off():
+    warmup = [0] * 10
+    assert grows_without_bound(warmup + list(range(100, 140)), relative=0.1, absolute=5)
+    # Levelled off
+    assert not grows_without_bound(warmup + [100] * 20 + [120] * 20, relative=0.1, absolute=5)
+    # Rising, but within the tolerances
+    assert not grows_without_bound(warmup + list(range(100, 140)), relative=0.5, absolute=5)
+    # A single spike
+    assert not grows_without_bound(warmup + [100] * 39 + [1000], relative=0.1, absolute=5)
+
+
+def test_monitor_prunes_only_frames(tmp_path):
+    (tmp_path / "TL1.NEF").write_bytes(b"x")
+    (tmp_path / "TL2_b1.NEF").write_bytes(b"x")
+    (tmp_path / "missed.jsonl").write_text("")
+    clock = AcceleratedClock()
+    monitor = SoakMonitor(clock, sample_every=1, count_objects=False, prune_dir=tmp_path)
+
+    monitor(1, clock.now())
+
+    assert [path.name for path in tmp_path.iterdir()] == ["missed.jsonl"]
+
+
+def test_soak_run_passes():
+    report = soak(300, timedelta(seconds=20), sample_every=10, count_objects=False)
+
+    assert report.passed, report.failures
+    assert report.frames == 300
+    assert len(report.samples) == 30
+    assert report.virtual_duration >= timedelta(seconds=20 * 299)
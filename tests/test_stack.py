@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from chrophos.stack import (
+    WHITE,
+    CometReducer,
+    MaxReducer,
+    MedianReducer,
+    Method,
+    MomentsReducer,
+    reducers,
+    stack,
+)
+
+SHAPE = (2, 3, 3)
+
+
+def reduce(reducer, frames, constants=None):
+    state = {name: np.zeros(shape, dtype) for name, (shape, dtype) in reducer.state(SHAPE).items()}
+    for index, frame in enumerate(frames):
+        reducer.add(state, np.asarray(frame, dtype=np.uint16), index, constants or {})
+    return reducer.result(state)
+
+
+def sigma_clip(frames, kappa=3.0):
+    moments, clipped = reducers(Method.SIGMA_CLIP, len(frames), kappa=kappa)
+    mean, std = reduce(moments, frames)
+    return reduce(clipped, frames, {"mean": mean, "std": std})
+
+
+def constant(value):
+    return np.full(SHAPE, value, dtype=np.uint16)
+
+
+def test_max():
+    frames = [constant(100), constant(300), constant(200)]
+
+    assert reduce(MaxReducer(), frames) == pytest.approx(np.full(SHAPE, 300 / WHITE))
+    assert reduce(MaxReducer("float32"), frames) == pytest.approx(np.full(SHAPE, 300 / WHITE))
+
+
+def test_comet_fades_older_frames():
+    frames = [constant(WHITE), constant(0), constant(0)]
+
+    assert reduce(CometReducer(3, decay=0.5), frames) == pytest.approx(
+        np.full(SHAPE, 0.25), abs=1 / WHITE
+    )
+
+
+def test_partials_merge_to_the_same_result():
+    frames = [constant(value) for value in (10, 20, 30, 40)]
+    reducer = MomentsReducer()
+    partials = []
+    for half in (frames[:2], frames[2:]):
+        state = {
+            name: np.zeros(shape, dtype) for name, (shape, dtype) in reducer.state(SHAPE).items()
+        }
+        for index, frame in enumerate(half):
+            reducer.add(state, frame, index, {})
+        partials.append(state)
+
+    reducer.merge(*partials)
+
+    mean, std = reducer.result(partials[0])
+    assert mean == pytest.approx(np.full(SHAPE, 25 / WHITE))
+    assert std == pytest.approx(np.full(SHAPE, np.std([10, 20, 30, 40]) / WHITE), rel=1e-3)
+
+
+@pytest.mark.parametrize("frames", [50, 3000])
+def test_sigma_clip_keeps_constant_pixels(frames):
+    result = sigma_clip([constant(12345)] * frames)
+
+    assert result == pytest.approx(np.full(SHAPE, 12345 / WHITE), abs=3 / WHITE)
+
+
+def test_sigma_clip_rejects_outliers():
+    rng = np.random.default_rng(0)
+    frames = [rng.normal(1000, 10, SHAPE).astype(np.uint16) for _ in range(50)]
+    frames[7] = constant(65000)
+
+    result = sigma_clip(frames)
+
+    # A plain mean would be about 2280
+    assert result == pytest.approx(np.full(SHAPE, 1000 / WHITE), abs=20 / WHITE)
+
+
+def test_median_is_robust_to_outliers():
+    frames = [constant(value) for value in (1000, 1100, 1200, 1300, 60000)]
+
+    result = reduce(MedianReducer(bins=256), frames).reshape(SHAPE)
+
+    assert result == pytest.approx(np.full(SHAPE, 1200 / WHITE), abs=100 / WHITE)
+
+
+def test_unknown_method_is_refused():
+    with pytest.raises(ValueError):
+        reducers("sum", 10)
+
+
+@pytest.mark.parametrize("method", [Method.MAX, Method.MEAN, Method.SIGMA_CLIP])
+def test_stack_in_bands_with_workers(tmp_path, method):
+    rng = np.random.default_rng(1)
+    images = [rng.integers(0, 256, (12, 16, 3), dtype=np.uint8) for _ in range(4)]
+    sources = []
+    for number, image in enumerate(images, 1):
+        path = tmp_path / f"TL{number}.PNG"
+        Image.fromarray(image).save(path)
+        sources.append(path)
+
+    # Small enough a memory limit that it takes several bands
+    stack(sources, tmp_path / "whole.npy", method=method, workers=1)
+    stack(sources, tmp_path / "bands.npy", method=method, workers=2, memory_limit=1000)
+
+    whole = np.load(tmp_path / "whole.npy")
+    assert np.load(tmp_path / "bands.npy") == pytest.approx(whole, abs=1e-6)
+    if method == Method.MAX:
+        assert whole == pytest.approx(np.max(images, axis=0) / 255, abs=1e-6)
+    elif method == Method.MEAN:
+        assert whole == pytest.approx(np.mean(images, axis=0) / 255, abs=1e-5)
@@ -0,0 +1,89 @@
+import os
+
+from chrophos.storage import INCOMPLETE_DIR_NAME, FrameWriter, recover
+
+
+def test_recover_quarantines_truncated_uncommitted_frame(tmp_path):
+    writer = FrameWriter(tmp_path, commit_frames=10)
+    for number in range(1, 4):
+        writer.write(f"TL{number}.NEF", bytes([number]) * 1000)
+    # Power loss: nothing was committed, and the second frame only partly made it to disk
+    with open(tmp_path / "TL2.NEF", "r+b") as file:
+        file.truncate(400)
+
+    last_consistent, quarantined = recover(tmp_path)
+
+    assert quarantined == [tmp_path / INCOMPLETE_DIR_NAME / "TL2.NEF"]
+    assert not (tmp_path / "TL2.NEF").exists()
+    assert (tmp_path / "TL1.NEF").exists()
+    assert (tmp_path / "TL3.NEF").exists()
+    assert last_consistent == "TL3.NEF"
+
+
+def test_recover_quarantines_frame_missing_from_journal(tmp_path):
+    writer = FrameWriter(tmp_path, commit_frames=2)
+    writer.write("TL1.NEF", b"1" * 1000)
+    writer.write("TL2.NEF", b"2" * 1000)
+    # Power loss: the frame made it to disk, but its journal record didn't
+    (tmp_path / "TL3.NEF").write_bytes(b"3" * 1000)
+
+    last_consistent, quarantined = recover(tmp_path)
+
+    assert quarantined == [tmp_path / INCOMPLETE_DIR_NAME / "TL3.NEF"]
+    assert last_consistent == "TL2.NEF"
+    assert (tmp_path / "TL1.NEF").exists()
+    assert (tmp_path / "TL2.NEF").exists()
+
+
+def test_recover_keeps_frames_committed_before_compaction(tmp_path):
+    writer = FrameWriter(tmp_path, commit_frames=1, max_journal_bytes=0)
+    for number in range(1, 4):
+        writer.write(f"TL{number}.NEF", bytes([number]) * 1000)
+    writer.close()
+    (tmp_path / "layout.json").write_text("{}")
+
+    last_consistent, quarantined = recover(tmp_path)
+
+    assert quarantined == []
+    assert last_consistent == "TL3.NEF"
+    assert sorted(path.name for path in tmp_path.iterdir() if not path.name.startswith(".")) == [
+        "TL1.NEF",
+        "TL2.NEF",
+        "TL3.NEF",
+        "layout.json",
+    ]
+
+
+def test_journal_is_only_synced_on_commit(tmp_path, monkeypatch):
+    writer = FrameWriter(tmp_path, commit_frames=5)
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or real_fsync(fd))
+    journal_fd = writer._journal.fileno()
+    for number in range(1, 5):
+        writer.write(f"TL{number}.NEF", b"x" * 100)
+    assert journal_fd not in synced
+
+    writer.write("TL5.NEF", b"x" * 100)
+
+    assert synced.count(journal_fd) == 1
+    writer.close()
+
+
+def test_frames_are_committed_in_groups(tmp_path):
+    groups = []
+    writer = FrameWriter(tmp_path, commit_frames=3, on_commit=groups.append)
+    for number in range(1, 8):
+        writer.write(f"TL{number}.NEF", b"x" * 100)
+
+    assert [[path.name for path in group] for group in groups] == [
+        ["TL1.NEF", "TL2.NEF", "TL3.NEF"],
+        ["TL4.NEF", "TL5.NEF", "TL6.NEF"],
+    ]
+    assert writer.last_committed == "TL6.NEF"
+
+    writer.close()
+
+    assert [path.name for path in groups[-1]] == ["TL7.NEF"]
+    assert writer.last_committed == "TL7.NEF"
+    assert recover(tmp_path) == ("TL7.NEF", [])
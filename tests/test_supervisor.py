@@ -0,0 +1,117 @@
+import json
+from datetime import timedelta
+from pathlib import Path
+
+import gphoto2 as gp
+import pytest
+
+from chrophos.camera.backend import BackendError
+from chrophos.camera.fake import fake_camera
+from chrophos.camera.supervisor import INCIDENT_LOG_NAME, CameraSupervisor, ErrorKind, classify
+from chrophos.clock import AcceleratedClock
+from chrophos.timelapse import timelapse
+
+PROFILE = Path(__file__).parents[1] / "config" / "nikon_z6.toml"
+
+
+class StubBackend:
+    def __init__(self):
+        self.reconnects = 0
+
+    def reconnect(self):
+        self.reconnects += 1
+
+
+def failing(*codes):
+    """A function that raises each of the given gphoto2 errors in turn, then returns "ok" """
+    codes = list(codes)
+
+    def func():
+        if codes:
+            raise gp.GPhoto2Error(codes.pop(0))
+        return "ok"
+
+    return func
+
+
+def test_classify():
+    assert classify(gp.GPhoto2Error(gp.GP_ERROR_CAMERA_BUSY)) == ErrorKind.RETRY
+    assert classify(gp.GPhoto2Error(gp.GP_ERROR_IO_USB_CLAIM)) == ErrorKind.RECONNECT
+    assert classify(gp.GPhoto2Error(gp.GP_ERROR_NOT_SUPPORTED)) == ErrorKind.FATAL
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    supervisor = CameraSupervisor(
+        StubBackend(), initial_backoff=timedelta(seconds=1), max_backoff=timedelta(seconds=5)
+    )
+
+    assert [supervisor.backoff(attempt).total_seconds() for attempt in range(1, 6)] == [
+        1,
+        2,
+        4,
+        5,
+        5,
+    ]
+
+
+def test_retries_then_reconnects(tmp_path):
+    backend = StubBackend()
+    clock = AcceleratedClock()
+    supervisor = CameraSupervisor(
+        backend, retries_before_reconnect=2, log_path=tmp_path / "incidents.jsonl", clock=clock
+    )
+    start = clock.monotonic()
+
+    busy = gp.GP_ERROR_CAMERA_BUSY
+    assert supervisor.call(failing(busy, busy, busy)) == "ok"
+
+    # Only the third attempt reconnected; the waits were 1 + 2 + 4 seconds
+    assert backend.reconnects == 1
+    assert clock.monotonic() - start >= 7
+    (incident,) = [json.loads(line) for line in (tmp_path / "incidents.jsonl").open()]
+    assert incident["attempts"] == 3
+    assert incident["reconnects"] == 1
+    assert incident["recovered"]
+
+
+def test_usb_errors_reconnect_straight_away():
+    backend = StubBackend()
+    supervisor = CameraSupervisor(backend, clock=AcceleratedClock())
+
+    supervisor.call(failing(gp.GP_ERROR_IO_USB_CLAIM))
+
+    assert backend.reconnects == 1
+
+
+def test_gives_up_on_fatal_errors_and_after_max_attempts():
+    supervisor = CameraSupervisor(StubBackend(), max_attempts=3, clock=AcceleratedClock())
+
+    with pytest.raises(BackendError):
+        supervisor.call(failing(gp.GP_ERROR_NOT_SUPPORTED))
+    with pytest.raises(BackendError, match="after 3 attempt"):
+        supervisor.call(failing(*[gp.GP_ERROR_CAMERA_BUSY] * 3))
+    assert [incident.recovered for incident in supervisor.incidents] == [False, False]
+
+
+def test_timelapse_survives_a_disconnect(tmp_path):
+    clock = AcceleratedClock()
+    camera = fake_camera(PROFILE, clock=clock.timestamp)
+    supervisor = CameraSupervisor(
+        camera.backend, log_path=tmp_path / INCIDENT_LOG_NAME, clock=clock
+    )
+    camera.backend._camera.camera.fail_next(gp.GP_ERROR_IO_USB_CLAIM, count=2)
+
+    timelapse(
+        camera,
+        3,
+        timedelta(seconds=20),
+        tmp_path,
+        mode="manual",
+        supervisor=supervisor,
+        clock=clock,
+    )
+
+    assert sorted(path.name for path in tmp_path.glob("TL*")) == ["TL1.NEF", "TL2.NEF", "TL3.NEF"]
+    (incident,) = supervisor.incidents
+    assert incident.recovered
+    assert incident.reconnects == 2